@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Task Resource Detection
+os.cpu_count() (and everything sized from it: XGBoost n_jobs=-1, Arrow's CPU
+pool, thread pools) reports the CPUs of the host, not the task's vCPU quota, so
+a 4-vCPU task on a larger host runs one thread per host CPU and they all share
+4 CPUs of time. detect() reads what the task is actually allowed:
+
+  CPUs    cgroup v2 cpu.max / v1 cpu.cfs_quota_us / cfs_period_us, the CPU
+          affinity mask, else the ECS task metadata Limits.CPU (Fargate)
+  memory  cgroup v2 memory.max / v1 memory.limit_in_bytes, else the ECS task
+          metadata Limits.Memory, bounded by the physical memory
+
+and the settings derived from it - thread_count(), process_count(),
+chunk_rows() - size the model threads, worker processes and row chunks of
+training, prediction and parsing. Each entry point logs what it chose
+(log_settings).
+
+One copy for the prediction and training images, like the Lambda common layer:
+both are built from fargate-predict-age and copy it from ai-agent-predict-age-common
+(put that directory on PYTHONPATH to run their modules outside the images).
+
+Usage:
+  python resources.py    # Print the detected CPUs and memory as JSON
+"""
+
+import os
+import sys
+import json
+import math
+import logging
+import urllib.request
+from functools import lru_cache
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+MEMORY_FRACTION = 0.5  # Of the task memory for row chunks and worker processes (models, lookups, outputs use the rest)
+
+def read_text(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def cgroup_dirs(root=CGROUP_ROOT, controller=None):
+    """
+    This process's cgroup directory and its visible ancestors, innermost first:
+    cgroup v2 (controller None) or the v1 hierarchy of controller
+    """
+    path, mounts = '/', [root if controller is None else os.path.join(root, controller)]
+    for line in (read_text('/proc/self/cgroup') or '').splitlines():
+        _, controllers, line_path = line.split(':', 2)
+        if controller is None and controllers == '':
+            path = line_path or '/'
+        elif controller is not None and controller in controllers.split(','):
+            path, mounts = line_path or '/', [os.path.join(root, controllers), os.path.join(root, controller)]
+    dirs = []
+    while True:
+        for mount in mounts:
+            directory = os.path.join(mount, path.lstrip('/'))
+            if os.path.isdir(directory) and directory not in dirs:
+                dirs.append(directory)
+        if path in ('/', ''):
+            return dirs
+        path = os.path.dirname(path)
+
+def cgroup_cpu_limit(root=CGROUP_ROOT):
+    """CPUs allowed by the cgroup CPU quota (fractional), None if there is no quota"""
+    limits = []
+    for directory in cgroup_dirs(root):
+        value = read_text(os.path.join(directory, 'cpu.max'))  # "max 100000" or "400000 100000"
+        if value and not value.startswith('max'):
+            quota, period = value.split()[:2]
+            limits.append(int(quota) / int(period))
+    for directory in cgroup_dirs(root, 'cpu'):
+        quota = read_text(os.path.join(directory, 'cpu.cfs_quota_us'))  # v1: -1 without a quota
+        period = read_text(os.path.join(directory, 'cpu.cfs_period_us'))
+        if quota and period and int(quota) > 0:
+            limits.append(int(quota) / int(period))
+    return min(limits) if limits else None
+
+def cgroup_memory_limit(root=CGROUP_ROOT):
+    """Bytes allowed by the cgroup memory limit, None if there is no limit"""
+    limits = []
+    for directory in cgroup_dirs(root):
+        value = read_text(os.path.join(directory, 'memory.max'))  # "max" or bytes
+        if value and value != 'max':
+            limits.append(int(value))
+    for directory in cgroup_dirs(root, 'memory'):
+        value = read_text(os.path.join(directory, 'memory.limit_in_bytes'))  # v1: ~2^63 without a limit
+        if value and int(value) < 2 ** 60:
+            limits.append(int(value))
+    return min(limits) if limits else None
+
+def task_metadata_limits():
+    """(vCPUs, memory MB) of the ECS task (task metadata endpoint v4), None outside ECS"""
+    uri = os.environ.get('ECS_CONTAINER_METADATA_URI_V4')
+    if not uri:
+        return None
+    try:
+        with urllib.request.urlopen(f'{uri}/task', timeout=1) as response:
+            limits = json.loads(response.read()).get('Limits', {})
+    except (OSError, ValueError) as e:
+        logger.warning(f"Task metadata unavailable: {e}")
+        return None
+    return limits.get('CPU'), limits.get('Memory')
+
+def physical_memory():
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        return None
+
+@lru_cache(maxsize=1)
+def detect():
+    """
+    CPUs and memory this task may use: {'cpus', 'memory_mb', 'host_cpus', 'cpu_source',
+    'memory_source'}. cpus is a whole number >= 1 (a fractional quota rounds up).
+    """
+    host_cpus = os.cpu_count() or 1
+    cpus, cpu_source = host_cpus, 'host'
+    if hasattr(os, 'sched_getaffinity') and len(os.sched_getaffinity(0)) < cpus:
+        cpus, cpu_source = len(os.sched_getaffinity(0)), 'affinity'
+    memory, memory_source = physical_memory(), 'host'
+
+    task = (None, None)
+    quota, quota_source = cgroup_cpu_limit(), 'cgroup'
+    limit, limit_source = cgroup_memory_limit(), 'cgroup'
+    if quota is None or limit is None:
+        task = task_metadata_limits() or task
+    if quota is None and task[0]:
+        quota, quota_source = float(task[0]), 'task metadata'
+    if limit is None and task[1]:
+        limit, limit_source = int(task[1]) * 2 ** 20, 'task metadata'
+
+    if quota is not None and math.ceil(quota) < cpus:
+        cpus, cpu_source = max(1, math.ceil(quota)), quota_source
+    if limit is not None and (memory is None or limit < memory):
+        memory, memory_source = limit, limit_source
+    return {
+        'cpus': cpus,
+        'memory_mb': int(memory / 2 ** 20) if memory else None,
+        'host_cpus': host_cpus,
+        'cpu_source': cpu_source,
+        'memory_source': memory_source
+    }
+
+def thread_count(reserve=0):
+    """Threads for one CPU-bound pool (model n_jobs, Arrow), leaving reserve CPUs to other threads"""
+    return max(1, detect()['cpus'] - reserve)
+
+def memory_budget_mb():
+    memory_mb = detect()['memory_mb']
+    return memory_mb * MEMORY_FRACTION if memory_mb else None
+
+def process_count(process_mb, maximum=None):
+    """Worker processes: one per CPU, as many as fit in the memory budget at process_mb each"""
+    processes = detect()['cpus']
+    budget = memory_budget_mb()
+    if budget is not None:
+        processes = min(processes, int(budget // process_mb))
+    if maximum is not None:
+        processes = min(processes, maximum)
+    return max(1, processes)
+
+def chunk_rows(row_bytes, in_flight=1, minimum=4096, maximum=65536):
+    """
+    Rows per chunk so that in_flight chunks of row_bytes per row fit in the memory
+    budget, a multiple of 1024 within [minimum, maximum] (maximum=None: no upper bound)
+    """
+    budget = memory_budget_mb()
+    if budget is None:
+        return maximum or minimum
+    rows = int(budget * 2 ** 20 / (in_flight * row_bytes)) // 1024 * 1024
+    return max(minimum, rows if maximum is None else min(rows, maximum))
+
+def log_settings(component, settings):
+    """One line: the detected resources and what component derived from them"""
+    resources = detect()
+    memory = f"{resources['memory_mb']:,} MB" if resources['memory_mb'] else 'unknown memory'
+    chosen = ', '.join(f'{name}={value}' for name, value in settings.items())
+    logger.info(f"Resources: {resources['cpus']} CPUs ({resources['cpu_source']}, host {resources['host_cpus']}), "
+                f"{memory} ({resources['memory_source']}); {component}: {chosen}")
+
+if __name__ == '__main__':
+    print(json.dumps(detect(), indent=2))
+    sys.exit(0)
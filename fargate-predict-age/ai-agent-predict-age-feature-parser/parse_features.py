@@ -2,6 +2,8 @@
 """
 Fargate Feature Parser - Parse JSON and create ML features
 Reads raw training data from Athena, parses JSON in Python, saves to S3 permanently
+Superseded by feature_spec.py ctas (prediction image, TrainingFeatureSpec step of the
+pipeline), which writes the same table from the feature spec shared with prediction.
 """
 
 import json
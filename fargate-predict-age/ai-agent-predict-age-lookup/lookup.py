@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Point Lookup over Final Results
+Builds a compact, id-sorted snapshot of predict_age_final_results_{YYYYQQ} and
+answers single/bulk id lookups from memory-mapped arrays (no Athena query).
+
+Snapshot layout (one .npy file per column, memory-mapped read-only):
+  ids.npy         uint64   sorted ascending
+  age.npy         uint8    predicted_age
+  confidence.npy  float16  confidence_score
+  source.npy      uint8    prediction_source code (see SOURCE_CODES)
+  manifest.json   row count, source table, build time
+
+Usage:
+  python lookup.py build                      # Parquet on S3 -> snapshot -> S3
+  python lookup.py get 12345 67890            # Lookup ids from a local snapshot
+  python lookup.py bench --entries 378024173  # Synthetic benchmark
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+from datetime import datetime
+import numpy as np
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Environment variables
+S3_BUCKET = os.environ.get('S3_BUCKET')
+YYYYQQ = os.environ.get('YYYYQQ', 'YYYYQQ')
+FINAL_RESULTS_TABLE = f'predict_age_final_results_{YYYYQQ}'
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', '/tmp/age_lookup')
+
+# Under permanent/ (kept by pre-cleanup and cleanup), outside the table location so Athena
+# never reads the snapshot files; rebuilt by the pipeline's BuildLookupSnapshot step
+SNAPSHOT_PREFIX = f'predict-age/permanent/lookup/{FINAL_RESULTS_TABLE}'
+
+# prediction_source <-> uint8 code
+SOURCE_CODES = {
+    'EXISTING_APPROX_AGE': 0,
+    'EXISTING_BIRTH_YEAR': 1,
+    'ML_PREDICTION': 2,
+    'DEFAULT_RULE': 3
+}
+SOURCE_NAMES = {code: name for name, code in SOURCE_CODES.items()}
+UNKNOWN_SOURCE = 255
+
+# One in-memory fence key per FENCE_STRIDE ids: a lookup touches one page of ids.npy
+FENCE_STRIDE = 512
+
+COLUMN_FILES = {
+    'ids': 'ids.npy',
+    'age': 'age.npy',
+    'confidence': 'confidence.npy',
+    'source': 'source.npy'
+}
+
+class AgeLookup:
+    """Memory-mapped id -> (predicted_age, confidence_score, prediction_source) lookup"""
+
+    def __init__(self, snapshot_dir=SNAPSHOT_DIR):
+        self.ids = np.load(os.path.join(snapshot_dir, COLUMN_FILES['ids']), mmap_mode='r')
+        self.age = np.load(os.path.join(snapshot_dir, COLUMN_FILES['age']), mmap_mode='r')
+        self.confidence = np.load(os.path.join(snapshot_dir, COLUMN_FILES['confidence']), mmap_mode='r')
+        self.source = np.load(os.path.join(snapshot_dir, COLUMN_FILES['source']), mmap_mode='r')
+
+        # Small sparse index kept in RAM (378M ids -> ~740K fences, ~6 MB)
+        self.fences = np.array(self.ids[::FENCE_STRIDE])
+        logger.info(f"Loaded lookup snapshot from {snapshot_dir}: {len(self.ids):,} ids")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _position(self, pid):
+        """Return the row position of a single id, or -1 if absent"""
+        block = int(np.searchsorted(self.fences, pid, side='right')) - 1
+        if block < 0:
+            return -1
+        start = block * FENCE_STRIDE
+        window = self.ids[start:start + FENCE_STRIDE]
+        offset = int(np.searchsorted(window, pid))
+        if offset < len(window) and window[offset] == pid:
+            return start + offset
+        return -1
+
+    def get(self, pid):
+        """Look up one id. Returns a dict or None if the id is not in the snapshot."""
+        pos = self._position(np.uint64(pid))
+        if pos < 0:
+            return None
+        return {
+            'id': int(pid),
+            'predicted_age': int(self.age[pos]),
+            'confidence_score': float(self.confidence[pos]),
+            'prediction_source': SOURCE_NAMES.get(int(self.source[pos]), 'UNKNOWN')
+        }
+
+    def get_many(self, pids):
+        """
+        Bulk lookup (vectorized binary search).
+        Returns (found, age, confidence, source) arrays aligned with pids.
+        """
+        pids = np.asarray(pids, dtype=np.uint64)
+        pos = np.searchsorted(self.ids, pids)
+        in_range = pos < len(self.ids)
+        found = np.zeros(len(pids), dtype=bool)
+        found[in_range] = self.ids[pos[in_range]] == pids[in_range]
+
+        hits = pos[found]
+        age = np.zeros(len(pids), dtype=np.uint8)
+        confidence = np.full(len(pids), np.nan, dtype=np.float16)
+        source = np.full(len(pids), UNKNOWN_SOURCE, dtype=np.uint8)
+        age[found] = self.age[hits]
+        confidence[found] = self.confidence[hits]
+        source[found] = self.source[hits]
+        return found, age, confidence, source
+
+def write_snapshot(ids, age, confidence, source, snapshot_dir, source_table):
+    """Sort columns by id and write them as .npy files plus manifest.json"""
+    os.makedirs(snapshot_dir, exist_ok=True)
+
+    logger.info(f"Sorting {len(ids):,} ids...")
+    sort_start = time.time()
+    order = np.argsort(ids, kind='stable')
+    logger.info(f"Sorted in {time.time() - sort_start:.2f}s")
+
+    np.save(os.path.join(snapshot_dir, COLUMN_FILES['ids']), ids[order])
+    np.save(os.path.join(snapshot_dir, COLUMN_FILES['age']), age[order])
+    np.save(os.path.join(snapshot_dir, COLUMN_FILES['confidence']), confidence[order])
+    np.save(os.path.join(snapshot_dir, COLUMN_FILES['source']), source[order])
+
+    manifest = {
+        'source_table': source_table,
+        'row_count': int(len(ids)),
+        'fence_stride': FENCE_STRIDE,
+        'source_codes': SOURCE_CODES,
+        'created_at': datetime.now().isoformat()
+    }
+    with open(os.path.join(snapshot_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest
+
+def build_snapshot_from_s3(snapshot_dir=SNAPSHOT_DIR):
+    """Read final results Parquet from S3 and build a local snapshot"""
+    import boto3
+    import pyarrow.parquet as pq
+    import pyarrow.fs as pafs
+
+    if not S3_BUCKET:
+        raise ValueError("S3_BUCKET environment variable is required")
+
+    s3_client = boto3.client('s3')
+    s3_fs = pafs.S3FileSystem()
+    prefix = f'predict-age/final-results/{FINAL_RESULTS_TABLE}/'
+
+    # List all data files (Athena CTAS doesn't add .parquet extension)
+    paginator = s3_client.get_paginator('list_objects_v2')
+    files = []
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].endswith('/') and '_metadata' not in obj['Key']:
+                files.append(f"{S3_BUCKET}/{obj['Key']}")
+    logger.info(f"Found {len(files)} final results files under s3://{S3_BUCKET}/{prefix}")
+
+    columns = ['id', 'predicted_age', 'confidence_score', 'prediction_source']
+    ids, age, confidence, source = [], [], [], []
+    for path in files:
+        table = pq.read_table(path, columns=columns, filesystem=s3_fs)
+        ids.append(table.column('id').to_numpy().astype(np.uint64))
+        age.append(np.clip(table.column('predicted_age').to_numpy(), 0, 255).astype(np.uint8))
+        confidence.append(table.column('confidence_score').to_numpy().astype(np.float16))
+
+        # Dictionary-encode the source strings once per file
+        encoded = table.column('prediction_source').dictionary_encode().combine_chunks()
+        codes = np.array([SOURCE_CODES.get(name, UNKNOWN_SOURCE) for name in encoded.dictionary.to_pylist()],
+                         dtype=np.uint8)
+        source.append(codes[encoded.indices.to_numpy(zero_copy_only=False)])
+
+    manifest = write_snapshot(
+        np.concatenate(ids), np.concatenate(age), np.concatenate(confidence), np.concatenate(source),
+        snapshot_dir, FINAL_RESULTS_TABLE
+    )
+    logger.info(f"✅ Snapshot built: {manifest['row_count']:,} ids in {snapshot_dir}")
+    return manifest
+
+def upload_snapshot(snapshot_dir=SNAPSHOT_DIR):
+    """Upload snapshot files to S3"""
+    import boto3
+    s3_client = boto3.client('s3')
+    for filename in list(COLUMN_FILES.values()) + ['manifest.json']:
+        key = f'{SNAPSHOT_PREFIX}/{filename}'
+        s3_client.upload_file(os.path.join(snapshot_dir, filename), S3_BUCKET, key)
+        logger.info(f"Uploaded s3://{S3_BUCKET}/{key}")
+
+def download_snapshot(snapshot_dir=SNAPSHOT_DIR):
+    """Download snapshot files from S3 (for consumers that serve lookups)"""
+    import boto3
+    s3_client = boto3.client('s3')
+    os.makedirs(snapshot_dir, exist_ok=True)
+    for filename in list(COLUMN_FILES.values()) + ['manifest.json']:
+        s3_client.download_file(S3_BUCKET, f'{SNAPSHOT_PREFIX}/{filename}', os.path.join(snapshot_dir, filename))
+    logger.info(f"Downloaded snapshot to {snapshot_dir}")
+
+def run_benchmark(entries, queries, snapshot_dir):
+    """Build a synthetic snapshot of `entries` ids and time single and bulk lookups"""
+    rng = np.random.default_rng(42)
+
+    logger.info(f"Generating {entries:,} synthetic entries...")
+    # Strictly increasing ids with gaps, like real sparse PIDs
+    ids = np.cumsum(rng.integers(1, 4, size=entries, dtype=np.uint64))
+    age = rng.integers(18, 76, size=entries, dtype=np.uint8)
+    confidence = rng.uniform(0, 100, size=entries).astype(np.float16)
+    source = rng.integers(0, 4, size=entries, dtype=np.uint8)
+
+    build_start = time.time()
+    write_snapshot(ids, age, confidence, source, snapshot_dir, 'synthetic')
+    build_sec = time.time() - build_start
+
+    probe = rng.choice(ids, size=queries)
+    del ids, age, confidence, source
+
+    lookup = AgeLookup(snapshot_dir)
+
+    # Warm the fence index and pages touched by the probes
+    for pid in probe[:1000]:
+        lookup.get(pid)
+
+    single_start = time.perf_counter()
+    for pid in probe:
+        lookup.get(pid)
+    single_us = (time.perf_counter() - single_start) / len(probe) * 1e6
+
+    bulk_start = time.perf_counter()
+    found, _, _, _ = lookup.get_many(probe)
+    bulk_sec = time.perf_counter() - bulk_start
+
+    size_mb = sum(os.path.getsize(os.path.join(snapshot_dir, f)) for f in COLUMN_FILES.values()) / (1024 * 1024)
+    results = {
+        'entries': entries,
+        'snapshot_size_mb': round(size_mb, 1),
+        'bytes_per_entry': round(size_mb * 1024 * 1024 / entries, 2),
+        'build_sec': round(build_sec, 2),
+        'single_lookup_us': round(single_us, 2),
+        'bulk_lookups': queries,
+        'bulk_total_ms': round(bulk_sec * 1000, 2),
+        'bulk_per_id_us': round(bulk_sec / queries * 1e6, 3),
+        'all_found': bool(found.all())
+    }
+    logger.info(f"Benchmark results: {json.dumps(results, indent=2)}")
+    return results
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description='Point lookup over final age predictions')
+    subparsers = parser.add_subparsers(dest='command')
+
+    build_parser = subparsers.add_parser('build', help='Build snapshot from final results Parquet and upload it')
+    build_parser.add_argument('--no-upload', action='store_true', help='Keep the snapshot local only')
+
+    get_parser = subparsers.add_parser('get', help='Look up ids in a local snapshot')
+    get_parser.add_argument('ids', nargs='+', type=int)
+    get_parser.add_argument('--download', action='store_true', help='Download the snapshot from S3 first')
+
+    bench_parser = subparsers.add_parser('bench', help='Benchmark on a synthetic snapshot')
+    bench_parser.add_argument('--entries', type=int, default=378024173)
+    bench_parser.add_argument('--queries', type=int, default=100000)
+
+    args = parser.parse_args()
+
+    if args.command == 'get':
+        if args.download:
+            download_snapshot(SNAPSHOT_DIR)
+        lookup = AgeLookup(SNAPSHOT_DIR)
+        for pid in args.ids:
+            print(json.dumps(lookup.get(pid) or {'id': pid, 'found': False}))
+    elif args.command == 'bench':
+        run_benchmark(args.entries, args.queries, os.path.join(SNAPSHOT_DIR, 'bench'))
+    else:
+        # Default (container entrypoint): build and upload
+        build_snapshot_from_s3(SNAPSHOT_DIR)
+        if not getattr(args, 'no_upload', False):
+            upload_snapshot(SNAPSHOT_DIR)
+
+if __name__ == '__main__':
+    sys.exit(main())
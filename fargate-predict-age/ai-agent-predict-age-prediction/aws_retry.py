@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+In-Process AWS Retries
+Without them a throttled S3 GET or an Athena query that fails on a transient
+engine error fails the whole prediction task, and the Map state's Retry starts
+it again from container launch (model load, UNLOAD, every part). Each AWS call
+of a prediction task goes through call_with_retries() instead, which classifies
+the error:
+
+  throttled  SlowDown, Throttling, TooManyRequests, ...   backoff from 1s
+  transient  5xx / InternalError, connection and read     backoff from 0.2s
+             errors, Athena queries failed as Retryable
+  fatal      everything else (NoSuchKey, AccessDenied,    raised at once
+             invalid queries, ...)
+
+and retries the first two with full-jitter exponential backoff (the same delay
+policy as s3_delete.backoff_delay in the Lambda layer) for at most
+AWS_RETRY_ATTEMPTS attempts. The unit retried is what was lost: one part's
+download inside the stage pipeline (the chunks already written stay written),
+one UNLOAD (resubmitted to a fresh prefix), one upload. Retries per class and
+the time spent sleeping go to the batch manifest (retry_stats).
+
+Usage:
+  python aws_retry.py bench --calls 200 --failure-rate 0.005
+      # Simulated batch with transient S3 errors: task restarts vs in-process retries
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import logging
+import threading
+from botocore.exceptions import BotoCoreError, ClientError, HTTPClientError, IncompleteReadError
+from botocore.exceptions import ConnectionError as EndpointConnectionFailure
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Attempts per AWS call (1: no retries)
+AWS_RETRY_ATTEMPTS = int(os.environ.get('AWS_RETRY_ATTEMPTS', '5'))
+BACKOFF_BASE_SEC = {'throttled': 1.0, 'transient': 0.2}
+BACKOFF_CAP_SEC = 20.0
+
+THROTTLING_ERROR_CODES = {
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'ProvisionedThroughputExceededException'
+}
+TRANSIENT_ERROR_CODES = {
+    'InternalError',
+    'InternalFailure',
+    'InternalServerException',
+    'ServiceUnavailable',
+    'RequestTimeout',
+    'RequestTimeoutException',
+    '500',
+    '502',
+    '503',
+    '504'
+}
+THROTTLING_MESSAGES = ('rate exceeded', 'slow down', 'reduce your request rate', 'too many requests')
+
+class QueryFailed(Exception):
+    """Athena query FAILED / CANCELLED; retryable as reported by the query's AthenaError"""
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+def query_failure(status):
+    """QueryFailed for a QueryExecution Status (AthenaError.Retryable, else a throttling reason)"""
+    reason = status.get('StateChangeReason', 'Unknown')
+    retryable = status.get('AthenaError', {}).get('Retryable', False) \
+        or any(message in reason.lower() for message in THROTTLING_MESSAGES)
+    return QueryFailed(f"Query {status['State']}: {reason}", retryable=retryable)
+
+def error_code(error):
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code', '') or \
+            str(error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', ''))
+    return type(error).__name__
+
+def classify(error):
+    """'throttled', 'transient' or 'fatal'"""
+    if isinstance(error, ClientError):
+        code = error_code(error)
+        if code in THROTTLING_ERROR_CODES:
+            return 'throttled'
+        return 'transient' if code in TRANSIENT_ERROR_CODES else 'fatal'
+    if isinstance(error, QueryFailed):
+        if not error.retryable:
+            return 'fatal'
+        return 'throttled' if any(message in str(error).lower() for message in THROTTLING_MESSAGES) else 'transient'
+    if isinstance(error, (EndpointConnectionFailure, HTTPClientError, IncompleteReadError)):
+        return 'transient'  # Endpoint / connect / read timeouts, connections closed or bodies cut mid-stream
+    if isinstance(error, BotoCoreError):
+        return 'fatal'
+    return 'transient' if isinstance(error, (ConnectionError, TimeoutError)) else 'fatal'
+
+def backoff_delay(attempt, kind='transient'):
+    """Full-jitter exponential backoff delay for the given (0-based) attempt"""
+    return random.uniform(0, min(BACKOFF_CAP_SEC, BACKOFF_BASE_SEC[kind] * (2 ** attempt)))
+
+RETRY_STATS = {'throttled': 0, 'transient': 0, 'gave_up': 0, 'sleep_sec': 0.0}
+STATS_LOCK = threading.Lock()  # Pipeline stages retry concurrently
+
+def reset_retry_stats():
+    with STATS_LOCK:
+        RETRY_STATS.update(throttled=0, transient=0, gave_up=0, sleep_sec=0.0)
+
+def retry_stats():
+    with STATS_LOCK:
+        return {**RETRY_STATS, 'sleep_sec': round(RETRY_STATS['sleep_sec'], 2)}
+
+def call_with_retries(fn, description, attempts=None, on_retry=None):
+    """
+    fn() until it returns, retrying throttled and transient errors with backoff.
+    Fatal errors and the last attempt's error are raised. on_retry(error) runs
+    before each retry (e.g. to clean up a failed attempt's output).
+    """
+    attempts = attempts or AWS_RETRY_ATTEMPTS
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except Exception as e:
+            kind = classify(e)
+            if kind == 'fatal':
+                raise
+            if attempt + 1 == attempts:
+                with STATS_LOCK:
+                    RETRY_STATS['gave_up'] += 1
+                logger.error(f"{description}: {kind} error ({error_code(e)}) after {attempts} attempts, giving up")
+                raise
+            delay = backoff_delay(attempt, kind)
+            with STATS_LOCK:
+                RETRY_STATS[kind] += 1
+                RETRY_STATS['sleep_sec'] += delay
+            logger.warning(f"{description}: {kind} error ({error_code(e)}: {e}), "
+                           f"retry {attempt + 1}/{attempts - 1} in {delay:.1f}s")
+            if on_retry is not None:
+                on_retry(e)
+            time.sleep(delay)
+
+def get_bytes(s3_client, bucket, key):
+    """Body of an S3 object; the GET and the body read are retried together (a body can fail mid-stream)"""
+    return call_with_retries(lambda: s3_client.get_object(Bucket=bucket, Key=key)['Body'].read(),
+                             f"GET s3://{bucket}/{key}")
+
+def run_benchmark(calls, failure_rate, call_ms, restart_sec):
+    """
+    One batch of calls S3 calls of call_ms each, failing transiently at
+    failure_rate: without retries the first failure restarts the task
+    (restart_sec: container launch + model load + UNLOAD, then every call again);
+    with call_with_retries only the failed call is repeated.
+    """
+    rng = random.Random(7)
+
+    def s3_call():
+        time.sleep(call_ms / 1000)
+        if rng.random() < failure_rate:
+            raise ClientError({'Error': {'Code': 'SlowDown', 'Message': 'Please reduce your request rate.'}}, 'GetObject')
+
+    results = {'calls': calls, 'failure_rate': failure_rate, 'call_ms': call_ms, 'restart_sec': restart_sec}
+
+    # Task-level retry: any failure starts over (simulated restart cost, not slept)
+    start = time.time()
+    restarts = 0
+    simulated_sec = 0.0
+    while restarts < 20:
+        try:
+            for _ in range(calls):
+                s3_call()
+            break
+        except ClientError:
+            restarts += 1
+            simulated_sec += restart_sec
+    results['task_restarts'] = {'sec': round(time.time() - start + simulated_sec, 2), 'restarts': restarts,
+                                'completed': restarts < 20}
+
+    reset_retry_stats()
+    start = time.time()
+    for index in range(calls):
+        call_with_retries(s3_call, f'bench call {index}')
+    results['in_process_retries'] = {'sec': round(time.time() - start, 2), **retry_stats()}
+    results['speedup'] = round(results['task_restarts']['sec'] / results['in_process_retries']['sec'], 2)
+    logger.info(f"Benchmark results: {json.dumps(results, indent=2)}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='In-process AWS retries')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    bench_parser = subparsers.add_parser('bench', help='Task restarts vs in-process retries')
+    bench_parser.add_argument('--calls', type=int, default=200)
+    bench_parser.add_argument('--failure-rate', type=float, default=0.005)
+    bench_parser.add_argument('--call-ms', type=float, default=20.0, help='Simulated S3 call time')
+    bench_parser.add_argument('--restart-sec', type=float, default=90.0,
+                              help='Simulated task restart: Map retry interval + launch + model load + UNLOAD')
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        run_benchmark(args.calls, args.failure_rate, args.call_ms, args.restart_sec)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
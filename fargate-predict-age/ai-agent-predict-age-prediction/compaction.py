@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""
+Prediction Output Compaction
+Rewrites per-batch prediction files (batch_NNNN.parquet) whose id ranges
+overlap - MOD batches, where every file spans the whole id range - into
+target-sized files sorted by id with tuned row groups and dictionary-encoded
+string columns. Row-group min/max statistics then let Athena and pyarrow skip
+everything but the matching range for id joins and lookups.
+
+Id-range batches (GenerateBatchIds' default plan) already give each file its
+own disjoint slice of ids, so file statistics already prune almost as well as
+compacted output: `bench --layout range` (10M rows, 898 batches) gives 1.0x
+lookups and 1.2x joins, against ~20x for MOD batches. When the
+batch manifests' id ranges are disjoint the step is skipped and the table keeps
+reading the batch files.
+
+Bucket sort in three passes, bounded by one output file in memory:
+  1. read the id column of every batch file, pick id boundaries so each output
+     file gets ~equal rows
+  2. stream each batch file once, spilling rows into per-output-range local files
+  3. sort each range by id and write/upload the final file
+
+Output goes to s3://{S3_BUCKET}/predict-age/predictions-compacted/{YYYYQQ}/ and
+predict_age_predictions_{YYYYQQ} is pointed at it (ALTER TABLE ... SET LOCATION).
+Row count and content checksum are checked against the batch manifests first.
+
+Usage:
+  python compaction.py                         # Compact S3 predictions (container default)
+  python compaction.py bench --rows 10000000   # Synthetic before/after join + lookup benchmark (MOD batches)
+  python compaction.py bench --layout range    # Same with id-range batches
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from output_schema import COMPACT_SCHEMA, OUTPUT_COMPRESSION, to_compact_schema
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Environment variables
+S3_BUCKET = os.environ.get('S3_BUCKET')
+DATABASE_NAME = os.environ.get('DATABASE_NAME', 'ml_predict_age')
+WORKGROUP = os.environ.get('WORKGROUP', 'ai-agent-predict-age')
+YYYYQQ = os.environ.get('YYYYQQ', 'YYYYQQ')
+# Compact-schema files are registered under the _compact table (the legacy name is a view over it)
+PREDICTIONS_TABLE = f'predict_age_predictions_{YYYYQQ}' + ('_compact' if COMPACT_SCHEMA else '')
+TARGET_FILE_MB = int(os.environ.get('TARGET_FILE_MB', '256'))
+ROW_GROUP_ROWS = int(os.environ.get('ROW_GROUP_ROWS', '131072'))  # ~1 MB id chunk: cheap point lookups
+WORK_DIR = os.environ.get('COMPACTION_WORK_DIR', '/tmp/compaction')
+
+INPUT_PREFIX = f'predict-age/predictions/{YYYYQQ}/'
+OUTPUT_PREFIX = f'predict-age/predictions-compacted/{YYYYQQ}/'
+MANIFEST_PREFIX = f'predict-age/manifests/{YYYYQQ}/'
+
+# Low-cardinality string columns (one model version, one timestamp per batch)
+DICTIONARY_COLUMNS = ['prediction_ts', 'model_version']
+
+def ranges_disjoint(ranges):
+    """True if no two (id_min, id_max) ranges overlap"""
+    ranges = sorted(ranges)
+    return all(previous[1] < current[0] for previous, current in zip(ranges, ranges[1:]))
+
+def plan_boundaries(input_files, num_outputs):
+    """Id boundaries splitting all rows into num_outputs ~equal ranges (pass 1: id column only)"""
+    ids = np.concatenate([pq.read_table(path, columns=['id']).column('id').to_numpy() for path in input_files])
+    if num_outputs <= 1 or len(ids) == 0:
+        return np.array([], dtype=np.int64), len(ids)
+    quantiles = np.linspace(0, 1, num_outputs + 1)[1:-1]
+    boundaries = np.unique(np.quantile(ids, quantiles, method='lower').astype(np.int64))
+    return boundaries, len(ids)
+
+def spill_by_range(input_files, boundaries, spill_dir, remove_inputs=False):
+    """Stream each input file once, appending rows to the spill file of their id range (pass 2)"""
+    os.makedirs(spill_dir, exist_ok=True)
+    writers = {}
+    try:
+        for path in input_files:
+            table = pq.read_table(path)
+            ranges = np.searchsorted(boundaries, table.column('id').to_numpy(), side='right')
+            order = np.argsort(ranges, kind='stable')
+            table = table.take(order)
+            starts = np.searchsorted(ranges[order], np.arange(len(boundaries) + 2))
+            for range_id in range(len(boundaries) + 1):
+                start, end = starts[range_id], starts[range_id + 1]
+                if start == end:
+                    continue
+                if range_id not in writers:
+                    spill_path = os.path.join(spill_dir, f'range_{range_id:05d}.parquet')
+                    writers[range_id] = pq.ParquetWriter(spill_path, table.schema, compression='lz4')
+                writers[range_id].write_table(table.slice(start, end - start))
+            if remove_inputs:
+                os.remove(path)  # Keeps peak disk at ~input + spill
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return sorted(writers)
+
+def write_sorted(spill_path, output_path, row_group_rows=ROW_GROUP_ROWS):
+    """Sort one id range and write it with tuned row groups and dictionary encoding (pass 3)"""
+    table = pq.read_table(spill_path).sort_by('id')
+    pq.write_table(
+        table,
+        output_path,
+        row_group_size=row_group_rows,
+        use_dictionary=[column for column in DICTIONARY_COLUMNS if column in table.column_names],
+        compression=OUTPUT_COMPRESSION,
+        write_statistics=True
+    )
+    return table
+
+def compact_files(input_files, output_dir, target_file_mb=TARGET_FILE_MB, on_output=None, remove_inputs=False):
+    """
+    Compact local Parquet files into id-sorted files in output_dir.
+    on_output(path, table) is called for each finished file (e.g. upload + checksum).
+    Returns stats.
+    """
+    start_time = time.time()
+    input_bytes = sum(os.path.getsize(path) for path in input_files)
+    num_outputs = max(1, math.ceil(input_bytes / (target_file_mb * 1024 * 1024)))
+
+    boundaries, total_rows = plan_boundaries(input_files, num_outputs)
+    plan_sec = time.time() - start_time
+    logger.info(f"Compacting {len(input_files)} files ({input_bytes / (1024 * 1024):,.1f} MB, {total_rows:,} rows) "
+                f"into {len(boundaries) + 1} id ranges")
+
+    spill_dir = os.path.join(output_dir, '_spill')
+    range_ids = spill_by_range(input_files, boundaries, spill_dir, remove_inputs)
+    spill_sec = time.time() - start_time - plan_sec
+
+    output_rows = output_bytes = 0
+    output_files = []
+    for part, range_id in enumerate(range_ids):
+        spill_path = os.path.join(spill_dir, f'range_{range_id:05d}.parquet')
+        output_path = os.path.join(output_dir, f'part-{part:05d}.parquet')
+        table = write_sorted(spill_path, output_path)
+        os.remove(spill_path)
+        output_rows += table.num_rows
+        output_bytes += os.path.getsize(output_path)
+        output_files.append(output_path)
+        if on_output:
+            on_output(output_path, table)
+    shutil.rmtree(spill_dir, ignore_errors=True)
+
+    if output_rows != total_rows:
+        raise ValueError(f"Compaction row count mismatch: {output_rows:,} written, {total_rows:,} read")
+
+    return {
+        'input_files': len(input_files),
+        'input_mb': round(input_bytes / (1024 * 1024), 1),
+        'output_files': len(output_files),
+        'output_mb': round(output_bytes / (1024 * 1024), 1),
+        'rows': output_rows,
+        'plan_sec': round(plan_sec, 2),
+        'spill_sec': round(spill_sec, 2),
+        'total_sec': round(time.time() - start_time, 2),
+        'output_paths': output_files
+    }
+
+def run_athena_query(athena_client, query):
+    """Run an Athena statement and wait for it"""
+    query_id = athena_client.start_query_execution(
+        QueryString=query,
+        QueryExecutionContext={'Database': DATABASE_NAME},
+        WorkGroup=WORKGROUP,
+        ResultConfiguration={'OutputLocation': f's3://{S3_BUCKET}/athena-results/'}
+    )['QueryExecutionId']
+    while True:
+        status = athena_client.get_query_execution(QueryExecutionId=query_id)['QueryExecution']['Status']
+        if status['State'] == 'SUCCEEDED':
+            return query_id
+        if status['State'] in ['FAILED', 'CANCELLED']:
+            raise Exception(f"Query {status['State']}: {status.get('StateChangeReason', 'Unknown')}")
+        time.sleep(2)
+
+def compact_s3_predictions():
+    """Download batch outputs, compact them, verify against manifests, upload and repoint the table"""
+    import boto3
+    from prediction import content_checksum
+
+    if not S3_BUCKET:
+        raise ValueError("S3_BUCKET environment variable is required")
+
+    s3_client = boto3.client('s3')
+    athena_client = boto3.client('athena')
+    paginator = s3_client.get_paginator('list_objects_v2')
+
+    keys = [obj['Key'] for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=INPUT_PREFIX)
+            for obj in page.get('Contents', []) if obj['Key'].endswith('.parquet')]
+    if not keys:
+        logger.info(f"No prediction files under s3://{S3_BUCKET}/{INPUT_PREFIX} (map-side assembly?), nothing to compact")
+        return None
+
+    # Manifests: expected rows/checksum, and each file's id range (read before downloading anything)
+    manifest_keys = [obj['Key'] for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=MANIFEST_PREFIX)
+                     for obj in page.get('Contents', [])]
+    manifests = [json.loads(s3_client.get_object(Bucket=S3_BUCKET, Key=key)['Body'].read()) for key in manifest_keys]
+    manifests = [m for m in manifests if m['output_key'] and m['output_key'].startswith(INPUT_PREFIX)]
+    ranges = {m['output_key']: (m['id_min'], m['id_max']) for m in manifests if m['id_min'] is not None}
+    if set(keys) <= set(ranges) and ranges_disjoint([ranges[key] for key in keys]):
+        logger.info(f"{len(keys)} prediction files have disjoint id ranges (id-range batches), "
+                    f"already pruned by file statistics - skipping compaction")
+        return {'skipped': True, 'input_files': len(keys)}
+
+    input_dir = os.path.join(WORK_DIR, 'input')
+    output_dir = os.path.join(WORK_DIR, 'output')
+    os.makedirs(input_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+
+    def download(key):
+        path = os.path.join(input_dir, os.path.basename(key))
+        s3_client.download_file(S3_BUCKET, key, path)
+        return path
+
+    download_start = time.time()
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        input_files = list(pool.map(download, keys))
+    logger.info(f"Downloaded {len(input_files)} batch files in {time.time() - download_start:.2f}s")
+
+    # Stale compacted files from an earlier attempt must not be mixed in
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=OUTPUT_PREFIX):
+        stale = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if stale:
+            s3_client.delete_objects(Bucket=S3_BUCKET, Delete={'Objects': stale})
+
+    # Manifest checksums are uint64 sums of row hashes, so they add up across any file layout
+    checksum_total = 0
+
+    def upload(path, table):
+        nonlocal checksum_total
+        checksum_total = (checksum_total + int(content_checksum(table.to_pandas()), 16)) % (1 << 64)
+        s3_client.upload_file(path, S3_BUCKET, f'{OUTPUT_PREFIX}{os.path.basename(path)}')
+        os.remove(path)
+
+    stats = compact_files(input_files, output_dir, on_output=upload, remove_inputs=True)
+    stats.pop('output_paths')
+
+    # Rows and content must match what the prediction tasks recorded
+    if manifests:
+        expected_rows = sum(m['row_count'] for m in manifests)
+        expected_checksum = sum(int(m['checksum'], 16) for m in manifests) % (1 << 64)
+        if expected_rows != stats['rows'] or expected_checksum != checksum_total:
+            raise ValueError(f"Compacted output does not match manifests: {stats['rows']:,} rows "
+                             f"(expected {expected_rows:,}), checksum {checksum_total:016x} "
+                             f"(expected {expected_checksum:016x})")
+        logger.info(f"✅ Compacted output matches {len(manifests)} batch manifests")
+
+    run_athena_query(
+        athena_client,
+        f"ALTER TABLE {DATABASE_NAME}.{PREDICTIONS_TABLE} SET LOCATION 's3://{S3_BUCKET}/{OUTPUT_PREFIX}'"
+    )
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    logger.info(f"✅ {PREDICTIONS_TABLE} now reads s3://{S3_BUCKET}/{OUTPUT_PREFIX}")
+    logger.info(f"Compaction stats: {json.dumps(stats)}")
+    return stats
+
+def read_overlapping(files, low, high, columns=None):
+    """Read only the row groups whose id statistics overlap [low, high]. Returns (table, row_groups_read)."""
+    tables = []
+    row_groups_read = 0
+    for parquet_file in files:
+        for rg in range(parquet_file.metadata.num_row_groups):
+            stats = parquet_file.metadata.row_group(rg).column(0).statistics  # column 0 is id
+            if stats is not None and stats.has_min_max and (stats.max < low or stats.min > high):
+                continue
+            tables.append(parquet_file.read_row_group(rg, columns=columns))
+            row_groups_read += 1
+    table = pa.concat_tables(tables) if tables else None
+    return table, row_groups_read
+
+def time_downstream(paths, probe_ids, join_low, join_high):
+    """Time point lookups and an id-range join against a set of Parquet files"""
+    import pandas as pd
+
+    files = [pq.ParquetFile(path) for path in paths]
+
+    lookup_start = time.perf_counter()
+    lookup_row_groups = 0
+    for pid in probe_ids:
+        table, row_groups = read_overlapping(files, pid, pid, columns=['id', 'predicted_age'])
+        lookup_row_groups += row_groups
+        ids = table.column('id').to_numpy()
+        assert (ids == pid).any()
+    lookup_ms = (time.perf_counter() - lookup_start) / len(probe_ids) * 1000
+
+    # Join a contiguous source id range (like one source file / Athena split) to predictions
+    join_start = time.perf_counter()
+    table, join_row_groups = read_overlapping(files, join_low, join_high)
+    predictions = table.to_pandas()
+    source = pd.DataFrame({'id': np.arange(join_low, join_high + 1, dtype=np.int64)})
+    joined = source.merge(predictions, on='id', how='inner')
+    join_ms = (time.perf_counter() - join_start) * 1000
+
+    return {
+        'lookup_ms': round(lookup_ms, 2),
+        'lookup_row_groups_per_id': round(lookup_row_groups / len(probe_ids), 1),
+        'join_ms': round(join_ms, 1),
+        'join_row_groups': join_row_groups,
+        'join_rows': len(joined)
+    }
+
+def run_benchmark(rows, batches, lookups, work_dir, layout='mod'):
+    """Synthetic batch files (MOD or id-range batches, rows unsorted) vs compacted output: join and lookup time"""
+    import pandas as pd
+
+    rng = np.random.default_rng(42)
+    before_dir = os.path.join(work_dir, 'before')
+    after_dir = os.path.join(work_dir, 'after')
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(before_dir)
+    os.makedirs(after_dir)
+
+    logger.info(f"Writing {rows:,} synthetic predictions as {batches} {layout.upper()} batches...")
+    ids = np.sort(rng.choice(rows * 4, size=rows, replace=False)).astype(np.int64)
+    if layout == 'mod':
+        batch_of = ids % batches
+    else:
+        batch_of = np.arange(rows) * batches // rows  # Equal-row id ranges, like GenerateBatchIds
+    before_paths = []
+    for batch_id in range(batches):
+        batch_ids = rng.permutation(ids[batch_of == batch_id])  # Athena / chunk order is arbitrary
+        df = pd.DataFrame({
+            'id': batch_ids,
+            'predicted_age': rng.integers(18, 76, size=len(batch_ids)),
+            'confidence_score': np.round(rng.uniform(0, 40, size=len(batch_ids)), 2),
+            'prediction_ts': '2025-10-23T12:00:00.000000',
+            'model_version': 'v1.0_xgboost',
+            'batch_id': batch_id
+        })
+        if COMPACT_SCHEMA:
+            df = to_compact_schema(df)
+        path = os.path.join(before_dir, f'batch_{batch_id:04d}.parquet')
+        df.to_parquet(path, index=False, compression=OUTPUT_COMPRESSION)  # Same writer as prediction.py
+        before_paths.append(path)
+
+    target_mb = max(1, int(sum(os.path.getsize(p) for p in before_paths) / (1024 * 1024) / 8))
+    stats = compact_files(before_paths, after_dir, target_file_mb=target_mb)
+    after_paths = stats.pop('output_paths')
+
+    probe_ids = rng.choice(ids, size=lookups)
+    join_low = int(ids[len(ids) // 2])
+    join_high = join_low + len(ids) // 25  # ~1% of the id span
+    before = time_downstream(before_paths, probe_ids, join_low, join_high)
+    after = time_downstream(after_paths, probe_ids, join_low, join_high)
+
+    results = {
+        'rows': rows,
+        'layout': layout,
+        'compaction': stats,
+        'before': before,
+        'after': after,
+        'lookup_speedup': round(before['lookup_ms'] / max(after['lookup_ms'], 1e-6), 1),
+        'join_speedup': round(before['join_ms'] / max(after['join_ms'], 1e-6), 1)
+    }
+    logger.info(f"Benchmark results: {json.dumps(results, indent=2)}")
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description='Compact prediction outputs into id-sorted files')
+    subparsers = parser.add_subparsers(dest='command')
+
+    bench_parser = subparsers.add_parser('bench', help='Before/after benchmark on synthetic batch files')
+    bench_parser.add_argument('--rows', type=int, default=10000000)
+    bench_parser.add_argument('--batches', type=int, default=898)
+    bench_parser.add_argument('--lookups', type=int, default=200)
+    bench_parser.add_argument('--layout', choices=['mod', 'range'], default='mod',
+                              help='Batch layout of the synthetic inputs (range: disjoint id ranges)')
+
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        run_benchmark(args.rows, args.batches, args.lookups, os.path.join(WORK_DIR, 'bench'), args.layout)
+    else:
+        # Default (container command): compact this run's predictions on S3
+        compact_s3_predictions()
+
+if __name__ == '__main__':
+    sys.exit(main())
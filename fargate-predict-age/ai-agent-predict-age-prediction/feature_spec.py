@@ -0,0 +1,751 @@
+#!/usr/bin/env python3
+"""
+Declarative Feature Spec
+The 21 model features, defined once (FEATURE_SPEC) and compiled to two backends:
+  - compute_features(): vectorized pandas/NumPy kernel (prediction, feature store)
+  - select_expressions(): Athena (Trino) SELECT expressions (training CTAS, scan pushdown)
+
+Training reads the table `ctas` builds from this spec (the TrainingFeatureSpec
+step runs it before Training), so the models are trained on exactly the
+encodings served here; parse_features.py encoded several columns differently.
+
+Entries are either model features or intermediates (parsed dates, the parsed
+graduation year, the tenure fallback) that other entries reference. Entries
+that depend on the run date (current_date) are time-dependent; everything else
+is static and can be computed once - in the Athena scan (FEATURE_PUSHDOWN) or
+in the feature store - and fed back in as precomputed columns.
+
+SQL semantics are the reference: NULL propagates through arithmetic (NaN),
+a NULL condition does not match, dates are TRY_CAST(... AS DATE) ('YYYY-MM-DD'),
+date_diff('month') counts whole months with Joda's end-of-month rule.
+
+Usage:
+  python feature_spec.py sql                                    # Print the compiled SELECT expressions
+  python feature_spec.py ctas --source predict_age_training_raw_14m   # Training features table from the spec
+  python feature_spec.py parity --table predict_age_full_evaluation_raw_378m --rows 100000
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import logging
+from io import BytesIO
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+from json_scan import array_lengths
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Environment variables
+S3_BUCKET = os.environ.get('S3_BUCKET')
+DATABASE_NAME = os.environ.get('DATABASE_NAME', 'ml_predict_age')
+WORKGROUP = os.environ.get('WORKGROUP', 'ai-agent-predict-age')
+FEATURE_PUSHDOWN = os.environ.get('FEATURE_PUSHDOWN', 'false').lower() == 'true'
+YYYYQQ = os.environ.get('YYYYQQ', 'YYYYQQ')
+# Reruns of a quarter keep a features table built by this spec version from the same source
+RESUME = os.environ.get('RESUME', 'true').lower() == 'true'
+
+PUSHDOWN_PREFIX = 'spec_'  # Athena-computed static entries ride along with the raw row as spec_{name}
+
+def sql_literal(value):
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return repr(value)
+
+STRING_DTYPE = pd.StringDtype('pyarrow')
+
+def text_values(series):
+    """Raw column as Arrow-backed strings (NA = NULL), like CAST(column AS VARCHAR)"""
+    return series if series.dtype == STRING_DTYPE else series.astype(STRING_DTYPE)
+
+def mask(values):
+    """Nullable boolean -> bool array (NULL never matches)"""
+    return values.fillna(False).to_numpy(dtype=bool)
+
+def python_values(series, chunk_rows=16384):
+    """Column as Python strings (None = NULL) for the per-value JSON parsers, a chunk at a time"""
+    text = text_values(series)
+    for start in range(0, len(text), chunk_rows):
+        yield from text.iloc[start:start + chunk_rows].to_numpy(dtype=object, na_value=None)
+
+class Expr:
+    """A spec expression: numpy(env) -> array (float64 / bool / datetime64), sql() -> Trino expression"""
+    time_dependent = False
+
+    def children(self):
+        return []
+
+    def columns(self):
+        return [column for child in self.children() for column in child.columns()]
+
+    def refs(self):
+        return [name for child in self.children() for name in child.refs()]
+
+    def depends_on_time(self, spec):
+        return self.time_dependent or any(child.depends_on_time(spec) for child in self.children())
+
+    def __add__(self, other):
+        return Arith('+', self, wrap(other))
+
+    def __sub__(self, other):
+        return Arith('-', self, wrap(other))
+
+    def __rsub__(self, other):
+        return Arith('-', wrap(other), self)
+
+    def __mul__(self, other):
+        return Arith('*', self, wrap(other))
+
+    def __truediv__(self, other):
+        return Arith('/', self, wrap(other))
+
+    def gt(self, other):
+        return Compare('>', self, wrap(other))
+
+    def is_not_null(self):
+        return NotNull(self)
+
+def wrap(value):
+    return value if isinstance(value, Expr) else Num(value)
+
+class Num(Expr):
+    def __init__(self, value):
+        self.value = value
+
+    def numpy(self, env):
+        return np.full(env.rows, float(self.value))
+
+    def sql(self, spec):
+        return sql_literal(self.value)
+
+class Ref(Expr):
+    """Another spec entry (feature or intermediate), inlined in SQL"""
+    def __init__(self, name):
+        self.name = name
+
+    def refs(self):
+        return [self.name]
+
+    def depends_on_time(self, spec):
+        return spec[self.name].depends_on_time(spec)
+
+    def numpy(self, env):
+        return env.value(self.name)
+
+    def sql(self, spec):
+        return f'({spec[self.name].sql(spec)})'
+
+class ColumnExpr(Expr):
+    def __init__(self, column):
+        self.column = column
+
+    def columns(self):
+        return [self.column]
+
+    def text_sql(self):
+        return f'CAST({self.column} AS VARCHAR)'
+
+class Lookup(ColumnExpr):
+    """Exact string match of a column against a mapping, default otherwise"""
+    def __init__(self, column, mapping, default):
+        super().__init__(column)
+        self.mapping, self.default = mapping, default
+
+    def numpy(self, env):
+        text = text_values(env.raw(self.column))
+        return np.select([mask(text == key) for key in self.mapping],
+                         [float(value) for value in self.mapping.values()], float(self.default))
+
+    def sql(self, spec):
+        cases = ' '.join(f'WHEN {sql_literal(key)} THEN {sql_literal(value)}' for key, value in self.mapping.items())
+        return f'CASE {self.text_sql()} {cases} ELSE {sql_literal(self.default)} END'
+
+class Keywords(ColumnExpr):
+    """First rule with a keyword contained in the lowercased column wins, default otherwise"""
+    def __init__(self, column, rules, default):
+        super().__init__(column)
+        self.rules, self.default = rules, default
+
+    def numpy(self, env):
+        text = text_values(env.raw(self.column))  # Case-insensitive match, no lowercased copy of the column
+        conditions = [np.logical_or.reduce([mask(text.str.contains(keyword, case=False, regex=False)) for keyword in keywords])
+                      for keywords, _ in self.rules]
+        return np.select(conditions, [float(value) for _, value in self.rules], float(self.default))
+
+    def sql(self, spec):
+        cases = ' '.join(
+            'WHEN ' + ' OR '.join(f"LOWER({self.text_sql()}) LIKE {sql_literal('%' + keyword + '%')}" for keyword in keywords)
+            + f' THEN {sql_literal(value)}' for keywords, value in self.rules)
+        return f'CASE {cases} ELSE {sql_literal(self.default)} END'
+
+class Thresholds(ColumnExpr):
+    """First rule whose threshold the numeric column exceeds, default otherwise (and for non-numbers)"""
+    def __init__(self, column, rules, default):
+        super().__init__(column)
+        self.rules, self.default = rules, default
+
+    def numpy(self, env):
+        values = pd.to_numeric(env.raw(self.column), errors='coerce').values.astype('float64')
+        return np.select([values > threshold for threshold, _ in self.rules],
+                         [float(value) for _, value in self.rules], float(self.default))
+
+    def sql(self, spec):
+        cases = ' '.join(f'WHEN TRY_CAST({self.column} AS DOUBLE) > {sql_literal(threshold)} THEN {sql_literal(value)}'
+                         for threshold, value in self.rules)
+        return f'CASE {cases} ELSE {sql_literal(self.default)} END'
+
+class Present(ColumnExpr):
+    """Column is non-NULL and non-empty (Athena CSV results cannot tell the two apart)"""
+    def numpy(self, env):
+        return mask(text_values(env.raw(self.column)) != '')
+
+    def sql(self, spec):
+        return f"COALESCE({self.text_sql()}, '') <> ''"
+
+class IsTrue(ColumnExpr):
+    """Boolean or 'true'/'false' string column is true"""
+    def numpy(self, env):
+        return mask(text_values(env.raw(self.column)).str.lower() == 'true')
+
+    def sql(self, spec):
+        return f"LOWER({self.text_sql()}) = 'true'"
+
+class JsonArrayLength(ColumnExpr):
+    """Length of a JSON array column, 0 if missing, invalid or not an array"""
+    def numpy(self, env):
+        return array_lengths(text_values(env.raw(self.column)))
+
+    def sql(self, spec):
+        return f'COALESCE(TRY(json_array_length(json_parse({self.column}))), 0)'
+
+class JsonScalarInt(ColumnExpr):
+    """Integer at a JSON path like '$[0].end_date' (json_extract_scalar + CAST), NULL otherwise"""
+    def __init__(self, column, path):
+        super().__init__(column)
+        self.path = path
+        self.steps = [int(index) if index else key for index, key in re.findall(r'\[(\d+)\]|\.(\w+)', path)]
+
+    def numpy(self, env):
+        def extract(value):
+            try:
+                node = json.loads(value)
+                for step in self.steps:
+                    node = node[step]
+            except (TypeError, ValueError, KeyError, IndexError):
+                return np.nan
+            if node is None or isinstance(node, (dict, list)):
+                return np.nan
+            text = json.dumps(node) if not isinstance(node, str) else node
+            try:
+                return float(int(text))
+            except ValueError:
+                return np.nan
+        return np.fromiter((extract(value) for value in python_values(env.raw(self.column))), dtype='float64', count=env.rows)
+
+    def sql(self, spec):
+        return f"TRY(CAST(json_extract_scalar(json_parse({self.column}), {sql_literal(self.path)}) AS INTEGER))"
+
+class ParseDate(ColumnExpr):
+    """TRY_CAST(column AS DATE): 'YYYY-M-D' (1-2 digit month/day, surrounding whitespace allowed), NaT otherwise"""
+    def numpy(self, env):
+        text = text_values(env.raw(self.column)).str.strip()
+        text = text.where(mask(text.str.fullmatch(r'\d{4}-\d{1,2}-\d{1,2}')))
+        return pd.to_datetime(text, format='%Y-%m-%d', errors='coerce').values
+
+    def sql(self, spec):
+        return f'TRY_CAST({self.column} AS DATE)'
+
+class DaysSince(Expr):
+    time_dependent = True
+
+    def __init__(self, date):
+        self.date = date
+
+    def children(self):
+        return [self.date]
+
+    def numpy(self, env):
+        dates = pd.DatetimeIndex(self.date.numpy(env))
+        return ((env.today - dates) // pd.Timedelta(days=1)).values.astype('float64')
+
+    def sql(self, spec):
+        return f"date_diff('day', {self.date.sql(spec)}, current_date)"
+
+class MonthsSince(Expr):
+    """Whole months to today; day-of-month rule as Joda (date_diff('month')), incl. end-of-month"""
+    time_dependent = True
+
+    def __init__(self, date):
+        self.date = date
+
+    def children(self):
+        return [self.date]
+
+    def numpy(self, env):
+        dates = pd.DatetimeIndex(self.date.numpy(env))
+        today = env.today
+        months = (today.year - dates.year) * 12 + (today.month - dates.month)
+        day = np.asarray(dates.day, dtype='float64')
+        if today.day == today.days_in_month:
+            day = np.minimum(day, today.day)
+        return np.where(today.day < day, months - 1, months).astype('float64')
+
+    def sql(self, spec):
+        return f"date_diff('month', {self.date.sql(spec)}, current_date)"
+
+class CurrentQuarter(Expr):
+    time_dependent = True
+
+    def numpy(self, env):
+        return np.full(env.rows, float((env.today.month - 1) // 3 + 1))
+
+    def sql(self, spec):
+        return 'quarter(current_date)'
+
+class Coalesce(Expr):
+    def __init__(self, value, fallback):
+        self.value, self.fallback = value, wrap(fallback)
+
+    def children(self):
+        return [self.value, self.fallback]
+
+    def numpy(self, env):
+        value = self.value.numpy(env)
+        return np.where(np.isnan(value), self.fallback.numpy(env), value)
+
+    def sql(self, spec):
+        return f'COALESCE({self.value.sql(spec)}, {self.fallback.sql(spec)})'
+
+class Arith(Expr):
+    OPS = {'+': np.add, '-': np.subtract, '*': np.multiply, '/': np.divide}
+
+    def __init__(self, op, left, right):
+        self.op, self.left, self.right = op, left, right
+
+    def children(self):
+        return [self.left, self.right]
+
+    def numpy(self, env):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.OPS[self.op](self.left.numpy(env), self.right.numpy(env))
+
+    def sql(self, spec):
+        if self.op == '/':  # Trino integer division truncates
+            return f'(CAST({self.left.sql(spec)} AS DOUBLE) / CAST({self.right.sql(spec)} AS DOUBLE))'
+        return f'({self.left.sql(spec)} {self.op} {self.right.sql(spec)})'
+
+class Clip(Expr):
+    def __init__(self, value, lower, upper):
+        self.value, self.lower, self.upper = value, lower, upper
+
+    def children(self):
+        return [self.value]
+
+    def numpy(self, env):
+        return np.clip(self.value.numpy(env), self.lower, self.upper)
+
+    def sql(self, spec):
+        return f'LEAST({sql_literal(self.upper)}, GREATEST({sql_literal(self.lower)}, {self.value.sql(spec)}))'
+
+class Compare(Expr):
+    def __init__(self, op, left, right):
+        self.op, self.left, self.right = op, left, right
+
+    def children(self):
+        return [self.left, self.right]
+
+    def numpy(self, env):
+        with np.errstate(invalid='ignore'):
+            return np.greater(self.left.numpy(env), self.right.numpy(env))  # NaN (NULL) never matches
+
+    def sql(self, spec):
+        return f'({self.left.sql(spec)} {self.op} {self.right.sql(spec)})'
+
+class NotNull(Expr):
+    def __init__(self, value):
+        self.value = value
+
+    def children(self):
+        return [self.value]
+
+    def numpy(self, env):
+        return ~np.isnan(self.value.numpy(env))
+
+    def sql(self, spec):
+        return f'({self.value.sql(spec)} IS NOT NULL)'
+
+class All(Expr):
+    def __init__(self, *conditions):
+        self.conditions = conditions
+
+    def children(self):
+        return list(self.conditions)
+
+    def numpy(self, env):
+        return np.logical_and.reduce([condition.numpy(env) for condition in self.conditions])
+
+    def sql(self, spec):
+        return '(' + ' AND '.join(condition.sql(spec) for condition in self.conditions) + ')'
+
+class Any(All):
+    def numpy(self, env):
+        return np.logical_or.reduce([condition.numpy(env) for condition in self.conditions])
+
+    def sql(self, spec):
+        return '(' + ' OR '.join(condition.sql(spec) for condition in self.conditions) + ')'
+
+class Case(Expr):
+    """First matching (condition, value), else default (CASE WHEN)"""
+    def __init__(self, rules, default):
+        self.rules = [(condition, wrap(value)) for condition, value in rules]
+        self.default = wrap(default)
+
+    def children(self):
+        return [node for rule in self.rules for node in rule] + [self.default]
+
+    def numpy(self, env):
+        return np.select([condition.numpy(env) for condition, _ in self.rules],
+                         [value.numpy(env) for _, value in self.rules], self.default.numpy(env))
+
+    def sql(self, spec):
+        cases = ' '.join(f'WHEN {condition.sql(spec)} THEN {value.sql(spec)}' for condition, value in self.rules)
+        return f'CASE {cases} ELSE {self.default.sql(spec)} END'
+
+class Entry:
+    """A named spec expression; feature=False marks an intermediate (not a model input)"""
+    def __init__(self, name, expr, feature=True):
+        self.name, self.expr, self.feature = name, expr, feature
+        self.is_date = isinstance(expr, ParseDate)
+
+    def depends_on_time(self, spec):
+        return self.expr.depends_on_time(spec)
+
+    def sql(self, spec):
+        return self.expr.sql(spec)
+
+def Feature(name, expr):
+    return Entry(name, expr)
+
+def Intermediate(name, expr):
+    return Entry(name, expr, feature=False)
+
+SENIORITY_KEYWORDS = [
+    (('chief', 'vp'), 5), (('senior', 'principal'), 4), (('manager', 'director'), 3),
+    (('associate', 'analyst'), 2), (('junior', 'entry'), 1)
+]
+EDUCATION_KEYWORDS = [
+    (('phd', 'doctorate', 'doctor of'), 5), (('master', 'mba', 'm.s.', 'm.a.'), 4),
+    (('bachelor', 'b.s.', 'b.a.'), 3), (('associate',), 2), (('high school',), 1)
+]
+LINKEDIN_VALID = IsTrue('linkedin_url_is_valid')
+
+# Model input order = order of the features below (training.py prepare_training_data)
+FEATURE_SPEC = [
+    Intermediate('job_start_ts', ParseDate('job_start_date')),
+    Intermediate('ev_last_ts', ParseDate('ev_last_date')),
+    Intermediate('tenure_default', Lookup('job_level', {'C-Team': 120, 'Manager': 60}, 36)),
+    Intermediate('graduation_year_parsed', JsonScalarInt('education', '$[0].end_date')),
+
+    # Career stage
+    Feature('tenure_months', Coalesce(MonthsSince(Ref('job_start_ts')), Ref('tenure_default'))),
+    Feature('job_level_encoded', Lookup('job_level', {'C-Team': 4, 'Manager': 3, 'Staff': 2}, 1)),
+    Feature('job_seniority_score', Keywords('job_title', SENIORITY_KEYWORDS, 3)),
+    Feature('compensation_encoded', Lookup('compensation_range', {
+        '$200,001+': 8, '$150,001 - $200,000': 7, '$100,001 - $150,000': 6,
+        '$75,001 - $100,000': 5, '$50,001 - $75,000': 4, '$25,001 - $50,000': 3
+    }, 4)),
+    Feature('company_size_encoded', Lookup('employee_range', {
+        '10000+': 9, '5000 to 9999': 8, '1000 to 4999': 7, '500 to 999': 6, '200 to 499': 5
+    }, 4)),
+
+    # Digital footprint
+    Feature('linkedin_activity_score', Thresholds('linkedin_connection_count', [(500, 1.0), (200, 0.8), (100, 0.6)], 0.3)),
+    Feature('days_since_profile_update', Coalesce(DaysSince(Ref('ev_last_ts')), 365)),
+    Feature('social_media_presence_score', Case([
+        (All(LINKEDIN_VALID, Present('facebook_url'), Present('twitter_url')), 1.0),
+        (All(LINKEDIN_VALID, Any(Present('facebook_url'), Present('twitter_url'))), 0.7),
+        (LINKEDIN_VALID, 0.5)
+    ], 0.2)),
+    Feature('email_engagement_score', Case([
+        (All(Present('work_email'), Present('personal_email')), 1.0),
+        (Any(Present('work_email'), Present('personal_email')), 0.5)
+    ], 0.0)),
+
+    # Industry & function
+    Feature('industry_typical_age', Lookup('industry', {
+        'Technology': 35, 'Consulting': 38, 'Finance': 42, 'Healthcare': 45, 'Education': 48, 'Government': 50
+    }, 40)),
+    Feature('job_function_encoded', Lookup('job_function', {
+        'Engineering': 1, 'Sales': 2, 'Marketing': 3, 'Finance': 4, 'Operations': 5
+    }, 0)),
+    Feature('company_revenue_encoded', Lookup('revenue_range', {'$1B+': 9, '$500M to $1B': 8, '$100M to $500M': 7}, 5)),
+
+    # Temporal
+    Feature('quarter', CurrentQuarter()),
+
+    # Education & experience (JSON)
+    Feature('education_level_encoded', Keywords('education', EDUCATION_KEYWORDS, 2)),
+    Feature('graduation_year', Coalesce(Ref('graduation_year_parsed'), 0)),  # Training filled NULL with 0
+    Feature('number_of_jobs', JsonArrayLength('work_experience')),
+    Feature('skill_count', JsonArrayLength('skills')),
+    Feature('total_career_years', Case([
+        (Ref('number_of_jobs').gt(0), Clip(Ref('tenure_months') / 12.0 + (Ref('number_of_jobs') - 1) * 2.5, 1, 50)),
+        (Ref('graduation_year_parsed').is_not_null(), 2025 - Ref('graduation_year_parsed'))
+    ], Ref('tenure_months') / 12.0)),
+    Feature('job_churn_rate', Case([
+        (All(Ref('number_of_jobs').gt(0), Ref('tenure_months').gt(12)), Ref('number_of_jobs') / (Ref('tenure_months') / 12.0))
+    ], 0.2)),
+
+    # Interactions
+    Feature('tenure_job_level_interaction', Ref('tenure_months') * Ref('job_level_encoded')),
+    Feature('comp_size_interaction', Ref('compensation_encoded') * Ref('company_size_encoded'))
+]
+
+SPEC = {entry.name: entry for entry in FEATURE_SPEC}
+FEATURE_COLUMNS = [entry.name for entry in FEATURE_SPEC if entry.feature]
+INTERMEDIATE_COLUMNS = [entry.name for entry in FEATURE_SPEC if not entry.feature]
+DATE_COLUMNS = [entry.name for entry in FEATURE_SPEC if entry.is_date]
+TIME_FEATURE_COLUMNS = [name for name in FEATURE_COLUMNS if SPEC[name].depends_on_time(SPEC)]
+STATIC_FEATURE_COLUMNS = [name for name in FEATURE_COLUMNS if name not in TIME_FEATURE_COLUMNS]
+STATIC_COLUMNS = [entry.name for entry in FEATURE_SPEC if not entry.depends_on_time(SPEC)]  # Pushdown / store
+# Raw columns read by the spec, in order of first use
+INPUT_COLUMNS = list(dict.fromkeys(column for entry in FEATURE_SPEC for column in entry.expr.columns()))
+
+class Env:
+    """Evaluation state of one compute_features call: raw frame, run date, memoized entry values"""
+    def __init__(self, df, today, precomputed):
+        self.df, self.today, self.rows = df, today, len(df)
+        self.values = dict(precomputed)
+
+    def raw(self, column):
+        if column in self.df:
+            return self.df[column]
+        return pd.Series([None] * self.rows, index=self.df.index, dtype=STRING_DTYPE)  # Missing column = NULL
+
+    def value(self, name):
+        if name not in self.values:
+            self.values[name] = SPEC[name].expr.numpy(self)
+        return self.values[name]
+
+def coerce_precomputed(name, values):
+    """Precomputed entry values (store columns, pushed-down Athena CSV columns) in kernel dtypes"""
+    if SPEC[name].is_date:
+        return np.asarray(pd.to_datetime(values, errors='coerce'), dtype='datetime64[ns]')
+    return np.asarray(pd.to_numeric(values, errors='coerce'), dtype='float64')
+
+def pushed_down(df):
+    """{entry: values} for the spec_{name} columns the Athena scan computed (load_raw_data_for_batch)"""
+    return {name: coerce_precomputed(name, df[PUSHDOWN_PREFIX + name])
+            for name in STATIC_COLUMNS if PUSHDOWN_PREFIX + name in df}
+
+def compute_features(df, today=None, precomputed=None, with_intermediates=False):
+    """
+    The spec's features for df (raw columns, plus any precomputed entries:
+    {name: values}), as id + FEATURE_COLUMNS (+ INTERMEDIATE_COLUMNS).
+    today: run date (current_date); defaults to today.
+
+    Entries are evaluated in float64; the features are stored as one float32
+    block (the trees split on float32 anyway), which feature_matrix returns
+    without a copy.
+    """
+    today = pd.Timestamp(today or datetime.now()).normalize()
+    env = Env(df, today, {name: coerce_precomputed(name, values) for name, values in (precomputed or {}).items()})
+    matrix = np.empty((len(df), len(FEATURE_COLUMNS)), dtype='float32')
+    for index, name in enumerate(FEATURE_COLUMNS):
+        matrix[:, index] = env.value(name)
+    result = pd.DataFrame(matrix, columns=FEATURE_COLUMNS, copy=False)
+    result.insert(0, 'id', np.asarray(df['id'], dtype='int64'))
+    for name in INTERMEDIATE_COLUMNS if with_intermediates else []:
+        result[name] = env.value(name)
+    return result
+
+def feature_matrix(df_features):
+    """Model input (rows x FEATURE_COLUMNS, float32): a view of compute_features' feature block"""
+    return df_features.iloc[:, 1:1 + len(FEATURE_COLUMNS)].to_numpy(dtype='float32', copy=False)
+
+def compute_time_features(df_static, today=None):
+    """Time-dependent features from a frame of static entries (STATIC_COLUMNS, e.g. the feature store)"""
+    precomputed = {name: df_static[name].values for name in STATIC_COLUMNS if name in df_static}
+    return compute_features(df_static, today, precomputed, with_intermediates=True)
+
+def select_expressions(names=None, prefix=''):
+    """Athena SELECT expressions for spec entries (default: the features), aliased prefix + name"""
+    expressions = []
+    for name in names or FEATURE_COLUMNS:
+        target = 'DATE' if SPEC[name].is_date else 'DOUBLE'
+        expressions.append(f'CAST({SPEC[name].sql(SPEC)} AS {target}) AS {prefix}{name}')
+    return expressions
+
+def pushdown_select():
+    """Extra SELECT list for the prediction scan: every static entry, computed by Athena"""
+    return ',\n    '.join(select_expressions(STATIC_COLUMNS, PUSHDOWN_PREFIX))
+
+# Changes whenever a compiled definition changes (feature store prefix, training table feature_version)
+SPEC_VERSION = 'spec_' + hashlib.sha256('\n'.join(select_expressions(FEATURE_COLUMNS + INTERMEDIATE_COLUMNS))
+                                        .encode('utf-8')).hexdigest()[:12]
+
+def run_query(athena_client, query, poll_sec=2):
+    """Run an Athena query to completion; returns the final QueryExecution"""
+    response = athena_client.start_query_execution(
+        QueryString=query,
+        QueryExecutionContext={'Database': DATABASE_NAME},
+        WorkGroup=WORKGROUP,
+        ResultConfiguration={'OutputLocation': f's3://{S3_BUCKET}/athena-results/'}
+    )
+    query_id = response['QueryExecutionId']
+    while True:
+        execution = athena_client.get_query_execution(QueryExecutionId=query_id)['QueryExecution']
+        status = execution['Status']['State']
+        if status == 'SUCCEEDED':
+            return execution
+        elif status in ['FAILED', 'CANCELLED']:
+            raise Exception(f"Query {status}: {execution['Status'].get('StateChangeReason', 'Unknown')}")
+        time.sleep(poll_sec)
+
+def ctas_checkpoint_key(table):
+    """Same layout as the CTAS checkpoints of the Lambda layer (checkpoint.py); training.py reads it"""
+    return f'predict-age/checkpoints/{YYYYQQ}/{table}.json'
+
+def ctas(source, table, location):
+    """
+    (Re)create a features table (id + the 21 features) from a raw table with the compiled
+    spec and checkpoint it. With RESUME, a table this spec version already built from the
+    same source for this run is kept.
+    """
+    import boto3
+
+    s3_client = boto3.client('s3')
+    athena_client = boto3.client('athena')
+    checkpoint_key = ctas_checkpoint_key(table)
+    if RESUME:
+        try:
+            checkpoint = json.loads(s3_client.get_object(Bucket=S3_BUCKET, Key=checkpoint_key)['Body'].read())
+            athena_client.get_table_metadata(CatalogName='AwsDataCatalog', DatabaseName=DATABASE_NAME, TableName=table)
+        except (s3_client.exceptions.NoSuchKey, athena_client.exceptions.MetadataException):
+            checkpoint = None
+        if checkpoint and (checkpoint['spec_version'], checkpoint['source']) == (SPEC_VERSION, source):
+            logger.info(f"{DATABASE_NAME}.{table} already built by {SPEC_VERSION} from {source}, skipping CTAS")
+            return checkpoint
+    run_query(athena_client, f'DROP TABLE IF EXISTS {DATABASE_NAME}.{table}')
+    # CTAS needs an empty external location
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=location):
+        objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if objects:
+            s3_client.delete_objects(Bucket=S3_BUCKET, Delete={'Objects': objects})
+
+    features = ',\n    '.join(select_expressions())
+    execution = run_query(athena_client, f"""
+    CREATE TABLE {DATABASE_NAME}.{table}
+    WITH (
+        format = 'PARQUET',
+        parquet_compression = 'SNAPPY',
+        external_location = 's3://{S3_BUCKET}/{location}'
+    ) AS
+    SELECT
+    CAST(id AS BIGINT) AS id,
+    {features},
+    current_date AS feature_creation_date,
+    '{SPEC_VERSION}' AS feature_version
+    FROM {DATABASE_NAME}.{source}
+    WHERE id IS NOT NULL
+    """, poll_sec=10)
+    stats = execution['Statistics']
+    logger.info(f"✅ {DATABASE_NAME}.{table} ({SPEC_VERSION}) from {source}: "
+                f"{stats['DataScannedInBytes'] / 1e9:.1f} GB scanned in {stats['EngineExecutionTimeInMillis'] / 1000:.0f}s")
+    checkpoint = {
+        'run_id': YYYYQQ,
+        'table': table,
+        'location': f's3://{S3_BUCKET}/{location}',
+        'source': source,
+        'spec_version': SPEC_VERSION,
+        'recorded_at': datetime.now().isoformat()
+    }
+    s3_client.put_object(Bucket=S3_BUCKET, Key=checkpoint_key, Body=json.dumps(checkpoint),
+                         ContentType='application/json')
+    return checkpoint
+
+def run_parity(table, rows):
+    """
+    Cross-backend parity and cost: the same sample through Athena (compiled SQL)
+    and the NumPy kernel; per-feature mismatches, Athena time/bytes with and
+    without the feature expressions, kernel throughput.
+    """
+    import boto3
+
+    s3_client = boto3.client('s3')
+    athena_client = boto3.client('athena')
+    sample = f'FROM {DATABASE_NAME}.{table} WHERE id IS NOT NULL LIMIT {rows}'
+
+    raw_execution = run_query(athena_client, f"SELECT id, {', '.join(INPUT_COLUMNS)} {sample}")
+    execution = run_query(athena_client, f"""
+    SELECT id, {', '.join(INPUT_COLUMNS)},
+    {', '.join(select_expressions(FEATURE_COLUMNS + INTERMEDIATE_COLUMNS, 'sql_'))}
+    {sample}
+    """)
+    body = s3_client.get_object(Bucket=S3_BUCKET, Key=f"athena-results/{execution['QueryExecutionId']}.csv")['Body'].read()
+    df = pd.read_csv(BytesIO(body))
+    today = execution['Status']['SubmissionDateTime'].astimezone(timezone.utc).date()  # Athena current_date
+
+    start = time.time()
+    kernel = compute_features(df[['id'] + INPUT_COLUMNS], today, with_intermediates=True)
+    kernel_sec = time.time() - start
+
+    mismatches = {}
+    for name in FEATURE_COLUMNS + [column for column in INTERMEDIATE_COLUMNS if column not in DATE_COLUMNS]:
+        athena = pd.to_numeric(df[f'sql_{name}'], errors='coerce').values.astype('float64')
+        ours = kernel[name].values.astype('float64')
+        same = np.isclose(ours, athena, rtol=1e-9, atol=1e-9) | (np.isnan(ours) & np.isnan(athena))
+        if not same.all():
+            first = int(np.argmax(~same))
+            mismatches[name] = {'rows': int((~same).sum()), 'example_id': int(df['id'].iloc[first]),
+                                'numpy': float(ours[first]), 'athena': float(athena[first])}
+
+    raw_stats, stats = raw_execution['Statistics'], execution['Statistics']
+    results = {
+        'table': table,
+        'rows': len(df),
+        'spec_version': SPEC_VERSION,
+        'features_matching': len(FEATURE_COLUMNS) - len([name for name in mismatches if name in FEATURE_COLUMNS]),
+        'mismatches': mismatches,
+        'kernel_sec': round(kernel_sec, 2),
+        'kernel_rows_per_sec': round(len(df) / kernel_sec),
+        'athena_raw_ms': raw_stats['EngineExecutionTimeInMillis'],
+        'athena_with_features_ms': stats['EngineExecutionTimeInMillis'],
+        'athena_raw_scanned_mb': round(raw_stats['DataScannedInBytes'] / 1e6, 1),
+        'athena_with_features_scanned_mb': round(stats['DataScannedInBytes'] / 1e6, 1)
+    }
+    logger.info(f"Benchmark results: {json.dumps(results, indent=2)}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Declarative feature spec (NumPy kernel + Athena SQL)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('sql', help='Print the compiled SELECT expressions')
+    ctas_parser = subparsers.add_parser('ctas', help='Create a training features table from a raw table')
+    ctas_parser.add_argument('--source', default='predict_age_training_raw_14m')
+    ctas_parser.add_argument('--table', default='predict_age_training_features_parsed_14m')  # Training FEATURES_TABLE
+    ctas_parser.add_argument('--location', default='predict-age/permanent/training_features_parsed_14m/')
+    parity_parser = subparsers.add_parser('parity', help='Athena vs NumPy kernel on the same sample')
+    parity_parser.add_argument('--table', default=os.environ.get('RAW_TABLE', 'predict_age_full_evaluation_raw_378m'))
+    parity_parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.command == 'sql':
+        print(f'-- {SPEC_VERSION}')
+        print('SELECT\n    id,\n    ' + ',\n    '.join(select_expressions()))
+    elif args.command == 'ctas':
+        ctas(args.source, args.table, args.location)
+    elif args.command == 'parity':
+        run_parity(args.table, args.rows)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Parsed Feature Store
+Model features parsed once per FEATURE_VERSION and shared by batch prediction
+and training, so profiles are not re-parsed from raw JSON on every run.
+
+Layout (under permanent/, never removed by cleanup), one file per writer and id range:
+  predict-age/permanent/feature-store/{FEATURE_VERSION}/{raw_table}_ids_{id_min}_{id_max}.parquet
+  id, input_hash, the 21 model features, the spec's intermediates (parsed dates,
+  graduation year, tenure fallback), reference_date
+
+input_hash is incremental.input_hashes over the profile's raw feature inputs;
+a stored row is only used while the profile still hashes the same. The time
+features (TIME_FEATURE_COLUMNS) are stored as of reference_date for training;
+prediction reads the static entries (STATIC_COLUMNS: static features and
+intermediates) and recomputes the time features (feature_spec.compute_time_features)
+- date parsing costs as much as the JSON parsing.
+
+Writers:
+  - build: parse every row of a raw table (or an id range of it)
+  - prediction batches with FEATURE_STORE=true rewrite their range's file when
+    they had to parse profiles that were missing or stale in the store
+Readers:
+  - read_features(): column projection + id range filter (newest file wins for an id)
+  - training: Athena table predict_age_feature_store (register), FEATURES_TABLE in the training task
+
+FEATURE_VERSION is the feature spec's hash (feature_spec.SPEC_VERSION): any change
+to a feature definition starts from an empty prefix, filled by build.
+
+Usage:
+  python feature_store.py build --table predict_age_training_raw_14m --ranges 8
+  python feature_store.py build --table predict_age_training_raw_14m   # Ranges sized to the task memory
+  python feature_store.py build --table predict_age_full_evaluation_raw_378m --id-min 1000 --id-max 5000000
+  python feature_store.py register     # (Re)create the Athena table over this FEATURE_VERSION
+  python feature_store.py bench --rows 100000 --changed 0.1
+"""
+
+import os
+import re
+import math
+import sys
+import json
+import time
+import argparse
+import logging
+from io import BytesIO
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from feature_spec import SPEC_VERSION, FEATURE_COLUMNS, STATIC_COLUMNS, INTERMEDIATE_COLUMNS, DATE_COLUMNS
+from resources import chunk_rows, log_settings
+from aws_retry import call_with_retries, get_bytes
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Environment variables
+S3_BUCKET = os.environ.get('S3_BUCKET')
+DATABASE_NAME = os.environ.get('DATABASE_NAME', 'ml_predict_age')
+WORKGROUP = os.environ.get('WORKGROUP', 'ai-agent-predict-age')
+FEATURE_STORE = os.environ.get('FEATURE_STORE', 'false').lower() == 'true'
+BUILD_ROW_BYTES = 2000  # Peak memory per raw row in build (CSV-read object columns, features, intermediates, hashes)
+
+FEATURE_VERSION = SPEC_VERSION
+STORE_PREFIX = 'predict-age/permanent/feature-store'
+STORE_TABLE = 'predict_age_feature_store'
+STORE_KEY_PATTERN = re.compile(r'ids_(-?\d+)_(-?\d+)\.parquet$')
+
+def store_key(source, id_min, id_max, version=FEATURE_VERSION):
+    return f'{STORE_PREFIX}/{version}/{source}_ids_{id_min}_{id_max}.parquet'
+
+# Parquet writer options of store files (dates as millisecond timestamps)
+TIMESTAMP_OPTIONS = {'coerce_timestamps': 'ms', 'allow_truncated_timestamps': True}
+
+def features_frame(df_features, reference_date):
+    """
+    Store file rows: id and input_hash as int64 (Athena has no unsigned types),
+    features as double, dates as timestamps
+    """
+    df = pd.DataFrame({
+        'id': df_features['id'].values.astype('int64'),
+        'input_hash': np.asarray(df_features['input_hash'].values, dtype='uint64').view('int64')
+    })
+    for column in FEATURE_COLUMNS + INTERMEDIATE_COLUMNS:
+        if column in DATE_COLUMNS:
+            df[column] = pd.to_datetime(df_features[column].values)
+        else:
+            df[column] = df_features[column].values.astype('float64')
+    df['reference_date'] = reference_date
+    return df
+
+def features_to_parquet(df_features, reference_date, compression='snappy'):
+    """Store file bytes (features_frame rows, dates as millisecond timestamps)"""
+    buffer = BytesIO()
+    features_frame(df_features, reference_date).to_parquet(buffer, index=False, compression=compression, **TIMESTAMP_OPTIONS)
+    return buffer.getvalue()
+
+def read_parquet_bytes(body, columns=None, id_min=None, id_max=None):
+    """One store file: only the requested columns (plus id) and ids in [id_min, id_max]"""
+    import pyarrow.parquet as pq
+
+    filters = []
+    if id_min is not None:
+        filters.append(('id', '>=', int(id_min)))
+    if id_max is not None:
+        filters.append(('id', '<=', int(id_max)))
+    projection = None if columns is None else ['id'] + [column for column in columns if column != 'id']
+    df = pq.read_table(BytesIO(body), columns=projection, filters=filters or None).to_pandas()
+    if 'input_hash' in df:
+        df['input_hash'] = df['input_hash'].values.astype('int64').view('uint64')
+    return df
+
+def read_features(s3_client, bucket, columns=None, id_min=None, id_max=None, version=FEATURE_VERSION):
+    """
+    Stored feature rows for ids in [id_min, id_max] (either bound optional), with
+    only the requested columns (None = all). Files whose id range does not
+    overlap are not fetched; if several files hold an id, the newest wins.
+    """
+    def list_objects():
+        paginator = s3_client.get_paginator('list_objects_v2')
+        return [obj for page in paginator.paginate(Bucket=bucket, Prefix=f'{STORE_PREFIX}/{version}/')
+                for obj in page.get('Contents', [])]
+
+    files = []
+    for obj in call_with_retries(list_objects, f"LIST s3://{bucket}/{STORE_PREFIX}/{version}/"):
+        match = STORE_KEY_PATTERN.search(obj['Key'])
+        if not match:
+            continue
+        if (id_min is not None and int(match.group(2)) < id_min) or (id_max is not None and int(match.group(1)) > id_max):
+            continue
+        files.append(obj)
+
+    frames = []
+    for obj in sorted(files, key=lambda obj: obj['LastModified']):
+        frames.append(read_parquet_bytes(get_bytes(s3_client, bucket, obj['Key']), columns, id_min, id_max))
+    if not frames:
+        return pd.DataFrame(columns=['id'] + [column for column in (columns or []) if column != 'id'])
+    df = pd.concat(frames, ignore_index=True)
+    return df.drop_duplicates('id', keep='last') if len(frames) > 1 else df
+
+def split_stored(ids, hashes, stored):
+    """
+    Match a batch's ids and current input hashes against stored rows.
+    Returns (stored rows still valid, boolean mask of ids that need parsing).
+    """
+    current = pd.DataFrame({'id': np.asarray(ids, dtype='int64'), 'input_hash': np.asarray(hashes, dtype='uint64')})
+    if len(stored) == 0:
+        return stored.drop(columns='input_hash', errors='ignore'), np.ones(len(current), dtype=bool)
+    valid = current.merge(stored.astype({'id': 'int64', 'input_hash': 'uint64'}), on=['id', 'input_hash'], how='inner')
+    needs_parse = ~np.isin(current['id'].values, valid['id'].values)
+    return valid.drop(columns='input_hash'), needs_parse
+
+def write_features(s3_client, bucket, source, id_min, id_max, df_features, reference_date=None,
+                   version=FEATURE_VERSION, compression='snappy'):
+    """Write (replace) the store file for one writer and id range; df_features needs id, input_hash, FEATURE_COLUMNS and INTERMEDIATE_COLUMNS"""
+    reference_date = reference_date or datetime.now().strftime('%Y-%m-%d')
+    key = store_key(source, id_min, id_max, version)
+    body = features_to_parquet(df_features, reference_date, compression)
+    call_with_retries(lambda: s3_client.put_object(Bucket=bucket, Key=key, Body=body), f"PUT s3://{bucket}/{key}")
+    logger.info(f"Feature store: {len(df_features)} rows -> s3://{bucket}/{key}")
+    return key
+
+def upload_features(s3_client, bucket, source, id_min, id_max, path, rows, version=FEATURE_VERSION):
+    """Upload (replace) the store file for one writer and id range from a local file of features_frame rows"""
+    key = store_key(source, id_min, id_max, version)
+    call_with_retries(lambda: s3_client.upload_file(path, bucket, key), f"PUT s3://{bucket}/{key}")
+    logger.info(f"Feature store: {rows} rows -> s3://{bucket}/{key}")
+    return key
+
+def run_query(athena_client, query, poll_sec=2):
+    """Run an Athena query to completion and return its execution id"""
+    response = athena_client.start_query_execution(
+        QueryString=query,
+        QueryExecutionContext={'Database': DATABASE_NAME},
+        WorkGroup=WORKGROUP,
+        ResultConfiguration={'OutputLocation': f's3://{S3_BUCKET}/athena-results/'}
+    )
+    query_id = response['QueryExecutionId']
+    while True:
+        status_response = athena_client.get_query_execution(QueryExecutionId=query_id)
+        status = status_response['QueryExecution']['Status']['State']
+        if status == 'SUCCEEDED':
+            return query_id
+        elif status in ['FAILED', 'CANCELLED']:
+            reason = status_response['QueryExecution']['Status'].get('StateChangeReason', 'Unknown')
+            raise Exception(f"Query {status}: {reason}")
+        time.sleep(poll_sec)
+
+def read_query_csv(s3_client, query_id):
+    obj = s3_client.get_object(Bucket=S3_BUCKET, Key=f'athena-results/{query_id}.csv')
+    return pd.read_csv(BytesIO(obj['Body'].read()))
+
+def build(table, id_min=None, id_max=None, ranges=None):
+    """
+    Parse every row of a raw table (or [id_min, id_max]) in `ranges` equal-width id
+    ranges and write them to the store; ranges None: as many as keep one range's
+    rows within the task's memory budget (resources.py)
+    """
+    import boto3
+    from prediction import create_features_from_raw
+    from incremental import input_hashes
+
+    if not S3_BUCKET:
+        raise ValueError("S3_BUCKET environment variable is required")
+
+    start_time = time.time()
+    s3_client = boto3.client('s3')
+    athena_client = boto3.client('athena')
+
+    if id_min is None or id_max is None or ranges is None:
+        conditions = ['id IS NOT NULL'] + ([f'CAST(id AS BIGINT) >= {id_min}'] if id_min is not None else []) \
+            + ([f'CAST(id AS BIGINT) <= {id_max}'] if id_max is not None else [])
+        bounds = read_query_csv(s3_client, run_query(
+            athena_client, f"SELECT MIN(CAST(id AS BIGINT)) AS id_min, MAX(CAST(id AS BIGINT)) AS id_max, COUNT(*) AS num_rows "
+                           f"FROM {DATABASE_NAME}.{table} WHERE {' AND '.join(conditions)}"))
+        id_min = int(bounds['id_min'][0]) if id_min is None else id_min
+        id_max = int(bounds['id_max'][0]) if id_max is None else id_max
+    if ranges is None:
+        range_rows = chunk_rows(BUILD_ROW_BYTES, maximum=None)
+        ranges = max(1, math.ceil(int(bounds['num_rows'][0]) / range_rows))
+        log_settings('feature store build', {'range_rows': range_rows, 'ranges': ranges})
+
+    edges = np.linspace(id_min, id_max + 1, ranges + 1).astype('int64')
+    rows = 0
+    for low, high in zip(edges[:-1], edges[1:] - 1):
+        query_id = run_query(athena_client, f"""
+        SELECT *
+        FROM {DATABASE_NAME}.{table}
+        WHERE id IS NOT NULL
+        AND CAST(id AS BIGINT) BETWEEN {low} AND {high}
+        """)
+        df_raw = read_query_csv(s3_client, query_id)
+        if len(df_raw) == 0:
+            continue
+        df_features = create_features_from_raw(df_raw, with_intermediates=True)
+        df_features['input_hash'] = input_hashes(df_raw)
+        write_features(s3_client, S3_BUCKET, table, int(low), int(high), df_features)
+        rows += len(df_features)
+
+    logger.info(f"✅ Feature store {FEATURE_VERSION}: {rows:,} rows of {table} written in {time.time() - start_time:.1f}s")
+    return rows
+
+def register():
+    """(Re)create the Athena table over this FEATURE_VERSION (read by training with FEATURES_TABLE)"""
+    import boto3
+
+    athena_client = boto3.client('athena')
+    columns = ',\n        '.join(['id bigint', 'input_hash bigint']
+                                  + [f"{column} {'timestamp' if column in DATE_COLUMNS else 'double'}"
+                                     for column in FEATURE_COLUMNS + INTERMEDIATE_COLUMNS] + ['reference_date string'])
+    run_query(athena_client, f"DROP TABLE IF EXISTS {DATABASE_NAME}.{STORE_TABLE}")
+    run_query(athena_client, f"""
+    CREATE EXTERNAL TABLE {DATABASE_NAME}.{STORE_TABLE} (
+        {columns}
+    )
+    STORED AS PARQUET
+    LOCATION 's3://{S3_BUCKET}/{STORE_PREFIX}/{FEATURE_VERSION}/'
+    """)
+    logger.info(f"✅ {DATABASE_NAME}.{STORE_TABLE} -> s3://{S3_BUCKET}/{STORE_PREFIX}/{FEATURE_VERSION}/")
+
+def run_benchmark(rows, changed):
+    """
+    One batch: parse every profile vs hash + read the batch's store file (static
+    entries) + recompute time features, parsing only the changed profiles.
+    Run in the prediction image (prediction.py needs S3_BUCKET).
+    """
+    from prediction import create_features_from_raw
+    from feature_spec import compute_time_features
+    from incremental import input_hashes, synthetic_raw
+
+    df_raw = synthetic_raw(rows, seed=1)
+    df_written = create_features_from_raw(df_raw, with_intermediates=True)
+    df_written['input_hash'] = input_hashes(df_raw)
+    body = features_to_parquet(df_written, '2025-07-01')
+    # Changed profiles since the store was written
+    changed_rows = np.random.default_rng(2).random(rows) < changed
+    df_raw.loc[changed_rows, 'job_title'] = 'Director'
+
+    start = time.time()
+    create_features_from_raw(df_raw)
+    parse_sec = time.time() - start
+
+    start = time.time()
+    stored = read_parquet_bytes(body, ['input_hash'] + STATIC_COLUMNS,
+                                df_raw['id'].min(), df_raw['id'].max())
+    read_sec = time.time() - start
+    df_stored, needs_parse = split_stored(df_raw['id'].values, input_hashes(df_raw), stored)
+    df_stored = compute_time_features(df_stored)
+    if needs_parse.any():
+        create_features_from_raw(df_raw[needs_parse])
+    store_sec = time.time() - start
+
+    results = {
+        'rows': rows,
+        'changed_fraction': changed,
+        'parsed': int(needs_parse.sum()),
+        'read_from_store': len(df_stored),
+        'store_file_mb': round(len(body) / 1e6, 2),
+        'parse_all_sec': round(parse_sec, 2),
+        'store_sec': round(store_sec, 2),
+        'store_read_sec': round(read_sec, 3),
+        'speedup': round(parse_sec / store_sec, 2)
+    }
+    logger.info(f"Benchmark results: {json.dumps(results, indent=2)}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Parsed feature store (write once per FEATURE_VERSION)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='Parse a raw table (or an id range of it) into the store')
+    build_parser.add_argument('--table', default=os.environ.get('RAW_TABLE', 'predict_age_training_raw_14m'))
+    build_parser.add_argument('--id-min', type=int)
+    build_parser.add_argument('--id-max', type=int)
+    build_parser.add_argument('--ranges', type=int, help='Equal-width id ranges (one Athena query and file each); '
+                                                        'default: sized to the task memory')
+    subparsers.add_parser('register', help='Create the Athena table over this FEATURE_VERSION')
+    bench_parser = subparsers.add_parser('bench', help='Parse vs feature store read for one batch')
+    bench_parser.add_argument('--rows', type=int, default=100000)
+    bench_parser.add_argument('--changed', type=float, default=0.1, help='Fraction of profiles changed since the store was written')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build(args.table, args.id_min, args.id_max, args.ranges)
+    elif args.command == 'register':
+        register()
+    elif args.command == 'bench':
+        run_benchmark(args.rows, args.changed)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
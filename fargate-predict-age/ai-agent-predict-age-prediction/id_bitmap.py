@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Needs-Prediction Id Bitmap
+Compressed (roaring-style) set of ids with no known age (birth_year IS NULL AND
+approximate_age IS NULL), built ONCE per run so batch planning, the prediction
+reader and map-side final assembly don't rescan the raw table.
+
+Layout (roaring-style, ids split into 2^16-id containers by id >> 16):
+- sparse containers (<= 4096 ids): sorted uint16 low bits
+- dense containers  (>  4096 ids): 1024 x uint64 bitmap (8 KB)
+
+Stored under s3://{S3_BUCKET}/predict-age/needs-prediction/{YYYYQQ}/:
+  needs_prediction.npz   bitmap containers
+  summary.json           counts, total_batches and per-batch work (read by batch_generator)
+  ranges.csv             id-range batches with exact per-batch counts (batch plan manifest)
+
+The ids are sorted and deduplicated once after the UNLOAD; the bitmap, the batch
+counts and the ranges are all built from that one array. With RESUME, a bitmap
+whose summary the current batch plan was built from is kept (GenerateBatchIds
+reuses that plan, so a rebuild would only repeat the UNLOAD).
+
+plan_batch_count, the batch plan manifest CSV and S3PrefixDeleter come from the
+shared Lambda layer (copied into the image, see the Dockerfile).
+
+Usage:
+  python id_bitmap.py
+"""
+
+import os
+import json
+import math
+import time
+import logging
+from io import BytesIO
+from datetime import datetime
+import numpy as np
+from aws_retry import get_bytes
+from batch_manifest import plan_batch_count, write_batch_manifest
+from s3_delete import S3PrefixDeleter
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Environment variables
+S3_BUCKET = os.environ.get('S3_BUCKET')
+DATABASE_NAME = os.environ.get('DATABASE_NAME', 'ml_predict_age')
+WORKGROUP = os.environ.get('WORKGROUP', 'ai-agent-predict-age')
+RAW_TABLE = os.environ.get('RAW_TABLE', 'predict_age_training_raw_14m')
+YYYYQQ = os.environ.get('YYYYQQ', 'YYYYQQ')
+TARGET_ROWS_PER_BATCH = int(os.environ.get('TARGET_ROWS_PER_BATCH', '420962'))
+MAX_CONCURRENCY = int(os.environ.get('MAX_CONCURRENCY', '500'))
+RESUME = os.environ.get('RESUME', 'true').lower() == 'true'
+
+BITMAP_PREFIX = f'predict-age/needs-prediction/{YYYYQQ}'
+BITMAP_KEY = f'{BITMAP_PREFIX}/needs_prediction.npz'
+SUMMARY_KEY = f'{BITMAP_PREFIX}/summary.json'
+RANGES_KEY = f'{BITMAP_PREFIX}/ranges.csv'
+PLAN_KEY = f'predict-age/plans/{YYYYQQ}/batch_plan.json'  # Written by batch_generator
+
+CONTAINER_BITS = 16
+ARRAY_CONTAINER_MAX = 4096  # Above this a 8 KB bitmap is smaller than a uint16 array
+WORDS_PER_BITMAP = (1 << CONTAINER_BITS) // 64
+PLAN_CHUNK_IDS = 1 << 22  # Ids per bincount pass in plan_batches (bounds the modulo temporaries)
+
+class IdBitmap:
+    """Roaring-style compressed set of non-negative 64-bit ids"""
+
+    def __init__(self, array_keys, array_offsets, array_lows, bitmap_keys, bitmap_words):
+        self.array_keys = array_keys        # uint64 high keys of sparse containers
+        self.array_offsets = array_offsets  # int64, len(array_keys) + 1
+        self.array_lows = array_lows        # uint16 low bits, concatenated
+        self.bitmap_keys = bitmap_keys      # uint64 high keys of dense containers
+        self.bitmap_words = bitmap_words    # uint64, shape (len(bitmap_keys), 1024)
+
+        # Rank-prefixed low bits give one monotonic array for vectorized membership
+        ranks = np.repeat(np.arange(len(array_keys), dtype=np.uint64), np.diff(array_offsets))
+        self._array_index = (ranks << np.uint64(CONTAINER_BITS)) | array_lows.astype(np.uint64)
+
+    @classmethod
+    def from_ids(cls, ids):
+        """Build from an array of ids (any order, duplicates allowed)"""
+        return cls.from_sorted_ids(np.unique(np.asarray(ids, dtype=np.uint64)))
+
+    @classmethod
+    def from_sorted_ids(cls, ids):
+        """Build from sorted uint64 ids without duplicates (containers are runs of equal high bits)"""
+        high = ids >> np.uint64(CONTAINER_BITS)
+        boundaries = np.flatnonzero(np.diff(high)) + 1
+        starts = np.concatenate([[0], boundaries]).astype(np.int64) if len(ids) else boundaries
+        keys = high[starts]
+        counts = np.diff(np.append(starts, len(ids)))
+        del high
+        low = ids.astype(np.uint16)  # Truncation keeps the low 16 bits
+        dense = counts > ARRAY_CONTAINER_MAX
+
+        # Sparse containers keep their sorted low bits
+        sparse_mask = np.repeat(~dense, counts)
+        array_counts = counts[~dense]
+        array_offsets = np.concatenate([[0], np.cumsum(array_counts)]).astype(np.int64)
+
+        # Dense containers become 1024-word bitmaps
+        bitmap_keys = keys[dense]
+        bitmap_words = np.zeros((len(bitmap_keys), WORDS_PER_BITMAP), dtype=np.uint64)
+        dense_lows = low[~sparse_mask].astype(np.uint64)
+        dense_rank = np.repeat(np.arange(len(bitmap_keys)), counts[dense])
+        np.bitwise_or.at(
+            bitmap_words,
+            (dense_rank, (dense_lows >> np.uint64(6)).astype(np.int64)),
+            np.uint64(1) << (dense_lows & np.uint64(63))
+        )
+
+        return cls(keys[~dense], array_offsets, low[sparse_mask], bitmap_keys, bitmap_words)
+
+    def __len__(self):
+        dense_count = int(np.unpackbits(self.bitmap_words.view(np.uint8)).sum())
+        return len(self.array_lows) + dense_count
+
+    def contains(self, ids):
+        """Vectorized membership test. Returns a bool array aligned with ids."""
+        ids = np.asarray(ids, dtype=np.uint64)
+        high = ids >> np.uint64(CONTAINER_BITS)
+        low = ids & np.uint64(0xFFFF)
+        found = np.zeros(len(ids), dtype=bool)
+
+        # Sparse containers: binary search on (rank << 16 | low)
+        if len(self.array_keys):
+            rank = np.searchsorted(self.array_keys, high)
+            hit = rank < len(self.array_keys)
+            hit[hit] = self.array_keys[rank[hit]] == high[hit]
+            probe = (rank[hit].astype(np.uint64) << np.uint64(CONTAINER_BITS)) | low[hit]
+            pos = np.searchsorted(self._array_index, probe)
+            in_range = pos < len(self._array_index)
+            match = np.zeros(len(probe), dtype=bool)
+            match[in_range] = self._array_index[pos[in_range]] == probe[in_range]
+            found[np.flatnonzero(hit)[match]] = True
+
+        # Dense containers: bit test
+        if len(self.bitmap_keys):
+            rank = np.searchsorted(self.bitmap_keys, high)
+            hit = rank < len(self.bitmap_keys)
+            hit[hit] = self.bitmap_keys[rank[hit]] == high[hit]
+            words = self.bitmap_words[rank[hit], (low[hit] >> np.uint64(6)).astype(np.int64)]
+            bits = (words >> (low[hit] & np.uint64(63))) & np.uint64(1)
+            found[np.flatnonzero(hit)[bits.astype(bool)]] = True
+
+        return found
+
+    def to_bytes(self):
+        """Serialize to .npz bytes"""
+        buffer = BytesIO()
+        np.savez(
+            buffer,
+            array_keys=self.array_keys,
+            array_offsets=self.array_offsets,
+            array_lows=self.array_lows,
+            bitmap_keys=self.bitmap_keys,
+            bitmap_words=self.bitmap_words
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Deserialize from .npz bytes"""
+        npz = np.load(BytesIO(data))
+        return cls(npz['array_keys'], npz['array_offsets'], npz['array_lows'],
+                   npz['bitmap_keys'], npz['bitmap_words'])
+
+def plan_batches(ids, target_rows_per_batch=TARGET_ROWS_PER_BATCH, max_concurrency=MAX_CONCURRENCY):
+    """
+    Size MOD batches by actual work (needs-prediction ids), not raw id count, with the
+    batch_generator rule (plan_batch_count), so the per-batch counts line up with its plan.
+    Counted PLAN_CHUNK_IDS ids at a time: the modulo never copies the whole array.
+    """
+    total_batches = plan_batch_count(len(ids), target_rows_per_batch, max_concurrency)
+    batch_counts = np.zeros(total_batches, dtype=np.int64)
+    for start in range(0, len(ids), PLAN_CHUNK_IDS):
+        batch_ids = (ids[start:start + PLAN_CHUNK_IDS] % np.uint64(total_batches)).astype(np.int64)
+        batch_counts += np.bincount(batch_ids, minlength=total_batches)
+    return total_batches, batch_counts
+
+def plan_ranges(ids, total_batches):
+    """
+    Split the needs-prediction ids (sorted, no duplicates) into total_batches contiguous
+    id ranges of equal work. Returns (id_min, id_max, count) arrays; bounds are exact ids,
+    so id BETWEEN id_min AND id_max selects exactly `count` needs-prediction rows.
+    """
+    starts = (np.arange(total_batches, dtype=np.int64) * len(ids)) // total_batches
+    ends = np.append(starts[1:], len(ids))
+    keep = ends > starts  # Fewer ids than batches
+    starts, ends = starts[keep], ends[keep]
+    return ids[starts], ids[ends - 1], ends - starts
+
+def sorted_unique(ids):
+    """Sort ids in place and drop duplicates (copies only when there are any)"""
+    ids.sort()
+    if len(ids) > 1:
+        distinct = np.empty(len(ids), dtype=bool)
+        distinct[0] = True
+        np.not_equal(ids[1:], ids[:-1], out=distinct[1:])
+        if not distinct.all():
+            ids = ids[distinct]
+    return ids
+
+def load_needs_prediction_ids(s3_client, athena_client):
+    """
+    UNLOAD ids with no known age to Parquet and read them back (id column only).
+    Returns them sorted, without duplicates, as uint64.
+    """
+    import pyarrow.parquet as pq
+
+    unload_prefix = f'{BITMAP_PREFIX}/ids/'
+    # UNLOAD requires an empty target location
+    stats = S3PrefixDeleter(s3_client, S3_BUCKET).delete_prefix(unload_prefix)
+    if stats['errors']:
+        raise Exception(f"Could not empty s3://{S3_BUCKET}/{unload_prefix}: {stats['errors'][0]}")
+
+    query = f"""
+    UNLOAD (
+        SELECT CAST(id AS BIGINT) as id
+        FROM {DATABASE_NAME}.{RAW_TABLE}
+        WHERE id IS NOT NULL
+        AND (birth_year IS NULL AND approximate_age IS NULL)
+    )
+    TO 's3://{S3_BUCKET}/{unload_prefix}'
+    WITH (format = 'PARQUET', compression = 'SNAPPY')
+    """
+    response = athena_client.start_query_execution(
+        QueryString=query,
+        QueryExecutionContext={'Database': DATABASE_NAME},
+        WorkGroup=WORKGROUP,
+        ResultConfiguration={'OutputLocation': f's3://{S3_BUCKET}/athena-results/'}
+    )
+    query_id = response['QueryExecutionId']
+    logger.info(f"Athena UNLOAD started: {query_id}")
+
+    while True:
+        status_response = athena_client.get_query_execution(QueryExecutionId=query_id)
+        status = status_response['QueryExecution']['Status']['State']
+        if status == 'SUCCEEDED':
+            break
+        elif status in ['FAILED', 'CANCELLED']:
+            reason = status_response['QueryExecution']['Status'].get('StateChangeReason', 'Unknown')
+            raise Exception(f"Query {status}: {reason}")
+        time.sleep(5)
+
+    chunks = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=unload_prefix):
+        for obj in page.get('Contents', []):
+            body = s3_client.get_object(Bucket=S3_BUCKET, Key=obj['Key'])['Body'].read()
+            chunks.append(pq.read_table(BytesIO(body), columns=['id']).column('id').to_numpy())
+    # One copy: the int64 files land in a uint64 array that is then sorted in place
+    ids = np.concatenate(chunks, dtype=np.uint64, casting='unsafe') if chunks else np.array([], dtype=np.uint64)
+    del chunks
+    ids = sorted_unique(ids)
+    logger.info(f"Loaded {len(ids):,} needs-prediction ids")
+    return ids
+
+def load_bitmap_from_s3(s3_client, summary_only=False):
+    """Load the bitmap and summary for this run, or (None, None) if not built"""
+    try:
+        summary = json.loads(get_bytes(s3_client, S3_BUCKET, SUMMARY_KEY))
+        if summary_only:
+            return None, summary
+        bitmap = IdBitmap.from_bytes(get_bytes(s3_client, S3_BUCKET, BITMAP_KEY))
+        return bitmap, summary
+    except s3_client.exceptions.NoSuchKey:
+        return None, None
+
+def reusable_summary(s3_client):
+    """
+    The summary of this run's bitmap if the current batch plan was built from it with the
+    same settings (a resumed run: GenerateBatchIds will reuse that plan), else None
+    """
+    _, summary = load_bitmap_from_s3(s3_client, summary_only=True)
+    if summary is None:
+        return None
+    try:
+        plan = json.loads(get_bytes(s3_client, S3_BUCKET, PLAN_KEY))
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    settings = (RAW_TABLE, TARGET_ROWS_PER_BATCH, MAX_CONCURRENCY)
+    if (summary['raw_table'], summary['target_rows_per_batch'], summary['max_concurrency']) != settings:
+        return None
+    if (plan.get('sized_by'), plan.get('total_records')) != ('needs_prediction_bitmap', summary['needs_prediction_count']):
+        return None
+    return summary
+
+def build():
+    """Build the needs-prediction bitmap and per-batch work summary, and save both to S3"""
+    import boto3
+
+    if not S3_BUCKET:
+        raise ValueError("S3_BUCKET environment variable is required")
+
+    start_time = time.time()
+    s3_client = boto3.client('s3')
+    athena_client = boto3.client('athena')
+
+    if RESUME:
+        summary = reusable_summary(s3_client)
+        if summary:
+            logger.info(f"Batch plan was built from the bitmap of {summary['created_at']} "
+                        f"({summary['needs_prediction_count']:,} ids), keeping it")
+            return summary
+
+    ids = load_needs_prediction_ids(s3_client, athena_client)
+    bitmap = IdBitmap.from_sorted_ids(ids)
+    total_batches, batch_counts = plan_batches(ids)
+
+    bitmap_bytes = bitmap.to_bytes()
+    s3_client.put_object(Bucket=S3_BUCKET, Key=BITMAP_KEY, Body=bitmap_bytes)
+
+    range_min, range_max, range_counts = plan_ranges(ids, total_batches)
+    write_batch_manifest(s3_client, S3_BUCKET, RANGES_KEY, list(zip(range_min.tolist(), range_max.tolist())),
+                         range_counts.tolist())
+
+    summary = {
+        'raw_table': RAW_TABLE,
+        'needs_prediction_count': int(len(ids)),
+        'target_rows_per_batch': TARGET_ROWS_PER_BATCH,
+        'max_concurrency': MAX_CONCURRENCY,
+        'total_batches': total_batches,
+        'batch_counts': batch_counts.tolist(),
+        'ranges_key': RANGES_KEY,
+        'range_batches': int(len(range_counts)),
+        'array_containers': int(len(bitmap.array_keys)),
+        'bitmap_containers': int(len(bitmap.bitmap_keys)),
+        'bitmap_bytes': len(bitmap_bytes),
+        'created_at': datetime.now().isoformat()
+    }
+    s3_client.put_object(
+        Bucket=S3_BUCKET,
+        Key=SUMMARY_KEY,
+        Body=json.dumps(summary),
+        ContentType='application/json'
+    )
+
+    logger.info(f"✅ Needs-prediction bitmap saved to s3://{S3_BUCKET}/{BITMAP_KEY}")
+    logger.info(f"   {len(ids):,} ids, {len(bitmap_bytes) / (1024 * 1024):.1f} MB, "
+                f"{total_batches} batches of ~{math.ceil(len(ids) / total_batches):,} rows")
+    logger.info(f"   Built in {time.time() - start_time:.2f}s")
+    return summary
+
+if __name__ == '__main__':
+    build()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Incremental Quarterly Prediction
+Most profiles do not change between quarters. With INCREMENTAL=true each
+id-range batch hashes the raw columns the feature spec reads; ids whose
+hash and MODEL_VERSION match the previous quarter's prediction cache carry that
+prediction forward, and only new or changed ids go through JSON parsing,
+feature creation and inference.
+
+Cache (kept across runs, one file per id-range batch):
+  predict-age/prediction-cache/{YYYYQQ}/ids_{id_min}_{id_max}.parquet
+  id, input_hash, predicted_age, confidence_score, model_version, prediction_ts, predicted_yyyyqq
+
+Time-dependent features (tenure, days since profile update, quarter) are derived
+from the run date, not stored in the profile, so they are not part of the hash:
+a carried prediction keeps the reference date it was computed at. Predictions
+computed MAX_CARRY_QUARTERS or more quarters ago are recomputed; bump
+MODEL_VERSION in prediction.py to recompute everything.
+
+Usage:
+  python incremental.py bench --rows 420962 --changed 0.1   # Hash + carry-forward vs full feature/inference time
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import logging
+from io import BytesIO
+import numpy as np
+import pandas as pd
+from feature_spec import INPUT_COLUMNS
+from aws_retry import call_with_retries, get_bytes
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Environment variables
+INCREMENTAL = os.environ.get('INCREMENTAL', 'false').lower() == 'true'
+MAX_CARRY_QUARTERS = int(os.environ.get('MAX_CARRY_QUARTERS', '4'))
+
+CACHE_PREFIX = 'predict-age/prediction-cache'
+CACHE_KEY_PATTERN = re.compile(r'ids_(-?\d+)_(-?\d+)\.parquet$')
+CACHE_COLUMNS = ['id', 'input_hash', 'predicted_age', 'confidence_score', 'model_version',
+                 'prediction_ts', 'predicted_yyyyqq']
+
+# Every raw column the feature spec reads
+FEATURE_INPUT_COLUMNS = INPUT_COLUMNS
+
+def parse_quarter(yyyyqq):
+    """'2025q3' -> (2025, 3); None if not a quarter id"""
+    match = re.fullmatch(r'(\d{4})[qQ]([1-4])', str(yyyyqq))
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+def previous_quarter(yyyyqq):
+    """The quarter before yyyyqq in the same format ('2025q1' -> '2024q4'), or None"""
+    parsed = parse_quarter(yyyyqq)
+    if not parsed:
+        return None
+    year, quarter = parsed
+    year, quarter = (year - 1, 4) if quarter == 1 else (year, quarter - 1)
+    return f"{year}{yyyyqq[4]}{quarter}"
+
+def quarters_between(earlier, later):
+    """Whole quarters from earlier to later (None if either is not a quarter id)"""
+    a, b = parse_quarter(earlier), parse_quarter(later)
+    if not a or not b:
+        return None
+    return (b[0] - a[0]) * 4 + (b[1] - a[1])
+
+def input_hashes(df_raw):
+    """
+    uint64 hash per row of the feature input columns. Values are normalized so
+    the hash does not depend on CSV type inference: numeric columns as float64
+    (500 == 500.0), everything else as strings with '' for missing.
+    """
+    normalized = {}
+    for column in FEATURE_INPUT_COLUMNS:
+        values = df_raw[column] if column in df_raw else pd.Series([''] * len(df_raw), index=df_raw.index)
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            normalized[column] = values.astype('float64')
+        else:
+            normalized[column] = values.astype(object).where(values.notna(), '').astype(str)
+    return pd.util.hash_pandas_object(pd.DataFrame(normalized), index=False).values
+
+def cache_key(yyyyqq, id_min, id_max):
+    return f'{CACHE_PREFIX}/{yyyyqq}/ids_{id_min}_{id_max}.parquet'
+
+def load_previous_predictions(s3_client, bucket, yyyyqq, id_min, id_max):
+    """Cached predictions of quarter yyyyqq for ids in [id_min, id_max] (any batch layout)"""
+    def list_keys():
+        paginator = s3_client.get_paginator('list_objects_v2')
+        return [obj['Key'] for page in paginator.paginate(Bucket=bucket, Prefix=f'{CACHE_PREFIX}/{yyyyqq}/')
+                for obj in page.get('Contents', [])]
+
+    frames = []
+    for key in call_with_retries(list_keys, f"LIST s3://{bucket}/{CACHE_PREFIX}/{yyyyqq}/"):
+        match = CACHE_KEY_PATTERN.search(key)
+        if not match or int(match.group(2)) < id_min or int(match.group(1)) > id_max:
+            continue
+        df = pd.read_parquet(BytesIO(get_bytes(s3_client, bucket, key)))
+        frames.append(df[(df['id'] >= id_min) & (df['id'] <= id_max)])
+    if not frames:
+        return pd.DataFrame(columns=CACHE_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+def split_carried(ids, hashes, previous, model_version, yyyyqq, max_carry_quarters=MAX_CARRY_QUARTERS):
+    """
+    Match this batch's ids against the previous quarter's cache.
+    Returns (carried cache rows, boolean mask of ids that still need the model).
+    """
+    current = pd.DataFrame({'id': np.asarray(ids, dtype='int64'), 'input_hash': np.asarray(hashes, dtype='uint64')})
+    if len(previous) == 0:
+        return previous.iloc[0:0], np.ones(len(current), dtype=bool)
+
+    previous = previous[previous['model_version'] == model_version]
+    age = previous['predicted_yyyyqq'].map(lambda quarter: quarters_between(quarter, yyyyqq))
+    previous = previous[age.notna() & (age < max_carry_quarters)]
+
+    carried = current.merge(previous.astype({'input_hash': 'uint64'}), on=['id', 'input_hash'], how='inner')
+    needs_model = ~np.isin(current['id'].values, carried['id'].values)
+    return carried[CACHE_COLUMNS], needs_model
+
+def write_prediction_cache(s3_client, bucket, yyyyqq, id_min, id_max, path, rows):
+    """
+    Upload this batch's cache file (new and carried predictions with their input
+    hashes, CACHE_COLUMNS) from the local Parquet file the pipeline wrote
+    """
+    key = cache_key(yyyyqq, id_min, id_max)
+    call_with_retries(lambda: s3_client.upload_file(path, bucket, key), f"PUT s3://{bucket}/{key}")
+    logger.info(f"Prediction cache: {rows} rows -> s3://{bucket}/{key}")
+    return key
+
+def synthetic_raw(rows, seed):
+    """Raw rows with the feature input columns, shaped like the 378M table"""
+    rng = np.random.default_rng(seed)
+    years = rng.integers(1995, 2024, rows)
+    return pd.DataFrame({
+        'id': np.arange(rows, dtype='int64') * 7 + 1000003,
+        'education': [f'[{{"degree": "Bachelor", "end_date": {y}}}]' for y in years],
+        'work_experience': [f'[{{"start_date": "{y}-01-01", "end_date": "{y + 3}-06-01"}}, {{"start_date": "{y + 3}-07-01"}}]'
+                            for y in years],
+        'skills': ['["python", "sql", "excel"]'] * rows,
+        'job_level': rng.choice(['Staff', 'Manager', 'C-Team', ''], rows),
+        'job_title': rng.choice(['Engineer', 'Sales Manager', 'VP Marketing', 'CEO'], rows),
+        'compensation_range': rng.choice(['$50-75k', '$100-150k', '$250k+'], rows),
+        'employee_range': rng.choice(['11-50', '201-500', '10000+'], rows),
+        'linkedin_connection_count': rng.integers(0, 1000, rows),
+        'ev_last_date': pd.to_datetime(rng.integers(1.6e9, 1.75e9, rows), unit='s').strftime('%Y-%m-%d'),
+        'linkedin_url_is_valid': rng.choice(['true', 'false'], rows),
+        'facebook_url': rng.choice(['', 'https://facebook.com/x'], rows),
+        'twitter_url': rng.choice(['', 'https://twitter.com/x'], rows),
+        'work_email': rng.choice(['', 'a@b.com'], rows),
+        'personal_email': rng.choice(['', 'a@c.com'], rows),
+        'industry': rng.choice(['Technology', 'Finance', 'Retail'], rows),
+        'job_function': rng.choice(['Engineering', 'Sales', 'Other'], rows),
+        'revenue_range': rng.choice(['$1-10M', '$1B+'], rows),
+        'job_start_date': [f'{y + 3}-07-01' for y in years]
+    })
+
+def run_benchmark(rows, changed):
+    """
+    One batch, previous quarter cached: full features + inference for every row vs
+    hash + cache match + features + inference for the changed rows only.
+    Inference is timed with a stand-in (a dot product per model), so the speedup
+    is a lower bound. Run in the prediction image (prediction.py needs S3_BUCKET).
+    """
+    from prediction import create_features_from_raw
+
+    def infer(features):
+        X = features.drop('id', axis=1).values.astype('float64')
+        weights = np.linspace(0.1, 1.0, X.shape[1])
+        return np.clip(np.round(X @ weights), 18, 75), np.abs(X @ weights[::-1]) / 100
+
+    df_raw = synthetic_raw(rows, seed=1)
+    previous = pd.DataFrame({
+        'id': df_raw['id'].values,
+        'input_hash': input_hashes(df_raw),
+        'predicted_age': 40,
+        'confidence_score': 5.0,
+        'model_version': 'bench',
+        'prediction_ts': '2025-07-01T00:00:00',
+        'predicted_yyyyqq': '2025q2'
+    })
+    # Changed profiles this quarter
+    changed_rows = np.random.default_rng(2).random(rows) < changed
+    df_raw.loc[changed_rows, 'job_title'] = 'Director'
+
+    start = time.time()
+    infer(create_features_from_raw(df_raw))
+    full_sec = time.time() - start
+
+    start = time.time()
+    hashes = input_hashes(df_raw)
+    hash_sec = time.time() - start
+    carried, needs_model = split_carried(df_raw['id'].values, hashes, previous, 'bench', '2025q3')
+    if needs_model.any():
+        infer(create_features_from_raw(df_raw[needs_model]))
+    incremental_sec = time.time() - start
+
+    results = {
+        'rows': rows,
+        'changed_fraction': changed,
+        'recomputed': int(needs_model.sum()),
+        'carried_forward': len(carried),
+        'full_sec': round(full_sec, 2),
+        'incremental_sec': round(incremental_sec, 2),
+        'hash_sec': round(hash_sec, 2),
+        'speedup': round(full_sec / incremental_sec, 2)
+    }
+    logger.info(f"Benchmark results: {json.dumps(results, indent=2)}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Incremental quarterly prediction (input hashing + carry-forward)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    bench_parser = subparsers.add_parser('bench', help='Full vs incremental feature + inference time for one batch')
+    bench_parser.add_argument('--rows', type=int, default=420962)  # One batch
+    bench_parser.add_argument('--changed', type=float, default=0.1, help='Fraction of profiles changed since last quarter')
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        run_benchmark(args.rows, args.changed)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
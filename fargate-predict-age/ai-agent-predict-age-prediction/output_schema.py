@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Compact Prediction Output Schema
+Per-row storage for the ~378M prediction rows:
+
+  column            legacy            compact
+  id                int64             int64
+  predicted_age     int64             int8      (clipped to 18-75)
+  confidence_score  float64           -> confidence_centi int16 (score * 100, 2 dp exact)
+  prediction_ts     string per row    dictionary (one value per batch)
+  model_version     string per row    dictionary
+  batch_id          int64             int16
+
+Athena keeps reading the legacy column names and types: create_predictions_table
+registers the compact files as predict_age_predictions_{YYYYQQ}_compact and exposes
+predict_age_predictions_{YYYYQQ} as a view casting back to int / double.
+
+int8 rather than uint8 and scaled int16 rather than float16: Athena's Parquet reader
+maps signed INT_8/INT_16 to tinyint/smallint directly, while unsigned and FLOAT16
+annotations are not readable by every engine version.
+
+Usage:
+  python output_schema.py bench --rows 420962   # Size and write/read time: legacy vs compact
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Environment variables (must match create_predictions_table's COMPACT_SCHEMA)
+COMPACT_SCHEMA = os.environ.get('COMPACT_SCHEMA', 'true').lower() == 'true'
+OUTPUT_COMPRESSION = os.environ.get('OUTPUT_COMPRESSION', 'snappy')  # 'zstd' for ~smaller files
+
+CONFIDENCE_SCALE = 100
+INT16_MAX = np.iinfo(np.int16).max
+
+def to_compact_schema(predictions_df):
+    """Convert a legacy predictions frame to the compact schema"""
+    confidence = np.round(predictions_df['confidence_score'].values.astype('float64') * CONFIDENCE_SCALE)
+    return pd.DataFrame({
+        'id': predictions_df['id'].values.astype('int64'),
+        'predicted_age': predictions_df['predicted_age'].values.astype('int8'),
+        'confidence_centi': np.clip(confidence, -INT16_MAX, INT16_MAX).astype('int16'),
+        'prediction_ts': pd.Categorical(predictions_df['prediction_ts']),
+        'model_version': pd.Categorical(predictions_df['model_version']),
+        'batch_id': predictions_df['batch_id'].values.astype('int16')
+    })
+
+def from_compact_schema(compact_df):
+    """Inverse of to_compact_schema (what the Athena view returns)"""
+    return pd.DataFrame({
+        'id': compact_df['id'].values,
+        'predicted_age': compact_df['predicted_age'].values.astype('int64'),
+        'confidence_score': compact_df['confidence_centi'].values.astype('float64') / CONFIDENCE_SCALE,
+        'prediction_ts': compact_df['prediction_ts'].astype(str).values,
+        'model_version': compact_df['model_version'].astype(str).values,
+        'batch_id': compact_df['batch_id'].values.astype('int64')
+    })
+
+def run_benchmark(rows, work_dir):
+    """Write/read one synthetic batch in legacy and compact layouts, report size and time"""
+    rng = np.random.default_rng(42)
+    os.makedirs(work_dir, exist_ok=True)
+
+    legacy = pd.DataFrame({
+        'id': np.sort(rng.choice(rows * 900, size=rows, replace=False)).astype('int64'),
+        'predicted_age': np.clip(np.round(rng.normal(42, 12, size=rows)), 18, 75).astype(int),
+        'confidence_score': np.round(rng.gamma(4, 3, size=rows), 2),
+        'prediction_ts': '2025-10-23T12:00:00.000000',
+        'model_version': 'v1.0_xgboost',
+        'batch_id': 17
+    })
+    compact = to_compact_schema(legacy)
+    roundtrip = from_compact_schema(compact)
+    assert (roundtrip['confidence_score'].values == legacy['confidence_score'].values).all()
+    assert (roundtrip['predicted_age'].values == legacy['predicted_age'].values).all()
+
+    variants = [
+        ('legacy_snappy', legacy, 'snappy'),
+        ('compact_snappy', compact, 'snappy'),
+        ('compact_zstd', compact, 'zstd')
+    ]
+    results = {'rows': rows}
+    for name, df, compression in variants:
+        path = os.path.join(work_dir, f'{name}.parquet')
+        write_start = time.perf_counter()
+        df.to_parquet(path, index=False, compression=compression)
+        write_ms = (time.perf_counter() - write_start) * 1000
+        read_start = time.perf_counter()
+        read_back = pd.read_parquet(path)
+        read_ms = (time.perf_counter() - read_start) * 1000
+        results[name] = {
+            'file_kb': round(os.path.getsize(path) / 1024, 1),
+            'bytes_per_row': round(os.path.getsize(path) / rows, 2),
+            'write_ms': round(write_ms, 1),
+            'read_ms': round(read_ms, 1),
+            'memory_mb': round(read_back.memory_usage(deep=True).sum() / (1024 * 1024), 1)
+        }
+        os.remove(path)
+
+    logger.info(f"Benchmark results: {json.dumps(results, indent=2)}")
+    return results
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description='Compact prediction output schema')
+    subparsers = parser.add_subparsers(dest='command')
+    bench_parser = subparsers.add_parser('bench', help='Legacy vs compact size and write/read time')
+    bench_parser.add_argument('--rows', type=int, default=420962)  # One batch
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        run_benchmark(args.rows, '/tmp/output_schema_bench')
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,18 +3,58 @@
 Fargate Prediction with Inline JSON Parsing
 Reads raw data, parses JSON on-the-fly, makes predictions
 Optimized for cost: no pre-parsing required!
+Features come from the declarative feature spec (feature_spec.py), shared with
+training. With FEATURE_PUSHDOWN=true the Athena scan computes the static features
+(JSON included) and only the time features are computed here.
+With FEATURE_STORE=true, profiles already parsed for this FEATURE_VERSION are read
+from the feature store (feature_store.py) instead of being parsed again.
+The batch streams through download -> parse -> features -> predict -> write
+stages on their own threads (stage_pipeline.py), chunk by chunk, so S3 transfers
+overlap feature creation and inference; output, prediction cache and feature
+store rows are appended to local Parquet files chunk by chunk (the manifest's row
+count, id range and checksum accumulate with them) and uploaded at the end, so
+no stage holds the batch. With PREDICTION_WORKERS > 1, forked worker processes
+share the models and each computes a row shard of every part (shared_inference.py). Model threads, worker processes and chunk rows are sized
+from the task's cgroup CPU quota and memory limit (resources.py), not the host's.
+Every S3 / Athena call is retried in process on throttling and transient errors
+(aws_retry.py): a blip costs a part's download or a query, not the task.
+Each attempt writes its output under its own key and commits it with a
+conditional PUT of the batch manifest (If-Match the manifest seen at start), so
+of two copies of a batch (speculative or re-leased) exactly one output is
+referenced; the other copy deletes its file.
 """
 
 import os
 import time
 import json
 import boto3
+import hashlib
+import uuid
 import logging
-from datetime import datetime
+import threading
+from datetime import datetime, timezone
+from functools import lru_cache
+from botocore.exceptions import ClientError
 import joblib
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 from io import BytesIO
+from id_bitmap import load_bitmap_from_s3
+from output_schema import COMPACT_SCHEMA, OUTPUT_COMPRESSION, to_compact_schema
+from incremental import (CACHE_COLUMNS, INCREMENTAL, input_hashes, load_previous_predictions, previous_quarter,
+                         split_carried, write_prediction_cache)
+from feature_spec import (FEATURE_PUSHDOWN, FEATURE_COLUMNS, INTERMEDIATE_COLUMNS, STATIC_COLUMNS,
+                          compute_features, compute_time_features, feature_matrix, pushed_down, pushdown_select)
+from raw_frame import (ASSEMBLY_COLUMNS, RAW_COLUMNS, UNLOAD_PREFIX, delete_unloaded, iter_parquet_frames,
+                       list_unloaded, unload_query)
+from feature_store import (FEATURE_STORE, FEATURE_VERSION, TIMESTAMP_OPTIONS, features_frame, read_features,
+                           split_stored, upload_features)
+from stage_pipeline import PIPELINE_QUEUE_SIZE, log_metrics, run_stages
+from shared_inference import ARENA_SLOTS, SharedArena, fork_pool, row_shards, wait_result, worker_count
+from resources import chunk_rows, detect, log_settings, thread_count
+from aws_retry import call_with_retries, get_bytes, query_failure, reset_retry_stats, retry_stats
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -32,391 +72,848 @@ WORKGROUP = os.environ.get('WORKGROUP', 'ai-agent-predict-age')
 if not S3_BUCKET:
     raise ValueError("S3_BUCKET environment variable is required")
 BATCH_ID = int(os.environ.get('BATCH_ID', '0'))
+# Id-range batches from the batch plan manifest (Distributed Map item); unset -> MOD(id, TOTAL_BATCHES) batches
+ID_MIN = int(os.environ['ID_MIN']) if os.environ.get('ID_MIN') else None
+ID_MAX = int(os.environ['ID_MAX']) if os.environ.get('ID_MAX') else None
+EXPECTED_PREDICTIONS = int(os.environ['EXPECTED_PREDICTIONS']) if os.environ.get('EXPECTED_PREDICTIONS') else None
+ENV_BATCH = {'batch_id': BATCH_ID, 'id_min': ID_MIN, 'id_max': ID_MAX, 'expected_predictions': EXPECTED_PREDICTIONS}
 RAW_TABLE = os.environ.get('RAW_TABLE', 'predict_age_training_raw_14m')  # For testing
-TOTAL_BATCHES = int(os.environ.get('TOTAL_BATCHES', '898'))
+YYYYQQ = os.environ.get('YYYYQQ', 'YYYYQQ')
+FINAL_RESULTS_TABLE = f'predict_age_final_results_{YYYYQQ}'
+# Incremental mode: prediction cache to carry unchanged profiles forward from
+PREVIOUS_YYYYQQ = os.environ.get('PREVIOUS_YYYYQQ') or previous_quarter(YYYYQQ)
 
-# JSON parsing functions (from feature parser)
-def parse_education_level(edu_str):
-    """Parse education level from JSON string"""
-    if pd.isna(edu_str) or edu_str == '' or edu_str == '[]':
-        return 2
-    try:
-        edu_lower = str(edu_str).lower()
-        if 'phd' in edu_lower or 'doctorate' in edu_lower:
-            return 5
-        elif 'master' in edu_lower or 'mba' in edu_lower:
-            return 4
-        elif 'bachelor' in edu_lower:
-            return 3
-        elif 'associate' in edu_lower:
-            return 2
-        elif 'high school' in edu_lower:
-            return 1
-        else:
-            return 2
-    except:
-        return 2
+# Map-side final assembly: read ALL ids in the batch and write final-schema rows directly
+FINAL_ASSEMBLY = os.environ.get('FINAL_ASSEMBLY', 'false').lower() == 'true'
+# Reruns skip batches whose manifest checkpoint (run id, bounds, model hash) matches
+RESUME = os.environ.get('RESUME', 'true').lower() == 'true'
+# Rows per pipeline chunk (one output row group); at most PIPELINE_QUEUE_SIZE chunks wait between stages.
+# 0: as many rows (up to 65536) as the chunks in flight - one per stage and per queue slot - fit in memory
+CHUNK_ROW_BYTES = 1000  # Peak memory per raw row through parse + features (Arrow JSON columns, features)
+PIPELINE_CHUNK_ROWS = int(os.environ.get('PIPELINE_CHUNK_ROWS', '0')) or \
+    chunk_rows(CHUNK_ROW_BYTES, in_flight=5 + 4 * PIPELINE_QUEUE_SIZE)
+# Worker processes (PREDICTION_WORKERS, 0: as many as the task's CPUs and memory allow)
+WORKERS = worker_count(PIPELINE_CHUNK_ROWS * CHUNK_ROW_BYTES / 2 ** 20)
+# In-process inference: the features stage runs on its own core while the models predict
+MODEL_THREADS = thread_count(reserve=1 if PIPELINE_QUEUE_SIZE > 0 else 0)
+RESOURCE_SETTINGS = {
+    'model_threads': 1 if WORKERS > 1 else MODEL_THREADS,
+    'arrow_threads': thread_count(),
+    'workers': WORKERS,
+    'chunk_rows': PIPELINE_CHUNK_ROWS,
+    'queue_size': PIPELINE_QUEUE_SIZE
+}
 
-def parse_graduation_year(edu_str):
-    """Parse graduation year from education JSON"""
-    if pd.isna(edu_str) or edu_str == '' or edu_str == '[]':
-        return None
-    try:
-        edu_obj = json.loads(edu_str)
-        if isinstance(edu_obj, list) and len(edu_obj) > 0:
-            end_date = edu_obj[0].get('end_date')
-            if end_date:
-                return int(end_date)
-    except:
-        pass
-    return None
-
-def parse_json_array_length(json_str):
-    """Parse JSON array and return length"""
-    if pd.isna(json_str) or json_str == '' or json_str == '[]':
-        return 0
+MODEL_VERSION = 'v1.1_xgboost'  # v1.1: features from feature_spec.py (training encodings)
+XGB_MODEL_KEY = 'predict-age/models/xgboost_model.joblib'
+QRF_MODEL_KEY = 'predict-age/models/qrf_model.joblib'
+# Per-batch manifests: row count, id range, checksum, timings (checked before Human QA)
+MANIFEST_PREFIX = f'predict-age/manifests/{YYYYQQ}'
+PREDICTIONS_PREFIX = f'predict-age/predictions/{YYYYQQ}'  # predict_age_predictions_{YYYYQQ} location
+# Manifest PUT refused: another copy of this batch committed first
+COMMIT_CONFLICT_CODES = {'PreconditionFailed', 'ConditionalRequestConflict'}
+# Batch plan written by batch_generator (GenerateBatchIds): the single source of the batch count
+PLAN_KEY = f'predict-age/plans/{YYYYQQ}/batch_plan.json'
+
+def load_batch_plan():
+    """Load this run's batch plan (None if batch_generator has not written one)"""
     try:
-        obj = json.loads(json_str)
-        if isinstance(obj, list):
-            return len(obj)
-    except:
-        pass
-    return 0
-
-def calc_total_career_years(work_exp_str):
-    """Calculate total career years from work experience JSON"""
-    if pd.isna(work_exp_str) or work_exp_str == '' or work_exp_str == '[]':
+        return json.loads(get_bytes(s3_client, S3_BUCKET, PLAN_KEY))
+    except s3_client.exceptions.NoSuchKey:
         return None
-    try:
-        work_exp = json.loads(work_exp_str)
-        if isinstance(work_exp, list) and len(work_exp) > 0:
-            years = []
-            for job in work_exp:
-                start = job.get('start_year')
-                end = job.get('end_year', datetime.now().year)
-                if start:
-                    years.append(end - start)
-            if years:
-                return sum(years)
-    except:
-        pass
-    return None
-
-def create_features_from_raw(df_raw):
-    """Create ML features from raw data with JSON parsing"""
+
+def resolve_total_batches(plan):
+    """TOTAL_BATCHES from the Map/scheduler, checked against the plan; the plan alone if unset"""
+    total_batches = os.environ.get('TOTAL_BATCHES')
+    if total_batches is None:
+        if plan is None:
+            raise ValueError(f"TOTAL_BATCHES not set and no batch plan at s3://{S3_BUCKET}/{PLAN_KEY}")
+        return plan['total_batches']
+    if plan is not None and plan['total_batches'] != int(total_batches):
+        raise ValueError(f"TOTAL_BATCHES={total_batches} but batch plan has {plan['total_batches']} batches")
+    return int(total_batches)
+
+BATCH_PLAN = load_batch_plan()
+TOTAL_BATCHES = resolve_total_batches(BATCH_PLAN)
+
+def create_features_from_raw(df_raw, with_intermediates=False):
+    """
+    Create the 21 ML features (model input order) from raw data with the feature
+    spec (feature_spec.py); with_intermediates also returns the spec's
+    intermediates for the feature store. Entries the Athena scan already
+    computed (FEATURE_PUSHDOWN) are used as is.
+    """
     logger.info(f"Parsing JSON and creating features for {len(df_raw)} rows...")
     start_time = time.time()
     
-    df = df_raw.copy()
-    
-    # Parse JSON fields
-    logger.info("Parsing education...")
-    df['education_level_encoded'] = df['education'].apply(parse_education_level)
-    df['graduation_year'] = df['education'].apply(parse_graduation_year)
-    
-    logger.info("Parsing work experience and skills...")
-    df['number_of_jobs'] = df['work_experience'].apply(parse_json_array_length).astype(float)
-    df['skill_count'] = df['skills'].apply(parse_json_array_length).astype(float)
-    df['total_career_years'] = df['work_experience'].apply(calc_total_career_years).astype(float)
-    
-    # Fill missing values
-    df['total_career_years'] = df['total_career_years'].fillna(df['number_of_jobs'] * 3)
-    df['graduation_year'] = df['graduation_year'].fillna(2010)
-    
-    # Job churn rate
-    df['job_churn_rate'] = np.where(df['total_career_years'] > 0,
-                                     df['number_of_jobs'] / df['total_career_years'],
-                                     0.3)
-    
-    # Job level encoding
-    def encode_job_level(level):
-        if pd.isna(level) or level == '':
-            return 2
-        elif level == 'C-Team':
-            return 4
-        elif level == 'Manager':
-            return 3
-        else:
-            return 2
-    
-    df['job_level_encoded'] = df['job_level'].apply(encode_job_level)
-    
-    # Job seniority score
-    job_level_map = {'C-Team': 4, 'Manager': 3, 'Staff': 2}
-    def calc_seniority(row):
-        level_score = job_level_map.get(row['job_level'], 2)
-        title = str(row['job_title']).lower() if pd.notna(row['job_title']) else ''
-        if 'chief' in title or 'ceo' in title or 'president' in title:
-            return 5
-        elif 'vp' in title or 'vice president' in title:
-            return 4
-        elif 'manager' in title or 'director' in title:
-            return 3
-        else:
-            return level_score
-    
-    df['job_seniority_score'] = df.apply(calc_seniority, axis=1)
-    
-    # Compensation encoding
-    comp_map = {
-        '$0-25k': 1, '$25-50k': 2, '$50-75k': 3, '$75-100k': 4,
-        '$100-150k': 5, '$150-250k': 6, '$250k+': 7
-    }
-    df['compensation_encoded'] = df['compensation_range'].map(comp_map).fillna(4).astype(int)
-    
-    # Company size encoding
-    size_map = {
-        '1-10': 1, '11-50': 2, '51-200': 3, '201-500': 4,
-        '501-1000': 5, '1001-5000': 6, '5001-10000': 7, '10000+': 8
-    }
-    df['company_size_encoded'] = df['employee_range'].map(size_map).fillna(5).astype(int)
-    
-    # LinkedIn activity score (convert to numeric first)
-    df['linkedin_connection_count'] = pd.to_numeric(df['linkedin_connection_count'], errors='coerce').fillna(0).astype(int)
-    df['linkedin_activity_score'] = np.where(
-        df['linkedin_connection_count'] >= 500, 1.0,
-        np.where(df['linkedin_connection_count'] >= 100, 0.7,
-                 np.where(df['linkedin_connection_count'] > 0, 0.3, 0.0))
-    )
-    
-    # Days since profile update
-    def calc_days_since_update(ev_date):
-        if pd.isna(ev_date) or ev_date == '':
-            return 365
-        try:
-            ev_datetime = pd.to_datetime(ev_date)
-            return int((datetime.now() - ev_datetime).days)
-        except:
-            return 365
-    
-    df['days_since_profile_update'] = df['ev_last_date'].apply(calc_days_since_update)
-    
-    # Social media presence score
-    def calc_social_score(row):
-        linkedin_valid = row['linkedin_url_is_valid'] == 'true'
-        has_facebook = pd.notna(row['facebook_url']) and row['facebook_url'] != ''
-        has_twitter = pd.notna(row['twitter_url']) and row['twitter_url'] != ''
-        
-        if linkedin_valid and has_facebook and has_twitter:
-            return 1.0
-        elif linkedin_valid and (has_facebook or has_twitter):
-            return 0.7
-        elif linkedin_valid:
-            return 0.5
-        else:
-            return 0.2
-    
-    df['social_media_presence_score'] = df.apply(calc_social_score, axis=1)
-    
-    # Email engagement score
-    def calc_email_score(row):
-        has_work = pd.notna(row['work_email']) and row['work_email'] != ''
-        has_personal = pd.notna(row['personal_email']) and row['personal_email'] != ''
-        
-        if has_work and has_personal:
-            return 1.0
-        elif has_work or has_personal:
-            return 0.5
-        else:
-            return 0.0
-    
-    df['email_engagement_score'] = df.apply(calc_email_score, axis=1)
-    
-    # Industry typical age
-    industry_age_map = {
-        'Technology': 35, 'Consulting': 38, 'Finance': 42, 'Healthcare': 40,
-        'Education': 45, 'Retail': 32, 'Manufacturing': 43, 'Real Estate': 44
-    }
-    df['industry_typical_age'] = df['industry'].astype(str).map(industry_age_map).fillna(40).astype(int)
-    
-    # Job function encoding
-    function_map = {
-        'Engineering': 0, 'Sales': 1, 'Marketing': 2, 'Operations': 3,
-        'Finance': 4, 'HR': 5, 'Product': 6, 'Other': 7
-    }
-    df['job_function_encoded'] = df['job_function'].map(function_map).fillna(7).astype(int)
-    
-    # Company revenue encoding
-    revenue_map = {
-        '$0-1M': 1, '$1-10M': 2, '$10-50M': 3, '$50-100M': 4,
-        '$100-500M': 5, '$500M-1B': 6, '$1B+': 7
-    }
-    df['company_revenue_encoded'] = df['revenue_range'].map(revenue_map).fillna(5).astype(int)
-    
-    # Tenure months (from job_start_date)
-    def calc_tenure(start_date):
-        if pd.isna(start_date) or start_date == '':
-            return 36
-        try:
-            start = pd.to_datetime(start_date)
-            months = int((datetime.now() - start).days / 30)
-            return max(0, min(months, 600))
-        except:
-            return 36
-    
-    df['tenure_months'] = df['job_start_date'].apply(calc_tenure)
-    
-    # Quarter (current quarter)
-    df['quarter'] = (datetime.now().month - 1) // 3 + 1
-    
-    # Interaction features
-    df['tenure_job_level_interaction'] = df['tenure_months'] * df['job_level_encoded']
-    df['comp_size_interaction'] = df['compensation_encoded'] * df['company_size_encoded']
-    
-    # Select final feature columns (21 features)
-    feature_cols = [
-        'tenure_months', 'job_level_encoded', 'job_seniority_score',
-        'compensation_encoded', 'company_size_encoded', 'linkedin_activity_score',
-        'days_since_profile_update', 'social_media_presence_score', 
-        'email_engagement_score', 'industry_typical_age', 'job_function_encoded',
-        'company_revenue_encoded', 'quarter', 'education_level_encoded',
-        'graduation_year', 'number_of_jobs', 'skill_count', 'total_career_years',
-        'job_churn_rate', 'tenure_job_level_interaction', 'comp_size_interaction'
-    ]
+    df = compute_features(df_raw, precomputed=pushed_down(df_raw), with_intermediates=with_intermediates)
     
     elapsed = time.time() - start_time
-    logger.info(f"✅ Feature creation completed in {elapsed:.2f}s ({len(df)/elapsed:.0f} rows/sec)")
-    
-    return df[['id'] + feature_cols]
+    logger.info(f"✅ Feature creation completed in {elapsed:.2f}s ({len(df)/max(elapsed, 1e-9):.0f} rows/sec)")
+    return df
+
+def features_from_store(df_raw, stored):
+    """
+    Model features for df_raw (a chunk of an id-range batch), given the batch's
+    stored rows (read_features). Profiles whose raw inputs are unchanged since they
+    were written to the feature store get their static features and intermediates
+    from it plus fresh time features; the rest are parsed.
+    Returns (features, rows for this batch's store file, number of profiles parsed).
+    """
+    hashes = input_hashes(df_raw)
+    df_stored, needs_parse = split_stored(df_raw['id'].values, hashes, stored)
+    df_features = compute_time_features(df_stored)[['id'] + FEATURE_COLUMNS + INTERMEDIATE_COLUMNS]
+    if needs_parse.any():
+        df_parse = df_raw[needs_parse]
+        df_parsed = compute_features(df_parse, precomputed=pushed_down(df_parse), with_intermediates=True)
+        df_features = pd.concat([df_features, df_parsed], ignore_index=True)
+    hash_by_id = pd.Series(hashes, index=df_raw['id'].values)
+    store_rows = df_features.assign(input_hash=hash_by_id.reindex(df_features['id'].values).values)
+    return df_features[['id'] + FEATURE_COLUMNS], store_rows, int(needs_parse.sum())
 
+@lru_cache(maxsize=1)
 def load_models_from_s3():
-    """Load trained models from S3"""
+    """Load trained models from S3 (once per process: queue workers reuse them across units)"""
     logger.info("Loading models from S3...")
     
     # Load XGBoost model
-    xgb_key = 'predict-age/models/xgboost_model.joblib'
-    xgb_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=xgb_key)
-    model_xgb = joblib.load(BytesIO(xgb_obj['Body'].read()))
+    model_xgb = joblib.load(BytesIO(get_bytes(s3_client, S3_BUCKET, XGB_MODEL_KEY)))
     logger.info("XGBoost model loaded")
     
     # Load Quantile model
-    qrf_key = 'predict-age/models/qrf_model.joblib'
-    qrf_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=qrf_key)
-    model_quantile = joblib.load(BytesIO(qrf_obj['Body'].read()))
+    model_quantile = joblib.load(BytesIO(get_bytes(s3_client, S3_BUCKET, QRF_MODEL_KEY)))
     logger.info("Quantile model loaded")
     
     return model_xgb, model_quantile
 
-def load_raw_data_for_batch():
-    """Load raw data from Athena for this batch (ONLY PIDs missing age data)"""
-    logger.info(f"Loading raw data for batch {BATCH_ID}/{TOTAL_BATCHES}...")
+def head_object(key):
+    return call_with_retries(lambda: s3_client.head_object(Bucket=S3_BUCKET, Key=key), f"HEAD s3://{S3_BUCKET}/{key}")
+
+@lru_cache(maxsize=1)
+def model_hash():
+    """Short hash of the models' ETags (same as checkpoint.model_hash in the Lambda layer)"""
+    etags = [f"{key}:{head_object(key)['ETag']}" for key in (XGB_MODEL_KEY, QRF_MODEL_KEY)]
+    return hashlib.sha256('\n'.join(etags).encode('utf-8')).hexdigest()[:16]
+
+def id_range(batch):
+    """[id_min, id_max] of an id-range batch, None for a MOD(id, TOTAL_BATCHES) batch"""
+    return [batch['id_min'], batch['id_max']] if batch['id_min'] is not None else None
+
+def batch_checkpoint(batch):
+    """Identity of this batch's output: run id, batch bounds, model hash"""
+    return {
+        'run_id': YYYYQQ,
+        'batch_id': batch['batch_id'],
+        'total_batches': TOTAL_BATCHES,
+        'id_range': id_range(batch),
+        'final_assembly': FINAL_ASSEMBLY,
+        'model_hash': model_hash()
+    }
+
+def read_batch_manifest(batch_id):
+    """The batch's current manifest and its ETag (the commit precondition), (None, None) if there is none"""
+    key = f'{MANIFEST_PREFIX}/batch_{batch_id:04d}.json'
+
+    def get():
+        response = s3_client.get_object(Bucket=S3_BUCKET, Key=key)
+        return json.loads(response['Body'].read()), response['ETag']
+
+    try:
+        return call_with_retries(get, f"GET s3://{S3_BUCKET}/{key}")
+    except s3_client.exceptions.NoSuchKey:
+        return None, None
+
+def batch_already_done(checkpoint, manifest):
+    """True if a previous run wrote this batch's manifest with the same checkpoint and its output is intact (same ETag)"""
+    if manifest is None:
+        return False
+    if manifest.get('checkpoint') != checkpoint:
+        return False
+    if manifest['output_key'] is None:
+        return True
+    try:
+        head = head_object(manifest['output_key'])
+    except s3_client.exceptions.ClientError:
+        return False
+    return head['ContentLength'] == manifest['file_bytes'] and head['ETag'] == manifest.get('etag', head['ETag'])
+
+def unload_raw_data_for_batch(batch):
+    """
+    UNLOAD the batch's raw rows from Athena (ONLY PIDs missing age data, unless
+    FINAL_ASSEMBLY) to Parquet parts. Returns the parts as (key, size) pairs.
+    """
+    batch_id = batch['batch_id']
+    logger.info(f"Loading raw data for batch {batch_id}/{TOTAL_BATCHES}...")
+    
+    # Map-side final assembly needs the known-age rows too
+    missing_age_filter = '' if FINAL_ASSEMBLY else 'AND (birth_year IS NULL AND approximate_age IS NULL)'
+    
+    # Id-range batch from the plan manifest, else modulo batching
+    if batch['id_min'] is not None:
+        batch_filter = f"CAST(id AS BIGINT) BETWEEN {batch['id_min']} AND {batch['id_max']}"
+    else:
+        batch_filter = f'MOD(CAST(id AS BIGINT), {TOTAL_BATCHES}) = {batch_id}'
     
-    # Query raw data with modulo batching - ONLY predict for PIDs with missing age data
+    # Feature pushdown: Athena computes the static spec entries (spec_*) in the same scan
+    pushdown = f',\n    {pushdown_select()}' if FEATURE_PUSHDOWN else ''
+    
+    # Query raw data - ONLY predict for PIDs with missing age data; only the columns the batch uses
     query = f"""
-    SELECT *
+    SELECT CAST(id AS BIGINT) AS id, {', '.join(RAW_COLUMNS[1:])}{pushdown}
     FROM {DATABASE_NAME}.{RAW_TABLE}
     WHERE id IS NOT NULL
-    AND (birth_year IS NULL AND approximate_age IS NULL)
-    AND MOD(CAST(id AS BIGINT), {TOTAL_BATCHES}) = {BATCH_ID}
+    {missing_age_filter}
+    AND {batch_filter}
     """
     
-    # Execute query
-    response = athena_client.start_query_execution(
-        QueryString=query,
-        QueryExecutionContext={'Database': DATABASE_NAME},
-        WorkGroup=WORKGROUP,
-        ResultConfiguration={'OutputLocation': f's3://{S3_BUCKET}/athena-results/'}
+    # UNLOAD to Parquet (typed columns, Arrow strings); own prefix per task and attempt, speculative copies may run the same batch
+    prefixes = []
+    
+    def unload():
+        unload_prefix = f'{UNLOAD_PREFIX}/{YYYYQQ}/batch_{batch_id:04d}_{uuid.uuid4().hex[:12]}/'
+        prefixes.append(unload_prefix)
+        response = athena_client.start_query_execution(
+            QueryString=unload_query(query, S3_BUCKET, unload_prefix),
+            QueryExecutionContext={'Database': DATABASE_NAME},
+            WorkGroup=WORKGROUP,
+            ResultConfiguration={'OutputLocation': f's3://{S3_BUCKET}/athena-results/'}
+        )
+        query_id = response['QueryExecutionId']
+        logger.info(f"Athena query started: {query_id}")
+        
+        # Wait for completion (a failed status poll is retried on its own, a failed query is resubmitted)
+        while True:
+            status_response = call_with_retries(lambda: athena_client.get_query_execution(QueryExecutionId=query_id),
+                                                f"Athena query {query_id} status")
+            status = status_response['QueryExecution']['Status']
+            
+            if status['State'] == 'SUCCEEDED':
+                return unload_prefix
+            elif status['State'] in ['FAILED', 'CANCELLED']:
+                raise query_failure(status)
+            
+            time.sleep(2)
+    
+    def remove_failed_unload(error):
+        delete_unloaded(s3_client, S3_BUCKET, [key for key, _ in list_unloaded(s3_client, S3_BUCKET, prefixes[-1])])
+    
+    unload_prefix = call_with_retries(unload, f"UNLOAD batch {batch_id}", on_retry=remove_failed_unload)
+    parts = list_unloaded(s3_client, S3_BUCKET, unload_prefix)
+    logger.info(f"Query completed: {len(parts)} Parquet parts under s3://{S3_BUCKET}/{unload_prefix}")
+    return parts
+
+def assemble_final_results(df_raw, df_predictions, qa_timestamp=None):
+    """
+    Apply the final_results priority rules to every id in the batch (map-side assembly).
+    Priority: 1) existing approximate_age, 2) birth_year, 3) ML prediction, 4) default (35)
+    Output columns match predict_age_final_results_{YYYYQQ} (plus qa_status).
+    qa_timestamp: one value for all chunks of a batch (default: now).
+    """
+    pred = pd.DataFrame({'id': df_raw['id'].astype('int64').values}).merge(
+        df_predictions[['id', 'predicted_age', 'confidence_score', 'model_version']],
+        on='id', how='left'
+    )
+    
+    # A value that is not a number counts as missing everywhere (not only for the age)
+    approx_age = pd.to_numeric(df_raw['approximate_age'], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    birth_year_age = 2025 - pd.to_numeric(df_raw['birth_year'], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    has_approx = ~np.isnan(approx_age)
+    has_birth = ~np.isnan(birth_year_age)
+    has_pred = pred['predicted_age'].notna().values
+    
+    predicted_age = np.select(
+        [has_approx, has_birth, has_pred],
+        [approx_age, birth_year_age, pred['predicted_age'].values],
+        default=35
+    )
+    confidence_score = np.select(
+        [has_birth, has_approx, has_pred],
+        [100.0, 100.0, pred['confidence_score'].values],
+        default=15.0
+    )
+    model_version = np.select(
+        [has_pred, has_approx, has_birth],
+        [pred['model_version'].values, 'v1.0_existing_approx_age', 'v1.0_existing_birth_year'],
+        default='v1.0_default_rule'
+    )
+    prediction_status = np.select(
+        [has_pred, has_approx | has_birth],
+        ['HAS_PREDICTION', 'EXISTING_AGE'],
+        default='INSUFFICIENT_DATA'
+    )
+    prediction_source = np.select(
+        [has_approx, has_birth, has_pred],
+        ['EXISTING_APPROX_AGE', 'EXISTING_BIRTH_YEAR', 'ML_PREDICTION'],
+        default='DEFAULT_RULE'
     )
-    query_id = response['QueryExecutionId']
-    logger.info(f"Athena query started: {query_id}")
     
-    # Wait for completion
+    if qa_timestamp is None:
+        qa_timestamp = athena_timestamp()
+    
+    return pd.DataFrame({
+        'id': pred['id'].values,
+        'predicted_age': predicted_age.astype('int32'),
+        'confidence_score': confidence_score.astype('float64'),
+        'qa_timestamp': qa_timestamp,
+        'model_version': model_version,
+        'prediction_status': prediction_status,
+        'prediction_source': prediction_source,
+        'qa_status': np.where(has_pred, 'HAS_PREDICTION', 'MISSING_PREDICTION')
+    })
+
+def athena_timestamp():
+    """Now in the format of Athena's CAST(current_timestamp AS VARCHAR)"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3] + ' UTC'
+
+def chunk_features(df_raw, context):
+    """
+    Features stage for one chunk of raw rows: keep the PIDs needing a prediction,
+    carry unchanged ones forward (context['previous']: INCREMENTAL cache) and
+    create features for the rest (context['stored']: feature store rows, else
+    parsed). Returns (chunk for chunk_predictions, counts, store rows or None).
+    """
+    counts = {'loaded': len(df_raw)}
+    # Only PIDs without a known age go through the model
+    if FINAL_ASSEMBLY:
+        if context['bitmap'] is not None:
+            needs_prediction = context['bitmap'].contains(df_raw['id'].values)
+        else:
+            needs_prediction = (df_raw['birth_year'].isna() & df_raw['approximate_age'].isna()).values
+        df_missing_age = df_raw[needs_prediction]
+    else:
+        df_missing_age = df_raw
+    counts['needs_prediction'] = len(df_missing_age)
+    
+    # Incremental: unchanged profiles keep last quarter's prediction
+    carried = new_hashes = None
+    if context['previous'] is not None and len(df_missing_age) > 0:
+        hashes = input_hashes(df_missing_age)
+        carried, needs_model = split_carried(df_missing_age['id'].values, hashes, context['previous'], MODEL_VERSION, YYYYQQ)
+        df_missing_age = df_missing_age[needs_model]
+        new_hashes = pd.Series(hashes[needs_model], index=df_missing_age['id'].values)
+        counts['carried'] = len(carried)
+    
+    # Parse JSON and create features (feature store: only new or changed profiles are parsed)
+    df_features = store_rows = None
+    if len(df_missing_age) > 0:
+        if context['stored'] is not None:
+            df_features, store_rows, counts['parsed'] = features_from_store(df_missing_age, context['stored'])
+        else:
+            df_features = compute_features(df_missing_age, precomputed=pushed_down(df_missing_age))
+            counts['parsed'] = len(df_features)
+    # The JSON/text columns are consumed: keep only what final assembly reads
+    chunk = (df_raw[ASSEMBLY_COLUMNS] if FINAL_ASSEMBLY else None, df_features, carried, new_hashes)
+    return chunk, counts, store_rows
+
+def chunk_predictions(chunk, context):
+    """
+    Predict stage for one chunk_features() chunk. Returns (output rows in the
+    batch's output schema, prediction cache rows, counts).
+    """
+    df_raw, df_features, carried, new_hashes = chunk
+    if df_features is not None:
+        # float32 feature block, no copy
+        X = feature_matrix(df_features)
+        predictions = context['model_xgb'].predict(X)
+        pred_lower = context['model_quantile']['lower'].predict(X)
+        pred_upper = context['model_quantile']['upper'].predict(X)
+        confidence_scores = pred_upper - pred_lower
+        prediction_ids = df_features['id']
+    else:
+        predictions = confidence_scores = np.array([], dtype=float)
+        prediction_ids = pd.Series([], dtype='int64')
+    
+    df_results = pd.DataFrame({
+        'id': prediction_ids,
+        'predicted_age': np.clip(np.round(predictions), 18, 75).astype(int),
+        'confidence_score': np.round(confidence_scores, 2),
+        'prediction_ts': context['prediction_ts'],
+        'model_version': MODEL_VERSION,
+        'batch_id': context['batch_id']
+    })
+    
+    cache = []
+    if carried is not None:
+        cache.append(df_results.drop(columns='batch_id').assign(
+            input_hash=new_hashes.reindex(df_results['id'].values).values, predicted_yyyyqq=YYYYQQ))
+        # Empty (object-typed) carried frames would turn the uint64 hashes into objects
+        if len(carried) > 0:
+            cache.append(carried)
+            df_results = pd.concat([df_results, carried.drop(columns=['input_hash', 'predicted_yyyyqq'])
+                                    .assign(batch_id=context['batch_id'])], ignore_index=True)
+    counts = {'predictions': len(df_results), 'age_sum': float(df_results['predicted_age'].sum())}
+    
+    if FINAL_ASSEMBLY:
+        df_output = assemble_final_results(df_raw, df_results, context['qa_timestamp'])
+    else:
+        # int8 age / int16 centi-confidence / dictionary strings (read via the predictions view)
+        df_output = to_compact_schema(df_results) if COMPACT_SCHEMA else df_results
+    return df_output, cache, counts
+
+def set_model_threads(context, threads):
+    """n_jobs of the batch's models (trained with n_jobs=-1: one thread per host CPU)"""
+    for model in [context['model_xgb'], *context['model_quantile'].values()]:
+        if hasattr(model, 'get_params') and 'n_jobs' in model.get_params():
+            model.set_params(n_jobs=threads)
+
+# Batch context inherited by forked workers (WORKERS > 1): models, lookups, shared arena
+SHARD_CONTEXT = {}
+
+def limit_model_threads():
+    """Worker process initializer: one thread per model, the processes are the parallelism"""
+    set_model_threads(SHARD_CONTEXT, 1)
+
+def predict_shard(slot, nbytes, row_start, row_stop):
+    """
+    Worker process: rows [row_start, row_stop) of the part in arena slot (its first
+    nbytes), through features and predictions chunk by chunk. Returns (output frames,
+    cache frames, store frames, counts, seconds per stage).
+    """
+    context = SHARD_CONTEXT
+    outputs, cache, store = [], [], []
+    counts = {}
+    seconds = {'parse': 0.0, 'features': 0.0, 'predict': 0.0}
+    frames = iter_parquet_frames(context['arena'].view(slot, nbytes), PIPELINE_CHUNK_ROWS, rows=(row_start, row_stop))
     while True:
-        status_response = athena_client.get_query_execution(QueryExecutionId=query_id)
-        status = status_response['QueryExecution']['Status']['State']
-        
-        if status == 'SUCCEEDED':
+        start = time.perf_counter()
+        df_raw = next(frames, None)
+        seconds['parse'] += time.perf_counter() - start
+        if df_raw is None:
             break
-        elif status in ['FAILED', 'CANCELLED']:
-            reason = status_response['QueryExecution']['Status'].get('StateChangeReason', 'Unknown')
-            raise Exception(f"Query {status}: {reason}")
-        
-        time.sleep(2)
-    
-    logger.info(f"Query completed: {query_id}")
-    
-    # Read results from S3 (Athena writes to CSV)
-    results_key = f'athena-results/{query_id}.csv'
-    obj = s3_client.get_object(Bucket=S3_BUCKET, Key=results_key)
-    df = pd.read_csv(BytesIO(obj['Body'].read()))
-    
-    logger.info(f"Loaded {len(df)} raw records")
-    return df
+        start = time.perf_counter()
+        chunk, chunk_counts, store_rows = chunk_features(df_raw, context)
+        seconds['features'] += time.perf_counter() - start
+        start = time.perf_counter()
+        df_output, chunk_cache, prediction_counts = chunk_predictions(chunk, context)
+        seconds['predict'] += time.perf_counter() - start
+        outputs.append(df_output)
+        cache += chunk_cache
+        if store_rows is not None:
+            store.append(store_rows)
+        for name, value in {**chunk_counts, **prediction_counts}.items():
+            counts[name] = counts.get(name, 0) + value
+    return outputs, cache, store, counts, seconds
 
-def save_predictions_to_s3(predictions_df):
-    """Save predictions to S3 as Parquet"""
-    output_key = f'predict-age/predictions/batch_{BATCH_ID:04d}.parquet'
+class ParquetSink:
+    """
+    A local Parquet file written one row group per chunk, so no stage holds the
+    batch's rows: the schema is the first non-empty chunk's (later chunks are
+    cast to it); if every chunk was empty the file gets the first one's columns.
+    rows and chunks count what was written; with stats=True it also keeps the
+    manifest statistics (id min / max, uint64 sum of row hashes).
+    """
     
-    # Save to temp file
-    tmp_file = f'/tmp/predictions_batch_{BATCH_ID}.parquet'
-    predictions_df.to_parquet(tmp_file, index=False, compression='snappy')
+    def __init__(self, path, prepare=None, stats=False, **options):
+        self.path = path
+        self.prepare = prepare
+        self.stats = stats
+        self.options = {'compression': OUTPUT_COMPRESSION, **options}
+        self.writer = None
+        self.empty = None
+        self.rows = self.chunks = 0
+        self.id_min = self.id_max = None
+        self.hash_sum = 0
+    
+    def write(self, df):
+        self.chunks += 1
+        if len(df) == 0:
+            if self.empty is None:
+                self.empty = df
+            return
+        if self.stats:
+            ids = df['id'].values
+            self.id_min = int(ids.min()) if self.id_min is None else min(self.id_min, int(ids.min()))
+            self.id_max = int(ids.max()) if self.id_max is None else max(self.id_max, int(ids.max()))
+            self.hash_sum = (self.hash_sum + int(content_checksum(df), 16)) % (1 << 64)
+        self.rows += len(df)
+        if self.prepare is not None:
+            df = self.prepare(df)
+        table = pa.Table.from_pandas(df, schema=self.writer.schema if self.writer else None, preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema, **self.options)
+        self.writer.write_table(table)
+    
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        elif self.empty is not None:
+            df = self.empty if self.prepare is None else self.prepare(self.empty)
+            pq.write_table(pa.Table.from_pandas(df, preserve_index=False), self.path, **self.options)
+            self.empty = None
+    
+    def summary(self):
+        """Manifest fields of what was written (stats=True)"""
+        return {'row_count': self.rows, 'id_min': self.id_min, 'id_max': self.id_max,
+                'checksum': f'{self.hash_sum:016x}'}
+    
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def predict_parts(parts, context, sinks):
+    """
+    Stream the UNLOAD parts ((key, size)) through the stages of stage_pipeline.py
+    into the batch's local files (sinks: ParquetSink for 'output', 'cache' and
+    'store'), one row group per chunk: no stage keeps a chunk once it is written.
+    WORKERS = 1: download -> parse -> features -> predict -> write threads.
+    WORKERS > 1: the parent downloads each part into a free slot of a shared
+    arena and forked workers (shared_inference.py) each parse, featurize and
+    predict a row shard of it; the parent writes their outputs in part and shard
+    order and frees the slot after the part's last shard. A dead or hung worker
+    fails the batch (WorkerLost) instead of blocking it.
+    Returns (batch totals, pipeline metrics).
+    """
+    totals = {'loaded': 0, 'needs_prediction': 0, 'carried': 0, 'parsed': 0, 'predictions': 0, 'age_sum': 0.0}
+    
+    def add(counts):
+        for name, value in counts.items():
+            totals[name] += value
+    
+    def download(key):
+        yield get_bytes(s3_client, S3_BUCKET, key)  # A failed part is fetched again, the chunks before it are kept
+    
+    def parse(body):
+        yield from iter_parquet_frames(body, PIPELINE_CHUNK_ROWS)
+    
+    def features(df_raw):
+        chunk, counts, store_rows = chunk_features(df_raw, context)
+        add(counts)
+        if store_rows is not None:
+            sinks['store'].write(store_rows)
+        yield chunk
+    
+    def predict(chunk):
+        df_output, cache, counts = chunk_predictions(chunk, context)
+        add(counts)
+        for df_cache in cache:
+            sinks['cache'].write(df_cache)
+        yield df_output
+    
+    def write(df_output):
+        sinks['output'].write(df_output)
+        yield len(df_output)
+    
+    keys = [key for key, _ in parts]
+    pool = arena = None
+    aborted = threading.Event()  # Set by run_stages when a stage fails (wakes a download waiting for a slot)
+    worker_seconds = {'parse': 0.0, 'features': 0.0, 'predict': 0.0}
+    try:
+        if WORKERS > 1:
+            # Models and lookups are inherited by the fork; parts go through the arena's recycled slots
+            arena = SharedArena(min(ARENA_SLOTS, len(parts)) or 1, max((size for _, size in parts), default=1))
+            SHARD_CONTEXT.update(context, arena=arena)
+            pool = fork_pool(WORKERS, initializer=limit_model_threads)
+            
+            def download_to_arena(index):
+                slot = arena.acquire(aborted)
+                body = get_bytes(s3_client, S3_BUCKET, keys[index])
+                arena.write(slot, body)
+                yield slot, len(body), pq.ParquetFile(pa.BufferReader(body)).metadata.num_rows
+            
+            def dispatch(part):
+                slot, nbytes, num_rows = part
+                shards = row_shards(num_rows, WORKERS)
+                if not shards:
+                    arena.release(slot)
+                for shard, (row_start, row_stop) in enumerate(shards):
+                    # The part's last shard frees its slot once gathered
+                    yield slot if shard + 1 == len(shards) else None, \
+                        pool.apply_async(predict_shard, (slot, nbytes, row_start, row_stop))
+            
+            def gather(shard):
+                last_of_slot, result = shard
+                outputs, cache, store, counts, seconds = wait_result(pool, result)
+                if last_of_slot is not None:
+                    arena.release(last_of_slot)
+                add(counts)
+                for df_cache in cache:
+                    sinks['cache'].write(df_cache)
+                for store_rows in store:
+                    sinks['store'].write(store_rows)
+                for stage, value in seconds.items():
+                    worker_seconds[stage] += value
+                yield from outputs
+            
+            stages = [('download', download_to_arena), ('dispatch', dispatch), ('workers', gather), ('write', write)]
+            _, metrics = run_stages(range(len(parts)), stages, PIPELINE_QUEUE_SIZE, abort=aborted)
+            busy_sec = sum(worker_seconds.values())
+            metrics['workers'] = {
+                'processes': WORKERS,
+                **{f'{stage}_sec': round(value, 3) for stage, value in worker_seconds.items()},
+                'utilization': round(busy_sec / (WORKERS * metrics['wall_sec']), 3) if metrics['wall_sec'] else 0.0
+            }
+        else:
+            stages = [('download', download), ('parse', parse), ('features', features), ('predict', predict), ('write', write)]
+            _, metrics = run_stages(keys, stages, PIPELINE_QUEUE_SIZE)
+    finally:
+        for sink in sinks.values():
+            sink.close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+            SHARD_CONTEXT.clear()
+        if arena is not None:
+            arena.close()
+    log_metrics(metrics)
+    if 'workers' in metrics:
+        workers = metrics['workers']
+        logger.info(f"   {workers['processes']} worker processes: parse {workers['parse_sec']:.2f}s, "
+                    f"features {workers['features_sec']:.2f}s, predict {workers['predict_sec']:.2f}s "
+                    f"({100 * workers['utilization']:.1f}% of worker time busy)")
+    return totals, metrics
+
+def upload_predictions(tmp_file, batch_id, attempt, output_prefix=PREDICTIONS_PREFIX):
+    """
+    Upload this attempt's prediction Parquet file to S3 under its own key (another copy of
+    the batch never overwrites it). Returns (output_key, file_bytes, etag).
+    """
+    output_key = f'{output_prefix}/batch_{batch_id:04d}_{attempt}.parquet'
+    file_bytes = os.path.getsize(tmp_file)
     
     # Upload to S3
-    s3_client.upload_file(tmp_file, S3_BUCKET, output_key)
+    call_with_retries(lambda: s3_client.upload_file(tmp_file, S3_BUCKET, output_key), f"PUT s3://{S3_BUCKET}/{output_key}")
     logger.info(f"✅ Predictions saved to s3://{S3_BUCKET}/{output_key}")
     
-    return output_key
+    # ETag as stored (multipart uploads get a parts hash): verification compares it with the listing
+    etag = head_object(output_key)['ETag']
+    return output_key, file_bytes, etag
+
+def content_checksum(df):
+    """Order-independent checksum of a DataFrame's rows (uint64 sum of row hashes, as hex)"""
+    if len(df) == 0:
+        return '0' * 16
+    row_hashes = pd.util.hash_pandas_object(df, index=False).values
+    return f'{int(row_hashes.sum(dtype=np.uint64)):016x}'
+
+EMPTY_OUTPUT = {'row_count': 0, 'id_min': None, 'id_max': None, 'checksum': '0' * 16}
+
+def write_batch_manifest(batch, output, output_key, file_bytes, prediction_count, expected_predictions, timings, checkpoint,
+                         carried_forward=0, pipeline=None, etag=None, committed=(None, None)):
+    """
+    Write the batch's manifest to predict-age/manifests/{YYYYQQ}/batch_NNNN.json (written last: it
+    marks the batch done); output is the output file's row_count / id_min / id_max / checksum
+    (ParquetSink.summary, accumulated chunk by chunk). The PUT only succeeds if the manifest is
+    still the one read at start (committed: (manifest, ETag), (None, None) if it was absent); the
+    output it referenced is then deleted. Returns the manifest, or None if another copy committed first.
+    """
+    previous_manifest, previous_etag = committed
+    batch_id = batch['batch_id']
+    manifest = {
+        'batch_id': batch_id,
+        'total_batches': TOTAL_BATCHES,
+        'yyyyqq': YYYYQQ,
+        'final_assembly': FINAL_ASSEMBLY,
+        'output_key': output_key,
+        'file_bytes': file_bytes,
+        'etag': etag,  # Of the uploaded output file (verify-batches and resume compare it)
+        'row_count': output['row_count'],
+        'prediction_count': int(prediction_count),
+        'carried_forward': int(carried_forward),
+        'expected_predictions': expected_predictions,
+        'id_range': id_range(batch),
+        'id_min': output['id_min'],
+        'id_max': output['id_max'],
+        'checksum': output['checksum'],
+        'model_version': MODEL_VERSION,
+        'checkpoint': checkpoint,
+        'timings_sec': {stage: round(seconds, 2) for stage, seconds in timings.items()},
+        'pipeline': pipeline,  # Per-stage busy / starved / blocked seconds and utilization (stage_pipeline.py)
+        'resources': {**detect(), **RESOURCE_SETTINGS},  # Detected CPUs / memory and what was derived (resources.py)
+        'retries': retry_stats(),  # In-process AWS retries by class and backoff seconds (aws_retry.py)
+        'completed_at': datetime.now().isoformat()
+    }
+    manifest_key = f'{MANIFEST_PREFIX}/batch_{batch_id:04d}.json'
+    condition = {'IfMatch': previous_etag} if previous_etag else {'IfNoneMatch': '*'}
+    try:
+        call_with_retries(lambda: s3_client.put_object(
+            Bucket=S3_BUCKET,
+            Key=manifest_key,
+            Body=json.dumps(manifest),
+            ContentType='application/json',
+            **condition
+        ), f"PUT s3://{S3_BUCKET}/{manifest_key}")
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in COMMIT_CONFLICT_CODES:
+            raise
+        logger.warning(f"Batch {batch_id}: manifest changed since this task started, another copy committed first")
+        return None
+    logger.info(f"Manifest saved to s3://{S3_BUCKET}/{manifest_key}")
+    if previous_manifest and previous_manifest.get('output_key') not in (None, output_key):
+        delete_output(previous_manifest['output_key'], 'replaced by this attempt')
+    return manifest
+
+def delete_output(key, reason):
+    """Remove an output file no manifest references (this copy lost, or the previous attempt's file)"""
+    call_with_retries(lambda: s3_client.delete_object(Bucket=S3_BUCKET, Key=key), f"DELETE s3://{S3_BUCKET}/{key}")
+    logger.info(f"Deleted s3://{S3_BUCKET}/{key} ({reason})")
 
-def main():
-    """Main prediction function"""
+def main(batch=ENV_BATCH):
+    """
+    Predict one batch: batch_id, id_min / id_max (None: MOD(id, TOTAL_BATCHES) batch) and
+    expected_predictions, from the environment or a work_queue.py unit
+    """
+    batch_id, id_min, id_max = batch['batch_id'], batch['id_min'], batch['id_max']
     start_time = time.time()
+    timings = {}
+    stage_start = start_time
     
+    def end_stage(stage):
+        nonlocal stage_start
+        now = time.time()
+        timings[stage] = now - stage_start
+        stage_start = now
+    
+    sinks = {}
     try:
-        logger.info(f"=== Starting Prediction Batch {BATCH_ID} ===")
+        logger.info(f"=== Starting Prediction Batch {batch_id} ===")
+        reset_retry_stats()  # Queue workers run several units per process
         logger.info(f"Total batches: {TOTAL_BATCHES}")
+        if id_min is not None:
+            logger.info(f"Id range: {id_min} - {id_max}")
+        logger.info(f"Map-side final assembly: {FINAL_ASSEMBLY}")
+        log_settings('prediction', RESOURCE_SETTINGS)
+        pa.set_cpu_count(RESOURCE_SETTINGS['arrow_threads'])
         
-        # 1. Load models
-        model_xgb, model_quantile = load_models_from_s3()
+        checkpoint = batch_checkpoint(batch)
+        attempt = uuid.uuid4().hex[:8]  # Output key of this copy of the batch
+        committed = read_batch_manifest(batch_id)  # (manifest, ETag) this copy's commit must replace
+        if RESUME and batch_already_done(checkpoint, committed[0]):
+            logger.info(f"Batch {batch_id} already complete for this run and model ({checkpoint['model_hash']}), skipping")
+            return {'statusCode': 200, 'batch_id': batch_id, 'skipped': True}
+        end_stage('checkpoint')
         
-        # 2. Load raw data
-        df_raw = load_raw_data_for_batch()
+        # 1. Load needs-prediction bitmap (built once per run) if it matches this batch layout
+        bitmap, bitmap_summary = load_bitmap_from_s3(s3_client, summary_only=not FINAL_ASSEMBLY)
+        expected_predictions = None
+        if id_min is not None:
+            # Range batches: the manifest item carries the count; the bitmap itself doesn't depend on batching
+            expected_predictions = batch['expected_predictions']
+        elif bitmap_summary and bitmap_summary['total_batches'] == TOTAL_BATCHES:
+            expected_predictions = bitmap_summary['batch_counts'][batch_id]
+            logger.info(f"Needs-prediction bitmap: {expected_predictions} PIDs in batch {batch_id}")
+        elif bitmap_summary:
+            logger.warning(f"Ignoring bitmap built for {bitmap_summary['total_batches']} batches")
+            bitmap = None
+        end_stage('load_bitmap')
         
-        if len(df_raw) == 0:
-            logger.warning(f"No data for batch {BATCH_ID}")
-            return {'statusCode': 200, 'predictions': 0}
+        if expected_predictions == 0 and not FINAL_ASSEMBLY:
+            logger.info(f"No PIDs need a prediction in batch {batch_id}, skipping Athena query")
+            write_batch_manifest(batch, EMPTY_OUTPUT, None, 0, 0, expected_predictions, timings, checkpoint,
+                                 committed=committed)
+            return {'statusCode': 200, 'batch_id': batch_id, 'predictions': 0}
         
-        # 3. Parse JSON and create features
-        df_features = create_features_from_raw(df_raw)
+        # 2. Load models
+        model_xgb, model_quantile = load_models_from_s3()
+        end_stage('load_models')
         
-        # 4. Make predictions
-        logger.info("Making predictions...")
-        X = df_features.drop('id', axis=1).values
+        # 3. UNLOAD raw data (Parquet parts, streamed through the pipeline below)
+        parts = unload_raw_data_for_batch(batch)
+        end_stage('unload')
         
-        predictions = model_xgb.predict(X)
-        pred_lower = model_quantile['lower'].predict(X)
-        pred_upper = model_quantile['upper'].predict(X)
-        confidence_scores = pred_upper - pred_lower
+        # Batch-wide lookups the chunks are matched against (id-range batches only)
+        previous = stored = None
+        if INCREMENTAL and id_min is not None:
+            # Unchanged profiles keep last quarter's prediction
+            previous = load_previous_predictions(s3_client, S3_BUCKET, PREVIOUS_YYYYQQ, id_min, id_max) \
+                if PREVIOUS_YYYYQQ else pd.DataFrame()
+        elif INCREMENTAL:
+            logger.warning("Incremental mode needs id-range batches, predicting every profile")
+        if FEATURE_STORE and id_min is not None:
+            stored = read_features(s3_client, S3_BUCKET, ['input_hash'] + STATIC_COLUMNS, id_min, id_max)
+        end_stage('lookups')
         
-        # 5. Prepare results
-        df_results = pd.DataFrame({
-            'id': df_features['id'],
-            'predicted_age': np.clip(np.round(predictions), 18, 75).astype(int),
-            'confidence_score': np.round(confidence_scores, 2),
+        # 4-6. Download, parse, features, predict, write - overlapped, chunk by chunk (WORKERS processes)
+        context = {
+            'model_xgb': model_xgb,
+            'model_quantile': model_quantile,
+            'batch_id': batch_id,
+            'bitmap': bitmap,
+            'previous': previous,
+            'stored': stored,
             'prediction_ts': datetime.now().isoformat(),
-            'model_version': 'v1.0_xgboost',
-            'batch_id': BATCH_ID
-        })
+            'qa_timestamp': athena_timestamp()  # One value for the whole batch
+        }
+        if WORKERS == 1:
+            set_model_threads(context, MODEL_THREADS)
+        # Output, cache and store rows go to local files chunk by chunk, uploaded once the batch is done
+        reference_date = datetime.now().strftime('%Y-%m-%d')  # Of the store rows' time features
+        sinks = {
+            'output': ParquetSink(f'/tmp/predictions_batch_{batch_id}.parquet', stats=True),
+            'cache': ParquetSink(f'/tmp/prediction_cache_batch_{batch_id}.parquet', prepare=lambda df: df[CACHE_COLUMNS]),
+            'store': ParquetSink(f'/tmp/feature_store_batch_{batch_id}.parquet',
+                                 prepare=lambda df: features_frame(df, reference_date),
+                                 **TIMESTAMP_OPTIONS)
+        }
+        totals, pipeline = predict_parts(parts, context, sinks)
+        output = sinks['output'].summary()
+        delete_unloaded(s3_client, S3_BUCKET, [key for key, _ in parts])
+        end_stage('pipeline')
+        logger.info(f"Loaded {totals['loaded']} raw records")
+        
+        if totals['loaded'] == 0:
+            logger.warning(f"No data for batch {batch_id}")
+            write_batch_manifest(batch, EMPTY_OUTPUT, None, 0, 0, expected_predictions, timings, checkpoint,
+                                 pipeline=pipeline, committed=committed)
+            return {'statusCode': 200, 'predictions': 0}
+        
+        if FINAL_ASSEMBLY:
+            logger.info(f"{totals['needs_prediction']} of {totals['loaded']} PIDs need an ML prediction")
+        if expected_predictions is not None and totals['needs_prediction'] != expected_predictions:
+            logger.warning(f"Batch {batch_id}: loaded {totals['needs_prediction']} PIDs needing prediction, "
+                           f"bitmap expected {expected_predictions}")
+        if previous is not None:
+            logger.info(f"Incremental: {totals['carried']} predictions carried forward from {PREVIOUS_YYYYQQ}, "
+                        f"{totals['needs_prediction'] - totals['carried']} new or changed profiles")
+        if stored is not None:
+            needs_model = totals['needs_prediction'] - totals['carried']
+            logger.info(f"Feature store {FEATURE_VERSION}: {needs_model - totals['parsed']} of {needs_model} profiles read, "
+                        f"{totals['parsed']} parsed")
+        
+        # 7. Upload (final-schema rows go straight under the final results table location)
+        tmp_file = sinks['output'].path
+        if FINAL_ASSEMBLY:
+            output_key, file_bytes, etag = upload_predictions(tmp_file, batch_id, attempt, f'predict-age/final-results/{FINAL_RESULTS_TABLE}')
+            logger.info(f"   Final rows written: {output['row_count']}")
+        else:
+            output_key, file_bytes, etag = upload_predictions(tmp_file, batch_id, attempt)
+        end_stage('save')
+        
+        # 8. Manifest (read by the VerifyBatchManifests step instead of re-querying outputs) - commits this copy
+        timings['total'] = time.time() - start_time
+        manifest = write_batch_manifest(batch, output, output_key, file_bytes, totals['predictions'], expected_predictions,
+                                        timings, checkpoint, carried_forward=totals['carried'], pipeline=pipeline,
+                                        etag=etag, committed=committed)
+        if manifest is None:
+            delete_output(output_key, 'another copy of the batch committed first')
+            return {'statusCode': 200, 'batch_id': batch_id, 'superseded': True}
         
-        # 6. Save to S3
-        output_key = save_predictions_to_s3(df_results)
+        # Only the committed copy rewrites this batch's store and cache files
+        if stored is not None and totals['parsed'] > 0:
+            upload_features(s3_client, S3_BUCKET, RAW_TABLE, id_min, id_max, sinks['store'].path, sinks['store'].rows)
+        if sinks['cache'].chunks:
+            write_prediction_cache(s3_client, S3_BUCKET, YYYYQQ, id_min, id_max, sinks['cache'].path, sinks['cache'].rows)
         
         elapsed = time.time() - start_time
-        logger.info(f"✅ Batch {BATCH_ID} completed in {elapsed:.2f}s")
-        logger.info(f"   Processed {len(df_results)} predictions")
-        logger.info(f"   Average age: {df_results['predicted_age'].mean():.1f} years")
-        logger.info(f"   Throughput: {len(df_results)/elapsed:.0f} rows/sec")
+        logger.info(f"✅ Batch {batch_id} completed in {elapsed:.2f}s")
+        logger.info(f"   Processed {totals['predictions']} predictions")
+        logger.info(f"   Average age: {totals['age_sum'] / max(totals['predictions'], 1):.1f} years")
+        logger.info(f"   Throughput: {totals['predictions']/elapsed:.0f} rows/sec")
         
         return {
             'statusCode': 200,
-            'batch_id': BATCH_ID,
-            'predictions': len(df_results),
+            'batch_id': batch_id,
+            'predictions': totals['predictions'],
             'output_key': output_key,
             'elapsed_sec': round(elapsed, 2)
         }
         
     except Exception as e:
-        logger.error(f"Error in prediction batch {BATCH_ID}: {str(e)}")
+        logger.error(f"Error in prediction batch {batch_id}: {str(e)}")
         raise
+    finally:
+        for sink in sinks.values():
+            sink.remove()  # Queue workers run several batches per task
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Arrow-backed Raw Frames
+Prediction batches UNLOAD their rows to Parquet instead of reading Athena's CSV
+result: columns arrive typed, the JSON/text columns stay Arrow-backed strings in
+pandas (no Python str object per cell, no CSV parsing buffers), and only the
+columns a batch uses are selected (RAW_COLUMNS, not SELECT *). The text columns
+are dropped once the features are computed; the features are one float32 block
+handed to the models without another copy (feature_spec.feature_matrix).
+
+Layout (one prefix per task, deleted after reading; cleanup removes leftovers):
+  predict-age/batch-unload/{YYYYQQ}/batch_{NNNN}_{task}/
+
+Usage:
+  python raw_frame.py bench --rows 100000   # Peak RSS / time: CSV + object + float64 vs Parquet + Arrow + float32
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import tempfile
+import multiprocessing
+from io import BytesIO
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from feature_spec import INPUT_COLUMNS, STRING_DTYPE
+from aws_retry import call_with_retries
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+UNLOAD_PREFIX = 'predict-age/batch-unload'
+# Kept after feature creation (map-side final assembly priority rules)
+ASSEMBLY_COLUMNS = ['id', 'birth_year', 'approximate_age']
+# Everything a prediction batch reads from the raw table
+RAW_COLUMNS = ASSEMBLY_COLUMNS + INPUT_COLUMNS
+
+def arrow_type_mapper(arrow_type):
+    """Arrow strings stay Arrow-backed in pandas; other types convert as usual"""
+    if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+        return STRING_DTYPE
+    return None
+
+def unload_query(select_sql, bucket, prefix):
+    """UNLOAD a SELECT to Parquet under an empty prefix"""
+    return f"""
+    UNLOAD (
+    {select_sql}
+    )
+    TO 's3://{bucket}/{prefix}'
+    WITH (format = 'PARQUET', compression = 'SNAPPY')
+    """
+
+def read_parquet_frame(bodies, columns=None):
+    """DataFrame from Parquet file bytes (UNLOAD parts), strings Arrow-backed"""
+    tables = [pq.read_table(pa.BufferReader(body), columns=columns) for body in bodies]
+    if not tables:
+        return pd.DataFrame(columns=columns or [])
+    table = pa.concat_tables(tables, promote_options='default') if len(tables) > 1 else tables[0]
+    del tables
+    return table.to_pandas(types_mapper=arrow_type_mapper, date_as_object=False, split_blocks=True, self_destruct=True)
+
+def iter_parquet_frames(body, chunk_rows, columns=None, rows=None):
+    """
+    DataFrames of at most chunk_rows rows from one Parquet file's bytes, strings
+    Arrow-backed; rows=(start, stop) reads only that row range (only the row
+    groups it overlaps are decoded)
+    """
+    parquet = pq.ParquetFile(pa.BufferReader(body))
+    start, stop = rows if rows is not None else (0, parquet.metadata.num_rows)
+    row_groups, position, first_row = [], 0, None
+    for index in range(parquet.num_row_groups):
+        group_rows = parquet.metadata.row_group(index).num_rows
+        if position < stop and position + group_rows > start:
+            row_groups.append(index)
+            first_row = position if first_row is None else first_row
+        position += group_rows
+    if not row_groups:
+        return
+    position = first_row
+    for batch in parquet.iter_batches(batch_size=chunk_rows, row_groups=row_groups, columns=columns):
+        offset = max(start - position, 0)
+        length = min(stop - position, batch.num_rows) - offset
+        position += batch.num_rows
+        if length > 0:
+            yield pa.Table.from_batches([batch.slice(offset, length)]).to_pandas(
+                types_mapper=arrow_type_mapper, date_as_object=False, split_blocks=True, self_destruct=True)
+
+def list_unloaded(s3_client, bucket, prefix):
+    """(key, size) of the Parquet parts under an UNLOAD prefix"""
+    def list_parts():
+        paginator = s3_client.get_paginator('list_objects_v2')
+        return [(obj['Key'], obj['Size']) for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+                for obj in page.get('Contents', [])]
+    return call_with_retries(list_parts, f"LIST s3://{bucket}/{prefix}")
+
+def delete_unloaded(s3_client, bucket, keys):
+    for start in range(0, len(keys), 1000):
+        objects = [{'Key': key} for key in keys[start:start + 1000]]
+        call_with_retries(lambda: s3_client.delete_objects(Bucket=bucket, Delete={'Objects': objects}),
+                          f"DELETE {len(objects)} objects in s3://{bucket}")
+
+def memory_mb(field):
+    """VmRSS / VmHWM (peak) of this process in MB, from /proc (Linux)"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024
+    return None
+
+def reset_peak_rss():
+    """Restart VmHWM at the current RSS (ru_maxrss cannot be reset and survives fork/exec)"""
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+def bench_raw(rows):
+    """Raw rows in RAW_COLUMNS; like real profiles, every JSON document and URL/email is distinct"""
+    from incremental import synthetic_raw
+
+    raw = synthetic_raw(rows, seed=1)
+    ids = raw['id'].astype(str)
+    raw['education'] = '[{"school": "School ' + ids + '", ' + raw['education'].str[2:]
+    raw['work_experience'] = '[{"company": "Company ' + ids + '", ' + raw['work_experience'].str[2:]
+    raw['skills'] = '["python", "sql", "skill_' + ids + '"]'
+    raw['facebook_url'] = raw['facebook_url'].where(raw['facebook_url'] == '', 'https://facebook.com/' + ids)
+    raw['work_email'] = raw['work_email'].where(raw['work_email'] == '', 'user' + ids + '@example.com')
+    raw['birth_year'] = np.nan
+    raw['approximate_age'] = np.nan
+    return raw[RAW_COLUMNS]
+
+def measure_pipeline(mode, paths, results):
+    """Child process: result bytes -> raw frame -> features -> model matrix; peak RSS above the RSS with the bytes loaded"""
+    from feature_spec import compute_features, feature_matrix
+
+    def load(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    if mode == 'legacy':
+        # Athena CSV result: Python-object strings, full-frame copy, float64 features, .values copy
+        pd.set_option('future.infer_string', False)
+        body = load(paths['csv'])
+        compute_features(pd.read_csv(BytesIO(load(paths['csv_warmup']))))  # Lazily imported code is not pipeline memory
+        reset_peak_rss()
+        baseline_mb = memory_mb('VmRSS')
+        start = time.time()
+        df_raw = pd.read_csv(BytesIO(body)).copy()
+        raw_frame_mb = df_raw.memory_usage(deep=True).sum() / 1e6
+        df_features = compute_features(df_raw)
+        X = df_features.astype('float64').drop('id', axis=1).values
+    else:
+        # UNLOAD Parquet: Arrow strings, text columns dropped after features, float32 block as the matrix
+        body = load(paths['parquet'])
+        compute_features(read_parquet_frame([load(paths['parquet_warmup'])]))
+        reset_peak_rss()
+        baseline_mb = memory_mb('VmRSS')
+        start = time.time()
+        df_raw = read_parquet_frame([body])
+        raw_frame_mb = df_raw.memory_usage(deep=True).sum() / 1e6
+        df_features = compute_features(df_raw)
+        df_raw = df_raw[ASSEMBLY_COLUMNS]
+        X = feature_matrix(df_features)
+    results[mode] = {
+        'peak_rss_mb': round(memory_mb('VmHWM') - baseline_mb, 1),
+        'sec': round(time.time() - start, 2),
+        'raw_frame_mb': round(raw_frame_mb, 1),
+        'raw_frame_kept_mb': round(df_raw.memory_usage(deep=True).sum() / 1e6, 1),
+        'result_mb': round(len(body) / 1e6, 1),
+        'matrix_mb': round(X.nbytes / 1e6, 1),
+        'matrix_dtype': str(X.dtype),
+        'matrix_zero_copy': bool(np.shares_memory(X, df_features['tenure_months'].values))
+    }
+
+def run_benchmark(rows):
+    """
+    Peak RSS of one batch from query result to model matrix, each variant in a
+    fresh process (CSV result + object strings + float64 vs UNLOAD Parquet +
+    Arrow strings + float32)
+    """
+    import pyarrow.csv as pacsv
+
+    work_dir = tempfile.mkdtemp(prefix='raw_frame_bench_')
+    paths = {name: os.path.join(work_dir, name) for name in ['csv', 'csv_warmup', 'parquet', 'parquet_warmup']}
+    raw = bench_raw(rows)
+    raw.to_csv(paths['csv'], index=False)
+    raw.head(2000).to_csv(paths['csv_warmup'], index=False)
+    del raw
+    # Parquet parts as UNLOAD writes them: typed columns from the table schema
+    table = pacsv.read_csv(paths['csv'])
+    pq.write_table(table, paths['parquet'], compression='snappy')
+    pq.write_table(table.slice(0, 2000), paths['parquet_warmup'], compression='snappy')
+    del table
+
+    context = multiprocessing.get_context('spawn')
+    shared = context.Manager().dict()
+    for mode in ['legacy', 'arrow']:
+        process = context.Process(target=measure_pipeline, args=(mode, paths, shared))
+        process.start()
+        process.join()
+    for path in paths.values():
+        os.remove(path)
+    os.rmdir(work_dir)
+
+    results = {'rows': rows}
+    results.update(dict(shared))
+    results['peak_rss_reduction'] = round(results['legacy']['peak_rss_mb'] / max(results['arrow']['peak_rss_mb'], 0.1), 2)
+    logger.info(f"Benchmark results: {json.dumps(results, indent=2)}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Arrow-backed raw frames')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    bench_parser = subparsers.add_parser('bench', help='Peak RSS: CSV/object/float64 vs Parquet/Arrow/float32 pipeline')
+    bench_parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        run_benchmark(args.rows)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Shared-Memory Inference Workers
+Feature creation is single-core pandas/Arrow work, so a prediction task uses one
+of its vCPUs for most of a batch. With PREDICTION_WORKERS=N the task forks N
+worker processes once the models and the batch's lookups are loaded: they are
+inherited copy-on-write, not loaded or pickled N times. Each UNLOAD part is
+downloaded once by the parent into a slot of an anonymous shared mapping
+created before the fork (SharedArena, a ring of ARENA_SLOTS slots the size of
+the largest part, recycled once a part's shards are gathered: the mapping does
+not grow with the batch); the workers decode their row shard of a part straight
+from it (only the row groups the shard overlaps, no copy through a pipe),
+compute features and predictions, and send back only the output rows, which
+the parent writes in part and shard order into the batch's one output file.
+
+  parent:   download part -> arena ------------------------> write outputs
+  worker k:                    rows [k*n/N, (k+1)*n/N) -> features -> predict
+
+Workers run one model thread each (the processes are the parallelism). Fork
+before the parent runs any OpenMP code: prediction tasks in this mode never
+predict in the parent. PREDICTION_WORKERS=0 forks as many workers as the task's
+CPU quota and memory allow (resources.py).
+
+A worker killed mid-shard (out of memory, a native crash) is replaced by the
+pool without a word and its shard never completes: the parent waits for shard
+results with wait_result(), which fails the batch if one of the forked workers
+has exited or a shard takes longer than PREDICTION_WORKER_TIMEOUT_SEC.
+
+Usage:
+  python shared_inference.py bench --rows 100000 --workers 4 --model-mb 200
+      # Features + inference scaling over 1..N forked workers, model memory shared
+"""
+
+import os
+import sys
+import json
+import mmap
+import time
+import queue
+import argparse
+import logging
+import multiprocessing
+import numpy as np
+import pyarrow as pa
+from resources import detect, process_count
+from stage_pipeline import POLL_SEC, PIPELINE_QUEUE_SIZE, PipelineAborted
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Worker processes per prediction task; 1 computes in the task process (threads only), 0: from the task's resources
+PREDICTION_WORKERS = int(os.environ.get('PREDICTION_WORKERS', '1'))
+WORKER_BASE_MB = 64  # Private memory of a forked worker besides its chunk (interpreter pages it writes to)
+# Parts in the arena at once: one downloading, the queued ones, one in the workers
+ARENA_SLOTS = PIPELINE_QUEUE_SIZE + 2
+# Longest a shard may take before the batch fails (a hung worker)
+WORKER_TIMEOUT_SEC = float(os.environ.get('PREDICTION_WORKER_TIMEOUT_SEC', '1800'))
+
+class WorkerLost(RuntimeError):
+    """A forked worker died or overran WORKER_TIMEOUT_SEC: its shard will never complete, the batch fails"""
+
+class SharedArena:
+    """
+    A ring of equal slots, each of slot_bytes, in an anonymous MAP_SHARED
+    mapping. Created before the workers are forked, so what the parent writes
+    into a slot is visible to them without copying. The parent acquires a slot
+    per part and releases it once the part's shards are gathered; the mapping
+    is freed with the last process that maps it.
+    """
+    def __init__(self, slots, slot_bytes):
+        self.slot_bytes = max(int(slot_bytes), 1)
+        self.mmap = mmap.mmap(-1, slots * self.slot_bytes)
+        self.free = queue.Queue()  # Parent only
+        for slot in range(slots):
+            self.free.put(slot)
+
+    def acquire(self, abort=None):
+        """A free slot, waiting for a release; raises PipelineAborted once abort (threading.Event) is set"""
+        while True:
+            if abort is not None and abort.is_set():
+                raise PipelineAborted()
+            try:
+                return self.free.get(timeout=POLL_SEC)
+            except queue.Empty:
+                continue
+
+    def release(self, slot):
+        self.free.put(slot)
+
+    def write(self, slot, body):
+        if len(body) > self.slot_bytes:
+            raise ValueError(f"Part is {len(body)} bytes, slot holds {self.slot_bytes}")
+        start = slot * self.slot_bytes
+        self.mmap[start:start + len(body)] = body
+
+    def view(self, slot, nbytes):
+        """Zero-copy Arrow buffer over a slot's first nbytes (workers only: the mapping cannot be closed while it is exported)"""
+        return pa.py_buffer(self.mmap).slice(slot * self.slot_bytes, nbytes)
+
+    def close(self):
+        self.mmap.close()
+
+def row_shards(num_rows, shards):
+    """Contiguous (start, stop) row ranges of nearly equal size, empty ones dropped"""
+    bounds = np.linspace(0, num_rows, shards + 1).astype('int64')
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+def worker_count(chunk_mb):
+    """PREDICTION_WORKERS, or (0) one worker per CPU as far as workers holding a chunk_mb chunk fit in memory"""
+    return PREDICTION_WORKERS or process_count(WORKER_BASE_MB + chunk_mb)
+
+def fork_pool(workers, initializer=None):
+    """Worker processes forked from this one (module state, models included, is inherited)"""
+    pool = multiprocessing.get_context('fork').Pool(workers, initializer=initializer)
+    pool.forked = list(pool._pool)  # The pool replaces a dead worker itself; wait_result() checks these
+    return pool
+
+def wait_result(pool, result, timeout=WORKER_TIMEOUT_SEC):
+    """
+    result.get() of a fork_pool() task; raises WorkerLost if a forked worker has
+    exited (the task it held never completes) or after timeout seconds
+    """
+    deadline = time.monotonic() + timeout
+    while not result.ready():
+        dead = [process.pid for process in pool.forked if process.exitcode is not None]
+        if dead:
+            raise WorkerLost(f"Worker process(es) {', '.join(map(str, dead))} exited, shard results are lost")
+        if time.monotonic() >= deadline:
+            raise WorkerLost(f"No shard result after {timeout:.0f}s")
+        result.wait(POLL_SEC)
+    return result.get()
+
+def memory_mb():
+    """Rss / Pss / private / shared MB of this process (/proc/self/smaps_rollup, Linux)"""
+    fields = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return {
+        'rss_mb': round(fields.get('Rss', 0), 1),
+        'pss_mb': round(fields.get('Pss', 0), 1),
+        'private_mb': round(fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0), 1),
+        'shared_mb': round(fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0), 1)
+    }
+
+# Bench state inherited by the forked workers
+BENCH = {}
+
+def bench_shard(slot, nbytes, row_start, row_stop):
+    """Bench worker: features and stand-in inference for one row shard of a part in the arena"""
+    from feature_spec import compute_features, feature_matrix
+    from raw_frame import iter_parquet_frames
+
+    start = time.perf_counter()
+    rows = 0
+    checksum = 0.0
+    for df_raw in iter_parquet_frames(BENCH['arena'].view(slot, nbytes), BENCH['chunk_rows'], rows=(row_start, row_stop)):
+        X = feature_matrix(compute_features(df_raw))
+        model = BENCH['model']
+        model[::1024].sum()  # Stand-in model: reads its (shared) pages for every chunk
+        checksum += float((X.astype('float64') @ model[:X.shape[1]].astype('float64')).sum())
+        rows += len(X)
+    return rows, checksum, time.perf_counter() - start, os.getpid(), memory_mb()
+
+def run_benchmark(rows, parts, max_workers, model_mb, chunk_rows):
+    """
+    One batch (rows in parts) through features + inference with 1..max_workers
+    forked workers over a shared arena; the model is a model_mb float32 array
+    loaded before the fork. Reports wall time, speedup and per-worker memory
+    (private MB stays small: the model pages are shared, not copied).
+    """
+    import pyarrow.parquet as pq
+    from feature_spec import compute_features
+    from raw_frame import bench_raw, iter_parquet_frames
+
+    raw = pa.Table.from_pandas(bench_raw(rows), preserve_index=False)
+    part_rows = -(-rows // parts)
+    bodies = []
+    for start in range(0, rows, part_rows):
+        sink = pa.BufferOutputStream()
+        pq.write_table(raw.slice(start, part_rows), sink, compression='snappy', row_group_size=chunk_rows)
+        bodies.append(sink.getvalue().to_pybytes())
+    del raw
+    compute_features(next(iter_parquet_frames(bodies[0], 1000)))  # Lazily imported code is loaded before the fork
+
+    results = {'rows': rows, 'parts': len(bodies), 'model_mb': model_mb, 'chunk_rows': chunk_rows,
+               'cpus': detect()['cpus'], 'workers': {}}
+    BENCH['model'] = np.ones(int(model_mb * 1e6 / 4), dtype='float32')
+    BENCH['chunk_rows'] = chunk_rows
+    checksums = set()
+    for workers in sorted({1, *range(2, max_workers + 1)}):
+        arena = SharedArena(len(bodies), max(len(body) for body in bodies))
+        BENCH['arena'] = arena
+        pool = fork_pool(workers)
+        start = time.time()
+        pending = []
+        for body in bodies:
+            slot = arena.acquire()
+            arena.write(slot, body)
+            num_rows = pq.ParquetFile(pa.BufferReader(body)).metadata.num_rows
+            pending += [pool.apply_async(bench_shard, (slot, len(body), row_start, row_stop))
+                        for row_start, row_stop in row_shards(num_rows, workers)]
+        shards = [wait_result(pool, result) for result in pending]
+        sec = time.time() - start
+        pool.close()
+        pool.join()
+        arena.close()
+
+        if sum(shard[0] for shard in shards) != rows:
+            raise AssertionError(f"{workers} workers processed {sum(shard[0] for shard in shards)} of {rows} rows")
+        checksums.add(round(sum(shard[1] for shard in shards), 1))
+        by_worker = {}
+        for _, _, _, pid, memory in shards:
+            by_worker[pid] = memory  # Last reading per worker
+        results['workers'][workers] = {
+            'sec': round(sec, 2),
+            'rows_per_sec': round(rows / sec),
+            'speedup': round(results['workers'][1]['sec'] / sec, 2) if workers > 1 else 1.0,
+            'busy_sec': round(sum(shard[2] for shard in shards), 2),
+            'worker_private_mb': max(memory['private_mb'] for memory in by_worker.values()),
+            'worker_shared_mb': min(memory['shared_mb'] for memory in by_worker.values())
+        }
+    if len(checksums) != 1:
+        raise AssertionError(f"Results differ between worker counts: {checksums}")
+    logger.info(f"Benchmark results: {json.dumps(results, indent=2)}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Shared-memory inference workers')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    bench_parser = subparsers.add_parser('bench', help='Scaling over forked workers')
+    bench_parser.add_argument('--rows', type=int, default=100000)
+    bench_parser.add_argument('--parts', type=int, default=4)
+    bench_parser.add_argument('--workers', type=int, default=detect()['cpus'])
+    bench_parser.add_argument('--model-mb', type=float, default=200.0)
+    bench_parser.add_argument('--chunk-rows', type=int, default=16384)
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        run_benchmark(args.rows, args.parts, args.workers, args.model_mb, args.chunk_rows)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Staged Batch Pipeline
+A prediction batch is a chain of stages - download the UNLOAD parts, decode
+them into row chunks, features, inference, Parquet write. Run one after the
+other, the network is idle while the CPU computes and the CPU is idle while S3
+transfers. run_stages() runs each stage on its own thread, connected by bounded
+queues: S3 reads, Parquet decoding, Arrow string kernels and XGBoost predict
+release the GIL, so the download of part N+1 and the write of chunk N-1 overlap
+the features and inference of chunk N, and at most queue_size items wait
+between two stages. A stage must not keep what it passed on (prediction.py's
+write stages append each chunk to a local Parquet file): then the pipeline's
+memory is bounded by the chunk size and queue_size, not the batch.
+
+A stage is (name, fn): fn(item) yields zero or more items for the next stage
+(a part yields several chunks); what the last stage yields is returned in
+order. The first exception in any stage stops the others and is raised; a
+stage that waits on something other than its input queue (a free buffer) polls
+the abort event passed to run_stages() and unwinds with PipelineAborted.
+
+Per-stage metrics (logged and written to the batch manifest):
+  busy_sec     time in the stage's own code
+  starved_sec  waiting for the previous stage (input queue empty)
+  blocked_sec  waiting for the next stage (output queue full)
+  utilization  busy_sec / pipeline wall time - the stage near 1.0 is the bottleneck
+
+Usage:
+  python stage_pipeline.py bench --rows 100000 --parts 8 --mb-per-sec 50 --latency-ms 50
+      # Sequential vs pipelined stages on UNLOAD-shaped parts with simulated S3 transfer times
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import logging
+import threading
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Items waiting between two stages; 0 runs the stages in sequence on the calling thread
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', '2'))
+POLL_SEC = 0.1  # Blocked stages re-check for a failure elsewhere at this interval
+END = object()  # End of a stage's input
+
+class PipelineAborted(Exception):
+    """Another stage failed; raised inside the remaining stages to unwind them"""
+
+def new_stats():
+    return {'items_in': 0, 'items_out': 0, 'busy_sec': 0.0, 'starved_sec': 0.0, 'blocked_sec': 0.0}
+
+def drive(fn, item, emit, stats):
+    """Run fn(item) to exhaustion; only the time inside fn counts as busy (emit is the next stage's or a queue's)"""
+    stats['items_in'] += 1
+    start = time.perf_counter()
+    outputs = iter(fn(item))
+    while True:
+        try:
+            output = next(outputs)
+        except StopIteration:
+            stats['busy_sec'] += time.perf_counter() - start
+            return
+        stats['busy_sec'] += time.perf_counter() - start
+        stats['items_out'] += 1
+        emit(output)
+        start = time.perf_counter()
+
+def run_sequential(source, stages, stats, results):
+    """Every item goes through all stages before the next one is read (the pre-pipeline behaviour)"""
+    def emitter(index):
+        if index == len(stages):
+            return results.append
+        name, fn = stages[index]
+        emit = emitter(index + 1)
+        return lambda item: drive(fn, item, emit, stats[name])
+
+    first = emitter(0)
+    for item in source:
+        first(item)
+
+def run_threaded(source, stages, stats, results, queue_size, failed):
+    """One thread per stage, bounded queues in between; failed is set by the first stage that fails"""
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages[1:]]
+    errors = []
+
+    def put(q, item, stage_stats):
+        start = time.perf_counter()
+        while True:
+            if failed.is_set():
+                raise PipelineAborted()
+            try:
+                q.put(item, timeout=POLL_SEC)
+                break
+            except queue.Full:
+                continue
+        stage_stats['blocked_sec'] += time.perf_counter() - start
+
+    def get(q, stage_stats):
+        start = time.perf_counter()
+        while True:
+            if failed.is_set():
+                raise PipelineAborted()
+            try:
+                item = q.get(timeout=POLL_SEC)
+                break
+            except queue.Empty:
+                continue
+        stage_stats['starved_sec'] += time.perf_counter() - start
+        return item
+
+    def items(index, stage_stats):
+        if index == 0:
+            iterator = iter(source)
+            while True:
+                start = time.perf_counter()
+                item = next(iterator, END)
+                stage_stats['starved_sec'] += time.perf_counter() - start
+                if item is END:
+                    return
+                yield item
+        else:
+            while True:
+                item = get(queues[index - 1], stage_stats)
+                if item is END:
+                    return
+                yield item
+
+    def worker(index):
+        name, fn = stages[index]
+        stage_stats = stats[name]
+        if index + 1 < len(stages):
+            emit = lambda item: put(queues[index], item, stage_stats)
+        else:
+            emit = results.append
+        try:
+            for item in items(index, stage_stats):
+                drive(fn, item, emit, stage_stats)
+            if index + 1 < len(stages):
+                put(queues[index], END, stage_stats)
+        except PipelineAborted:
+            pass
+        except BaseException as e:
+            errors.append((name, e))
+            failed.set()
+
+    threads = [threading.Thread(target=worker, args=(index,), name=f'stage-{name}', daemon=True)
+               for index, (name, _) in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        name, error = errors[0]
+        logger.error(f"Pipeline stage {name} failed: {error}")
+        raise error
+
+def run_stages(source, stages, queue_size=PIPELINE_QUEUE_SIZE, abort=None):
+    """
+    Feed the items of source through stages [(name, fn)], each fn(item) yielding
+    items for the next stage. Returns (what the last stage yielded, metrics).
+    queue_size > 0: one thread per stage with queues of that size in between;
+    0: in sequence on the calling thread (same metrics, nothing overlaps).
+    abort (threading.Event) is set when a stage fails.
+    """
+    stats = {name: new_stats() for name, _ in stages}
+    results = []
+    start = time.perf_counter()
+    if queue_size > 0:
+        run_threaded(source, stages, stats, results, queue_size, abort if abort is not None else threading.Event())
+    else:
+        run_sequential(source, stages, stats, results)
+    wall_sec = time.perf_counter() - start
+
+    busy_sec = sum(stage['busy_sec'] for stage in stats.values())
+    for stage in stats.values():
+        stage['utilization'] = round(stage['busy_sec'] / wall_sec, 3) if wall_sec > 0 else 0.0
+        for key in ['busy_sec', 'starved_sec', 'blocked_sec']:
+            stage[key] = round(stage[key], 3)
+    metrics = {
+        'queue_size': queue_size,
+        'wall_sec': round(wall_sec, 3),
+        'busy_sec': round(busy_sec, 3),
+        'overlap': round(busy_sec / wall_sec, 2) if wall_sec > 0 else 0.0,  # > 1: stages ran concurrently
+        'bottleneck': max(stats, key=lambda name: stats[name]['busy_sec']) if stats else None,
+        'stages': stats
+    }
+    return results, metrics
+
+def log_metrics(metrics):
+    """One line per stage: where the batch's time went"""
+    logger.info(f"Pipeline: {metrics['wall_sec']:.2f}s wall, {metrics['busy_sec']:.2f}s stage time "
+                f"(overlap {metrics['overlap']:.2f}x, queue size {metrics['queue_size']}), "
+                f"bottleneck: {metrics['bottleneck']}")
+    for name, stage in metrics['stages'].items():
+        logger.info(f"   {name:<10} busy {stage['busy_sec']:7.2f}s ({100 * stage['utilization']:5.1f}%)  "
+                    f"starved {stage['starved_sec']:7.2f}s  blocked {stage['blocked_sec']:7.2f}s  "
+                    f"{stage['items_in']} in / {stage['items_out']} out")
+
+def run_benchmark(rows, parts, mb_per_sec, latency_ms, chunk_rows):
+    """
+    One batch as UNLOAD parts: download (simulated S3 GET: latency_ms + part
+    size / mb_per_sec, GIL released like a socket read) -> Parquet chunks -> features ->
+    inference (NumPy stand-in for the models) -> Parquet write, in sequence and
+    pipelined. Outputs must be identical.
+    """
+    import tempfile
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from feature_spec import compute_features, feature_matrix
+    from raw_frame import bench_raw, iter_parquet_frames
+
+    raw = pa.Table.from_pandas(bench_raw(rows), preserve_index=False)
+    bodies = []
+    for start in range(0, rows, -(-rows // parts)):
+        sink = pa.BufferOutputStream()
+        pq.write_table(raw.slice(start, -(-rows // parts)), sink, compression='snappy')
+        bodies.append(sink.getvalue().to_pybytes())
+    del raw
+    weights = np.linspace(0.1, 1.0, 21, dtype='float32')
+    compute_features(next(iter_parquet_frames(bodies[0], 1000)))  # Lazily imported code is not pipeline time
+
+    def download(body):
+        time.sleep(latency_ms / 1000 + len(body) / (mb_per_sec * 1e6))
+        yield body
+
+    def parse(body):
+        yield from iter_parquet_frames(body, chunk_rows)
+
+    def features(df_raw):
+        yield compute_features(df_raw)
+
+    def predict(df_features):
+        X = feature_matrix(df_features)
+        yield pa.table({'id': df_features['id'].values, 'predicted_age': np.clip(np.round(X @ weights), 18, 75)})
+
+    def run(queue_size, path):
+        writer = None
+
+        def write(table):
+            nonlocal writer
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema, compression='snappy')
+            writer.write_table(table)
+            yield len(table)
+
+        start = time.time()
+        written, metrics = run_stages(bodies, [('download', download), ('parse', parse), ('features', features),
+                                               ('predict', predict), ('write', write)], queue_size)
+        writer.close()
+        return sum(written), time.time() - start, metrics
+
+    work_dir = tempfile.mkdtemp(prefix='stage_pipeline_bench_')
+    paths = {mode: os.path.join(work_dir, f'{mode}.parquet') for mode in ['sequential', 'pipelined']}
+    results = {'rows': rows, 'parts': len(bodies), 'mb': round(sum(map(len, bodies)) / 1e6, 1),
+               'mb_per_sec': mb_per_sec, 'latency_ms': latency_ms, 'chunk_rows': chunk_rows}
+    for mode, queue_size in [('sequential', 0), ('pipelined', PIPELINE_QUEUE_SIZE or 2)]:
+        written, sec, metrics = run(queue_size, paths[mode])
+        log_metrics(metrics)
+        results[mode] = {'sec': round(sec, 2), 'rows_written': written, 'overlap': metrics['overlap'],
+                         'bottleneck': metrics['bottleneck'],
+                         'utilization': {name: stage['utilization'] for name, stage in metrics['stages'].items()}}
+    if not pq.read_table(paths['sequential']).equals(pq.read_table(paths['pipelined'])):
+        raise AssertionError("Pipelined output differs from sequential output")
+    for path in paths.values():
+        os.remove(path)
+    os.rmdir(work_dir)
+    results['speedup'] = round(results['sequential']['sec'] / results['pipelined']['sec'], 2)
+    logger.info(f"Benchmark results: {json.dumps(results, indent=2)}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Staged batch pipeline')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    bench_parser = subparsers.add_parser('bench', help='Sequential vs pipelined stages')
+    bench_parser.add_argument('--rows', type=int, default=100000)
+    bench_parser.add_argument('--parts', type=int, default=8)
+    bench_parser.add_argument('--mb-per-sec', type=float, default=50.0, help='Simulated S3 read throughput')
+    bench_parser.add_argument('--latency-ms', type=float, default=50.0, help='Simulated S3 time to first byte')
+    bench_parser.add_argument('--chunk-rows', type=int, default=16384)
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        run_benchmark(args.rows, args.parts, args.mb_per_sec, args.latency_ms, args.chunk_rows)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
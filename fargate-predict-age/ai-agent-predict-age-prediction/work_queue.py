@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+Work-Stealing Prediction Queue
+Pull-based alternative to one Fargate task per batch: a fixed pool of workers
+leases id-range work units (rows of the batch plan manifest) from a queue, so
+fast workers keep pulling and one slow placement or Athena queue delay only
+delays its own unit instead of the whole run.
+
+Leases are visibility timeouts: a leased unit is invisible for
+LEASE_SECONDS, a heartbeat thread extends it while the unit runs, ack deletes
+it. If a worker dies the lease expires and another worker picks the unit up
+(after MAX_ATTEMPTS leases it goes to the dead-letter queue / 'failed').
+Units are idempotent - a re-run writes its own batch_NNNN_{attempt} output and
+replaces the manifest only if no other lease of the unit committed meanwhile
+(prediction.write_batch_manifest).
+
+Backends:
+  SqsWorkQueue      SQS (QUEUE_URL), used by the RunWorkerPool step
+  SqliteWorkQueue   local file, same semantics, for testing and local runs
+
+Usage:
+  python work_queue.py worker                                     # SQS worker (container command)
+  python work_queue.py worker --db /tmp/queue.db                  # Local worker on a SQLite queue
+  python work_queue.py enqueue --db /tmp/queue.db --manifest batches.csv
+  python work_queue.py bench --batches 898 --workers 100          # Task per batch vs worker pool makespan
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import random
+import sqlite3
+import argparse
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Environment variables
+QUEUE_URL = os.environ.get('QUEUE_URL')
+WORKER_ID = os.environ.get('WORKER_ID', '0')
+LEASE_SECONDS = int(os.environ.get('LEASE_SECONDS', '600'))
+MAX_ATTEMPTS = int(os.environ.get('MAX_ATTEMPTS', '3'))  # Matches the SQS redrive maxReceiveCount
+EMPTY_CHECKS_TO_EXIT = 2  # SQS counts are approximate: require two empty readings in a row
+
+class SqsWorkQueue:
+    """Work units as SQS messages; a lease is the receipt handle of an invisible message"""
+
+    def __init__(self, sqs_client, queue_url):
+        self.sqs = sqs_client
+        self.queue_url = queue_url
+
+    def put(self, units):
+        entries = [{'Id': str(i), 'MessageBody': json.dumps(unit)} for i, unit in enumerate(units)]
+        for start in range(0, len(entries), 10):  # SendMessageBatch limit
+            response = self.sqs.send_message_batch(QueueUrl=self.queue_url, Entries=entries[start:start + 10])
+            if response.get('Failed'):
+                raise Exception(f"Failed to enqueue {len(response['Failed'])} units: {response['Failed'][:3]}")
+        return len(entries)
+
+    def lease(self, lease_seconds):
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=1,
+            WaitTimeSeconds=20,  # Long poll
+            VisibilityTimeout=lease_seconds,
+            AttributeNames=['ApproximateReceiveCount']
+        )
+        messages = response.get('Messages', [])
+        if not messages:
+            return None
+        message = messages[0]
+        return {
+            'unit': json.loads(message['Body']),
+            'handle': message['ReceiptHandle'],
+            'attempt': int(message['Attributes']['ApproximateReceiveCount'])
+        }
+
+    def extend(self, lease, lease_seconds):
+        self.sqs.change_message_visibility(QueueUrl=self.queue_url, ReceiptHandle=lease['handle'],
+                                           VisibilityTimeout=lease_seconds)
+
+    def ack(self, lease):
+        self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=lease['handle'])
+
+    def release(self, lease):
+        """Make the unit visible again now (another worker retries it)"""
+        self.extend(lease, 0)
+
+    def remaining(self):
+        attributes = self.sqs.get_queue_attributes(
+            QueueUrl=self.queue_url,
+            AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible']
+        )['Attributes']
+        return int(attributes['ApproximateNumberOfMessages']) + int(attributes['ApproximateNumberOfMessagesNotVisible'])
+
+class SqliteWorkQueue:
+    """Local stand-in for SqsWorkQueue: one row per unit, lease_until as the visibility timeout"""
+
+    def __init__(self, path, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        # Threads of one process take turns here instead of in SQLite's sleeping busy handler
+        self.lock = threading.Lock()
+        self.local = threading.local()  # One connection per thread
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS units (
+                unit_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                body TEXT NOT NULL,
+                lease_until REAL NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                done INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+
+    def _connection(self):
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self.local.conn.execute('PRAGMA synchronous=NORMAL')  # WAL stays consistent; no fsync per lease
+        return self.local.conn
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            return self._connection().execute(sql, params)
+
+    def put(self, units):
+        conn = self._connection()
+        with self.lock:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('INSERT INTO units (body) VALUES (?)', [(json.dumps(unit),) for unit in units])
+            conn.execute('COMMIT')
+        return len(units)
+
+    def lease(self, lease_seconds):
+        conn = self._connection()
+        with self.lock:
+            now = time.time()
+            conn.execute('BEGIN IMMEDIATE')  # Serializes leases across processes
+            try:
+                row = conn.execute(
+                    'SELECT unit_id, body, attempts FROM units '
+                    'WHERE done = 0 AND lease_until <= ? AND attempts < ? ORDER BY unit_id LIMIT 1',
+                    (now, self.max_attempts)
+                ).fetchone()
+                if row is not None:
+                    conn.execute('UPDATE units SET lease_until = ?, attempts = attempts + 1 WHERE unit_id = ?',
+                                 (now + lease_seconds, row[0]))
+            finally:
+                conn.execute('COMMIT')
+        if row is None:
+            return None
+        return {'unit': json.loads(row[1]), 'handle': row[0], 'attempt': row[2] + 1}
+
+    def extend(self, lease, lease_seconds):
+        self._execute('UPDATE units SET lease_until = ? WHERE unit_id = ?', (time.time() + lease_seconds, lease['handle']))
+
+    def ack(self, lease):
+        self._execute('UPDATE units SET done = 1 WHERE unit_id = ?', (lease['handle'],))
+
+    def release(self, lease):
+        self.extend(lease, 0)
+
+    def remaining(self):
+        """Units not done that can still run (visible, or leased and may come back)"""
+        return self._execute(
+            'SELECT COUNT(*) FROM units WHERE done = 0 AND (attempts < ? OR lease_until > ?)',
+            (self.max_attempts, time.time())
+        ).fetchone()[0]
+
+    def failed(self):
+        """Units that used up MAX_ATTEMPTS without an ack (the SQS dead-letter queue equivalent)"""
+        rows = self._execute('SELECT body FROM units WHERE done = 0 AND attempts >= ? AND lease_until <= ?',
+                             (self.max_attempts, time.time())).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+def read_manifest_units(path):
+    """Work units from a local batch plan manifest CSV (batch_id,id_min,id_max,expected_predictions)"""
+    with open(path) as f:
+        return [dict(row) for row in csv.DictReader(f)]
+
+def run_worker(queue, process_unit, lease_seconds=LEASE_SECONDS, poll_seconds=1.0):
+    """
+    Lease units until the queue is drained. process_unit(unit) raises on failure;
+    the lease is extended by a heartbeat while it runs. Returns per-worker stats.
+    """
+    stats = {'completed': 0, 'released': 0, 'busy_sec': 0.0}
+    empty_checks = 0
+    while True:
+        lease = queue.lease(lease_seconds)
+        if lease is None:
+            empty_checks = empty_checks + 1 if queue.remaining() == 0 else 0
+            if empty_checks >= EMPTY_CHECKS_TO_EXIT:
+                return stats
+            time.sleep(poll_seconds)  # Other workers' leases may still expire and come back
+            continue
+        empty_checks = 0
+
+        stop_heartbeat = threading.Event()
+
+        def heartbeat():
+            while not stop_heartbeat.wait(lease_seconds / 3):
+                queue.extend(lease, lease_seconds)
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        start = time.time()
+        try:
+            process_unit(lease['unit'])
+        except Exception as e:
+            logger.error(f"Unit {lease['unit'].get('batch_id')} failed (attempt {lease['attempt']}): {str(e)}")
+            queue.release(lease)
+            stats['released'] += 1
+            continue
+        finally:
+            stop_heartbeat.set()
+            heartbeat_thread.join()
+            stats['busy_sec'] += time.time() - start
+        queue.ack(lease)
+        stats['completed'] += 1
+
+def unit_batch(unit):
+    """prediction.main()'s batch argument for one queue unit (a batch plan manifest row)"""
+    expected = unit.get('expected_predictions')
+    return {
+        'batch_id': int(unit['batch_id']),
+        'id_min': int(unit['id_min']),
+        'id_max': int(unit['id_max']),
+        'expected_predictions': int(expected) if expected not in (None, '') else None
+    }
+
+def predict_unit(unit):
+    """Run prediction.main() for one id-range unit (models stay cached across units)"""
+    import prediction
+
+    if unit.get('plan_created_at') and prediction.BATCH_PLAN and unit['plan_created_at'] != prediction.BATCH_PLAN['created_at']:
+        logger.warning(f"Dropping unit {unit['batch_id']} from an older batch plan")
+        return
+    prediction.main(unit_batch(unit))
+
+def run_benchmark(batches, workers, units_per_batch, straggler_rate, crash_rate, work_dir):
+    """
+    One Fargate task per batch (Map with MaxConcurrency = workers) vs a warm worker
+    pool pulling units_per_batch smaller units per batch from a SqliteWorkQueue.
+    Simulated at 3 ms per real second: batch work 300 s, task startup (placement +
+    model load) 60 s, Athena queueing 5 s per query; straggler_rate of startups and
+    queries take 8x / 20x longer. crash_rate fails a pool unit once (released, retried).
+    """
+    scale = 0.003
+    rng = random.Random(42)
+
+    def startup():
+        return 60 * scale * (8 if rng.random() < straggler_rate else 1) * rng.lognormvariate(0, 0.2)
+
+    def athena_wait():
+        return 5 * scale * (20 if rng.random() < straggler_rate else 1)
+
+    batch_work = [300 * scale * rng.lognormvariate(0, 0.2) for _ in range(batches)]
+
+    # One task per batch: every batch pays startup + its query, slots are refilled as tasks finish
+    def run_task(batch_id):
+        time.sleep(startup() + athena_wait() + batch_work[batch_id])
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(run_task, range(batches)))
+    task_per_batch_sec = time.time() - start
+
+    # Worker pool: startup once per worker, then pull small units until drained
+    os.makedirs(work_dir, exist_ok=True)
+    db_path = os.path.join(work_dir, 'bench_queue.db')
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    queue = SqliteWorkQueue(db_path)
+    queue.put([{'batch_id': batch_id, 'part': part}
+               for batch_id in range(batches) for part in range(units_per_batch)])
+    crashed = set()
+    crash_lock = threading.Lock()
+
+    def process(unit):
+        time.sleep(athena_wait() + batch_work[unit['batch_id']] / units_per_batch)
+        key = (unit['batch_id'], unit['part'])
+        with crash_lock:
+            crash = key not in crashed and rng.random() < crash_rate
+            if crash:
+                crashed.add(key)
+        if crash:
+            raise Exception("simulated worker crash")
+
+    def run_pool_worker(_):
+        time.sleep(startup())
+        return run_worker(queue, process, lease_seconds=5, poll_seconds=0.01)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        worker_stats = list(pool.map(run_pool_worker, range(workers)))
+    work_stealing_sec = time.time() - start
+
+    results = {
+        'batches': batches,
+        'workers': workers,
+        'units': batches * units_per_batch,
+        'ideal_sec': round(sum(batch_work) / workers, 3),
+        'task_per_batch_makespan_sec': round(task_per_batch_sec, 3),
+        'work_stealing_makespan_sec': round(work_stealing_sec, 3),
+        'speedup': round(task_per_batch_sec / work_stealing_sec, 2),
+        'completed': sum(s['completed'] for s in worker_stats),
+        'retried_after_crash': len(crashed),
+        'failed': len(queue.failed())
+    }
+    logger.info(f"Benchmark results (3 ms = 1 s): {json.dumps(results, indent=2)}")
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    return results
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description='Work-stealing prediction queue')
+    subparsers = parser.add_subparsers(dest='command')
+
+    worker_parser = subparsers.add_parser('worker', help='Lease and predict units until the queue is drained')
+    worker_parser.add_argument('--db', help='SQLite queue file (default: SQS QUEUE_URL)')
+
+    enqueue_parser = subparsers.add_parser('enqueue', help='Load a batch plan manifest into a SQLite queue')
+    enqueue_parser.add_argument('--db', required=True)
+    enqueue_parser.add_argument('--manifest', required=True, help='Local batches.csv')
+
+    bench_parser = subparsers.add_parser('bench', help='Task per batch vs worker pool (simulated, 3 ms = 1 s)')
+    bench_parser.add_argument('--batches', type=int, default=898)
+    bench_parser.add_argument('--workers', type=int, default=100)
+    bench_parser.add_argument('--units-per-batch', type=int, default=4)
+    bench_parser.add_argument('--straggler-rate', type=float, default=0.02)
+    bench_parser.add_argument('--crash-rate', type=float, default=0.01)
+
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        if args.db:
+            queue = SqliteWorkQueue(args.db)
+        else:
+            import boto3
+            if not QUEUE_URL:
+                raise ValueError("QUEUE_URL environment variable is required")
+            queue = SqsWorkQueue(boto3.client('sqs'), QUEUE_URL)
+        logger.info(f"=== Worker {WORKER_ID} starting ===")
+        stats = run_worker(queue, predict_unit)
+        logger.info(f"✅ Worker {WORKER_ID} done: {json.dumps(stats)}")
+    elif args.command == 'enqueue':
+        count = SqliteWorkQueue(args.db).put(read_manifest_units(args.manifest))
+        logger.info(f"Enqueued {count} units into {args.db}")
+    elif args.command == 'bench':
+        run_benchmark(args.batches, args.workers, args.units_per_batch, args.straggler_rate,
+                      args.crash_rate, '/tmp/work_queue_bench')
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,6 +12,7 @@ from sklearn.linear_model import Ridge
 import xgboost as xgb
 import joblib
 import io
+from resources import log_settings, thread_count
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -25,10 +26,27 @@ s3_client = boto3.client('s3')
 DATABASE_NAME = os.environ.get('DATABASE_NAME', 'ml_predict_age')
 S3_BUCKET = os.environ.get('S3_BUCKET')
 WORKGROUP = os.environ.get('WORKGROUP', 'primary')
+YYYYQQ = os.environ.get('YYYYQQ', 'YYYYQQ')
+# Reruns of a quarter reuse the models while the training checkpoint matches: retrained
+# models change the model hash of every prediction batch checkpoint, rerunning all batches
+RESUME = os.environ.get('RESUME', 'true').lower() == 'true'
+TRAINING_CHECKPOINT_KEY = f'predict-age/checkpoints/{YYYYQQ}/training.json'
+MODEL_KEYS = [
+    'predict-age/models/ridge_model.joblib',
+    'predict-age/models/xgboost_model.joblib',
+    'predict-age/models/qrf_model.joblib'
+]
+# Features table (feature_spec.py ctas or the feature store) and the TrainingFeatures CTAS tables;
+# their checkpoints change whenever they are built again
+FEATURES_TABLE = os.environ.get('FEATURES_TABLE', 'predict_age_training_features_parsed_14m')
+TRAINING_INPUT_TABLES = [FEATURES_TABLE, 'predict_age_real_training_features_14m', 'predict_age_real_training_targets_14m']
 
 if not S3_BUCKET:
     raise ValueError("S3_BUCKET environment variable is required")
 
+# XGBoost threads: the task's CPU quota (n_jobs=-1 would start one per host CPU)
+MODEL_THREADS = thread_count()
+
 def main():
     """
     Main function to train regression models for age prediction.
@@ -36,6 +54,12 @@ def main():
     """
     try:
         logger.info("Starting age prediction model training")
+        log_settings('training', {'n_jobs': MODEL_THREADS})
+
+        inputs = training_inputs()
+        if RESUME and training_complete(inputs):
+            logger.info("Models already trained for this run from the same inputs, skipping training")
+            return
 
         # 1. Load training data from Athena
         logger.info("Loading training features and targets from Athena...")
@@ -82,6 +106,7 @@ def main():
             'timestamp': datetime.now().isoformat()
         }
         save_evaluation_metrics(combined_metrics)
+        record_training(inputs)
 
         logger.info("Model training completed successfully!")
         logger.info(f"Training records: {len(training_data)}")
@@ -94,8 +119,8 @@ def main():
 def load_training_data():
     """Load training data from Athena"""
     try:
-        # Get table names from environment variables (Fargate parsed features + targets)
-        features_table = os.environ.get('FEATURES_TABLE', 'predict_age_training_features_parsed_14m')
+        # Get table names from environment variables (Fargate parsed features or the feature store + targets)
+        features_table = FEATURES_TABLE
         targets_table = os.environ.get('TARGETS_TABLE', 'predict_age_training_targets_14m')
         
         # Join features with targets
@@ -223,7 +248,7 @@ def train_xgboost_model(X_train, y_train, X_val, y_val):
             'subsample': 0.8,
             'colsample_bytree': 0.8,
             'random_state': 42,
-            'n_jobs': -1,
+            'n_jobs': MODEL_THREADS,
             'reg_alpha': 0.1,
             'reg_lambda': 1.0,
             'min_child_weight': 3
@@ -259,7 +284,7 @@ def train_quantile_model(X_train, y_train, X_val, y_val):
             'learning_rate': 0.1,
             'n_estimators': 100,
             'random_state': 42,
-            'n_jobs': -1
+            'n_jobs': MODEL_THREADS
         }
         
         params_upper = {
@@ -269,7 +294,7 @@ def train_quantile_model(X_train, y_train, X_val, y_val):
             'learning_rate': 0.1,
             'n_estimators': 100,
             'random_state': 42,
-            'n_jobs': -1
+            'n_jobs': MODEL_THREADS
         }
         
         model_lower = xgb.XGBRegressor(**params_lower)
@@ -364,6 +389,55 @@ def save_evaluation_metrics(metrics):
         logger.error(f"Error saving evaluation metrics: {str(e)}")
         raise
 
+def load_json(key):
+    """JSON object at key, or None if it does not exist"""
+    try:
+        return json.loads(s3_client.get_object(Bucket=S3_BUCKET, Key=key)['Body'].read())
+    except s3_client.exceptions.NoSuchKey:
+        return None
+
+def training_inputs():
+    """When each input table was checkpointed (None: not checkpointed)"""
+    inputs = {}
+    for table in TRAINING_INPUT_TABLES:
+        checkpoint = load_json(f'predict-age/checkpoints/{YYYYQQ}/{table}.json')
+        inputs[table] = checkpoint['recorded_at'] if checkpoint else None
+    return inputs
+
+def model_etags():
+    etags = {}
+    for key in MODEL_KEYS:
+        try:
+            etags[key] = s3_client.head_object(Bucket=S3_BUCKET, Key=key)['ETag']
+        except s3_client.exceptions.ClientError:
+            etags[key] = None
+    return etags
+
+def training_complete(inputs):
+    """True if this run's models were trained from the same inputs and are still the ones in S3"""
+    checkpoint = load_json(TRAINING_CHECKPOINT_KEY)
+    if not checkpoint:
+        return False
+    if checkpoint['inputs'] != inputs:
+        logger.info(f"Training inputs changed: {checkpoint['inputs']} -> {inputs}")
+        return False
+    if checkpoint['models'] != model_etags():
+        logger.info("Models in S3 differ from the training checkpoint")
+        return False
+    return True
+
+def record_training(inputs):
+    """Record the saved models' ETags and the inputs they were trained from"""
+    checkpoint = {
+        'run_id': YYYYQQ,
+        'inputs': inputs,
+        'models': model_etags(),
+        'recorded_at': datetime.now().isoformat()
+    }
+    s3_client.put_object(Bucket=S3_BUCKET, Key=TRAINING_CHECKPOINT_KEY,
+                         Body=json.dumps(checkpoint), ContentType='application/json')
+    logger.info(f"Training checkpoint saved to s3://{S3_BUCKET}/{TRAINING_CHECKPOINT_KEY}")
+
 def execute_athena_query(query, description):
     """Execute Athena query and return execution ID"""
     try:
@@ -1,38 +1,295 @@
+import io
+import csv
 import json
+import math
+import time
+import boto3
 import logging
+import os
+from datetime import datetime
+from botocore.config import Config
+from parquet_footer import count_prefix_rows  # Shared layer: ai-agent-predict-age-common
+from batch_manifest import (plan_batch_count, ranges_from_bounds, read_batch_manifest, write_batch_manifest,
+                            write_manifest_items)
+from checkpoint import batch_checkpoint, completed_batches, load_json, model_hash
+from s3_delete import S3PrefixDeleter
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Initialize AWS clients
+s3_client = boto3.client('s3', config=Config(max_pool_connections=50))  # Concurrent footer reads
+athena_client = boto3.client('athena')
+
+# Configuration from environment variables
+S3_BUCKET = os.environ.get('S3_BUCKET')
+DATABASE_NAME = os.environ.get('DATABASE_NAME', 'ml_predict_age')
+RAW_TABLE = os.environ.get('RAW_TABLE', 'predict_age_full_evaluation_raw_378m')
+YYYYQQ = os.environ.get('YYYYQQ', 'YYYYQQ')
+TARGET_ROWS_PER_BATCH = int(os.environ.get('TARGET_ROWS_PER_BATCH', '420962'))
+MAX_CONCURRENCY = int(os.environ.get('MAX_CONCURRENCY', '500'))  # Map MaxConcurrency
+RESUME = os.environ.get('RESUME', 'true').lower() == 'true'
+
+# Written by the BuildNeedsPredictionBitmap step (id_bitmap.py in the prediction image)
+BITMAP_SUMMARY_KEY = f'predict-age/needs-prediction/{YYYYQQ}/summary.json'
+# Read by every prediction task, so the batch count can't drift from the Map input
+PLAN_KEY = f'predict-age/plans/{YYYYQQ}/batch_plan.json'
+# One CSV row per batch (id range + expected count), iterated by the Distributed Map's ItemReader
+MANIFEST_KEY = f'predict-age/plans/{YYYYQQ}/batches.csv'
+# Resumed runs: only the batches without a matching checkpoint (dispatched instead of MANIFEST_KEY)
+PENDING_MANIFEST_KEY = f'predict-age/plans/{YYYYQQ}/pending.csv'
+BATCH_MANIFEST_PREFIX = f'predict-age/manifests/{YYYYQQ}'  # Per-batch manifests written by prediction.py
+PREDICTIONS_PREFIX = f'predict-age/predictions/{YYYYQQ}/'
+PREDICTION_CACHE_PREFIX = f'predict-age/prediction-cache/{YYYYQQ}/'  # Incremental mode, one file per id range
+# Map-side assembly: batch outputs are the final results table's files
+FINAL_RESULTS_PREFIX = f'predict-age/final-results/predict_age_final_results_{YYYYQQ}/'
+# A reused plan must describe the same work, or its ranges (and checkpoints) would not apply
+PLAN_IDENTITY_FIELDS = ['total_records', 'sized_by', 'map_side', 'target_rows_per_batch', 'max_concurrency', 'raw_table']
+
+if not S3_BUCKET:
+    raise ValueError("S3_BUCKET environment variable is required")
+
+def load_bitmap_summary():
+    """Load the needs-prediction bitmap summary for this run (None if it was not built)"""
+    try:
+        response = s3_client.get_object(Bucket=S3_BUCKET, Key=BITMAP_SUMMARY_KEY)
+        return json.loads(response['Body'].read())
+    except s3_client.exceptions.NoSuchKey:
+        logger.info(f"No bitmap summary at s3://{S3_BUCKET}/{BITMAP_SUMMARY_KEY}")
+        return None
+
+def get_table_storage(table_name):
+    """Return (bucket, prefix, is_parquet) for an Athena table's S3 location, or None"""
+    try:
+        response = athena_client.get_table_metadata(
+            CatalogName='AwsDataCatalog',
+            DatabaseName=DATABASE_NAME,
+            TableName=table_name
+        )
+    except athena_client.exceptions.MetadataException:
+        return None
+
+    parameters = response['TableMetadata'].get('Parameters', {})
+    location = parameters.get('location', '')
+    if not location.startswith('s3://'):
+        return None
+    bucket, _, prefix = location[len('s3://'):].partition('/')
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    is_parquet = 'parquet' in parameters.get('inputformat', '').lower()
+    return bucket, prefix, is_parquet
+
+def run_query(query):
+    """Run an Athena query to completion and return its result rows (from the CSV output)"""
+    execution_id = athena_client.start_query_execution(
+        QueryString=query,
+        QueryExecutionContext={'Database': DATABASE_NAME},
+        ResultConfiguration={'OutputLocation': f's3://{S3_BUCKET}/athena-results/'},
+        WorkGroup='primary'
+    )['QueryExecutionId']
+    while True:
+        status = athena_client.get_query_execution(QueryExecutionId=execution_id)['QueryExecution']['Status']
+        if status['State'] == 'SUCCEEDED':
+            break
+        if status['State'] in ['FAILED', 'CANCELLED']:
+            raise Exception(f"Query {status['State'].lower()}: {status.get('StateChangeReason', 'Unknown error')}")
+        time.sleep(2)
+    body = s3_client.get_object(Bucket=S3_BUCKET, Key=f'athena-results/{execution_id}.csv')['Body'].read()
+    return list(csv.reader(io.StringIO(body.decode('utf-8'))))[1:]
+
+def count_raw_rows():
+    """Current raw table size: Parquet footers (no scan), else COUNT(*)"""
+    storage = get_table_storage(RAW_TABLE)
+    if storage and storage[2]:
+        bucket, prefix, _ = storage
+        return count_prefix_rows(s3_client, bucket, prefix)['rows'], 'raw_table_footers'
+
+    logger.info(f"{RAW_TABLE} is not Parquet on S3, counting with Athena")
+    rows = run_query(f"SELECT COUNT(*) FROM {DATABASE_NAME}.{RAW_TABLE}")
+    return int(rows[0][0]), 'raw_table_count'
+
+def raw_id_ranges(total_batches, map_side):
+    """
+    Equal-work id ranges from the raw table: min/max id and total_batches - 1
+    approx_percentile split points in one id-only query. Ids without a known
+    age only, unless map-side (every id is written).
+    """
+    missing_age_filter = '' if map_side else 'AND (birth_year IS NULL AND approximate_age IS NULL)'
+    split_points = (f"approx_percentile(CAST(id AS BIGINT), transform(sequence(1, {total_batches - 1}), "
+                    f"i -> i / {float(total_batches)}))") if total_batches > 1 else 'ARRAY[]'
+    rows = run_query(f"""
+    SELECT id_min, id_max, CAST(bound AS VARCHAR)
+    FROM (
+        SELECT MIN(CAST(id AS BIGINT)) AS id_min, MAX(CAST(id AS BIGINT)) AS id_max, {split_points} AS bounds
+        FROM {DATABASE_NAME}.{RAW_TABLE}
+        WHERE id IS NOT NULL
+        {missing_age_filter}
+    )
+    LEFT JOIN UNNEST(bounds) WITH ORDINALITY AS t(bound, position) ON TRUE
+    ORDER BY position
+    """)
+    if not rows or not rows[0][0]:
+        return []
+    id_min, id_max = int(rows[0][0]), int(rows[0][1])
+    return ranges_from_bounds(id_min, id_max, [int(row[2]) for row in rows if row[2]])
+
+def build_plan(map_side):
+    """
+    Pick the batch count from the work to do and write the id-range manifest:
+    - needs-prediction bitmap: PIDs without a known age, ranges with exact counts
+      (ranges.csv from id_bitmap.py, same sizing rule)
+    - otherwise (or map-side, where every id is written): the raw table size,
+      ranges from approx_percentile split points
+    """
+    summary = load_bitmap_summary()
+    if summary and not map_side:
+        total_records = summary['needs_prediction_count']
+        sized_by = 'needs_prediction_bitmap'
+    else:
+        total_records, sized_by = count_raw_rows()
+
+    planned_batches = plan_batch_count(total_records, TARGET_ROWS_PER_BATCH, MAX_CONCURRENCY)
+
+    if summary and not map_side and summary.get('ranges_key') and summary['total_batches'] == planned_batches:
+        s3_client.copy_object(Bucket=S3_BUCKET, Key=MANIFEST_KEY,
+                              CopySource={'Bucket': S3_BUCKET, 'Key': summary['ranges_key']})
+        total_batches = summary['range_batches']
+    else:
+        if summary and not map_side:
+            logger.warning(f"Bitmap was built for {summary['total_batches']} batches, plan has "
+                           f"{planned_batches}; splitting the raw table instead")
+        ranges = raw_id_ranges(planned_batches, map_side)
+        total_batches = write_batch_manifest(s3_client, S3_BUCKET, MANIFEST_KEY, ranges)
+
+    return {
+        'total_batches': total_batches,
+        'partitioning': 'id_range',
+        'manifest_key': MANIFEST_KEY,
+        'records_per_batch': math.ceil(total_records / max(total_batches, 1)),
+        'total_records': total_records,
+        'target_rows_per_batch': TARGET_ROWS_PER_BATCH,
+        'max_concurrency': MAX_CONCURRENCY,
+        'sized_by': sized_by,
+        'map_side': map_side,
+        'raw_table': RAW_TABLE,
+        'created_at': datetime.now().isoformat()
+    }
+
+def work_size(map_side):
+    """(total_records, sized_by) for this run, without building ranges"""
+    summary = load_bitmap_summary()
+    if summary and not map_side:
+        return summary['needs_prediction_count'], 'needs_prediction_bitmap'
+    return count_raw_rows()
+
+def reusable_plan(map_side):
+    """
+    The previous attempt's plan for this run, if it describes the same work.
+    Keeping its ranges keeps the batch checkpoints valid (approx_percentile
+    split points are not reproducible).
+    """
+    previous = load_json(s3_client, S3_BUCKET, PLAN_KEY)
+    if not previous:
+        return None
+    total_records, sized_by = work_size(map_side)
+    current = {
+        'total_records': total_records,
+        'sized_by': sized_by,
+        'map_side': map_side,
+        'target_rows_per_batch': TARGET_ROWS_PER_BATCH,
+        'max_concurrency': MAX_CONCURRENCY,
+        'raw_table': RAW_TABLE
+    }
+    if any(previous.get(field) != current[field] for field in PLAN_IDENTITY_FIELDS):
+        logger.info("Previous batch plan describes different work, planning again")
+        return None
+    return previous
+
+def pending_items(plan, map_side):
+    """Manifest items without a matching batch checkpoint (run id, bounds, model hash)"""
+    items = read_batch_manifest(s3_client, S3_BUCKET, MANIFEST_KEY)
+    models = model_hash(s3_client, S3_BUCKET)
+    checkpoints = {
+        batch_id: batch_checkpoint(YYYYQQ, batch_id, plan['total_batches'], item['id_min'], item['id_max'],
+                                   map_side, models)
+        for batch_id, item in items.items()
+    }
+    done = completed_batches(s3_client, S3_BUCKET, BATCH_MANIFEST_PREFIX, checkpoints)
+    return {batch_id: item for batch_id, item in items.items() if batch_id not in done}
+
 def lambda_handler(event, context):
     """
-    Generate batch IDs for parallel prediction processing.
-    Creates an array of batch IDs from 0 to 897 (898 total batches).
-    Each batch will process ~420K records (378M total / 898).
+    Plan the prediction batches for this run.
+    Batch count comes from the current work size (needs-prediction bitmap, or the
+    raw table's row count from its Parquet footers), a target rows-per-batch and the
+    Map concurrency - see batch_manifest.plan_batch_count. Each batch is an id range; the ranges
+    are written as a CSV manifest that the Distributed Map reads with an ItemReader,
+    so only the manifest key travels in the state payload (no 256KB limit on the
+    number of batches). Every prediction task checks TOTAL_BATCHES against the plan.
+
+    Map-side final assembly (event['map_side']) splits every id, since each batch
+    also writes the known-age rows.
+
+    With RESUME (reruns of the same quarter), the previous plan is kept when it
+    describes the same work, and only batches without a matching checkpoint are
+    dispatched (dispatch_manifest_key); verification still uses the full manifest.
+    A new plan removes the previous attempt's batch outputs (predictions or map-side
+    final results, manifests, prediction cache), whose ranges no longer apply.
+
+    Errors are raised (the state's Catch sends them to PipelineFailed).
     """
     try:
-        total_batches = 898  # 378,024,173 records / 420,962 ≈ 898 batches
-        
-        logger.info(f"Generating {total_batches} batch IDs for parallel prediction (~420K records each)")
-        
-        # Generate array of batch IDs
-        batch_ids = list(range(total_batches))
-        
-        logger.info(f"Generated {len(batch_ids)} batch IDs (0 to {total_batches-1})")
-        
+        start_time = time.time()
+        map_side = bool(event.get('map_side', False))
+        plan = reusable_plan(map_side) if RESUME else None
+        if plan:
+            logger.info(f"Resuming batch plan created at {plan['created_at']}")
+        else:
+            if RESUME:
+                deleted = S3PrefixDeleter(s3_client, S3_BUCKET).delete_prefixes(
+                    [PREDICTIONS_PREFIX, BATCH_MANIFEST_PREFIX + '/', PREDICTION_CACHE_PREFIX, FINAL_RESULTS_PREFIX])
+                errors = [error for stats in deleted.values() for error in stats['errors']]
+                if errors:
+                    raise Exception(f"Could not remove outputs of previous plans: {errors[0]}")
+                logger.info(f"New plan: removed {sum(stats['deleted'] for stats in deleted.values())} "
+                            f"outputs of previous plans")
+            plan = build_plan(map_side)
+
+        s3_client.put_object(
+            Bucket=S3_BUCKET,
+            Key=PLAN_KEY,
+            Body=json.dumps(plan),
+            ContentType='application/json'
+        )
+
+        logger.info(f"Planned {plan['total_batches']} id-range batches of ~{plan['records_per_batch']:,} records "
+                    f"({plan['total_records']:,} total, sized by {plan['sized_by']}, "
+                    f"{time.time() - start_time:.2f}s)")
+        logger.info(f"Batch manifest: s3://{S3_BUCKET}/{MANIFEST_KEY}")
+
+        dispatch_manifest_key, pending_batches = MANIFEST_KEY, plan['total_batches']
+        if RESUME:
+            pending = pending_items(plan, map_side)
+            pending_batches = len(pending)
+            if pending_batches < plan['total_batches']:
+                write_manifest_items(s3_client, S3_BUCKET, PENDING_MANIFEST_KEY, pending)
+                dispatch_manifest_key = PENDING_MANIFEST_KEY
+                logger.info(f"{plan['total_batches'] - pending_batches} batches already complete, "
+                            f"dispatching {pending_batches}")
+
         return {
             'statusCode': 200,
-            'batch_ids': batch_ids,
-            'total_batches': total_batches,
-            'records_per_batch': 420962,  # ~420K records per batch
-            'total_records': 378024173
+            'total_batches': plan['total_batches'],
+            'manifest_key': MANIFEST_KEY,
+            'dispatch_manifest_key': dispatch_manifest_key,
+            'pending_batches': pending_batches,
+            'records_per_batch': plan['records_per_batch'],
+            'total_records': plan['total_records'],
+            'sized_by': plan['sized_by'],
+            'plan_key': PLAN_KEY
         }
 
     except Exception as e:
-        logger.error(f"Error generating batch IDs: {str(e)}")
-        return {
-            'statusCode': 500,
-            'error': str(e)
-        }
-
+        logger.error(f"Error generating batch plan: {str(e)}")
+        raise
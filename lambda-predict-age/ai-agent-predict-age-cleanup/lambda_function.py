@@ -2,12 +2,15 @@ import boto3
 import os
 import logging
 from datetime import datetime
+from botocore.config import Config
+from s3_delete import S3PrefixDeleter  # Shared layer: ai-agent-predict-age-common
+from parquet_footer import count_prefix_rows
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 athena_client = boto3.client('athena')
-s3_client = boto3.client('s3')
+s3_client = boto3.client('s3', config=Config(max_pool_connections=50))  # Concurrent footer reads / deletes
 ecs_client = boto3.client('ecs')
 ecr_client = boto3.client('ecr')
 
@@ -15,6 +18,10 @@ DATABASE_NAME = os.environ['DATABASE_NAME']
 S3_BUCKET = os.environ['S3_BUCKET']
 CLUSTER_NAME = os.environ['CLUSTER_NAME']
 YYYYQQ = os.environ.get('YYYYQQ', 'YYYYQQ')
+FINAL_RESULTS_TABLE = f'predict_age_final_results_{YYYYQQ}'
+PREDICTION_CACHE_PREFIX = 'predict-age/prediction-cache'  # Written by incremental.py in the prediction image
+SOURCE_TABLE = os.environ.get('SOURCE_TABLE', 'predict_age_full_evaluation_raw_378m')
+MIN_FINAL_RECORDS = 370000000  # Fallback floor (~378M) when the source count is unavailable
 
 def lambda_handler(event, context):
     """
@@ -24,6 +31,7 @@ def lambda_handler(event, context):
     1. Verifies no Fargate tasks are running
     2. Verifies no ECR image scans in progress
     3. Only runs after final results table is confirmed complete
+       (Parquet footer row counts of final results vs. source - no Athena scan)
     
     CLEANUP ACTIONS:
     1. Drop all Athena tables EXCEPT final results (predict_age_final_results_*)
@@ -62,9 +70,20 @@ def lambda_handler(event, context):
         logger.info("✅ Final results table exists")
         
         # SAFETY CHECK 3: Verify final results table has expected record count
+        # (Parquet footer metadata only - no Athena scan)
         logger.info("Safety Check 3: Verifying final results table record count...")
         record_count = verify_final_results_count()
-        if record_count < 370000000:  # Should be ~378M
+        expected_count = get_expected_record_count()
+        if expected_count is not None and record_count != expected_count:
+            logger.warning(f"❌ ABORT: Final results table has {record_count:,} records, source has {expected_count:,}")
+            logger.warning("Final results must be 1:1 with the source. Table may be incomplete.")
+            return {
+                'statusCode': 400,
+                'body': f'Cleanup aborted: Final results table incomplete ({record_count:,} of {expected_count:,} records)',
+                'record_count': record_count,
+                'expected_count': expected_count
+            }
+        if expected_count is None and record_count < MIN_FINAL_RECORDS:  # Should be ~378M
             logger.warning(f"❌ ABORT: Final results table has only {record_count:,} records")
             logger.warning("Expected ~378M records. Table may be incomplete.")
             return {
@@ -83,8 +102,10 @@ def lambda_handler(event, context):
         # CLEANUP 2: Clean intermediate S3 data
         logger.info("")
         logger.info("Cleanup 2: Cleaning intermediate S3 data...")
-        deleted_objects = cleanup_s3_data()
+        deleted_objects, s3_errors = cleanup_s3_data()
         logger.info(f"✅ Deleted {deleted_objects:,} S3 objects")
+        if s3_errors:
+            logger.warning(f"⚠️  {len(s3_errors)} prefixes not fully deleted: {', '.join(s3_errors)}")
         
         # CLEANUP 3: Stop any lingering tasks (should be none)
         logger.info("")
@@ -112,9 +133,11 @@ def lambda_handler(event, context):
             'summary': {
                 'tables_dropped': len(dropped_tables),
                 's3_objects_deleted': deleted_objects,
+                's3_delete_errors': s3_errors,
                 'tasks_stopped': stopped_tasks,
                 'active_resources': active_resources,
                 'final_table_records': record_count,
+                'source_table_records': expected_count,
                 'timestamp': datetime.now().isoformat()
             }
         }
@@ -157,48 +180,60 @@ def verify_final_results_table():
         logger.error(f"Error verifying final results table: {str(e)}")
         return False
 
-def verify_final_results_count():
-    """Verify final results table has expected record count"""
+def get_table_storage(table_name):
+    """Return (bucket, prefix, is_parquet) for an Athena table's S3 location, or None"""
     try:
-        query = f"""
-        SELECT COUNT(*) as record_count 
-        FROM {DATABASE_NAME}.predict_age_final_results_{YYYYQQ}
-        """
-        
-        response = athena_client.start_query_execution(
-            QueryString=query,
-            QueryExecutionContext={'Database': DATABASE_NAME},
-            ResultConfiguration={'OutputLocation': f's3://{S3_BUCKET}/athena-results/'},
-            WorkGroup='primary'
+        response = athena_client.get_table_metadata(
+            CatalogName='AwsDataCatalog',
+            DatabaseName=DATABASE_NAME,
+            TableName=table_name
         )
+    except athena_client.exceptions.MetadataException:
+        return None
+    
+    parameters = response['TableMetadata'].get('Parameters', {})
+    location = parameters.get('location', '')
+    if not location.startswith('s3://'):
+        return None
+    bucket, _, prefix = location[len('s3://'):].partition('/')
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    is_parquet = 'parquet' in parameters.get('inputformat', '').lower()
+    return bucket, prefix, is_parquet
+
+def verify_final_results_count():
+    """Verify final results table has expected record count (sum of Parquet footer num_rows)"""
+    try:
+        storage = get_table_storage(FINAL_RESULTS_TABLE)
+        if storage is None:
+            storage = (S3_BUCKET, f'predict-age/final-results/{FINAL_RESULTS_TABLE}/', True)
+        bucket, prefix, _ = storage
         
-        execution_id = response['QueryExecutionId']
-        
-        # Wait for query to complete (max 30 seconds)
-        import time
-        for _ in range(30):
-            status_response = athena_client.get_query_execution(QueryExecutionId=execution_id)
-            status = status_response['QueryExecution']['Status']['State']
-            
-            if status == 'SUCCEEDED':
-                results = athena_client.get_query_results(QueryExecutionId=execution_id)
-                if len(results['ResultSet']['Rows']) > 1:
-                    count_str = results['ResultSet']['Rows'][1]['Data'][0]['VarCharValue']
-                    return int(count_str)
-                return 0
-            elif status in ['FAILED', 'CANCELLED']:
-                logger.error(f"Query failed with status: {status}")
-                return 0
-            
-            time.sleep(1)
-        
-        logger.warning("Query timed out after 30 seconds")
-        return 0
+        stats = count_prefix_rows(s3_client, bucket, prefix)
+        return stats['rows']
         
     except Exception as e:
         logger.error(f"Error verifying record count: {str(e)}")
         return 0
 
+def get_expected_record_count():
+    """
+    Source row count for the 1:1 check, from the source table's Parquet footers.
+    Returns None when the source is missing or not Parquet (caller falls back to MIN_FINAL_RECORDS).
+    """
+    try:
+        storage = get_table_storage(SOURCE_TABLE)
+        if storage is None or not storage[2]:
+            logger.info(f"Source table {SOURCE_TABLE} is not Parquet on S3; using ~378M floor")
+            return None
+        bucket, prefix, _ = storage
+        
+        return count_prefix_rows(s3_client, bucket, prefix)['rows']
+        
+    except Exception as e:
+        logger.warning(f"Could not count source table {SOURCE_TABLE}: {str(e)}")
+        return None
+
 def cleanup_athena_tables():
     """
     Drop all intermediate Athena tables.
@@ -208,7 +243,8 @@ def cleanup_athena_tables():
         'predict_age_final_results_',
         'predict_age_training_raw_',  # Permanent: raw training data (no JSON parsing)
         'predict_age_training_targets_',  # Permanent: training targets  
-        'predict_age_training_features_parsed_'  # Permanent: Fargate-parsed features
+        'predict_age_training_features_parsed_',  # Permanent: Fargate-parsed features
+        'predict_age_feature_store'  # Permanent: parsed feature store (feature_store.py register)
     ]
     dropped_tables = []
     
@@ -227,9 +263,10 @@ def cleanup_athena_tables():
                 logger.info(f"  KEEP: {table_name} (final results)")
                 continue
             
-            # Drop all other tables
-            logger.info(f"  DROP: {table_name}")
-            drop_table(table_name)
+            # Drop all other tables (and views, e.g. single-pass Human QA)
+            is_view = table.get('TableType') == 'VIRTUAL_VIEW'
+            logger.info(f"  DROP: {table_name}{' (view)' if is_view else ''}")
+            drop_table(table_name, is_view=is_view)
             dropped_tables.append(table_name)
         
         return dropped_tables
@@ -238,10 +275,11 @@ def cleanup_athena_tables():
         logger.error(f"Error cleaning up Athena tables: {str(e)}")
         return dropped_tables
 
-def drop_table(table_name):
-    """Drop an Athena table"""
+def drop_table(table_name, is_view=False):
+    """Drop an Athena table (or view)"""
     try:
-        query = f"DROP TABLE IF EXISTS {DATABASE_NAME}.{table_name}"
+        object_type = 'VIEW' if is_view else 'TABLE'
+        query = f"DROP {object_type} IF EXISTS {DATABASE_NAME}.{table_name}"
         
         response = athena_client.start_query_execution(
             QueryString=query,
@@ -273,47 +311,61 @@ def cleanup_s3_data():
       - predict-age/final-results/ (final results data)
       - predict-age/permanent/ (permanent training data - NEVER DELETE)
       - predict-age/agent-context-upload/ (Bedrock Agent KB documents, if any)
+      - predict-age/prediction-cache/{YYYYQQ}/ (next quarter's incremental run carries it forward;
+        older quarters are removed)
+    Returns (objects deleted, {prefix: errors} for prefixes that were not fully deleted).
     """
     prefixes_to_clean = [
         'predict-age/staging/',
         'predict-age/features/',
         'predict-age/targets/',
         'predict-age/predictions/',
+        'predict-age/predictions-compacted/',
         'predict-age/models/',
         'predict-age/evaluation/',
         'predict-age/human-qa/',
+        'predict-age/needs-prediction/',  # Per-run needs-prediction bitmap
+        'predict-age/batch-unload/',  # Prediction task UNLOAD parts left by failed tasks
+        'predict-age/manifests/',  # Per-batch prediction manifests
+        'predict-age/scheduler/',  # Batch scheduler state
+        'predict-age/plans/',  # Per-run batch plan
+        'predict-age/checkpoints/',  # CTAS table checkpoints (tables are dropped above)
         'predict-age/test/',  # Test data
         'athena-results/'  # Clean up Athena query results too
     ]
     
     # NOTE: predict-age/permanent/ is explicitly NOT in this list
     # It contains parsed training data that we never want to recompute
+    try:
+        prefixes_to_clean += stale_prediction_cache_prefixes()
+    except Exception as e:
+        logger.error(f"Error listing prediction cache quarters: {str(e)}")
     
-    total_deleted = 0
+    # All prefixes are cleaned concurrently by the shared deletion engine; a prefix
+    # that fails is reported and does not stop the others
+    stats = S3PrefixDeleter(s3_client, S3_BUCKET).delete_prefixes(prefixes_to_clean)
     
+    total_deleted = 0
+    errors = {}
     for prefix in prefixes_to_clean:
-        deleted = delete_s3_prefix(prefix)
-        total_deleted += deleted
-        logger.info(f"    Deleted {deleted:,} objects from {prefix}")
+        total_deleted += stats[prefix]['deleted']
+        logger.info(f"    Deleted {stats[prefix]['deleted']:,} objects from {prefix} "
+                    f"({stats[prefix]['objects_per_sec']:,.0f} objects/sec)")
+        if stats[prefix]['errors']:
+            errors[prefix] = stats[prefix]['errors']
     
-    return total_deleted
+    return total_deleted, errors
+
+def stale_prediction_cache_prefixes():
+    """Prediction cache quarters other than this run's (incremental mode only reads the previous quarter)"""
+    response = s3_client.list_objects_v2(Bucket=S3_BUCKET, Prefix=f'{PREDICTION_CACHE_PREFIX}/', Delimiter='/')
+    return [common['Prefix'] for common in response.get('CommonPrefixes', [])
+            if common['Prefix'] != f'{PREDICTION_CACHE_PREFIX}/{YYYYQQ}/']
 
 def delete_s3_prefix(prefix):
     """Delete all objects under a prefix"""
     try:
-        paginator = s3_client.get_paginator('list_objects_v2')
-        pages = paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix)
-        
-        delete_count = 0
-        for page in pages:
-            if 'Contents' in page:
-                objects = [{'Key': obj['Key']} for obj in page['Contents']]
-                if objects:
-                    s3_client.delete_objects(Bucket=S3_BUCKET, Delete={'Objects': objects})
-                    delete_count += len(objects)
-        
-        return delete_count
-        
+        return S3PrefixDeleter(s3_client, S3_BUCKET).delete_prefix(prefix)['deleted']
     except Exception as e:
         logger.error(f"Error deleting S3 prefix {prefix}: {str(e)}")
         return 0
@@ -0,0 +1,67 @@
+"""
+Athena query polling for the Step Functions wait loops (shared Lambda layer).
+
+The CTAS Lambdas submit their queries and return at once; a Wait state then
+invokes them with action 'check', which polls every execution once through
+check_query_completion() and returns a combined query_state:
+
+  SUCCEEDED   every query succeeded
+  RUNNING     at least one is still queued or running (wait and check again)
+  FAILED /    a query failed or was cancelled (error: Athena's reason)
+  CANCELLED
+
+The Choice after each check routes on query_state; anything but SUCCEEDED or
+RUNNING goes to PipelineFailed, so a handler that fails returns FAILED too.
+
+table_type() tells which DROP a name needs: Human QA is a CTAS table in
+two-pass runs and a view in single-pass ones, and DROP TABLE fails on a view
+(and DROP VIEW on a table).
+"""
+
+import logging
+from datetime import datetime
+
+logger = logging.getLogger()
+
+def get_query_state(athena_client, execution_id):
+    """Return the current Athena state and failure reason without waiting"""
+    response = athena_client.get_query_execution(QueryExecutionId=execution_id)
+    status = response['QueryExecution']['Status']
+    return status['State'], status.get('StateChangeReason')
+
+def check_query_completion(athena_client, execution_ids):
+    """
+    Poll Athena once for each execution ID and return a combined state.
+    Used by the Step Functions wait loop instead of sleeping inside the Lambda.
+    """
+    query_state = 'SUCCEEDED'
+    for execution_id in execution_ids:
+        state, reason = get_query_state(athena_client, execution_id)
+        logger.info(f"Query {execution_id} status: {state}")
+
+        if state in ['FAILED', 'CANCELLED']:
+            logger.error(f"Query {execution_id} {state.lower()}: {reason or 'Unknown error'}")
+            return {
+                'statusCode': 500,
+                'query_state': state,
+                'execution_ids': execution_ids,
+                'error': reason or f'Athena query {state.lower()}',
+                'timestamp': datetime.now().isoformat()
+            }
+        if state != 'SUCCEEDED':
+            query_state = 'RUNNING'
+
+    return {
+        'statusCode': 200,
+        'query_state': query_state,
+        'execution_ids': execution_ids,
+        'timestamp': datetime.now().isoformat()
+    }
+
+def table_type(athena_client, database, table):
+    """'VIEW' or 'TABLE' - the DROP statement the catalog entry needs - or None if it does not exist"""
+    try:
+        metadata = athena_client.get_table_metadata(CatalogName='AwsDataCatalog', DatabaseName=database, TableName=table)
+    except athena_client.exceptions.MetadataException:
+        return None
+    return 'VIEW' if metadata['TableMetadata'].get('TableType') == 'VIRTUAL_VIEW' else 'TABLE'
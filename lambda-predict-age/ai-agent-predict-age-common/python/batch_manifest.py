@@ -0,0 +1,87 @@
+"""
+Batch plan manifest (shared Lambda layer).
+
+One CSV row per prediction batch, read by the Distributed Map's ItemReader
+(so batch ids never travel in the state payload), the scheduler and
+verify-batches:
+
+  batch_id,id_min,id_max,expected_predictions
+  0,1000017,1421093,420962
+  ...
+
+id_min/id_max are inclusive bounds on CAST(id AS BIGINT); the batches cover
+disjoint ranges. expected_predictions is empty when the plan was not built
+from the needs-prediction bitmap (count unknown).
+
+The prediction image copies this module too: id_bitmap.py writes ranges.csv
+with it and sizes its batches with plan_batch_count, the rule batch_generator
+plans with.
+"""
+
+import io
+import csv
+import math
+
+MANIFEST_COLUMNS = ['batch_id', 'id_min', 'id_max', 'expected_predictions']
+
+def plan_batch_count(total_rows, target_rows_per_batch, max_concurrency):
+    """
+    Number of prediction batches (id ranges) for total_rows.
+    Starts from ~target_rows_per_batch per batch; above max_concurrency it rounds up to
+    whole waves, so the last wave is full and every batch is a little smaller
+    (898 -> 1000 batches at 500 concurrency: same two waves, 378K rows instead of 421K).
+    """
+    batches = max(1, math.ceil(total_rows / target_rows_per_batch))
+    if batches > max_concurrency:
+        batches = math.ceil(batches / max_concurrency) * max_concurrency
+    return batches
+
+def ranges_from_bounds(id_min, id_max, bounds):
+    """
+    Contiguous inclusive ranges [id_min, b1], [b1+1, b2], ... [b_last+1, id_max]
+    from sorted split points. Repeated split points (skewed ids) are dropped
+    instead of producing empty ranges.
+    """
+    ranges = []
+    low = id_min
+    for bound in list(bounds) + [id_max]:
+        if bound < low:
+            continue
+        ranges.append((low, bound))
+        low = bound + 1
+    return ranges
+
+def write_batch_manifest(s3_client, bucket, key, ranges, expected_counts=None):
+    """Write ranges (and optional per-range counts) as the CSV manifest. Returns the item count."""
+    items = {
+        batch_id: {
+            'id_min': low,
+            'id_max': high,
+            'expected_predictions': None if expected_counts is None else expected_counts[batch_id]
+        }
+        for batch_id, (low, high) in enumerate(ranges)
+    }
+    return write_manifest_items(s3_client, bucket, key, items)
+
+def write_manifest_items(s3_client, bucket, key, items):
+    """Write {batch_id: item} (as returned by read_batch_manifest) as a CSV manifest. Returns the item count."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(MANIFEST_COLUMNS)
+    for batch_id, item in sorted(items.items()):
+        expected = item['expected_predictions']
+        writer.writerow([batch_id, int(item['id_min']), int(item['id_max']), '' if expected is None else int(expected)])
+    s3_client.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue().encode('utf-8'), ContentType='text/csv')
+    return len(items)
+
+def read_batch_manifest(s3_client, bucket, key):
+    """Read the CSV manifest. Returns {batch_id: {'id_min', 'id_max', 'expected_predictions'}}."""
+    body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+    items = {}
+    for row in csv.DictReader(io.StringIO(body)):
+        items[int(row['batch_id'])] = {
+            'id_min': int(row['id_min']),
+            'id_max': int(row['id_max']),
+            'expected_predictions': int(row['expected_predictions']) if row['expected_predictions'] else None
+        }
+    return items
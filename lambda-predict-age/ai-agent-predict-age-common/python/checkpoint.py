@@ -0,0 +1,170 @@
+"""
+Run checkpoints for resumable reruns (shared Lambda layer).
+
+A rerun of the pipeline for the same quarter (run id = YYYYQQ) only pays for
+missing work:
+
+- CTAS stages: after a CTAS succeeds its table is recorded as
+  predict-age/checkpoints/{YYYYQQ}/{table}.json (row and file count from the
+  Parquet footers). On a rerun the stage is skipped if the table still exists
+  and its files still add up to the recorded counts; otherwise the leftover
+  table and files are dropped and the CTAS runs again. Tables built from the
+  predictions (Human QA, final results) also record the predictions
+  fingerprint they were built from, so a rerun that rewrote a batch rebuilds them.
+- Training: training.py records predict-age/checkpoints/{YYYYQQ}/training.json
+  (the models' ETags and the checkpoints of the tables it trained on) and a
+  rerun reuses the models while it still matches, so the model hash below
+  stays the same.
+- Prediction batches: each batch manifest carries a checkpoint (run id,
+  batch bounds, model hash). A batch whose manifest matches is complete - see
+  completed_batches here and the same check in prediction.py.
+"""
+
+import re
+import json
+import time
+import hashlib
+import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from parquet_footer import count_prefix_rows
+from s3_delete import S3PrefixDeleter
+
+logger = logging.getLogger()
+
+CHECKPOINT_PREFIX = 'predict-age/checkpoints'
+# Trained models read by every prediction batch (prediction.py load_models_from_s3)
+MODEL_KEYS = ['predict-age/models/xgboost_model.joblib', 'predict-age/models/qrf_model.joblib']
+
+def ctas_target(sql):
+    """(table, bucket, prefix) of a CTAS statement from its CREATE TABLE and external_location"""
+    table = re.search(r'CREATE\s+TABLE\s+([\w.${}]+)', sql, re.IGNORECASE).group(1).split('.')[-1]
+    location = re.search(r"external_location\s*=\s*'s3://([^/']+)/([^']*)'", sql, re.IGNORECASE)
+    if not location:
+        return table, None, None
+    prefix = location.group(2)
+    return table, location.group(1), prefix if prefix.endswith('/') else prefix + '/'
+
+def checkpoint_key(run_id, table):
+    return f'{CHECKPOINT_PREFIX}/{run_id}/{table}.json'
+
+def load_json(s3_client, bucket, key):
+    """JSON object at key, or None if it does not exist"""
+    try:
+        return json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+    except s3_client.exceptions.NoSuchKey:
+        return None
+
+def table_exists(athena_client, database, table):
+    try:
+        athena_client.get_table_metadata(CatalogName='AwsDataCatalog', DatabaseName=database, TableName=table)
+        return True
+    except athena_client.exceptions.MetadataException:
+        return False
+
+def record_table(s3_client, checkpoint_bucket, run_id, sql, inputs=None):
+    """Record a finished CTAS table's footer counts (and what it was built from) as its checkpoint"""
+    table, bucket, prefix = ctas_target(sql)
+    counts = count_prefix_rows(s3_client, bucket, prefix)
+    checkpoint = {
+        'run_id': run_id,
+        'table': table,
+        'location': f's3://{bucket}/{prefix}',
+        'rows': counts['rows'],
+        'files': counts['files'],
+        'inputs': inputs,
+        'recorded_at': datetime.now().isoformat()
+    }
+    s3_client.put_object(Bucket=checkpoint_bucket, Key=checkpoint_key(run_id, table),
+                         Body=json.dumps(checkpoint), ContentType='application/json')
+    logger.info(f"Checkpoint {table}: {counts['rows']:,} rows in {counts['files']:,} files")
+    return checkpoint
+
+def table_complete(athena_client, s3_client, checkpoint_bucket, database, run_id, sql, inputs=None):
+    """
+    True if the CTAS table was recorded for this run from the same inputs and its
+    files still match the record
+    """
+    table, bucket, prefix = ctas_target(sql)
+    checkpoint = load_json(s3_client, checkpoint_bucket, checkpoint_key(run_id, table))
+    if not checkpoint or not table_exists(athena_client, database, table):
+        return False
+    if checkpoint.get('inputs') != inputs:
+        logger.info(f"{table}: built from {checkpoint.get('inputs')}, now {inputs}")
+        return False
+    counts = count_prefix_rows(s3_client, bucket, prefix)
+    complete = (checkpoint['location'] == f's3://{bucket}/{prefix}' and counts['rows'] > 0
+                and (counts['rows'], counts['files']) == (checkpoint['rows'], checkpoint['files']))
+    if not complete:
+        logger.warning(f"{table}: checkpoint has {checkpoint['rows']:,} rows in {checkpoint['files']:,} files, "
+                       f"found {counts['rows']:,} in {counts['files']:,}")
+    return complete
+
+def reset_table(athena_client, s3_client, checkpoint_bucket, database, run_id, sql, timeout_sec=60):
+    """Drop a leftover (incomplete or unrecorded) CTAS table and its files so the CTAS can run again"""
+    table, bucket, prefix = ctas_target(sql)
+    execution_id = athena_client.start_query_execution(
+        QueryString=f'DROP TABLE IF EXISTS {database}.{table}',
+        QueryExecutionContext={'Database': database},
+        ResultConfiguration={'OutputLocation': f's3://{checkpoint_bucket}/athena-results/'},
+        WorkGroup='primary'
+    )['QueryExecutionId']
+    deadline = time.time() + timeout_sec
+    while time.time() < deadline:
+        status = athena_client.get_query_execution(QueryExecutionId=execution_id)['QueryExecution']['Status']
+        if status['State'] == 'SUCCEEDED':
+            break
+        if status['State'] in ['FAILED', 'CANCELLED']:
+            raise Exception(f"DROP TABLE {table} {status['State'].lower()}: {status.get('StateChangeReason', 'Unknown error')}")
+        time.sleep(1)
+    else:
+        raise Exception(f"DROP TABLE {table} did not finish in {timeout_sec}s")
+
+    if bucket:
+        stats = S3PrefixDeleter(s3_client, bucket).delete_prefix(prefix)
+        if stats['errors']:
+            raise Exception(f"Could not empty s3://{bucket}/{prefix} for {table}: {stats['errors'][0]}")
+        logger.info(f"Reset {table}: dropped table, deleted {stats['deleted']} objects under s3://{bucket}/{prefix}")
+    s3_client.delete_object(Bucket=checkpoint_bucket, Key=checkpoint_key(run_id, table))
+
+def model_hash(s3_client, bucket):
+    """Short hash of the trained models' ETags; changes whenever a model is retrained"""
+    etags = [f"{key}:{s3_client.head_object(Bucket=bucket, Key=key)['ETag']}" for key in MODEL_KEYS]
+    return hashlib.sha256('\n'.join(etags).encode('utf-8')).hexdigest()[:16]
+
+def predictions_fingerprint(manifests):
+    """Short hash of the committed batch outputs (batch id, output key, ETag); changes whenever a batch is rewritten"""
+    entries = sorted(f"{m['batch_id']}:{m['output_key']}:{m.get('etag')}" for m in manifests)
+    return hashlib.sha256('\n'.join(entries).encode('utf-8')).hexdigest()[:16]
+
+def batch_checkpoint(run_id, batch_id, total_batches, id_min, id_max, final_assembly, models):
+    """Identity of one prediction batch's output; must match prediction.py batch_checkpoint"""
+    return {
+        'run_id': run_id,
+        'batch_id': int(batch_id),
+        'total_batches': int(total_batches),
+        'id_range': [int(id_min), int(id_max)] if id_min is not None else None,
+        'final_assembly': bool(final_assembly),
+        'model_hash': models
+    }
+
+def completed_batches(s3_client, bucket, manifest_prefix, checkpoints, max_workers=32):
+    """
+    Batch ids whose manifest carries the expected checkpoint and whose output file
+    is still there with the recorded size and ETag. checkpoints: {batch_id: batch_checkpoint}.
+    """
+    def is_complete(batch_id):
+        manifest = load_json(s3_client, bucket, f'{manifest_prefix}/batch_{batch_id:04d}.json')
+        if not manifest or manifest.get('checkpoint') != checkpoints[batch_id]:
+            return False
+        if manifest['output_key'] is None:
+            return True  # Nothing to write for this batch
+        try:
+            head = s3_client.head_object(Bucket=bucket, Key=manifest['output_key'])
+        except s3_client.exceptions.ClientError:
+            return False
+        return head['ContentLength'] == manifest['file_bytes'] and head['ETag'] == manifest.get('etag', head['ETag'])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(is_complete, list(checkpoints)))
+    return {batch_id for batch_id, complete in zip(checkpoints, results) if complete}
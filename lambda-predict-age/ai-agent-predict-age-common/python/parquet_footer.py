@@ -0,0 +1,182 @@
+"""
+Metadata-only Parquet row counts (shared Lambda layer).
+
+Reads FileMetaData.num_rows from each file's footer with ranged GETs, so a
+completeness check over the 378M-row final results costs one small request per
+file instead of an Athena COUNT(*) scan. No pyarrow needed: the footer is
+Thrift compact protocol and only field 3 (num_rows) is decoded.
+
+File layout: <data> <footer (FileMetaData)> <4-byte LE footer length> "PAR1"
+"""
+
+import os
+import time
+import struct
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+PARQUET_MAGIC = b'PAR1'
+FOOTER_TAIL_BYTES = 8  # footer length + magic
+INITIAL_FETCH_BYTES = 64 * 1024  # Covers the footer of typical CTAS/prediction files in one GET
+DEFAULT_MAX_WORKERS = int(os.environ.get('PARQUET_FOOTER_WORKERS', '32'))
+
+# Thrift compact protocol type ids
+CT_STOP = 0
+CT_BOOLEAN_TRUE = 1
+CT_BOOLEAN_FALSE = 2
+CT_BYTE = 3
+CT_I16 = 4
+CT_I32 = 5
+CT_I64 = 6
+CT_DOUBLE = 7
+CT_BINARY = 8
+CT_LIST = 9
+CT_SET = 10
+CT_MAP = 11
+CT_STRUCT = 12
+
+FILE_METADATA_NUM_ROWS_FIELD = 3
+
+class CompactReader:
+    """Just enough of the Thrift compact protocol to skip to a top-level i64 field"""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read_byte(self):
+        value = self.data[self.pos]
+        self.pos += 1
+        return value
+
+    def read_varint(self):
+        result = shift = 0
+        while True:
+            byte = self.read_byte()
+            result |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return result
+            shift += 7
+
+    def read_zigzag(self):
+        value = self.read_varint()
+        return (value >> 1) ^ -(value & 1)
+
+    def read_field_header(self, last_field_id):
+        """Returns (field_type, field_id); field_type CT_STOP ends the struct"""
+        header = self.read_byte()
+        field_type = header & 0x0F
+        if field_type == CT_STOP:
+            return CT_STOP, 0
+        delta = header >> 4
+        field_id = last_field_id + delta if delta else self.read_zigzag()
+        return field_type, field_id
+
+    def skip(self, field_type):
+        if field_type in (CT_BOOLEAN_TRUE, CT_BOOLEAN_FALSE):
+            return  # Value is carried in the field header
+        if field_type == CT_BYTE:
+            self.pos += 1
+        elif field_type in (CT_I16, CT_I32, CT_I64):
+            self.read_varint()
+        elif field_type == CT_DOUBLE:
+            self.pos += 8
+        elif field_type == CT_BINARY:
+            length = self.read_varint()
+            self.pos += length
+        elif field_type in (CT_LIST, CT_SET):
+            header = self.read_byte()
+            size = header >> 4
+            if size == 15:
+                size = self.read_varint()
+            element_type = header & 0x0F
+            for _ in range(size):
+                self.skip_element(element_type)
+        elif field_type == CT_MAP:
+            size = self.read_varint()
+            if size:
+                types = self.read_byte()
+                for _ in range(size):
+                    self.skip_element(types >> 4)
+                    self.skip_element(types & 0x0F)
+        elif field_type == CT_STRUCT:
+            self.skip_struct()
+        else:
+            raise ValueError(f"Unknown Thrift compact type {field_type} at offset {self.pos}")
+
+    def skip_element(self, element_type):
+        """Collection elements: booleans take a full byte, unlike struct fields"""
+        if element_type in (CT_BOOLEAN_TRUE, CT_BOOLEAN_FALSE):
+            self.pos += 1
+        else:
+            self.skip(element_type)
+
+    def skip_struct(self):
+        last_field_id = 0
+        while True:
+            field_type, field_id = self.read_field_header(last_field_id)
+            if field_type == CT_STOP:
+                return
+            self.skip(field_type)
+            last_field_id = field_id
+
+def parse_num_rows(footer):
+    """Decode FileMetaData.num_rows from raw footer bytes"""
+    reader = CompactReader(footer)
+    last_field_id = 0
+    while True:
+        field_type, field_id = reader.read_field_header(last_field_id)
+        if field_type == CT_STOP:
+            raise ValueError("FileMetaData has no num_rows field")
+        if field_id == FILE_METADATA_NUM_ROWS_FIELD and field_type == CT_I64:
+            return reader.read_zigzag()
+        reader.skip(field_type)
+        last_field_id = field_id
+
+def read_parquet_row_count(s3_client, bucket, key, size):
+    """Row count of one Parquet object from its footer. Returns (num_rows, bytes_fetched)."""
+    fetch = min(size, INITIAL_FETCH_BYTES)
+    tail = s3_client.get_object(Bucket=bucket, Key=key, Range=f'bytes=-{fetch}')['Body'].read()
+    bytes_fetched = len(tail)
+
+    if len(tail) < FOOTER_TAIL_BYTES or tail[-4:] != PARQUET_MAGIC:
+        raise ValueError(f"s3://{bucket}/{key} is not a Parquet file")
+    footer_length = struct.unpack('<I', tail[-8:-4])[0]
+
+    if footer_length + FOOTER_TAIL_BYTES > len(tail):
+        # Footer larger than the first read: fetch exactly the footer
+        tail = s3_client.get_object(
+            Bucket=bucket, Key=key, Range=f'bytes=-{footer_length + FOOTER_TAIL_BYTES}'
+        )['Body'].read()
+        bytes_fetched += len(tail)
+
+    footer = tail[-(footer_length + FOOTER_TAIL_BYTES):-FOOTER_TAIL_BYTES]
+    return parse_num_rows(footer), bytes_fetched
+
+def count_prefix_rows(s3_client, bucket, prefix, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Sum Parquet footer row counts for every object under a prefix, fetching footers concurrently.
+    Returns {'rows', 'files', 'bytes_fetched', 'elapsed_sec'}.
+    """
+    start_time = time.time()
+    objects = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        # Skip folder markers and empty objects (no footer)
+        objects.extend((obj['Key'], obj['Size']) for obj in page.get('Contents', [])
+                       if obj['Size'] > 0 and not obj['Key'].endswith('/'))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(lambda obj: read_parquet_row_count(s3_client, bucket, *obj), objects))
+
+    stats = {
+        'rows': sum(rows for rows, _ in results),
+        'files': len(objects),
+        'bytes_fetched': sum(fetched for _, fetched in results),
+        'elapsed_sec': round(time.time() - start_time, 2)
+    }
+    logger.info(f"Footer count s3://{bucket}/{prefix}: {stats['rows']:,} rows in {stats['files']:,} files "
+                f"({stats['bytes_fetched'] / 1024:,.0f} KB fetched, {stats['elapsed_sec']}s)")
+    return stats
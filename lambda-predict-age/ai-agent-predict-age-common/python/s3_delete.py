@@ -0,0 +1,194 @@
+"""
+Parallel S3 prefix deletion engine (shared Lambda layer).
+
+Replaces the page-at-a-time list_objects_v2 + delete_objects loops in cleanup,
+precleanup, final_results and human_qa:
+- listing is sharded by sub-prefix ('/' delimiter) and runs concurrently
+- 1000-key delete_objects calls run concurrently on a bounded thread pool
+- throttled keys (SlowDown, 503, InternalError) are retried with full jitter
+- reports deleted/failed counts, objects/sec and errors per prefix: a prefix
+  whose listing or delete calls fail does not fail the others
+- keep(key) spares listed keys (e.g. the batch outputs under a table prefix)
+"""
+
+import os
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+MAX_KEYS_PER_DELETE = 1000  # S3 DeleteObjects limit
+DEFAULT_MAX_WORKERS = int(os.environ.get('S3_DELETE_WORKERS', '16'))
+DEFAULT_MAX_ATTEMPTS = 6
+BACKOFF_BASE_SEC = 0.2
+BACKOFF_CAP_SEC = 10.0
+MAX_ERRORS_PER_PREFIX = 10  # Error messages kept per prefix (the failed count covers the rest)
+
+RETRYABLE_ERROR_CODES = {
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'ServiceUnavailable',
+    'InternalError',
+    '503'
+}
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff delay for the given (0-based) attempt"""
+    return random.uniform(0, min(BACKOFF_CAP_SEC, BACKOFF_BASE_SEC * (2 ** attempt)))
+
+class S3PrefixDeleter:
+    """Delete everything under one or more S3 prefixes with bounded concurrency"""
+
+    def __init__(self, s3_client, bucket, max_workers=DEFAULT_MAX_WORKERS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+
+    def delete_prefix(self, prefix, keep=None):
+        """Delete all objects under a prefix (except those keep(key) is true for). Returns a stats dict."""
+        return self.delete_prefixes([prefix], keep)[prefix]
+
+    def delete_prefixes(self, prefixes, keep=None):
+        """
+        Delete all objects under each prefix, sharing one listing pool and one delete pool;
+        keys for which keep(key) is true are left (and counted as kept).
+        Returns {prefix: {'deleted', 'failed', 'retried', 'kept', 'errors', 'elapsed_sec', 'objects_per_sec'}};
+        errors lists the listing and delete calls that failed for that prefix (empty when it was
+        deleted completely). Errors are not raised.
+        """
+        start_time = time.time()
+        stats = {prefix: {'deleted': 0, 'failed': 0, 'retried': 0, 'kept': 0, 'errors': []} for prefix in prefixes}
+        stats_lock = threading.Lock()
+
+        def record_error(prefix, message):
+            logger.error(f"s3://{self.bucket}/{prefix}: {message}")
+            with stats_lock:
+                if len(stats[prefix]['errors']) < MAX_ERRORS_PER_PREFIX:
+                    stats[prefix]['errors'].append(message)
+
+        # Bound queued delete batches so a huge listing doesn't buffer every key in memory
+        in_flight = threading.BoundedSemaphore(self.max_workers * 2)
+        delete_futures = []
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as delete_pool, \
+                ThreadPoolExecutor(max_workers=self.max_workers) as list_pool:
+
+            def submit_delete(prefix, keys):
+                if keep is not None:
+                    remaining = [key for key in keys if not keep(key)]
+                    with stats_lock:
+                        stats[prefix]['kept'] += len(keys) - len(remaining)
+                    keys = remaining
+                    if not keys:
+                        return
+                in_flight.acquire()
+                future = delete_pool.submit(self._delete_batch, keys)
+                future.add_done_callback(lambda _: in_flight.release())
+                with stats_lock:
+                    delete_futures.append((prefix, len(keys), future))
+
+            # Shard each prefix by its immediate sub-prefixes, list shards concurrently
+            list_futures = []
+            for prefix in prefixes:
+                try:
+                    shards = self._list_shard_level(prefix, submit_delete)
+                except Exception as e:
+                    record_error(prefix, f"list failed: {str(e)}")
+                    continue
+                for shard in shards:
+                    list_futures.append((prefix, shard, list_pool.submit(self._list_shard, prefix, shard, submit_delete)))
+            for prefix, shard, future in list_futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    record_error(prefix, f"list of {shard} failed: {str(e)}")
+
+            for prefix, key_count, future in delete_futures:
+                try:
+                    deleted, failed, retried, error = future.result()
+                except Exception as e:
+                    deleted, failed, retried, error = 0, key_count, 0, str(e)
+                stats[prefix]['deleted'] += deleted
+                stats[prefix]['failed'] += failed
+                stats[prefix]['retried'] += retried
+                if error:
+                    record_error(prefix, f"delete of {key_count} keys failed: {error}")
+
+        elapsed = max(time.time() - start_time, 1e-6)
+        for prefix, prefix_stats in stats.items():
+            prefix_stats['elapsed_sec'] = round(elapsed, 2)
+            prefix_stats['objects_per_sec'] = round(prefix_stats['deleted'] / elapsed, 1)
+            kept = f", {prefix_stats['kept']:,} kept" if keep is not None else ''
+            logger.info(f"Deleted {prefix_stats['deleted']:,} objects from s3://{self.bucket}/{prefix} "
+                        f"({prefix_stats['failed']} failed, {prefix_stats['retried']} retried{kept})")
+
+        total_deleted = sum(s['deleted'] for s in stats.values())
+        logger.info(f"S3 delete: {total_deleted:,} objects in {elapsed:.2f}s ({total_deleted / elapsed:,.0f} objects/sec)")
+        return stats
+
+    def _list_shard_level(self, prefix, submit_delete):
+        """List one level of a prefix: delete direct objects, return sub-prefixes as shards"""
+        shards = []
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter='/'):
+            keys = [obj['Key'] for obj in page.get('Contents', [])]
+            if keys:
+                submit_delete(prefix, keys)
+            shards.extend(common['Prefix'] for common in page.get('CommonPrefixes', []))
+        return shards
+
+    def _list_shard(self, prefix, shard, submit_delete):
+        """List a whole shard (no delimiter) and submit 1000-key delete batches"""
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=shard, PaginationConfig={'PageSize': MAX_KEYS_PER_DELETE}):
+            keys = [obj['Key'] for obj in page.get('Contents', [])]
+            if keys:
+                submit_delete(prefix, keys)
+
+    def _delete_batch(self, keys):
+        """
+        Delete up to 1000 keys, retrying throttled keys with jitter.
+        Returns (deleted, failed, retried, error): error is None unless a call failed, a key was
+        refused (AccessDenied, ...) or throttled keys were given up.
+        """
+        pending = keys
+        deleted = failed = retried = 0
+        refused = None  # Last key S3 would not delete, for the error message
+
+        for attempt in range(self.max_attempts):
+            try:
+                response = self.s3_client.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={'Objects': [{'Key': key} for key in pending], 'Quiet': True}
+                )
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code', '')
+                if code not in RETRYABLE_ERROR_CODES:
+                    return deleted, failed + len(pending), retried, f"{code}: {str(e)}"
+                retried += len(pending)
+                time.sleep(backoff_delay(attempt))
+                continue
+
+            errors = response.get('Errors', [])
+            retry_keys = [error['Key'] for error in errors if error.get('Code') in RETRYABLE_ERROR_CODES]
+            for error in errors:
+                if error.get('Code') not in RETRYABLE_ERROR_CODES:
+                    logger.warning(f"Could not delete {error['Key']}: {error.get('Code')} {error.get('Message', '')}")
+                    refused = f"{error['Key']}: {error.get('Code')}"
+            deleted += len(pending) - len(errors)
+            failed += len(errors) - len(retry_keys)
+
+            if not retry_keys:
+                return deleted, failed, retried, refused and f"{failed} keys refused (last {refused})"
+            retried += len(retry_keys)
+            pending = retry_keys
+            time.sleep(backoff_delay(attempt))
+
+        return deleted, failed + len(pending), retried, f"gave up on {len(pending)} keys after {self.max_attempts} attempts"
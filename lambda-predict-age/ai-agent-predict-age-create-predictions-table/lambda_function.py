@@ -3,6 +3,7 @@ import boto3
 import time
 import logging
 from datetime import datetime
+from athena_query import table_type  # Shared layer: ai-agent-predict-age-common
 
 # Configure logging
 logger = logging.getLogger()
@@ -14,7 +15,13 @@ athena_client = boto3.client('athena')
 import os
 
 DATABASE_NAME = os.environ.get('DATABASE_NAME', 'ml_predict_age')
-PREDICTIONS_TABLE_NAME = f'predict_age_predictions_{os.environ.get("YYYYQQ", "YYYYQQ")}'
+YYYYQQ = os.environ.get('YYYYQQ', 'YYYYQQ')
+PREDICTIONS_TABLE_NAME = f'predict_age_predictions_{YYYYQQ}'
+# Compact prediction files (int8 age, int16 centi-confidence) live in a _compact table;
+# PREDICTIONS_TABLE_NAME becomes a view with the legacy column types. Must match the prediction task.
+COMPACT_SCHEMA = os.environ.get('COMPACT_SCHEMA', 'true').lower() == 'true'
+COMPACT_TABLE_NAME = f'{PREDICTIONS_TABLE_NAME}_compact'
+PREDICTIONS_PREFIX = f'predict-age/predictions/{YYYYQQ}/'  # Written by the prediction tasks
 S3_BUCKET = os.environ.get('S3_BUCKET')
 if not S3_BUCKET:
     raise ValueError("S3_BUCKET environment variable is required")
@@ -61,6 +68,15 @@ def wait_for_query_completion(execution_id):
         logger.error(f"Error waiting for query completion: {str(e)}")
         raise
 
+def drop_table_or_view(table_name):
+    """Drop a table or view (DROP TABLE fails on views and vice versa)"""
+    object_type = table_type(athena_client, DATABASE_NAME, table_name)
+    if object_type is None:
+        return  # Does not exist
+    drop_execution_id = execute_athena_query(f"DROP {object_type} IF EXISTS {DATABASE_NAME}.{table_name}",
+                                             f"Dropping existing {table_name}")
+    wait_for_query_completion(drop_execution_id)
+
 def lambda_handler(event, context):
     """
     Pre-create predictions table to avoid race conditions in parallel execution.
@@ -69,28 +85,58 @@ def lambda_handler(event, context):
     try:
         logger.info(f"Creating predictions table {PREDICTIONS_TABLE_NAME}")
         
-        # Drop existing table first to ensure clean schema
-        drop_query = f"DROP TABLE IF EXISTS {DATABASE_NAME}.{PREDICTIONS_TABLE_NAME}"
-        drop_execution_id = execute_athena_query(drop_query, "Dropping existing predictions table")
-        wait_for_query_completion(drop_execution_id)
+        # Drop existing table/view first to ensure clean schema (either layout may exist from a previous run)
+        drop_table_or_view(PREDICTIONS_TABLE_NAME)
+        drop_table_or_view(COMPACT_TABLE_NAME)
         logger.info(f"Existing table dropped (if it existed)")
         
-        # Create table with Parquet format (updated from JSONL)
-        # Schema matches actual Parquet files: id (bigint), predicted_age (int), confidence_score (double), etc.
-        create_query = f"""
-        CREATE EXTERNAL TABLE {DATABASE_NAME}.{PREDICTIONS_TABLE_NAME} (
-            id bigint,
-            predicted_age int,
-            confidence_score double,
-            prediction_ts string,
-            model_version string
-        )
-        STORED AS PARQUET
-        LOCATION 's3://{S3_BUCKET}/predict-age/predictions/'
-        """
-        
-        execution_id = execute_athena_query(create_query, f"Creating predictions table")
-        success = wait_for_query_completion(execution_id)
+        if COMPACT_SCHEMA:
+            # Compact Parquet files: id (bigint), predicted_age (int8), confidence_centi (int16), dictionary strings
+            create_query = f"""
+            CREATE EXTERNAL TABLE {DATABASE_NAME}.{COMPACT_TABLE_NAME} (
+                id bigint,
+                predicted_age tinyint,
+                confidence_centi smallint,
+                prediction_ts string,
+                model_version string
+            )
+            STORED AS PARQUET
+            LOCATION 's3://{S3_BUCKET}/{PREDICTIONS_PREFIX}'
+            """
+            execution_id = execute_athena_query(create_query, f"Creating compact predictions table")
+            success = wait_for_query_completion(execution_id)
+            
+            # Legacy column names/types for human_qa and final_results
+            if success:
+                view_query = f"""
+                CREATE OR REPLACE VIEW {DATABASE_NAME}.{PREDICTIONS_TABLE_NAME} AS
+                SELECT
+                    id,
+                    CAST(predicted_age AS int) as predicted_age,
+                    CAST(confidence_centi AS double) / 100 as confidence_score,
+                    prediction_ts,
+                    model_version
+                FROM {DATABASE_NAME}.{COMPACT_TABLE_NAME}
+                """
+                execution_id = execute_athena_query(view_query, f"Creating predictions view")
+                success = wait_for_query_completion(execution_id)
+        else:
+            # Create table with Parquet format (updated from JSONL)
+            # Schema matches actual Parquet files: id (bigint), predicted_age (int), confidence_score (double), etc.
+            create_query = f"""
+            CREATE EXTERNAL TABLE {DATABASE_NAME}.{PREDICTIONS_TABLE_NAME} (
+                id bigint,
+                predicted_age int,
+                confidence_score double,
+                prediction_ts string,
+                model_version string
+            )
+            STORED AS PARQUET
+            LOCATION 's3://{S3_BUCKET}/{PREDICTIONS_PREFIX}'
+            """
+            
+            execution_id = execute_athena_query(create_query, f"Creating predictions table")
+            success = wait_for_query_completion(execution_id)
         
         if success:
             logger.info(f"✅ Predictions table {PREDICTIONS_TABLE_NAME} is ready")
@@ -98,6 +144,7 @@ def lambda_handler(event, context):
                 'statusCode': 200,
                 'body': json.dumps({
                     'message': f'Predictions table {PREDICTIONS_TABLE_NAME} created successfully',
+                    'compact_schema': COMPACT_SCHEMA,
                     'execution_id': execution_id,
                     'timestamp': datetime.now().isoformat()
                 })
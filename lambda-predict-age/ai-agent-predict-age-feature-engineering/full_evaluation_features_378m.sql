@@ -8,7 +8,6 @@ WITH (
 ) AS
 SELECT
     id,
-    CAST(MOD(CAST(id AS BIGINT), 898) AS BIGINT) as batch_id,
     CASE 
         WHEN position_start_date IS NOT NULL AND TRY_CAST(position_start_date AS DATE) IS NOT NULL THEN
             date_diff('month', TRY_CAST(position_start_date AS DATE), current_date)
@@ -4,6 +4,8 @@ import time
 import os
 from datetime import datetime
 import logging
+from checkpoint import record_table, reset_table, table_complete  # Shared layer: ai-agent-predict-age-common
+from athena_query import check_query_completion
 
 # Configure logging
 logger = logging.getLogger()
@@ -16,6 +18,8 @@ s3_client = boto3.client('s3')
 # Configuration from environment variables
 S3_BUCKET = os.environ.get('S3_BUCKET')
 DATABASE_NAME = os.environ.get('DATABASE_NAME', 'ml_predict_age')
+YYYYQQ = os.environ.get('YYYYQQ', 'YYYYQQ')  # Run id for checkpoints
+RESUME = os.environ.get('RESUME', 'true').lower() == 'true'
 
 if not S3_BUCKET:
     raise ValueError("S3_BUCKET environment variable is required")
@@ -87,14 +91,65 @@ def wait_for_query_completion(execution_id):
         logger.error(f"Error waiting for query completion: {str(e)}")
         raise
 
+def submit_ctas(queries, mode):
+    """
+    Start the CTAS queries ([(sql_file, description)]) without waiting; they run concurrently.
+    With RESUME, tables already verified complete for this run are skipped and
+    leftovers of the others are dropped first.
+    """
+    execution_ids, submitted, skipped = [], [], []
+    for sql_file, description in queries:
+        query = read_sql_file(sql_file)
+        if RESUME:
+            if table_complete(athena_client, s3_client, S3_BUCKET, DATABASE_NAME, YYYYQQ, query):
+                logger.info(f"{sql_file}: table already complete for this run, skipping CTAS")
+                skipped.append(sql_file)
+                continue
+            reset_table(athena_client, s3_client, S3_BUCKET, DATABASE_NAME, YYYYQQ, query)
+        execution_ids.append(execute_athena_query(query, description))
+        submitted.append(sql_file)
+
+    logger.info(f"{mode} CTAS submitted: {execution_ids} (skipped: {skipped})")
+    return {
+        'statusCode': 200,
+        'mode': mode,
+        'query_state': 'RUNNING' if execution_ids else 'SUCCEEDED',
+        'execution_ids': execution_ids,
+        'sql_files': submitted,
+        'skipped': skipped,
+        'timestamp': datetime.now().isoformat()
+    }
+
 def lambda_handler(event, context):
     """
     Lambda function to orchestrate feature engineering for training or full evaluation.
+    
+    Actions (event['action']):
+    - 'run' (default): start the CTAS queries and wait for them inside the Lambda
+    - 'submit': start the CTAS queries and return the execution IDs immediately;
+      with RESUME, skip tables already verified complete for this run
+    - 'check': poll event['execution_ids'] once (Step Functions wait loop) and
+      checkpoint event['sql_files'] tables once they succeed
     """
     try:
         logger.info(f"Received event: {event}")
 
         mode = event.get('mode', 'training')
+        action = event.get('action', 'run')
+        if action == 'check':
+            result = check_query_completion(athena_client, event['execution_ids'])
+            result['sql_files'] = event.get('sql_files', [])
+            if result['query_state'] == 'SUCCEEDED':
+                for sql_file in result['sql_files']:
+                    record_table(s3_client, S3_BUCKET, YYYYQQ, read_sql_file(sql_file))
+            return result
+
+        if action == 'submit':
+            if mode == 'full_evaluation':
+                return submit_ctas([('full_evaluation_features_378m.sql', "Creating full evaluation features table")], mode)
+            # Targets only read the source table, so both CTAS queries can run concurrently
+            return submit_ctas([('real_training_features_14m.sql', "Creating training features table"),
+                                ('real_training_targets_14m.sql', "Creating targets table")], mode)
 
         if mode == 'full_evaluation':
             # Full evaluation mode: Create evaluation features for all 378M PIDs
@@ -105,6 +160,7 @@ def lambda_handler(event, context):
             
             # Execute features query
             execution_id = execute_athena_query(features_query, "Creating full evaluation features table")
+            
             wait_for_query_completion(execution_id)
             
             logger.info("Full evaluation feature engineering completed successfully")
@@ -126,6 +182,7 @@ def lambda_handler(event, context):
             
             # Execute features query
             features_execution_id = execute_athena_query(features_query, "Creating training features table")
+            
             wait_for_query_completion(features_execution_id)
             
             # Create targets table
@@ -147,8 +204,10 @@ def lambda_handler(event, context):
 
     except Exception as e:
         logger.error(f"Error in feature engineering Lambda: {str(e)}")
+        # Step Functions' Choice reads query_state: a failed submit or check goes to PipelineFailed
         return {
             'statusCode': 500,
+            'query_state': 'FAILED',
             'body': json.dumps({
                 'error': str(e),
                 'timestamp': datetime.now().isoformat()
@@ -1,9 +1,13 @@
+import re
 import json
 import boto3
 import logging
 import os
 import time
 from datetime import datetime
+from s3_delete import S3PrefixDeleter  # Shared layer: ai-agent-predict-age-common
+from athena_query import check_query_completion, table_type
+from checkpoint import checkpoint_key, record_table, table_complete
 
 # Configure logging
 logger = logging.getLogger()
@@ -18,6 +22,11 @@ DATABASE_NAME = os.environ.get('DATABASE_NAME', 'ml_predict_age')
 S3_BUCKET = os.environ.get('S3_BUCKET')
 YYYYQQ = os.environ.get('YYYYQQ', 'YYYYQQ')
 FINAL_RESULTS_TABLE = f'predict_age_final_results_{YYYYQQ}'
+FINAL_RESULTS_PREFIX = f'predict-age/final-results/{FINAL_RESULTS_TABLE}/'
+# Reruns of a quarter skip the CTAS while its checkpoint matches the predictions
+RESUME = os.environ.get('RESUME', 'true').lower() == 'true'
+# Map-side batch outputs (prediction.py upload_predictions); anything else under the prefix is CTAS output
+BATCH_OUTPUT_PATTERN = re.compile(r'/batch_\d{4,}_[0-9a-f]{8}\.parquet$')
 
 if not S3_BUCKET:
     raise ValueError("S3_BUCKET environment variable is required")
@@ -64,15 +73,234 @@ def wait_for_query_completion(execution_id):
         logger.error(f"Error waiting for query completion: {str(e)}")
         raise
 
+def create_human_qa_view():
+    """
+    Recreate predict_age_human_qa_{YYYYQQ} as a view over the final results table.
+    Used by single-pass assembly, where the QA status columns are written by the final CTAS.
+    """
+    qa_table = f'predict_age_human_qa_{YYYYQQ}'
+    
+    # A previous two-pass run leaves a physical table behind; a view can't replace it
+    if table_type(athena_client, DATABASE_NAME, qa_table) == 'TABLE':
+        drop_query = f"DROP TABLE IF EXISTS {DATABASE_NAME}.{qa_table}"
+        drop_execution_id = execute_athena_query(drop_query, f"Dropping Human QA table {qa_table}")
+        wait_for_query_completion(drop_execution_id)
+    
+    # Same columns and defaults as the Human QA CTAS (Age: 35, Confidence: 15.0 when missing)
+    view_query = f"""
+    CREATE OR REPLACE VIEW {DATABASE_NAME}.{qa_table} AS
+    SELECT 
+        id,
+        CASE WHEN qa_status = 'HAS_PREDICTION' THEN predicted_age ELSE 35 END as predicted_age,
+        CASE WHEN qa_status = 'HAS_PREDICTION' THEN confidence_score ELSE 15.0 END as confidence_score,
+        qa_timestamp,
+        CASE WHEN qa_status = 'HAS_PREDICTION' THEN model_version ELSE 'v1.0_xgboost' END as model_version,
+        qa_status as prediction_status
+    FROM {DATABASE_NAME}.{FINAL_RESULTS_TABLE}
+    """
+    execution_id = execute_athena_query(view_query, f"Creating Human QA view {qa_table}")
+    wait_for_query_completion(execution_id)
+    logger.info(f"Human QA view {qa_table} created over {FINAL_RESULTS_TABLE}")
+    return qa_table
+
+def remove_ctas_leftovers():
+    """
+    Delete files under the final results prefix that no prediction task wrote: CTAS output
+    of an earlier two-pass or single-pass run of this quarter, kept by a resumed pre-cleanup.
+    Returns the number of files deleted; raises if any could not be deleted (the table
+    would read them alongside the batch outputs).
+    """
+    stats = S3PrefixDeleter(s3_client, S3_BUCKET).delete_prefix(
+        FINAL_RESULTS_PREFIX, keep=lambda key: BATCH_OUTPUT_PATTERN.search(key) is not None)
+    if stats['errors']:
+        raise RuntimeError(f"Could not remove CTAS files from {FINAL_RESULTS_PREFIX}: {stats['errors']}")
+    s3_client.delete_object(Bucket=S3_BUCKET, Key=checkpoint_key(YYYYQQ, FINAL_RESULTS_TABLE))
+    if stats['deleted']:
+        logger.warning(f"Removed {stats['deleted']} CTAS files from {FINAL_RESULTS_PREFIX}, "
+                       f"kept {stats['kept']} batch outputs")
+    return stats['deleted']
+
+def register_map_side_results(action):
+    """
+    Register predict_age_final_results_{YYYYQQ} over the batch files written by the
+    prediction tasks in map-side mode. The S3 prefix is NOT cleaned here (it holds the
+    results); only files that are not batch outputs are removed.
+    """
+    remove_ctas_leftovers()
+    query = f"""
+    CREATE EXTERNAL TABLE {DATABASE_NAME}.{FINAL_RESULTS_TABLE} (
+        id bigint,
+        predicted_age int,
+        confidence_score double,
+        qa_timestamp string,
+        model_version string,
+        prediction_status string,
+        prediction_source string,
+        qa_status string
+    )
+    STORED AS PARQUET
+    LOCATION 's3://{S3_BUCKET}/{FINAL_RESULTS_PREFIX}'
+    """
+    execution_id = execute_athena_query(query, f"Registering map-side final results table {FINAL_RESULTS_TABLE}")
+    
+    if action == 'submit':
+        return {
+            'statusCode': 200,
+            'query_state': 'RUNNING',
+            'execution_ids': [execution_id],
+            'table_name': FINAL_RESULTS_TABLE,
+            'map_side': True,
+            'timestamp': datetime.now().isoformat()
+        }
+    
+    wait_for_query_completion(execution_id)
+    qa_view = create_human_qa_view()
+    logger.info(f"Final results table {FINAL_RESULTS_TABLE} registered over map-side batch outputs")
+    
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': f'Final results table {FINAL_RESULTS_TABLE} registered over map-side batch outputs',
+            'table_name': FINAL_RESULTS_TABLE,
+            'qa_view': qa_view,
+            'execution_id': execution_id,
+            'timestamp': datetime.now().isoformat(),
+            'map_side': True
+        })
+    }
+
+def final_results_query(source_table, single_pass):
+    """CTAS for the final results table: existing ages, then ML predictions, then defaults"""
+    # Single-pass reads predictions directly; two-pass reads the Human QA table
+    if single_pass:
+        prediction_table = f'{DATABASE_NAME}.predict_age_predictions_{YYYYQQ}'
+        prediction_status = "'HAS_PREDICTION'"
+        qa_status_column = """,
+        CASE 
+            WHEN pred.id IS NULL THEN 'MISSING_PREDICTION'
+            ELSE 'HAS_PREDICTION'
+        END as qa_status"""
+    else:
+        prediction_table = f'{DATABASE_NAME}.predict_age_human_qa_{YYYYQQ}'
+        prediction_status = 'pred.prediction_status'
+        qa_status_column = ''
+
+    # Create final results table: Existing ages > ML predictions > Defaults
+    # Priority: 1) Known age from birth_year/approximate_age, 2) ML prediction, 3) Default (35)
+    return f"""
+    CREATE TABLE {DATABASE_NAME}.{FINAL_RESULTS_TABLE}
+    WITH (
+        external_location = 's3://{S3_BUCKET}/{FINAL_RESULTS_PREFIX}',
+        format = 'PARQUET',
+        parquet_compression = 'SNAPPY'
+    ) AS
+    SELECT 
+        s.id,
+        COALESCE(
+            CAST(s.approximate_age AS INTEGER),          -- Priority 1: Existing approximate_age
+            (2025 - CAST(s.birth_year AS INTEGER)),      -- Priority 2: Calculate from birth_year
+            pred.predicted_age,                          -- Priority 3: ML prediction
+            35                                           -- Priority 4: Default
+        ) as predicted_age,
+        CASE 
+            WHEN s.birth_year IS NOT NULL THEN 100.0         -- Existing birth year (CERTAIN - real data)
+            WHEN s.approximate_age IS NOT NULL THEN 100.0    -- Existing approximate age (CERTAIN - real data)
+            WHEN pred.id IS NOT NULL THEN pred.confidence_score  -- ML prediction confidence (varies)
+            ELSE 15.0                                        -- Default for missing data
+        END as confidence_score,
+        CAST(current_timestamp AS VARCHAR) as qa_timestamp,
+        COALESCE(
+            pred.model_version,
+            CASE
+                WHEN s.approximate_age IS NOT NULL THEN 'v1.0_existing_approx_age'
+                WHEN s.birth_year IS NOT NULL THEN 'v1.0_existing_birth_year'
+                ELSE 'v1.0_default_rule'
+            END
+        ) as model_version,
+        CASE 
+            WHEN pred.id IS NOT NULL THEN {prediction_status}  -- ML prediction status
+            WHEN s.approximate_age IS NOT NULL OR s.birth_year IS NOT NULL THEN 'EXISTING_AGE'
+            ELSE 'INSUFFICIENT_DATA'
+        END as prediction_status,
+        CASE
+            WHEN s.approximate_age IS NOT NULL THEN 'EXISTING_APPROX_AGE'
+            WHEN s.birth_year IS NOT NULL THEN 'EXISTING_BIRTH_YEAR'
+            WHEN pred.id IS NOT NULL THEN 'ML_PREDICTION'
+            ELSE 'DEFAULT_RULE'
+        END as prediction_source{qa_status_column}
+    FROM (
+        -- All IDs from source table with existing age data
+        SELECT 
+            CAST(id AS BIGINT) as id,
+            birth_year,
+            approximate_age
+        FROM {source_table}
+        WHERE id IS NOT NULL
+    ) s
+    LEFT JOIN {prediction_table} pred
+    ON s.id = pred.id
+    """
+
 def lambda_handler(event, context):
     """
     Create final results table with 1:1 mapping to source (378M PIDs).
     Combines Human QA predictions with default predictions for missing data.
     Default: Age: 35, Confidence: 15.0 (high uncertainty)
+    
+    Actions (event['action']):
+    - 'run' (default): start the CTAS and wait for it inside the Lambda
+    - 'submit': start the CTAS and return the execution ID immediately; with RESUME,
+      skip it if the table is already complete for this run and these predictions
+    - 'check': poll event['execution_ids'] once (Step Functions wait loop) and
+      checkpoint the event['ctas_tables'] table once it succeeds
+    
+    event['predictions_fingerprint'] (from VerifyBatchManifests) is recorded in the
+    checkpoint together with the assembly mode: a rerun that rewrote any batch or
+    switched modes rebuilds the table.
+    
+    Single-pass assembly (event['single_pass'] = true):
+    Joins the source directly to predict_age_predictions_{YYYYQQ} instead of the
+    Human QA table, writes the QA status column in the same CTAS, and recreates
+    predict_age_human_qa_{YYYYQQ} as a view. One scan/join/write instead of two.
+    
+    Map-side assembly (event['map_side'] = true):
+    Prediction tasks already wrote final-schema rows (FINAL_ASSEMBLY=true) under the
+    final results location, so the table is only registered over those files - no
+    378M-row join. Human QA is recreated as a view, as in single-pass mode.
     """
     try:
+        action = event.get('action', 'run')
+        single_pass = bool(event.get('single_pass', False))
+        map_side = bool(event.get('map_side', False))
         # Allow source table to be configurable for testing (use RAW table by default)
         source_table = event.get('source_table', f'{DATABASE_NAME}.predict_age_full_evaluation_raw_378m')
+        query = final_results_query(source_table, single_pass)
+        inputs = {'predictions': event.get('predictions_fingerprint'), 'source_table': source_table,
+                  'single_pass': single_pass}
+        if action == 'check':
+            result = check_query_completion(athena_client, event['execution_ids'])
+            result['ctas_tables'] = event.get('ctas_tables', [])
+            if result['query_state'] == 'SUCCEEDED':
+                if FINAL_RESULTS_TABLE in result['ctas_tables']:
+                    record_table(s3_client, S3_BUCKET, YYYYQQ, query, inputs)
+                if single_pass or map_side:
+                    result['qa_view'] = create_human_qa_view()
+            return result
+        
+        if RESUME and not map_side and \
+                table_complete(athena_client, s3_client, S3_BUCKET, DATABASE_NAME, YYYYQQ, query, inputs):
+            logger.info(f"{FINAL_RESULTS_TABLE} already complete for this run and these predictions, skipping CTAS")
+            return {
+                'statusCode': 200,
+                'query_state': 'SUCCEEDED',
+                'execution_ids': [],
+                'ctas_tables': [],
+                'skipped': [FINAL_RESULTS_TABLE],
+                'table_name': FINAL_RESULTS_TABLE,
+                'single_pass': single_pass,
+                'timestamp': datetime.now().isoformat()
+            }
+        
         logger.info(f"Creating final results table: {FINAL_RESULTS_TABLE} from {source_table}")
         
         # Drop existing table
@@ -81,79 +309,38 @@ def lambda_handler(event, context):
         wait_for_query_completion(drop_execution_id)
         logger.info(f"Existing table {FINAL_RESULTS_TABLE} dropped (if it existed).")
         
+        if map_side:
+            return register_map_side_results(action)
+        
         # Clean up S3 directory
-        prefix = f'predict-age/final-results/{FINAL_RESULTS_TABLE}/'
+        prefix = FINAL_RESULTS_PREFIX
         try:
-            paginator = s3_client.get_paginator('list_objects_v2')
-            pages = paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix)
-            delete_keys = []
-            for page in pages:
-                if 'Contents' in page:
-                    delete_keys.extend([{'Key': obj['Key']} for obj in page['Contents']])
-            if delete_keys:
-                s3_client.delete_objects(Bucket=S3_BUCKET, Delete={'Objects': delete_keys})
-                logger.info(f"Cleaned up {len(delete_keys)} S3 objects from {prefix}")
+            stats = S3PrefixDeleter(s3_client, S3_BUCKET).delete_prefix(prefix)
+            if stats['deleted']:
+                logger.info(f"Cleaned up {stats['deleted']} S3 objects from {prefix}")
         except Exception as e:
             logger.warning(f"Error cleaning S3 prefix {prefix}: {str(e)}")
         
-        # Create final results table: Existing ages > ML predictions > Defaults
-        # Priority: 1) Known age from birth_year/approximate_age, 2) ML prediction, 3) Default (35)
-        query = f"""
-        CREATE TABLE {DATABASE_NAME}.{FINAL_RESULTS_TABLE}
-        WITH (
-            external_location = 's3://{S3_BUCKET}/predict-age/final-results/{FINAL_RESULTS_TABLE}/',
-            format = 'PARQUET',
-            parquet_compression = 'SNAPPY'
-        ) AS
-        SELECT 
-            s.id,
-            COALESCE(
-                CAST(s.approximate_age AS INTEGER),          -- Priority 1: Existing approximate_age
-                (2025 - CAST(s.birth_year AS INTEGER)),      -- Priority 2: Calculate from birth_year
-                pred.predicted_age,                          -- Priority 3: ML prediction
-                35                                           -- Priority 4: Default
-            ) as predicted_age,
-            CASE 
-                WHEN s.birth_year IS NOT NULL THEN 100.0         -- Existing birth year (CERTAIN - real data)
-                WHEN s.approximate_age IS NOT NULL THEN 100.0    -- Existing approximate age (CERTAIN - real data)
-                WHEN pred.id IS NOT NULL THEN pred.confidence_score  -- ML prediction confidence (varies)
-                ELSE 15.0                                        -- Default for missing data
-            END as confidence_score,
-            CAST(current_timestamp AS VARCHAR) as qa_timestamp,
-            COALESCE(
-                pred.model_version,
-                CASE
-                    WHEN s.approximate_age IS NOT NULL THEN 'v1.0_existing_approx_age'
-                    WHEN s.birth_year IS NOT NULL THEN 'v1.0_existing_birth_year'
-                    ELSE 'v1.0_default_rule'
-                END
-            ) as model_version,
-            CASE 
-                WHEN pred.id IS NOT NULL THEN pred.prediction_status  -- ML prediction status
-                WHEN s.approximate_age IS NOT NULL OR s.birth_year IS NOT NULL THEN 'EXISTING_AGE'
-                ELSE 'INSUFFICIENT_DATA'
-            END as prediction_status,
-            CASE
-                WHEN s.approximate_age IS NOT NULL THEN 'EXISTING_APPROX_AGE'
-                WHEN s.birth_year IS NOT NULL THEN 'EXISTING_BIRTH_YEAR'
-                WHEN pred.id IS NOT NULL THEN 'ML_PREDICTION'
-                ELSE 'DEFAULT_RULE'
-            END as prediction_source
-        FROM (
-            -- All IDs from source table with existing age data
-            SELECT 
-                CAST(id AS BIGINT) as id,
-                birth_year,
-                approximate_age
-            FROM {source_table}
-            WHERE id IS NOT NULL
-        ) s
-        LEFT JOIN {DATABASE_NAME}.predict_age_human_qa_{YYYYQQ} pred
-        ON s.id = pred.id
-        """
         
         execution_id = execute_athena_query(query, f"Creating final results table with defaults")
+        
+        if action == 'submit':
+            logger.info(f"Final results CTAS submitted: {execution_id}")
+            return {
+                'statusCode': 200,
+                'query_state': 'RUNNING',
+                'execution_ids': [execution_id],
+                'ctas_tables': [FINAL_RESULTS_TABLE],
+                'table_name': FINAL_RESULTS_TABLE,
+                'single_pass': single_pass,
+                'timestamp': datetime.now().isoformat()
+            }
+        
         wait_for_query_completion(execution_id)
+        record_table(s3_client, S3_BUCKET, YYYYQQ, query, inputs)
+        
+        if single_pass:
+            create_human_qa_view()
         
         logger.info(f"Final results table {FINAL_RESULTS_TABLE} created successfully!")
         logger.info(f"Table includes:")
@@ -169,6 +356,7 @@ def lambda_handler(event, context):
                 'table_name': FINAL_RESULTS_TABLE,
                 'execution_id': execution_id,
                 'timestamp': datetime.now().isoformat(),
+                'single_pass': single_pass,
                 'expected_records': 378024173,
                 'default_age': 35,
                 'default_confidence': 15.0
@@ -177,8 +365,10 @@ def lambda_handler(event, context):
 
     except Exception as e:
         logger.error(f"Error in final_results Lambda: {str(e)}")
+        # Step Functions' Choice reads query_state: a failed submit or check goes to PipelineFailed
         return {
             'statusCode': 500,
+            'query_state': 'FAILED',
             'body': json.dumps({
                 'error': str(e),
                 'timestamp': datetime.now().isoformat()
@@ -4,6 +4,9 @@ import time
 import logging
 import os
 from datetime import datetime
+from s3_delete import S3PrefixDeleter  # Shared layer: ai-agent-predict-age-common
+from athena_query import check_query_completion, table_type
+from checkpoint import record_table, table_complete
 
 # Configure logging
 logger = logging.getLogger()
@@ -17,6 +20,9 @@ s3_client = boto3.client('s3')
 S3_BUCKET = os.environ.get('S3_BUCKET')
 DATABASE_NAME = os.environ.get('DATABASE_NAME', 'ml_predict_age')
 YYYYQQ = os.environ.get('YYYYQQ', 'YYYYQQ')
+# Reruns of a quarter skip the CTAS while its checkpoint matches the predictions
+RESUME = os.environ.get('RESUME', 'true').lower() == 'true'
+HUMAN_QA_TABLE = f'predict_age_human_qa_{YYYYQQ}'
 
 if not S3_BUCKET:
     raise ValueError("S3_BUCKET environment variable is required")
@@ -63,70 +69,113 @@ def wait_for_query_completion(execution_id):
         logger.error(f"Error waiting for query completion: {str(e)}")
         raise
 
+def human_qa_query(source_table):
+    """CTAS for the Human QA table: every source ID, with its prediction or the defaults"""
+    # Create Human QA table with LEFT JOIN to ensure all source IDs are included
+    # OPTIMIZED: No DISTINCT (id is unique), No ORDER BY (not needed)
+    return f"""
+    CREATE TABLE {DATABASE_NAME}.predict_age_human_qa_{YYYYQQ}
+    WITH (
+        external_location = 's3://{S3_BUCKET}/predict-age/human-qa/predict_age_human_qa_{YYYYQQ}/',
+        format = 'PARQUET',
+        parquet_compression = 'SNAPPY'
+    ) AS
+    SELECT 
+        s.id,
+        COALESCE(p.predicted_age, 35) as predicted_age,
+        COALESCE(p.confidence_score, 15.0) as confidence_score,
+        CAST(current_timestamp AS VARCHAR) as qa_timestamp,
+        COALESCE(p.model_version, 'v1.0_xgboost') as model_version,
+        CASE 
+            WHEN p.id IS NULL THEN 'MISSING_PREDICTION'
+            ELSE 'HAS_PREDICTION'
+        END as prediction_status
+    FROM (
+        -- Source table: Configurable (default: full_evaluation_features_378m)
+        -- This ensures 1:1 mapping with all predictions
+        SELECT CAST(id AS BIGINT) as id
+        FROM "{DATABASE_NAME}"."{source_table}"
+        WHERE id IS NOT NULL
+    ) s
+    LEFT JOIN {DATABASE_NAME}.predict_age_predictions_{YYYYQQ} p
+    ON s.id = p.id
+    """
+
 def lambda_handler(event, context):
     """
     Lambda function to create Human QA table with 1:1 mapping to source table.
     Ensures every ID from the source table has an age prediction.
+    
+    Actions (event['action']):
+    - 'run' (default): start the CTAS and wait for it inside the Lambda
+    - 'submit': start the CTAS and return the execution ID immediately; with RESUME,
+      skip it if the table is already complete for this run and these predictions
+    - 'check': poll event['execution_ids'] once (Step Functions wait loop) and
+      checkpoint the event['ctas_tables'] table once it succeeds
+    
+    event['predictions_fingerprint'] (from VerifyBatchManifests) is recorded in the
+    checkpoint: a rerun that rewrote any batch rebuilds the table.
     """
     try:
+        action = event.get('action', 'run')
         # Allow source table to be configurable for testing
         source_table = event.get('source_table', 'predict_age_full_evaluation_raw_378m')
+        query = human_qa_query(source_table)
+        inputs = {'predictions': event.get('predictions_fingerprint'), 'source_table': source_table}
+        if action == 'check':
+            result = check_query_completion(athena_client, event['execution_ids'])
+            result['ctas_tables'] = event.get('ctas_tables', [])
+            if result['query_state'] == 'SUCCEEDED' and HUMAN_QA_TABLE in result['ctas_tables']:
+                record_table(s3_client, S3_BUCKET, YYYYQQ, query, inputs)
+            return result
+        
+        if RESUME and table_complete(athena_client, s3_client, S3_BUCKET, DATABASE_NAME, YYYYQQ, query, inputs):
+            logger.info(f"{HUMAN_QA_TABLE} already complete for this run and these predictions, skipping CTAS")
+            return {
+                'statusCode': 200,
+                'query_state': 'SUCCEEDED',
+                'execution_ids': [],
+                'ctas_tables': [],
+                'skipped': [HUMAN_QA_TABLE],
+                'table_name': HUMAN_QA_TABLE,
+                'timestamp': datetime.now().isoformat()
+            }
+        
         logger.info(f"Starting Human QA table creation with 1:1 mapping from {source_table}")
         
-        # First, drop the table if it exists (including S3 data)
-        drop_query = f"DROP TABLE IF EXISTS {DATABASE_NAME}.predict_age_human_qa_{YYYYQQ}"
-        drop_execution_id = execute_athena_query(drop_query, "Dropping existing Human QA table")
-        wait_for_query_completion(drop_execution_id)
-        logger.info("Existing table dropped successfully")
+        # First, drop the table if it exists (including S3 data); a single-pass run left a view
+        object_type = table_type(athena_client, DATABASE_NAME, HUMAN_QA_TABLE)
+        if object_type is not None:
+            drop_query = f"DROP {object_type} IF EXISTS {DATABASE_NAME}.{HUMAN_QA_TABLE}"
+            drop_execution_id = execute_athena_query(drop_query, f"Dropping existing Human QA {object_type.lower()}")
+            wait_for_query_completion(drop_execution_id)
+            logger.info(f"Existing {object_type.lower()} dropped successfully")
         
         # Clean up S3 directory
         bucket = S3_BUCKET
         prefix = f'predict-age/human-qa/predict_age_human_qa_{YYYYQQ}/'
         try:
-            paginator = s3_client.get_paginator('list_objects_v2')
-            pages = paginator.paginate(Bucket=bucket, Prefix=prefix)
-            delete_keys = []
-            for page in pages:
-                if 'Contents' in page:
-                    delete_keys.extend([{'Key': obj['Key']} for obj in page['Contents']])
-            if delete_keys:
-                s3_client.delete_objects(Bucket=bucket, Delete={'Objects': delete_keys})
-                logger.info(f"Cleaned up {len(delete_keys)} S3 objects")
+            stats = S3PrefixDeleter(s3_client, bucket).delete_prefix(prefix)
+            if stats['deleted']:
+                logger.info(f"Cleaned up {stats['deleted']} S3 objects")
         except Exception as e:
             logger.warning(f"Error cleaning S3: {str(e)}")
         
-        # Create Human QA table with LEFT JOIN to ensure all source IDs are included
-        # OPTIMIZED: No DISTINCT (id is unique), No ORDER BY (not needed)
-        query = f"""
-        CREATE TABLE {DATABASE_NAME}.predict_age_human_qa_{YYYYQQ}
-        WITH (
-            external_location = 's3://{S3_BUCKET}/predict-age/human-qa/predict_age_human_qa_{YYYYQQ}/',
-            format = 'PARQUET',
-            parquet_compression = 'SNAPPY'
-        ) AS
-        SELECT 
-            s.id,
-            COALESCE(p.predicted_age, 35) as predicted_age,
-            COALESCE(p.confidence_score, 15.0) as confidence_score,
-            CAST(current_timestamp AS VARCHAR) as qa_timestamp,
-            COALESCE(p.model_version, 'v1.0_xgboost') as model_version,
-            CASE 
-                WHEN p.id IS NULL THEN 'MISSING_PREDICTION'
-                ELSE 'HAS_PREDICTION'
-            END as prediction_status
-        FROM (
-            -- Source table: Configurable (default: full_evaluation_features_378m)
-            -- This ensures 1:1 mapping with all predictions
-            SELECT CAST(id AS BIGINT) as id
-            FROM "{DATABASE_NAME}"."{source_table}"
-            WHERE id IS NOT NULL
-        ) s
-        LEFT JOIN {DATABASE_NAME}.predict_age_predictions_{YYYYQQ} p
-        ON s.id = p.id
-        """
-        
         execution_id = execute_athena_query(query, "Creating Human QA table with 1:1 mapping")
+        
+        if action == 'submit':
+            logger.info(f"Human QA CTAS submitted: {execution_id}")
+            return {
+                'statusCode': 200,
+                'query_state': 'RUNNING',
+                'execution_ids': [execution_id],
+                'ctas_tables': [HUMAN_QA_TABLE],
+                'table_name': HUMAN_QA_TABLE,
+                'timestamp': datetime.now().isoformat()
+            }
+        
         wait_for_query_completion(execution_id)
+        record_table(s3_client, S3_BUCKET, YYYYQQ, query, inputs)
         
         logger.info("Human QA table created successfully with 1:1 mapping!")
         
@@ -134,7 +183,7 @@ def lambda_handler(event, context):
             'statusCode': 200,
             'body': json.dumps({
                 'message': 'Human QA table created successfully with 1:1 mapping!',
-                'table_name': f'predict_age_human_qa_{YYYYQQ}',
+                'table_name': HUMAN_QA_TABLE,
                 'execution_id': execution_id,
                 'timestamp': datetime.now().isoformat()
             })
@@ -142,8 +191,10 @@ def lambda_handler(event, context):
 
     except Exception as e:
         logger.error(f"Error in Human QA Lambda: {str(e)}")
+        # Step Functions' Choice reads query_state: a failed submit or check goes to PipelineFailed
         return {
             'statusCode': 500,
+            'query_state': 'FAILED',
             'body': json.dumps({
                 'error': str(e),
                 'timestamp': datetime.now().isoformat()
@@ -2,6 +2,7 @@ import boto3
 import os
 import logging
 from datetime import datetime
+from s3_delete import S3PrefixDeleter  # Shared layer: ai-agent-predict-age-common
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -11,6 +12,20 @@ s3_client = boto3.client('s3')
 
 DATABASE_NAME = os.environ['DATABASE_NAME']
 S3_BUCKET = os.environ['S3_BUCKET']
+# Reruns resume: keep batch plan, manifests and predictions (prediction tasks and
+# GenerateBatchIds skip batches whose checkpoint matches). Execution input
+# {"fresh": true} forces a clean slate.
+RESUME = os.environ.get('RESUME', 'true').lower() == 'true'
+
+# Per-run outputs that a resumed run reuses
+RESUMABLE_PREFIXES = [
+    'predict-age/predictions/',    # Predictions (root cause of duplicates)
+    'predict-age/manifests/',      # Per-batch manifests (stale ones would fail verification)
+    'predict-age/plans/',          # Batch plan (stale TOTAL_BATCHES would fail prediction tasks)
+    'predict-age/checkpoints/',    # CTAS table and training checkpoints
+    'predict-age/final-results/',  # Map-side batch outputs / final results CTAS (checkpointed)
+    'predict-age/human-qa/',       # Human QA CTAS (checkpointed)
+]
 
 def lambda_handler(event, context):
     """
@@ -29,30 +44,41 @@ def lambda_handler(event, context):
     SAFETY:
     - Only cleans final results (intermediate data cleaned by post-cleanup)
     - Logs what was cleaned for audit trail
+    
+    RESUME (default): predictions, batch manifests, the batch plan, checkpoints
+    and the final results / Human QA outputs (with their tables) are kept so a
+    rerun only pays for missing work - in map-side mode the final results prefix
+    holds the batch outputs themselves; event {"fresh": true} (execution input)
+    cleans them too.
     """
     try:
+        resume = RESUME and not event.get('fresh', False)
         logger.info("=" * 80)
-        logger.info("PRE-CLEANUP: Preparing for new pipeline run")
+        logger.info(f"PRE-CLEANUP: Preparing for {'resumed' if resume else 'new'} pipeline run")
         logger.info("=" * 80)
         
-        # 1. Drop final results table (if exists)
-        logger.info("Step 1: Dropping final results table (if exists)...")
-        dropped = drop_final_results_table()
-        if dropped:
-            logger.info("✅ Final results table dropped")
+        # 1. Drop final results table (if exists); a resumed run checks its checkpoint instead
+        dropped = False
+        if resume:
+            logger.info("Step 1: Keeping final results table (resumed run, checkpointed)")
         else:
-            logger.info("ℹ️  No final results table to drop")
+            logger.info("Step 1: Dropping final results table (if exists)...")
+            dropped = drop_final_results_table()
+            if dropped:
+                logger.info("✅ Final results table dropped")
+            else:
+                logger.info("ℹ️  No final results table to drop")
         
         # 2. Clean final results S3 directory
         logger.info("")
         logger.info("Step 2: Cleaning final results S3 directory...")
-        deleted_count = clean_final_results_s3()
+        deleted_count = clean_final_results_s3(resume)
         logger.info(f"✅ Deleted {deleted_count:,} objects from final results S3")
         
         # 3. Verify cleanup
         logger.info("")
         logger.info("Step 3: Verifying cleanup...")
-        verification = verify_cleanup()
+        verification = {'skipped': 'resumed run keeps final results'} if resume else verify_cleanup()
         
         logger.info("=" * 80)
         logger.info("PRE-CLEANUP COMPLETED")
@@ -66,6 +92,7 @@ def lambda_handler(event, context):
             'statusCode': 200,
             'body': 'Pre-cleanup completed successfully',
             'summary': {
+                'resume': resume,
                 'table_dropped': dropped,
                 's3_objects_deleted': deleted_count,
                 'verification': verification,
@@ -117,44 +144,39 @@ def drop_final_results_table():
         logger.error(f"Error dropping final results table: {str(e)}")
         return False
 
-def clean_final_results_s3():
-    """Clean final results S3 directory AND upstream dependencies"""
-    try:
-        # Clean multiple S3 prefixes to prevent cascading duplicates
-        prefixes_to_clean = [
-            'predict-age/final-results/',  # Final results
-            'predict-age/human-qa/',       # Human QA (source of duplicates)
-            'predict-age/predictions/',    # Predictions (root cause of duplicates)
-        ]
-        
-        total_deleted = 0
-        for prefix in prefixes_to_clean:
-            logger.info(f"Cleaning S3 prefix: s3://{S3_BUCKET}/{prefix}")
-            
-            paginator = s3_client.get_paginator('list_objects_v2')
-            pages = paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix)
-            
-            delete_count = 0
-            for page in pages:
-                if 'Contents' in page:
-                    objects = [{'Key': obj['Key']} for obj in page['Contents']]
-                    if objects:
-                        logger.info(f"  Deleting batch of {len(objects)} objects from {prefix}...")
-                        s3_client.delete_objects(Bucket=S3_BUCKET, Delete={'Objects': objects})
-                        delete_count += len(objects)
-            
-            if delete_count == 0:
-                logger.info(f"  No objects to delete from {prefix} (clean slate)")
-            else:
-                logger.info(f"  Deleted {delete_count} objects from {prefix}")
-            
-            total_deleted += delete_count
-        
-        return total_deleted
+def clean_final_results_s3(resume):
+    """
+    Clean final results S3 directory AND upstream dependencies (batch outputs only if not resuming).
+    Raises if a prefix was not fully deleted: its leftovers would be read again by this run.
+    """
+    # Clean multiple S3 prefixes to prevent cascading duplicates
+    prefixes_to_clean = [
+        'predict-age/predictions-compacted/',  # Id-sorted compaction output
+        'predict-age/scheduler/',      # Batch scheduler state from a previous run
+    ]
+    if not resume:
+        prefixes_to_clean += RESUMABLE_PREFIXES
+    
+    logger.info(f"Cleaning S3 prefixes in parallel: {', '.join(prefixes_to_clean)}")
+    stats = S3PrefixDeleter(s3_client, S3_BUCKET).delete_prefixes(prefixes_to_clean)
+    
+    total_deleted = 0
+    failed = {}
+    for prefix in prefixes_to_clean:
+        delete_count = stats[prefix]['deleted']
+        if stats[prefix]['errors']:
+            logger.error(f"  {prefix}: {stats[prefix]['failed']} objects not deleted: {stats[prefix]['errors']}")
+            failed[prefix] = stats[prefix]['errors'][0]
+        elif delete_count == 0:
+            logger.info(f"  No objects to delete from {prefix} (clean slate)")
+        else:
+            logger.info(f"  Deleted {delete_count} objects from {prefix}")
         
-    except Exception as e:
-        logger.error(f"Error cleaning S3 directories: {str(e)}")
-        return 0
+        total_deleted += delete_count
+    
+    if failed:
+        raise Exception(f"Could not clean {len(failed)} S3 prefixes: {failed}")
+    return total_deleted
 
 def verify_cleanup():
     """Verify cleanup was successful"""
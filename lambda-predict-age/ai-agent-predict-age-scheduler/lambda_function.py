@@ -0,0 +1,191 @@
+import json
+import boto3
+import logging
+import os
+import time
+from datetime import datetime
+from botocore.exceptions import ClientError, ConnectionClosedError, ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError
+from scheduler import measure_limits, new_state, stop_all_tasks, tick
+from batch_manifest import read_batch_manifest  # Shared layer: ai-agent-predict-age-common
+
+# Configure logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Initialize AWS clients
+s3_client = boto3.client('s3')
+ecs_client = boto3.client('ecs')
+athena_client = boto3.client('athena')
+servicequotas_client = boto3.client('service-quotas')
+sqs_client = boto3.client('sqs')
+
+# Configuration from environment variables
+S3_BUCKET = os.environ.get('S3_BUCKET')
+YYYYQQ = os.environ.get('YYYYQQ', 'YYYYQQ')
+STATE_KEY = f'predict-age/scheduler/{YYYYQQ}/state.json'
+QUEUE_URL = os.environ.get('QUEUE_URL')  # Work queue for the worker-pool dispatch
+TICK_BUDGET_SEC = 60  # Leave headroom under the Lambda timeout
+PURGE_SETTLE_SEC = 60  # SQS may still delete messages sent within 60s of a PurgeQueue
+
+# Throttled or transient ECS/SQS/S3/Athena errors: raised as RetryableError for the state's Retry
+RETRYABLE_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'AWS.SimpleQueueService.RequestThrottled',
+    'SlowDown',
+    'ServiceUnavailable',
+    'ServiceUnavailableException',
+    'InternalError',
+    'InternalFailure',
+    'ServerException'
+}
+TRANSIENT_ERRORS = (ConnectionClosedError, ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError)
+
+class RetryableError(Exception):
+    """Step Functions retries the action on this error type (see the scheduler states' Retry)"""
+
+if not S3_BUCKET:
+    raise ValueError("S3_BUCKET environment variable is required")
+
+def load_state(missing_ok=False):
+    try:
+        return json.loads(s3_client.get_object(Bucket=S3_BUCKET, Key=STATE_KEY)['Body'].read())
+    except s3_client.exceptions.NoSuchKey:
+        if missing_ok:
+            return None
+        raise
+
+def save_state(state):
+    s3_client.put_object(Bucket=S3_BUCKET, Key=STATE_KEY, Body=json.dumps(state), ContentType='application/json')
+
+def save_state_quietly(state):
+    """Save the state on the error path (a second error must not hide the first)"""
+    try:
+        save_state(state)
+    except Exception as e:
+        logger.error(f"Could not save scheduler state: {str(e)}")
+
+def is_retryable(error):
+    """Throttling, 5xx and connection errors: the action can simply run again"""
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code', '')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return code in RETRYABLE_ERROR_CODES or status >= 500
+    return False
+
+def enqueue_units(manifest_key, plan_key, total_batches):
+    """
+    Send one work unit per manifest row to the work queue (work_queue.py workers).
+    Units carry the plan's created_at, so a worker never runs a unit from an
+    older plan with a newer one's TOTAL_BATCHES. The queue is purged first:
+    units left by an earlier run (or by a retried enqueue) would otherwise be
+    processed a second time.
+    """
+    try:
+        sqs_client.purge_queue(QueueUrl=QUEUE_URL)
+        logger.info(f"Purged {QUEUE_URL}, waiting {PURGE_SETTLE_SEC}s before enqueueing")
+    except sqs_client.exceptions.PurgeQueueInProgress:
+        logger.info(f"Purge of {QUEUE_URL} already in progress (retried enqueue)")
+    time.sleep(PURGE_SETTLE_SEC)
+
+    plan = json.loads(s3_client.get_object(Bucket=S3_BUCKET, Key=plan_key)['Body'].read())
+    items = read_batch_manifest(s3_client, S3_BUCKET, manifest_key)
+    entries = [{
+        'Id': str(batch_id),
+        'MessageBody': json.dumps({
+            'batch_id': batch_id,
+            **item,
+            'total_batches': total_batches,
+            'plan_created_at': plan['created_at']
+        })
+    } for batch_id, item in sorted(items.items())]
+
+    for start in range(0, len(entries), 10):  # SendMessageBatch limit
+        response = sqs_client.send_message_batch(QueueUrl=QUEUE_URL, Entries=entries[start:start + 10])
+        if response.get('Failed'):
+            raise Exception(f"Failed to enqueue {len(response['Failed'])} work units: {response['Failed'][0]}")
+    return len(entries)
+
+def lambda_handler(event, context):
+    """
+    Dispatch prediction batches as Fargate tasks within Athena/S3 limits.
+
+    Actions:
+      start - measure quotas, create scheduler state from event['manifest_key']
+              (id-range batch plan) or event['batch_ids'], plus event['total_batches'],
+              and run the first tick
+      tick  - refresh running tasks, adapt concurrency to Athena queue time and
+              throttling, launch more batches and speculative copies of slow
+              ones (called from a Wait/Choice loop)
+      enqueue - send the manifest's batches to the work queue (QUEUE_URL) for the
+              worker pool; returns the number of units enqueued
+
+    Returns scheduler_state RUNNING | SUCCEEDED | FAILED for the Choice state.
+    Throttled or transient AWS errors raise RetryableError (after saving the state,
+    so the retried action sees the tasks already launched; a retried start resumes
+    it); any other error stops the run's tasks and returns FAILED.
+    """
+    state = None
+    try:
+        action = event.get('action', 'tick')
+        if action == 'enqueue':
+            enqueued = enqueue_units(event['manifest_key'], event['plan_key'], int(event['total_batches']))
+            logger.info(f"Enqueued {enqueued} work units on {QUEUE_URL}")
+            return {
+                'statusCode': 200,
+                'enqueued': enqueued,
+                'timestamp': datetime.now().isoformat()
+            }
+        if action == 'start':
+            # PreCleanup removes the scheduler state, so one found here is a retried start's
+            state = load_state(missing_ok=True)
+            if state:
+                logger.info(f"Resuming scheduler state created at {state['created_at']} (retried start)")
+            else:
+                total_batches = int(event['total_batches'])
+                items = None
+                if event.get('manifest_key'):
+                    items = read_batch_manifest(s3_client, S3_BUCKET, event['manifest_key'])
+                    batch_ids = sorted(items)
+                else:
+                    batch_ids = event.get('batch_ids', list(range(total_batches)))
+                state = new_state(batch_ids, total_batches, measure_limits(servicequotas_client), items)
+                logger.info(f"Scheduling {len(batch_ids)} batches (of {total_batches})")
+        else:
+            state = load_state()
+
+        budget_sec = min(TICK_BUDGET_SEC, context.get_remaining_time_in_millis() / 1000 - 10) if context else TICK_BUDGET_SEC
+        summary = tick(state, ecs_client, athena_client, deadline=time.time() + budget_sec)
+        save_state(state)
+
+        return {
+            'statusCode': 200,
+            **{key: value for key, value in summary.items() if key != 'athena'},
+            'failed_batches': state['failed'],
+            'timestamp': datetime.now().isoformat()
+        }
+
+    except Exception as e:
+        if is_retryable(e):
+            logger.warning(f"Retryable error in batch scheduler: {str(e)}")
+            if state is not None:
+                save_state_quietly(state)
+            raise RetryableError(str(e)) from e
+
+        logger.error(f"Error in batch scheduler: {str(e)}")
+        stopped = 0
+        if state is not None:
+            stopped = stop_all_tasks(state, ecs_client, f'Scheduler failed: {str(e)[:200]}')
+            logger.error(f"Stopped {stopped} prediction tasks of this run")
+            save_state_quietly(state)
+        return {
+            'statusCode': 500,
+            'scheduler_state': 'FAILED',
+            'tasks_stopped': stopped,
+            'error': str(e)
+        }
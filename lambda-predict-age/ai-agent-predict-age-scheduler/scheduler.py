@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+"""
+Concurrency-aware prediction batch scheduler.
+
+Replaces the fixed MaxConcurrency = 500 Map: every prediction task starts with
+one Athena query, so launching 500 at once just queues them inside Athena while
+Fargate bills the wait. The scheduler launches tasks itself:
+
+- a token bucket paces launches at the rate Athena can absorb:
+    rate = athena_slots / observed query seconds   (capped by S3 PUT rate)
+  where athena_slots comes from the 'Active DML queries' service quota
+- an AIMD limiter caps running tasks: additive increase while Athena queue time
+  stays under target, multiplicative decrease on queueing or throttling
+- stopped tasks are classified (exit 0 -> done, otherwise retried up to MAX_ATTEMPTS)
+- speculative re-execution: a batch running SPECULATION_FACTOR x longer than the
+  median completed batch gets a second copy (within the same cap and bucket);
+  each copy writes its own batch_NNNN_{attempt} output and commits it with a
+  conditional PUT of the batch manifest, so exactly one copy's output is
+  referenced (the other deletes its file, or verify-batches removes it). The
+  other copy is stopped once one finishes, and the run only completes after
+  stopped copies have actually exited, so one slow task no longer costs a full
+  task timeout
+
+State lives in one JSON document (S3 for the Lambda, a local file for the CLI),
+so each tick is stateless: refresh running -> observe Athena -> adapt -> launch.
+
+Usage:
+  python scheduler.py --batches 898 --state-file /tmp/scheduler.json   # Local loop until done
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+from datetime import datetime
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Configuration from environment variables
+CLUSTER_ARN = os.environ.get('CLUSTER_ARN')
+TASK_DEFINITION_ARN = os.environ.get('TASK_DEFINITION_ARN')
+PREDICTION_CONTAINER = os.environ.get('PREDICTION_CONTAINER', 'prediction')
+SUBNET_IDS = [s for s in os.environ.get('SUBNET_IDS', '').split(',') if s]
+SECURITY_GROUP_IDS = [s for s in os.environ.get('SECURITY_GROUP_IDS', '').split(',') if s]
+RAW_TABLE = os.environ.get('RAW_TABLE', 'predict_age_full_evaluation_raw_378m')
+FINAL_ASSEMBLY = os.environ.get('FINAL_ASSEMBLY', 'false')
+RESUME = os.environ.get('RESUME', 'true')  # Passed through: prediction tasks skip checkpointed batches
+INCREMENTAL = os.environ.get('INCREMENTAL', 'false')  # Passed through: carry unchanged profiles forward
+WORKGROUP = os.environ.get('WORKGROUP', 'primary')
+
+MAX_CONCURRENCY = int(os.environ.get('MAX_CONCURRENCY', '500'))
+MIN_CONCURRENCY = int(os.environ.get('MIN_CONCURRENCY', '5'))
+TASK_VCPU = 4  # Prediction task definition
+ATHENA_DML_QUOTA_FALLBACK = int(os.environ.get('ATHENA_DML_QUOTA', '25'))
+ATHENA_SHARE = float(os.environ.get('ATHENA_SHARE', '0.8'))  # Leave headroom for other workloads
+EXPECTED_QUERY_SEC = float(os.environ.get('EXPECTED_QUERY_SEC', '30'))
+QUEUE_TARGET_MS = int(os.environ.get('QUEUE_TARGET_MS', '5000'))
+MAX_ATTEMPTS = int(os.environ.get('MAX_ATTEMPTS', '3'))
+SPECULATION_FACTOR = float(os.environ.get('SPECULATION_FACTOR', '2.0'))  # 0 disables speculative copies
+SPECULATION_MIN_SAMPLES = 20  # Completed batches before the median is trusted
+SPECULATION_SHARE = 0.1  # Max share of the running-task cap used by speculative copies
+DURATION_SAMPLES = 500
+
+# S3: 3,500 PUT/s per prefix; a batch writes its Parquet file + manifest (~3 requests)
+S3_PUTS_PER_SEC = 3500
+S3_PUTS_PER_BATCH = 3
+
+ADDITIVE_INCREASE = 5
+MULTIPLICATIVE_DECREASE = 0.7
+THROTTLE_MARKERS = ('Throttl', 'TooManyRequests', 'Rate exceeded', 'SlowDown')
+
+class TokenBucket:
+    """Launch pacing: `rate` tokens/sec, bursts up to `capacity`"""
+
+    def __init__(self, rate, capacity, tokens=None, updated_at=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity if tokens is None else tokens
+        self.updated_at = time.time() if updated_at is None else updated_at
+
+    def refill(self, now=None):
+        now = time.time() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self, now=None):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def to_dict(self):
+        return {'rate': self.rate, 'capacity': self.capacity, 'tokens': self.tokens, 'updated_at': self.updated_at}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['rate'], data['capacity'], data['tokens'], data['updated_at'])
+
+class AimdLimiter:
+    """Additive-increase / multiplicative-decrease cap on running tasks"""
+
+    def __init__(self, limit, minimum, maximum):
+        self.limit = limit
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def on_congestion(self):
+        self.limit = max(self.minimum, self.limit * MULTIPLICATIVE_DECREASE)
+
+    def on_clear(self):
+        self.limit = min(self.maximum, self.limit + ADDITIVE_INCREASE)
+
+    def to_dict(self):
+        return {'limit': self.limit, 'minimum': self.minimum, 'maximum': self.maximum}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['limit'], data['minimum'], data['maximum'])
+
+def find_quota(servicequotas_client, service_code, *name_parts):
+    """Value of the first service quota whose name contains all name_parts, or None"""
+    try:
+        paginator = servicequotas_client.get_paginator('list_service_quotas')
+        for page in paginator.paginate(ServiceCode=service_code):
+            for quota in page['Quotas']:
+                if all(part.lower() in quota['QuotaName'].lower() for part in name_parts):
+                    return quota['Value']
+    except ClientError as e:
+        logger.warning(f"Could not read {service_code} quotas: {str(e)}")
+    return None
+
+def measure_limits(servicequotas_client):
+    """Athena DML slots and Fargate task ceiling from the account's service quotas"""
+    athena_quota = find_quota(servicequotas_client, 'athena', 'active', 'dml') or ATHENA_DML_QUOTA_FALLBACK
+    fargate_vcpu = find_quota(servicequotas_client, 'fargate', 'on-demand', 'vcpu')
+    fargate_tasks = int(fargate_vcpu // TASK_VCPU) if fargate_vcpu else MAX_CONCURRENCY
+    limits = {
+        'athena_slots': max(1, int(athena_quota * ATHENA_SHARE)),
+        'max_tasks': max(MIN_CONCURRENCY, min(MAX_CONCURRENCY, fargate_tasks)),
+        's3_batches_per_sec': S3_PUTS_PER_SEC / S3_PUTS_PER_BATCH
+    }
+    logger.info(f"Limits: Athena DML quota {athena_quota:g} -> {limits['athena_slots']} slots, "
+                f"Fargate tasks {limits['max_tasks']}")
+    return limits
+
+def launch_rate(athena_slots, query_sec, s3_batches_per_sec):
+    """Steady-state launches/sec that keeps concurrent Athena queries within the slots"""
+    return min(athena_slots / max(query_sec, 1.0), s3_batches_per_sec)
+
+def new_state(batch_ids, total_batches, limits, items=None):
+    """Initial scheduler state for a run (items: id-range bounds per batch from the plan manifest)"""
+    initial_limit = min(limits['max_tasks'], max(MIN_CONCURRENCY, limits['athena_slots']))
+    return {
+        'total_batches': total_batches,
+        'items': {str(batch_id): item for batch_id, item in (items or {}).items()},
+        'pending': list(batch_ids),
+        'running': {},
+        'stopping': [],  # Stopped copies not yet STOPPED (could still upload)
+        'succeeded': [],
+        'failed': {},
+        'attempts': {},
+        'durations': [],
+        'speculated': 0,
+        'speculative_wins': 0,
+        'limits': limits,
+        'query_sec': EXPECTED_QUERY_SEC,
+        'limiter': AimdLimiter(initial_limit, MIN_CONCURRENCY, limits['max_tasks']).to_dict(),
+        'bucket': TokenBucket(
+            launch_rate(limits['athena_slots'], EXPECTED_QUERY_SEC, limits['s3_batches_per_sec']),
+            capacity=limits['athena_slots']
+        ).to_dict(),
+        'last_tick': time.time(),
+        'launch_throttled': False,
+        'history': [],
+        'created_at': datetime.now().isoformat()
+    }
+
+def running_tasks(state):
+    """Tasks in flight, counting speculative copies and copies still stopping"""
+    return sum(1 + ('backup_arn' in info) for info in state['running'].values()) + len(state['stopping'])
+
+def median_duration(state):
+    """Median completed batch duration in seconds (None until SPECULATION_MIN_SAMPLES batches finished)"""
+    durations = state['durations']
+    if len(durations) < SPECULATION_MIN_SAMPLES:
+        return None
+    return sorted(durations)[len(durations) // 2]
+
+def stop_task(state, ecs_client, task_arn, reason):
+    """Stop a copy; it is tracked in state['stopping'] until ECS reports it STOPPED"""
+    state['stopping'].append(task_arn)
+    try:
+        ecs_client.stop_task(cluster=CLUSTER_ARN, task=task_arn, reason=reason)
+    except ClientError as e:
+        logger.warning(f"Could not stop {task_arn}: {str(e)}")
+
+def stop_all_tasks(state, ecs_client, reason):
+    """Stop every copy the run still has running (a failed scheduler leaves none billing or writing). Returns the count."""
+    arns = [arn for info in state['running'].values() for arn in (info['task_arn'], info.get('backup_arn')) if arn]
+    for task_arn in arns:
+        stop_task(state, ecs_client, task_arn, reason)
+    state['running'] = {}
+    return len(arns)
+
+def refresh_running(state, ecs_client):
+    """Move stopped tasks to succeeded / pending (retry) / failed; settle speculative copies"""
+    arns = {}
+    for batch_id, info in state['running'].items():
+        arns[info['task_arn']] = batch_id
+        if info.get('backup_arn'):
+            arns[info['backup_arn']] = batch_id
+    arn_list = list(arns) + state['stopping']
+    for start in range(0, len(arn_list), 100):  # DescribeTasks limit
+        response = ecs_client.describe_tasks(cluster=CLUSTER_ARN, tasks=arn_list[start:start + 100])
+        for failure in response.get('failures', []):
+            if failure.get('reason') == 'MISSING' and failure.get('arn') in state['stopping']:
+                state['stopping'].remove(failure['arn'])  # Long gone
+        for task in response['tasks']:
+            if task['lastStatus'] != 'STOPPED':
+                continue
+            if task['taskArn'] in state['stopping']:
+                state['stopping'].remove(task['taskArn'])
+                continue
+            batch_id = arns[task['taskArn']]
+            info = state['running'].get(batch_id)
+            if info is None:
+                continue  # The other copy already settled this batch
+            is_backup = info.get('backup_arn') == task['taskArn']
+            other_arn = info.get('task_arn') if is_backup else info.get('backup_arn')
+            container = next((c for c in task.get('containers', []) if c['name'] == PREDICTION_CONTAINER), {})
+
+            if container.get('exitCode') == 0:
+                del state['running'][batch_id]
+                state['succeeded'].append(int(batch_id))
+                started_at = info['backup_started_at'] if is_backup else info['started_at']
+                state['durations'] = (state['durations'] + [round(time.time() - started_at, 1)])[-DURATION_SAMPLES:]
+                if other_arn:
+                    # The manifest references one copy's output: the other's work is redundant
+                    stop_task(state, ecs_client, other_arn, f'Batch {batch_id} finished by another copy')
+                    if is_backup:
+                        state['speculative_wins'] += 1
+                        logger.info(f"Batch {batch_id}: speculative copy finished first")
+                continue
+
+            reason = task.get('stoppedReason') or container.get('reason') or f"exit {container.get('exitCode')}"
+            if other_arn:
+                # Keep the batch on the surviving copy instead of retrying
+                logger.warning(f"Batch {batch_id}: {'speculative copy' if is_backup else 'task'} stopped ({reason}), "
+                               f"other copy continues")
+                if not is_backup:
+                    info['task_arn'], info['started_at'] = info['backup_arn'], info['backup_started_at']
+                del info['backup_arn'], info['backup_started_at']
+                continue
+
+            del state['running'][batch_id]
+            attempts = state['attempts'].get(batch_id, 0)
+            if attempts < MAX_ATTEMPTS:
+                logger.warning(f"Batch {batch_id} failed ({reason}), retrying ({attempts}/{MAX_ATTEMPTS})")
+                state['pending'].insert(0, int(batch_id))
+            else:
+                logger.error(f"Batch {batch_id} failed after {attempts} attempts: {reason}")
+                state['failed'][batch_id] = reason
+
+def observe_athena(athena_client, since):
+    """Queue time, engine time and throttling of this workgroup's queries submitted since `since`"""
+    ids = athena_client.list_query_executions(WorkGroup=WORKGROUP, MaxResults=50).get('QueryExecutionIds', [])
+    if not ids:
+        return None
+    executions = athena_client.batch_get_query_execution(QueryExecutionIds=ids)['QueryExecutions']
+
+    queue_ms, engine_ms, throttled = [], [], 0
+    for execution in executions:
+        submitted = execution['Status'].get('SubmissionDateTime')
+        if submitted is None or submitted.timestamp() < since:
+            continue
+        reason = execution['Status'].get('StateChangeReason', '')
+        if any(marker in reason for marker in THROTTLE_MARKERS):
+            throttled += 1
+        statistics = execution.get('Statistics', {})
+        if 'QueryQueueTimeInMillis' in statistics:
+            queue_ms.append(statistics['QueryQueueTimeInMillis'])
+        if execution['Status']['State'] == 'SUCCEEDED' and 'EngineExecutionTimeInMillis' in statistics:
+            engine_ms.append(statistics['EngineExecutionTimeInMillis'])
+
+    def median(values):
+        return sorted(values)[len(values) // 2] if values else None
+
+    return {'queries': len(queue_ms), 'queue_ms_p50': median(queue_ms),
+            'engine_ms_p50': median(engine_ms), 'throttled': throttled}
+
+def adapt(state, observation):
+    """AIMD on the running-task cap; re-size the bucket to the measured query time"""
+    limiter = AimdLimiter.from_dict(state['limiter'])
+    bucket = TokenBucket.from_dict(state['bucket'])
+
+    congested = state['launch_throttled']
+    if observation:
+        if observation['engine_ms_p50']:
+            # Smooth measured query time so one slow query doesn't stall launches
+            state['query_sec'] = 0.7 * state['query_sec'] + 0.3 * observation['engine_ms_p50'] / 1000
+        if observation['throttled'] or (observation['queue_ms_p50'] or 0) > QUEUE_TARGET_MS:
+            congested = True
+
+    if congested:
+        limiter.on_congestion()
+    elif state['running'] and running_tasks(state) >= int(limiter.limit) - 1:
+        limiter.on_clear()  # Only grow when the current cap is actually in use
+
+    limits = state['limits']
+    bucket.rate = launch_rate(limits['athena_slots'], state['query_sec'], limits['s3_batches_per_sec'])
+    if congested:
+        bucket.tokens = 0  # Drain the burst while Athena catches up
+
+    state['limiter'] = limiter.to_dict()
+    state['bucket'] = bucket.to_dict()
+    return congested
+
+def start_task(state, ecs_client, batch_id):
+    """RunTask for one batch. Returns the task ARN, or None when launches should back off."""
+    environment = [
+        {'name': 'BATCH_ID', 'value': str(batch_id)},
+        {'name': 'RAW_TABLE', 'value': RAW_TABLE},
+        {'name': 'TOTAL_BATCHES', 'value': str(state['total_batches'])},
+        {'name': 'FINAL_ASSEMBLY', 'value': FINAL_ASSEMBLY},
+        {'name': 'RESUME', 'value': RESUME},
+        {'name': 'INCREMENTAL', 'value': INCREMENTAL}
+    ]
+    item = state.get('items', {}).get(str(batch_id))
+    if item:
+        expected = item['expected_predictions']
+        environment += [
+            {'name': 'ID_MIN', 'value': str(item['id_min'])},
+            {'name': 'ID_MAX', 'value': str(item['id_max'])},
+            {'name': 'EXPECTED_PREDICTIONS', 'value': '' if expected is None else str(expected)}
+        ]
+    try:
+        response = ecs_client.run_task(
+            cluster=CLUSTER_ARN,
+            taskDefinition=TASK_DEFINITION_ARN,
+            launchType='FARGATE',
+            networkConfiguration={'awsvpcConfiguration': {
+                'subnets': SUBNET_IDS,
+                'securityGroups': SECURITY_GROUP_IDS,
+                'assignPublicIp': 'ENABLED'
+            }},
+            overrides={'containerOverrides': [{
+                'name': PREDICTION_CONTAINER,
+                'environment': environment
+            }]}
+        )
+    except ClientError as e:
+        if any(marker in str(e) for marker in THROTTLE_MARKERS):
+            return None
+        raise
+
+    if response.get('failures'):
+        # Capacity (RESOURCE:*) or API failures: back off and retry next tick
+        logger.warning(f"RunTask failures: {response['failures']}")
+        return None
+    return response['tasks'][0]['taskArn']
+
+def speculation_candidates(state):
+    """
+    Batches whose newest copy has run SPECULATION_FACTOR x the median duration,
+    slowest first (a slow speculative copy is replaced, not doubled up)
+    """
+    median = median_duration(state)
+    if SPECULATION_FACTOR <= 0 or median is None:
+        return []
+    now = time.time()
+    slow = []
+    for batch_id, info in state['running'].items():
+        elapsed = now - info.get('backup_started_at', info['started_at'])
+        if elapsed > SPECULATION_FACTOR * median:
+            slow.append((elapsed, batch_id))
+    return [batch_id for _, batch_id in sorted(slow, reverse=True)]
+
+def launch_batches(state, ecs_client, deadline):
+    """Launch pending batches, then speculative copies of slow ones, while the AIMD cap and token bucket allow"""
+    limiter = AimdLimiter.from_dict(state['limiter'])
+    bucket = TokenBucket.from_dict(state['bucket'])
+    state['launch_throttled'] = False
+    launched = 0
+
+    while state['pending'] and running_tasks(state) < int(limiter.limit) and time.time() < deadline:
+        if not bucket.take():
+            break
+        batch_id = state['pending'].pop(0)
+        try:
+            task_arn = start_task(state, ecs_client, batch_id)
+        except ClientError:
+            state['pending'].insert(0, batch_id)
+            raise
+        if task_arn is None:
+            state['pending'].insert(0, batch_id)
+            state['launch_throttled'] = True
+            break
+
+        key = str(batch_id)
+        state['attempts'][key] = state['attempts'].get(key, 0) + 1
+        state['running'][key] = {'task_arn': task_arn, 'started_at': time.time()}
+        launched += 1
+
+    # Copies only use capacity the pending batches left over
+    max_copies = max(1, int(limiter.limit * SPECULATION_SHARE))
+    copies = sum('backup_arn' in info for info in state['running'].values())
+    for key in speculation_candidates(state):
+        info = state['running'][key]
+        replacing = 'backup_arn' in info
+        if (state['launch_throttled'] or (not replacing and copies >= max_copies)
+                or (not replacing and running_tasks(state) >= int(limiter.limit))
+                or time.time() >= deadline or not bucket.take()):
+            break
+        task_arn = start_task(state, ecs_client, int(key))
+        if task_arn is None:
+            state['launch_throttled'] = True
+            break
+        logger.info(f"Batch {key}: running {time.time() - info['started_at']:.0f}s "
+                    f"(median {median_duration(state):.0f}s), launching a speculative copy")
+        if replacing:
+            stop_task(state, ecs_client, info['backup_arn'], f'Batch {key}: replaced by a new speculative copy')
+        else:
+            copies += 1
+        info.update({'backup_arn': task_arn, 'backup_started_at': time.time()})
+        state['speculated'] += 1
+        launched += 1
+
+    state['bucket'] = bucket.to_dict()
+    return launched
+
+def tick(state, ecs_client, athena_client, deadline):
+    """One scheduling round. Returns a summary for logs / Step Functions."""
+    refresh_running(state, ecs_client)
+    observation = observe_athena(athena_client, state['last_tick'])
+    state['last_tick'] = time.time()
+    congested = adapt(state, observation)
+    launched = launch_batches(state, ecs_client, deadline)
+
+    done = not state['pending'] and not state['running'] and not state['stopping']
+    summary = {
+        'pending': len(state['pending']),
+        'running': len(state['running']),
+        'stopping': len(state['stopping']),
+        'succeeded': len(state['succeeded']),
+        'failed': len(state['failed']),
+        'launched': launched,
+        'speculative_running': sum('backup_arn' in info for info in state['running'].values()),
+        'speculated': state['speculated'],
+        'speculative_wins': state['speculative_wins'],
+        'concurrency_limit': int(state['limiter']['limit']),
+        'launch_rate_per_sec': round(state['bucket']['rate'], 3),
+        'query_sec': round(state['query_sec'], 1),
+        'athena': observation,
+        'congested': congested,
+        'scheduler_state': ('FAILED' if state['failed'] else 'SUCCEEDED') if done else 'RUNNING'
+    }
+    state['history'] = (state['history'] + [{k: summary[k] for k in ('running', 'launched', 'concurrency_limit')}])[-50:]
+    logger.info(f"Scheduler tick: {json.dumps(summary, default=str)}")
+    return summary
+
+def main():
+    """Local CLI: run the scheduling loop until all batches finish"""
+    import boto3
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Dispatch prediction batches within Athena/S3 limits')
+    parser.add_argument('--batches', type=int, required=True, help='Total batches (ids 0..N-1)')
+    parser.add_argument('--state-file', default='/tmp/scheduler_state.json', help='Resume from / save state here')
+    parser.add_argument('--interval', type=int, default=30, help='Seconds between ticks')
+    args = parser.parse_args()
+
+    ecs_client = boto3.client('ecs')
+    athena_client = boto3.client('athena')
+
+    if os.path.exists(args.state_file):
+        with open(args.state_file) as f:
+            state = json.load(f)
+        logger.info(f"Resuming from {args.state_file}")
+    else:
+        state = new_state(range(args.batches), args.batches, measure_limits(boto3.client('service-quotas')))
+
+    while True:
+        summary = tick(state, ecs_client, athena_client, deadline=time.time() + args.interval)
+        with open(args.state_file, 'w') as f:
+            json.dump(state, f)
+        if summary['scheduler_state'] != 'RUNNING':
+            return 0 if summary['scheduler_state'] == 'SUCCEEDED' else 1
+        time.sleep(args.interval)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,6 +4,8 @@ import time
 import os
 from datetime import datetime
 import logging
+from checkpoint import record_table, reset_table, table_complete  # Shared layer: ai-agent-predict-age-common
+from athena_query import check_query_completion
 
 # Configure logging
 logger = logging.getLogger()
@@ -16,6 +18,9 @@ s3_client = boto3.client('s3')
 # Configuration from environment variables
 S3_BUCKET = os.environ.get('S3_BUCKET')
 DATABASE_NAME = os.environ.get('DATABASE_NAME', 'ml_predict_age')
+YYYYQQ = os.environ.get('YYYYQQ', 'YYYYQQ')  # Run id for checkpoints
+RESUME = os.environ.get('RESUME', 'true').lower() == 'true'
+STAGING_SQL_FILE = 'staging_parsed_features.sql'
 
 if not S3_BUCKET:
     raise ValueError("S3_BUCKET environment variable is required")
@@ -92,16 +97,57 @@ def lambda_handler(event, context):
     Lambda function to create staging table with parsed JSON features.
     This pre-parses JSON fields once to avoid repeated expensive parsing.
     Duration: 15-20 min, Cost: $0.50
+    
+    Actions (event['action']):
+    - 'run' (default): start the CTAS and wait for it inside the Lambda
+    - 'submit': start the CTAS and return the execution ID immediately; with RESUME,
+      skip it if this run's staging table is already verified complete
+    - 'check': poll event['execution_ids'] once (Step Functions wait loop) and
+      checkpoint event['sql_files'] tables once they succeed
     """
     try:
         logger.info(f"Received event: {event}")
+        
+        action = event.get('action', 'run')
+        if action == 'check':
+            result = check_query_completion(athena_client, event['execution_ids'])
+            result['sql_files'] = event.get('sql_files', [])
+            if result['query_state'] == 'SUCCEEDED':
+                for sql_file in result['sql_files']:
+                    record_table(s3_client, S3_BUCKET, YYYYQQ, read_sql_file(sql_file))
+            return result
         logger.info("Processing staging features with JSON parsing")
         
         # Read staging features query from SQL file
-        staging_query = read_sql_file('staging_parsed_features.sql')
+        staging_query = read_sql_file(STAGING_SQL_FILE)
+        
+        if action == 'submit' and RESUME:
+            if table_complete(athena_client, s3_client, S3_BUCKET, DATABASE_NAME, YYYYQQ, staging_query):
+                logger.info("Staging table already complete for this run, skipping CTAS")
+                return {
+                    'statusCode': 200,
+                    'query_state': 'SUCCEEDED',
+                    'execution_ids': [],
+                    'sql_files': [],
+                    'skipped': [STAGING_SQL_FILE],
+                    'timestamp': datetime.now().isoformat()
+                }
+            # Leftovers from a failed run would make the CTAS fail
+            reset_table(athena_client, s3_client, S3_BUCKET, DATABASE_NAME, YYYYQQ, staging_query)
         
         # Execute staging query
         execution_id = execute_athena_query(staging_query, "Creating staging table with parsed JSON features")
+        
+        if action == 'submit':
+            logger.info(f"Staging CTAS submitted: {execution_id}")
+            return {
+                'statusCode': 200,
+                'query_state': 'RUNNING',
+                'execution_ids': [execution_id],
+                'sql_files': [STAGING_SQL_FILE],
+                'timestamp': datetime.now().isoformat()
+            }
+        
         wait_for_query_completion(execution_id)
         
         logger.info("Staging feature engineering completed successfully")
@@ -117,8 +163,10 @@ def lambda_handler(event, context):
 
     except Exception as e:
         logger.error(f"Error in staging features Lambda: {str(e)}")
+        # Step Functions' Choice reads query_state: a failed submit or check goes to PipelineFailed
         return {
             'statusCode': 500,
+            'query_state': 'FAILED',
             'body': json.dumps({
                 'error': str(e),
                 'timestamp': datetime.now().isoformat()
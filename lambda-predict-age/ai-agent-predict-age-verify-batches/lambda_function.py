@@ -0,0 +1,202 @@
+import json
+import os
+import time
+import boto3
+import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from batch_manifest import read_batch_manifest  # Shared layer: ai-agent-predict-age-common
+from checkpoint import predictions_fingerprint
+from s3_delete import S3PrefixDeleter
+
+# Configure logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Initialize AWS clients (pool sized for concurrent manifest reads)
+s3_client = boto3.client('s3', config=Config(max_pool_connections=50))
+
+# Configuration from environment variables
+S3_BUCKET = os.environ.get('S3_BUCKET')
+YYYYQQ = os.environ.get('YYYYQQ', 'YYYYQQ')
+MANIFEST_PREFIX = f'predict-age/manifests/{YYYYQQ}/'
+BITMAP_SUMMARY_KEY = f'predict-age/needs-prediction/{YYYYQQ}/summary.json'
+# Where this run's batches write (predictions, or map-side final results): the only
+# places unreferenced outputs are removed from
+OUTPUT_PREFIXES = [f'predict-age/predictions/{YYYYQQ}/',
+                   f'predict-age/final-results/predict_age_final_results_{YYYYQQ}/']
+MAX_WORKERS = 32
+REPORT_LIMIT = 100  # Batch ids listed in the result (counts are always complete)
+
+if not S3_BUCKET:
+    raise ValueError("S3_BUCKET environment variable is required")
+
+def list_objects(prefix):
+    """Return {key: (size, etag)} for every object under a prefix"""
+    objects = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = (obj['Size'], obj['ETag'])
+    return objects
+
+def load_manifests():
+    """Read every batch manifest for this run concurrently. Returns {batch_id: manifest}."""
+    keys = [key for key in list_objects(MANIFEST_PREFIX) if key.endswith('.json')]
+
+    def read_manifest(key):
+        return json.loads(s3_client.get_object(Bucket=S3_BUCKET, Key=key)['Body'].read())
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        manifests = list(pool.map(read_manifest, keys))
+    return {manifest['batch_id']: manifest for manifest in manifests}
+
+def load_expected_counts(total_batches):
+    """Per-batch needs-prediction counts from the bitmap summary, if it matches this batch layout"""
+    try:
+        summary = json.loads(s3_client.get_object(Bucket=S3_BUCKET, Key=BITMAP_SUMMARY_KEY)['Body'].read())
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    if summary['total_batches'] != total_batches:
+        return None
+    return summary['batch_counts']
+
+def remove_unreferenced(output_objects, manifests):
+    """
+    Delete output files no manifest references: copies of a batch that lost the manifest
+    commit (speculative or re-leased) and were stopped before removing their own file, or
+    outputs replaced by a later attempt. They sit under the table location, so Athena
+    would read them as duplicates. Only Parquet files under this run's OUTPUT_PREFIXES
+    are candidates; they are logged before anything is deleted. Returns the deleted keys.
+    """
+    referenced = {m['output_key'] for m in manifests.values() if m['output_key']}
+    unreferenced = sorted(key for key in output_objects
+                          if key.endswith('.parquet') and key not in referenced
+                          and any(key.startswith(prefix) for prefix in OUTPUT_PREFIXES))
+    if not unreferenced:
+        return []
+    logger.warning(f"Removing {len(unreferenced)} output files no manifest references: {unreferenced[:20]}")
+
+    targets = set(unreferenced)
+    prefixes = sorted({key.rsplit('/', 1)[0] + '/' for key in unreferenced})
+    stats = S3PrefixDeleter(s3_client, S3_BUCKET).delete_prefixes(prefixes, keep=lambda key: key not in targets)
+    errors = [error for prefix_stats in stats.values() for error in prefix_stats['errors']]
+    if errors:
+        raise Exception(f"Could not remove unreferenced outputs: {errors[0]}")
+    logger.info(f"Removed {sum(prefix_stats['deleted'] for prefix_stats in stats.values())} unreferenced output files")
+    return unreferenced
+
+def check_manifest(batch_id, manifest, total_batches, output_objects, expected_counts, item=None):
+    """Return a list of problems with one batch manifest (empty if consistent)"""
+    problems = []
+    if manifest['total_batches'] != total_batches:
+        problems.append(f"built for {manifest['total_batches']} batches")
+
+    # Range batches: ids within the plan item's bounds; MOD batches: MOD(id, total_batches) = N
+    for bound in ('id_min', 'id_max'):
+        if manifest[bound] is None:
+            continue
+        if item is not None:
+            if not item['id_min'] <= manifest[bound] <= item['id_max']:
+                problems.append(f"{bound} {manifest[bound]} outside {item['id_min']}-{item['id_max']}")
+        elif manifest[bound] % total_batches != batch_id:
+            problems.append(f"{bound} {manifest[bound]} not in batch")
+
+    if manifest['output_key']:
+        size, etag = output_objects.get(manifest['output_key'], (None, None))
+        if size is None:
+            problems.append(f"output {manifest['output_key']} missing")
+        elif size != manifest['file_bytes']:
+            problems.append(f"output size {size} != manifest {manifest['file_bytes']}")
+        elif manifest.get('etag') and etag != manifest['etag']:
+            problems.append(f"output ETag {etag} != manifest {manifest['etag']} (rewritten after the manifest)")
+    elif manifest['row_count']:
+        problems.append("rows recorded without an output file")
+
+    if expected_counts is not None and manifest['prediction_count'] != expected_counts[batch_id]:
+        problems.append(f"{manifest['prediction_count']} predictions, bitmap expected {expected_counts[batch_id]}")
+    return problems
+
+def lambda_handler(event, context):
+    """
+    Verify per-batch prediction manifests before Human QA / final results.
+    Confirms every dispatched batch wrote a manifest, its output file exists with the
+    recorded size and ETag, its id range belongs to the batch and its prediction count matches
+    the needs-prediction bitmap - without querying the predictions table. Output files no
+    manifest references (losing copies of a batch) under this run's prefixes are deleted. The predictions
+    fingerprint returned keys the Human QA / final results checkpoints.
+
+    Event: {'manifest_key': ..., 'total_batches': N} (from GenerateBatchIds), or
+           {'batch_ids': [...], 'total_batches': N} for MOD batches
+    """
+    try:
+        start_time = time.time()
+        total_batches = int(event['total_batches'])
+        items = {}
+        if event.get('manifest_key'):
+            items = read_batch_manifest(s3_client, S3_BUCKET, event['manifest_key'])
+            batch_ids = sorted(items)
+            expected_counts = {batch_id: item['expected_predictions'] for batch_id, item in items.items()
+                               if item['expected_predictions'] is not None} or None
+        else:
+            batch_ids = event.get('batch_ids', list(range(total_batches)))
+            expected_counts = load_expected_counts(total_batches)
+
+        manifests = load_manifests()
+
+        # One listing per output directory instead of a HEAD per batch
+        output_dirs = {m['output_key'].rsplit('/', 1)[0] + '/' for m in manifests.values() if m['output_key']}
+        output_objects = {}
+        for output_dir in output_dirs:
+            output_objects.update(list_objects(output_dir))
+        unreferenced = remove_unreferenced(output_objects, manifests)
+
+        missing = [batch_id for batch_id in batch_ids if batch_id not in manifests]
+        inconsistent = {}
+        for batch_id in batch_ids:
+            if batch_id in manifests:
+                problems = check_manifest(batch_id, manifests[batch_id], total_batches, output_objects,
+                                          expected_counts, items.get(batch_id))
+                if problems:
+                    inconsistent[batch_id] = problems
+
+        present = [manifests[batch_id] for batch_id in batch_ids if batch_id in manifests]
+        total_rows = sum(m['row_count'] for m in present)
+        total_predictions = sum(m['prediction_count'] for m in present)
+        batch_seconds = sorted(((m['timings_sec'].get('total', 0), m['batch_id']) for m in present), reverse=True)
+
+        complete = not missing and not inconsistent
+        logger.info(f"Manifests: {len(present)}/{len(batch_ids)} batches, {total_rows:,} rows, "
+                    f"{total_predictions:,} predictions ({time.time() - start_time:.2f}s)")
+        if missing:
+            logger.error(f"❌ Missing manifests for {len(missing)} batches: {missing[:50]}")
+        for batch_id, problems in list(inconsistent.items())[:50]:
+            logger.error(f"❌ Batch {batch_id}: {'; '.join(problems)}")
+        if complete:
+            logger.info("✅ All batch manifests present and consistent")
+
+        return {
+            'statusCode': 200 if complete else 500,
+            'complete': complete,
+            'batches_expected': len(batch_ids),
+            'batches_present': len(present),
+            'missing_count': len(missing),
+            'missing_batches': missing[:REPORT_LIMIT],  # Capped: state payloads are limited to 256KB
+            'inconsistent_count': len(inconsistent),
+            'inconsistent_batches': {str(batch_id): problems for batch_id, problems in list(inconsistent.items())[:REPORT_LIMIT]},
+            'total_rows': total_rows,
+            'total_predictions': total_predictions,
+            'unreferenced_outputs_removed': len(unreferenced),
+            'predictions_fingerprint': predictions_fingerprint(present),
+            'slowest_batches': [{'batch_id': batch_id, 'seconds': seconds} for seconds, batch_id in batch_seconds[:5]],
+            'timestamp': datetime.now().isoformat()
+        }
+
+    except Exception as e:
+        logger.error(f"Error verifying batch manifests: {str(e)}")
+        return {
+            'statusCode': 500,
+            'complete': False,
+            'error': str(e)
+        }
@@ -1,22 +1,17 @@
 -- Evaluation Features: 21 features for ALL 378M PIDs
 -- Source: staging_parsed_features_2025q3 (pre-parsed JSON fields)
--- Used for batch prediction (898 batches of ~1M records each)
+-- Used for batch prediction (batch count planned per run by batch_generator)
 -- NOTE: Replace ${S3_BUCKET} with your actual S3 bucket name before execution
 
 CREATE TABLE ${DATABASE_NAME}.predict_age_full_evaluation_features_378m
 WITH (
     format = 'PARQUET',
     parquet_compression = 'SNAPPY',
-    external_location = 's3://${S3_BUCKET}/predict-age/predict_age_full_evaluation_features_378m/',
-    bucketed_by = ARRAY['batch_id'],
-    bucket_count = 898
+    external_location = 's3://${S3_BUCKET}/predict-age/predict_age_full_evaluation_features_378m/'
 ) AS
 SELECT 
     pid,
     
-    -- Batch ID for parallel processing (898 batches of ~1M records)
-    CAST(FLOOR(ROW_NUMBER() OVER (ORDER BY pid) / 420935.0) AS BIGINT) as batch_id,
-    
     -- ==================================================
     -- CAREER STAGE INDICATORS (5 features)
     -- ==================================================
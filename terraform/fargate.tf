@@ -48,6 +48,20 @@ resource "aws_ecr_repository" "feature_parser" {
   })
 }
 
+# ECR Repository for Lookup Snapshot Builder Docker Image
+resource "aws_ecr_repository" "lookup" {
+  name                 = "${var.project_name}-lookup"
+  image_tag_mutability = "MUTABLE"
+
+  image_scanning_configuration {
+    scan_on_push = true
+  }
+
+  tags = merge(local.common_tags, {
+    Purpose = "Memory-mapped point lookup snapshot over final results"
+  })
+}
+
 # IAM Role for Fargate Tasks
 resource "aws_iam_role" "fargate_task_role" {
   name = "${var.project_name}-task-role"
@@ -132,10 +146,45 @@ resource "aws_iam_role_policy" "fargate_task_policy" {
         ]
         Resource = "arn:aws:logs:*:*:*"
       },
+      {
+        Effect = "Allow"
+        Action = [
+          "sqs:ReceiveMessage",
+          "sqs:DeleteMessage",
+          "sqs:ChangeMessageVisibility",
+          "sqs:GetQueueAttributes",
+        ]
+        Resource = aws_sqs_queue.work_queue.arn
+      },
     ]
   })
 }
 
+# Work queue for the worker-pool dispatch (work_queue.py): one message per id-range batch.
+# A lease is the visibility timeout; workers extend it while a unit runs, so a
+# crashed worker's unit reappears after LEASE_SECONDS. Units received
+# maxReceiveCount times without an ack move to the dead-letter queue.
+resource "aws_sqs_queue" "work_queue_dlq" {
+  name                      = "${var.project_name}-work-queue-dlq"
+  message_retention_seconds = 1209600  # 14 days
+
+  tags = local.common_tags
+}
+
+resource "aws_sqs_queue" "work_queue" {
+  name                       = "${var.project_name}-work-queue"
+  visibility_timeout_seconds = 600  # LEASE_SECONDS in work_queue.py
+  message_retention_seconds  = 345600  # 4 days
+  receive_wait_time_seconds  = 20
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.work_queue_dlq.arn
+    maxReceiveCount     = 3  # MAX_ATTEMPTS in work_queue.py
+  })
+
+  tags = local.common_tags
+}
+
 # IAM Role for Fargate Task Execution
 resource "aws_iam_role" "fargate_execution_role" {
   name = "${var.project_name}-execution-role"
@@ -187,7 +236,9 @@ resource "aws_ecs_task_definition" "training" {
       environment = [
         { name = "S3_BUCKET", value = data.aws_s3_bucket.data_bucket.bucket },
         { name = "DATABASE_NAME", value = var.database_name },
-        { name = "WORKGROUP", value = "primary" }
+        { name = "WORKGROUP", value = "primary" },
+        { name = "FEATURES_TABLE", value = var.use_feature_store ? "predict_age_feature_store" : "predict_age_training_features_parsed_14m" },
+        { name = "RESUME", value = tostring(var.resume_reruns) }  # Reuse the models while the training checkpoint matches
       ]
       logConfiguration = {
         logDriver = "awslogs"
@@ -228,7 +279,15 @@ resource "aws_ecs_task_definition" "prediction" {
       environment = [
         { name = "S3_BUCKET", value = data.aws_s3_bucket.data_bucket.bucket },
         { name = "DATABASE_NAME", value = var.database_name },
-        { name = "WORKGROUP", value = "primary" }
+        { name = "WORKGROUP", value = "primary" },
+        { name = "COMPACT_SCHEMA", value = tostring(var.compact_prediction_schema) },
+        { name = "OUTPUT_COMPRESSION", value = var.prediction_output_compression },
+        { name = "FEATURE_STORE", value = tostring(var.use_feature_store) },
+        { name = "FEATURE_PUSHDOWN", value = tostring(var.feature_pushdown) },
+        { name = "PIPELINE_QUEUE_SIZE", value = tostring(var.prediction_pipeline_queue_size) },
+        { name = "PREDICTION_WORKERS", value = tostring(var.prediction_workers) },
+        { name = "PREDICTION_WORKER_TIMEOUT_SEC", value = tostring(var.prediction_worker_timeout_sec) },
+        { name = "AWS_RETRY_ATTEMPTS", value = tostring(var.prediction_aws_retry_attempts) }
       ]
       logConfiguration = {
         logDriver = "awslogs"
@@ -287,6 +346,52 @@ resource "aws_ecs_task_definition" "feature_parser" {
   })
 }
 
+# Fargate Task Definition for Lookup Snapshot Builder
+resource "aws_ecs_task_definition" "lookup" {
+  family                   = "ai-agent-predict-age-lookup"
+  cpu                      = "4096"  # 4 vCPU (sort of 378M ids)
+  memory                   = "30720" # 30 GB (ids + sort permutation + 3 value columns in memory)
+  network_mode             = "awsvpc"
+  requires_compatibilities = ["FARGATE"]
+  execution_role_arn       = aws_iam_role.fargate_execution_role.arn
+  task_role_arn            = aws_iam_role.fargate_task_role.arn
+
+  ephemeral_storage {
+    size_in_gib = 50  # ~4.5 GB snapshot + headroom
+  }
+
+  runtime_platform {
+    operating_system_family = "LINUX"
+    cpu_architecture        = "X86_64"
+  }
+
+  container_definitions = jsonencode([
+    {
+      name        = "lookup"
+      image       = "${aws_ecr_repository.lookup.repository_url}:latest"
+      cpu         = 4096
+      memory      = 30720
+      essential   = true
+      environment = [
+        { name = "S3_BUCKET", value = data.aws_s3_bucket.data_bucket.bucket },
+        { name = "SNAPSHOT_DIR", value = "/tmp/age_lookup" }
+      ]
+      logConfiguration = {
+        logDriver = "awslogs"
+        options = {
+          "awslogs-group"         = "/ecs/${var.project_name}-lookup"
+          "awslogs-region"        = data.aws_region.current.name
+          "awslogs-stream-prefix" = "ecs"
+        }
+      }
+    }
+  ])
+
+  tags = merge(local.common_tags, {
+    Purpose = "Memory-mapped point lookup snapshot over final results"
+  })
+}
+
 # CloudWatch Log Group for Training
 resource "aws_cloudwatch_log_group" "fargate_training" {
   name              = "/ecs/${var.project_name}-training"
@@ -313,6 +418,14 @@ resource "aws_cloudwatch_log_group" "fargate_feature_parser" {
   })
 }
 
+# CloudWatch Log Group for Lookup Snapshot Builder
+resource "aws_cloudwatch_log_group" "fargate_lookup" {
+  name              = "/ecs/${var.project_name}-lookup"
+  retention_in_days = 14
+
+  tags = local.common_tags
+}
+
 # Security Group for Fargate Tasks
 resource "aws_security_group" "fargate_tasks" {
   name_prefix = "${var.project_name}-fargate-tasks-"
@@ -359,6 +472,11 @@ output "ecr_prediction_repository_url" {
   value       = aws_ecr_repository.prediction.repository_url
 }
 
+output "ecr_lookup_repository_url" {
+  description = "URL of the ECR repository for the lookup snapshot builder Docker image"
+  value       = aws_ecr_repository.lookup.repository_url
+}
+
 output "fargate_task_role_arn" {
   description = "ARN of the Fargate task IAM role"
   value       = aws_iam_role.fargate_task_role.arn
@@ -9,12 +9,14 @@ resource "aws_lambda_function" "staging_features" {
   timeout         = 900  # 15 minutes for staging table creation
   memory_size     = 2048
   architectures   = ["arm64"]
+  layers          = [aws_lambda_layer_version.common.arn]
 
   environment {
     variables = {
       S3_BUCKET     = data.aws_s3_bucket.data_bucket.bucket
       DATABASE_NAME = var.database_name
       WORKGROUP     = "primary"
+      RESUME        = tostring(var.resume_reruns)
     }
   }
 
@@ -43,12 +45,14 @@ resource "aws_lambda_function" "feature_engineering" {
   timeout         = 900  # 15 minutes for full evaluation features
   memory_size     = 2048
   architectures   = ["arm64"]
+  layers          = [aws_lambda_layer_version.common.arn]
 
   environment {
     variables = {
       S3_BUCKET     = data.aws_s3_bucket.data_bucket.bucket
       DATABASE_NAME = var.database_name
       WORKGROUP     = "primary"
+      RESUME        = tostring(var.resume_reruns)
     }
   }
 
@@ -77,11 +81,13 @@ resource "aws_lambda_function" "precleanup" {
   timeout         = 300  # 5 minutes
   memory_size     = 1024
   architectures   = ["arm64"]
+  layers          = [aws_lambda_layer_version.common.arn]
 
   environment {
     variables = {
       S3_BUCKET     = data.aws_s3_bucket.data_bucket.bucket
       DATABASE_NAME = var.database_name
+      RESUME        = tostring(var.resume_reruns)
     }
   }
 
@@ -107,9 +113,21 @@ resource "aws_lambda_function" "batch_generator" {
   handler         = "lambda_function.lambda_handler"
   source_code_hash = data.archive_file.batch_generator_zip.output_base64sha256
   runtime         = "python3.11"
-  timeout         = 30
+  timeout         = 300  # COUNT(*) fallback when the raw table isn't Parquet
   memory_size     = 256
   architectures   = ["arm64"]
+  layers          = [aws_lambda_layer_version.common.arn]
+
+  environment {
+    variables = {
+      S3_BUCKET             = data.aws_s3_bucket.data_bucket.bucket
+      DATABASE_NAME         = var.database_name
+      RAW_TABLE             = "predict_age_full_evaluation_raw_378m"
+      TARGET_ROWS_PER_BATCH = tostring(var.target_rows_per_batch)
+      MAX_CONCURRENCY       = tostring(var.prediction_max_concurrency)
+      RESUME                = tostring(var.resume_reruns)
+    }
+  }
 
   depends_on = [
     aws_cloudwatch_log_group.lambda_logs["batch-generator"]
@@ -125,6 +143,82 @@ data "archive_file" "batch_generator_zip" {
   excludes    = ["deployment.zip", "__pycache__", "*.pyc"]
 }
 
+# Lambda function to verify per-batch prediction manifests (Zip)
+resource "aws_lambda_function" "verify_batches" {
+  filename         = "../lambda-predict-age/ai-agent-predict-age-verify-batches/deployment.zip"
+  function_name    = "ai-agent-predict-age-verify-batches"
+  role            = aws_iam_role.lambda_execution_role.arn
+  handler         = "lambda_function.lambda_handler"
+  source_code_hash = data.archive_file.verify_batches_zip.output_base64sha256
+  runtime         = "python3.11"
+  timeout         = 300  # Tens of thousands of manifests with fine-grained batch plans
+  memory_size     = 512
+  architectures   = ["arm64"]
+  layers          = [aws_lambda_layer_version.common.arn]
+
+  environment {
+    variables = {
+      S3_BUCKET = data.aws_s3_bucket.data_bucket.bucket
+    }
+  }
+
+  depends_on = [
+    aws_cloudwatch_log_group.lambda_logs["verify-batches"]
+  ]
+
+  tags = local.common_tags
+}
+
+data "archive_file" "verify_batches_zip" {
+  type        = "zip"
+  source_dir  = "../lambda-predict-age/ai-agent-predict-age-verify-batches"
+  output_path = "../lambda-predict-age/ai-agent-predict-age-verify-batches/deployment.zip"
+  excludes    = ["deployment.zip", "__pycache__", "*.pyc"]
+}
+
+# Lambda function to dispatch prediction batches within Athena/S3 limits (Zip)
+resource "aws_lambda_function" "scheduler" {
+  filename         = "../lambda-predict-age/ai-agent-predict-age-scheduler/deployment.zip"
+  function_name    = "ai-agent-predict-age-scheduler"
+  role            = aws_iam_role.lambda_execution_role.arn
+  handler         = "lambda_function.lambda_handler"
+  source_code_hash = data.archive_file.scheduler_zip.output_base64sha256
+  runtime         = "python3.11"
+  timeout         = 300  # Each tick stops launching after ~60s
+  memory_size     = 256
+  architectures   = ["arm64"]
+  layers          = [aws_lambda_layer_version.common.arn]
+
+  environment {
+    variables = {
+      S3_BUCKET           = data.aws_s3_bucket.data_bucket.bucket
+      CLUSTER_ARN         = aws_ecs_cluster.main.arn
+      TASK_DEFINITION_ARN = aws_ecs_task_definition.prediction.arn
+      SUBNET_IDS          = join(",", data.aws_subnets.default.ids)
+      SECURITY_GROUP_IDS  = aws_security_group.fargate_tasks.id
+      FINAL_ASSEMBLY      = tostring(var.map_side_final_assembly)
+      MAX_CONCURRENCY     = tostring(var.prediction_max_concurrency)
+      QUEUE_URL           = aws_sqs_queue.work_queue.url
+      SPECULATION_FACTOR  = tostring(var.speculation_factor)
+      RESUME              = tostring(var.resume_reruns)
+      INCREMENTAL         = tostring(var.incremental_prediction)
+    }
+  }
+
+  depends_on = [
+    aws_cloudwatch_log_group.lambda_logs["scheduler"]
+  ]
+
+  tags = local.common_tags
+}
+
+data "archive_file" "scheduler_zip" {
+  type        = "zip"
+  source_dir  = "../lambda-predict-age/ai-agent-predict-age-scheduler"
+  output_path = "../lambda-predict-age/ai-agent-predict-age-scheduler/deployment.zip"
+  excludes    = ["deployment.zip", "__pycache__", "*.pyc"]
+}
+
 # Lambda function to pre-create predictions table (Zip)
 resource "aws_lambda_function" "create_predictions_table" {
   filename         = "../lambda-predict-age/ai-agent-predict-age-create-predictions-table/deployment.zip"
@@ -136,11 +230,13 @@ resource "aws_lambda_function" "create_predictions_table" {
   timeout         = 60  # Quick operation (~3 seconds)
   memory_size     = 512
   architectures   = ["arm64"]
+  layers          = [aws_lambda_layer_version.common.arn]
 
   environment {
     variables = {
-      S3_BUCKET     = data.aws_s3_bucket.data_bucket.bucket
-      DATABASE_NAME = var.database_name
+      S3_BUCKET      = data.aws_s3_bucket.data_bucket.bucket
+      DATABASE_NAME  = var.database_name
+      COMPACT_SCHEMA = tostring(var.compact_prediction_schema)  # Must match the prediction task
     }
   }
 
@@ -169,12 +265,14 @@ resource "aws_lambda_function" "human_qa" {
   timeout         = 300
   memory_size     = 1536
   architectures   = ["arm64"]
+  layers          = [aws_lambda_layer_version.common.arn]
 
   environment {
     variables = {
       S3_BUCKET     = data.aws_s3_bucket.data_bucket.bucket
       DATABASE_NAME = var.database_name
       WORKGROUP     = "primary"
+      RESUME        = tostring(var.resume_reruns)
     }
   }
 
@@ -203,11 +301,13 @@ resource "aws_lambda_function" "final_results" {
   timeout         = 900  # 15 minutes for 378M records
   memory_size     = 2048
   architectures   = ["arm64"]
+  layers          = [aws_lambda_layer_version.common.arn]
 
   environment {
     variables = {
       S3_BUCKET     = data.aws_s3_bucket.data_bucket.bucket
       DATABASE_NAME = var.database_name
+      RESUME        = tostring(var.resume_reruns)
     }
   }
 
@@ -236,6 +336,7 @@ resource "aws_lambda_function" "cleanup" {
   timeout         = 900  # 15 minutes for cleanup
   memory_size     = 1024
   architectures   = ["arm64"]
+  layers          = [aws_lambda_layer_version.common.arn]
 
   environment {
     variables = {
@@ -259,6 +360,22 @@ data "archive_file" "cleanup_zip" {
   excludes    = ["deployment.zip", "__pycache__", "*.pyc"]
 }
 
+# Shared Lambda layer (parallel S3 prefix deletion engine)
+resource "aws_lambda_layer_version" "common" {
+  filename                 = "../lambda-predict-age/ai-agent-predict-age-common/layer.zip"
+  layer_name               = "ai-agent-predict-age-common"
+  source_code_hash         = data.archive_file.common_layer_zip.output_base64sha256
+  compatible_runtimes      = ["python3.11"]
+  compatible_architectures = ["arm64"]
+}
+
+data "archive_file" "common_layer_zip" {
+  type        = "zip"
+  source_dir  = "../lambda-predict-age/ai-agent-predict-age-common"
+  output_path = "../lambda-predict-age/ai-agent-predict-age-common/layer.zip"
+  excludes    = ["layer.zip", "__pycache__", "*.pyc"]
+}
+
 # Outputs
 output "staging_features_lambda_arn" {
   description = "ARN of the staging features Lambda function"
@@ -285,6 +402,16 @@ output "human_qa_lambda_arn" {
   value       = aws_lambda_function.human_qa.arn
 }
 
+output "verify_batches_lambda_arn" {
+  description = "ARN of the batch manifest verification Lambda function"
+  value       = aws_lambda_function.verify_batches.arn
+}
+
+output "scheduler_lambda_arn" {
+  description = "ARN of the prediction batch scheduler Lambda function"
+  value       = aws_lambda_function.scheduler.arn
+}
+
 output "final_results_lambda_arn" {
   description = "ARN of the final results Lambda function"
   value       = aws_lambda_function.final_results.arn
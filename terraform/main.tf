@@ -62,6 +62,114 @@ variable "database_name" {
   default     = "ml_predict_age"
 }
 
+variable "single_pass_final_assembly" {
+  description = "Build final results and Human QA status in one CTAS (Human QA becomes a view) instead of two full passes"
+  type        = bool
+  default     = true
+}
+
+variable "map_side_final_assembly" {
+  description = "Prediction tasks apply the final priority rules to every id in their batch and write final-schema rows; final results is then only registered (no 378M-row join)"
+  type        = bool
+  default     = false
+}
+
+variable "use_feature_store" {
+  description = "Prediction reads parsed features from the feature store (feature_store.py build) and training reads the predict_age_feature_store table instead of predict_age_training_features_parsed_14m"
+  type        = bool
+  default     = false
+}
+
+variable "feature_pushdown" {
+  description = "The prediction Athena scan computes the static features from the feature spec (JSON parsing included); tasks only compute the time features"
+  type        = bool
+  default     = false
+}
+
+variable "compact_prediction_schema" {
+  description = "Prediction files use int8 age / int16 centi-confidence / dictionary strings; Athena reads them through a view with the legacy column types"
+  type        = bool
+  default     = true
+}
+
+variable "prediction_pipeline_queue_size" {
+  description = "Chunks waiting between the download / parse / features / predict / write threads of a prediction task; 0 runs the stages in sequence"
+  type        = number
+  default     = 2
+}
+
+variable "prediction_workers" {
+  description = "Forked feature/inference processes per prediction task (models shared copy-on-write, row shards of each part); 1 keeps everything in the task process, 0 sizes them from the task's CPU quota and memory"
+  type        = number
+  default     = 1
+}
+
+variable "prediction_worker_timeout_sec" {
+  description = "Longest one row shard may take in a forked prediction worker before the batch fails (a hung worker); a worker that dies fails the batch at once"
+  type        = number
+  default     = 1800
+}
+
+variable "prediction_aws_retry_attempts" {
+  description = "Attempts per S3 / Athena call inside a prediction task (throttling and transient errors, jittered backoff) before the Map state's task-level Retry"
+  type        = number
+  default     = 5
+}
+
+variable "prediction_output_compression" {
+  description = "Parquet codec for prediction outputs (snappy or zstd)"
+  type        = string
+  default     = "snappy"
+}
+
+variable "target_rows_per_batch" {
+  description = "Target rows per prediction batch; the batch plan divides the current work size by this"
+  type        = number
+  default     = 420962
+}
+
+variable "prediction_max_concurrency" {
+  description = "Parallel prediction tasks (Map MaxConcurrency / scheduler ceiling); batch counts above it are rounded up to whole waves"
+  type        = number
+  default     = 500
+}
+
+variable "prediction_dispatch" {
+  description = "How prediction batches are launched: 'map' (Map state, fixed MaxConcurrency), 'scheduler' (Lambda paces launches by Athena quota, query time and queueing) or 'queue' (fixed worker pool pulling batches from SQS)"
+  type        = string
+  default     = "map"
+}
+
+variable "incremental_prediction" {
+  description = "Carry forward last quarter's prediction for profiles whose feature inputs are unchanged (content hash); only new/changed profiles are parsed and predicted"
+  type        = bool
+  default     = false
+}
+
+variable "resume_reruns" {
+  description = "Reruns of a quarter resume: skip CTAS stages and prediction batches whose checkpoints match (execution input {\"fresh\": true} forces a clean run)"
+  type        = bool
+  default     = true
+}
+
+variable "speculation_factor" {
+  description = "Scheduler dispatch: launch a second copy of a batch running this many times the median batch duration (first to finish wins, the other is stopped); 0 disables"
+  type        = number
+  default     = 2.0
+}
+
+variable "worker_pool_size" {
+  description = "Fargate workers for prediction_dispatch = 'queue'; each pulls id-range batches from the work queue until it is empty"
+  type        = number
+  default     = 100
+}
+
+variable "compact_predictions" {
+  description = "Rewrite per-batch prediction files into id-sorted, target-sized files (row-group pruning for joins/lookups) before Human QA / final results"
+  type        = bool
+  default     = true
+}
+
 # Data sources
 data "aws_caller_identity" "current" {}
 data "aws_region" "current" {}
@@ -118,7 +226,10 @@ resource "aws_iam_role_policy" "lambda_policy" {
           "athena:GetQueryExecution",
           "athena:GetQueryResults",
           "athena:GetWorkGroup",
-          "athena:ListTableMetadata"
+          "athena:GetTableMetadata",
+          "athena:ListTableMetadata",
+          "athena:ListQueryExecutions",
+          "athena:BatchGetQueryExecution"
         ]
         Resource = "*"
       },
@@ -174,10 +285,38 @@ resource "aws_iam_role_policy" "lambda_policy" {
         Action = [
           "ecs:ListTasks",
           "ecs:DescribeTasks",
-          "ecs:StopTask"
+          "ecs:StopTask",
+          "ecs:RunTask"
         ]
         Resource = "*"
       },
+      {
+        Effect = "Allow"
+        Action = [
+          "iam:PassRole"
+        ]
+        Resource = [
+          aws_iam_role.fargate_task_role.arn,
+          aws_iam_role.fargate_execution_role.arn
+        ]
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "servicequotas:ListServiceQuotas",
+          "servicequotas:GetServiceQuota"
+        ]
+        Resource = "*"
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "sqs:SendMessage",
+          "sqs:PurgeQueue",
+          "sqs:GetQueueAttributes"
+        ]
+        Resource = aws_sqs_queue.work_queue.arn
+      },
       {
         Effect = "Allow"
         Action = [
@@ -201,7 +340,9 @@ resource "aws_cloudwatch_log_group" "lambda_logs" {
     "precleanup",
     "batch-generator",
     "create-predictions-table",
-    "final-results"
+    "final-results",
+    "verify-batches",
+    "scheduler"
   ])
   
   name              = "/aws/lambda/${var.project_name}-${each.key}"
@@ -40,6 +40,8 @@ resource "aws_iam_role_policy" "step_functions_policy" {
           aws_lambda_function.batch_generator.arn,
           aws_lambda_function.create_predictions_table.arn,
           aws_lambda_function.final_results.arn,
+          aws_lambda_function.verify_batches.arn,
+          aws_lambda_function.scheduler.arn,
         ]
       },
       {
@@ -52,6 +54,7 @@ resource "aws_iam_role_policy" "step_functions_policy" {
         Resource = [
           aws_ecs_task_definition.training.arn,
           aws_ecs_task_definition.prediction.arn,
+          aws_ecs_task_definition.lookup.arn,
         ]
       },
       {
@@ -149,6 +152,20 @@ resource "aws_iam_role_policy" "step_functions_policy" {
         ]
         Resource = "*"
       },
+      {
+        Effect = "Allow"
+        Action = [
+          "states:StartExecution",
+          "states:DescribeExecution",
+          "states:StopExecution"
+        ]
+        Resource = [
+          # Distributed Map child executions (ARN built by name to avoid a dependency cycle)
+          "arn:aws:states:${local.region}:${local.account_id}:stateMachine:${var.project_name}-pipeline",
+          "arn:aws:states:${local.region}:${local.account_id}:execution:${var.project_name}-pipeline/*",
+          "arn:aws:states:${local.region}:${local.account_id}:execution:${var.project_name}-pipeline:*"
+        ]
+      },
       {
         Effect = "Allow"
         Action = [
@@ -179,13 +196,13 @@ resource "aws_sfn_state_machine" "pipeline" {
   type     = "STANDARD"
 
   definition = jsonencode({
-    Comment = "ML Pipeline: Pre-Cleanup -> Staging Features -> Training Features -> Training -> Evaluation Features -> Prediction -> Human QA -> Final Results -> Cleanup"
+    Comment = "ML Pipeline: Pre-Cleanup -> Staging Features -> Training Features -> Training Feature Spec -> Training -> Evaluation Features -> Prediction -> Human QA (optional) -> Final Results -> Lookup Snapshot -> Cleanup"
     StartAt = "PreCleanup"
     States = {
       PreCleanup = {
         Type     = "Task"
         Resource = aws_lambda_function.precleanup.arn
-        Comment  = "Pre-cleanup: Drop final results table and clean S3 to prevent duplicates on re-run"
+        Comment  = "Pre-cleanup: Drop final results table and clean S3 to prevent duplicates on re-run (batch outputs, final results and Human QA kept when resuming)"
         Next     = "StagingFeatures"
         Retry = [
           {
@@ -206,8 +223,44 @@ resource "aws_sfn_state_machine" "pipeline" {
       StagingFeatures = {
         Type     = "Task"
         Resource = aws_lambda_function.staging_features.arn
-        Comment  = "Create staging table with pre-parsed JSON features (15-20 min, $0.50)"
-        Next     = "TrainingFeatures"
+        Comment  = "Submit staging table CTAS with pre-parsed JSON features (15-20 min, $0.50)"
+        Parameters = {
+          action = "submit"
+        }
+        ResultPath = "$.stagingFeaturesQuery"
+        Next       = "WaitForStagingFeatures"
+        Retry = [
+          {
+            ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException"]
+            IntervalSeconds = 2
+            MaxAttempts     = 3
+            BackoffRate     = 2
+          }
+        ]
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"]
+            Next        = "PipelineFailed"
+            ResultPath  = "$.error"
+          }
+        ]
+      }
+      WaitForStagingFeatures = {
+        Type    = "Wait"
+        Seconds = 30
+        Next    = "CheckStagingFeatures"
+      }
+      CheckStagingFeatures = {
+        Type     = "Task"
+        Resource = aws_lambda_function.staging_features.arn
+        Comment  = "Poll the Athena query once (no sleeping inside the Lambda)"
+        Parameters = {
+          action            = "check"
+          "execution_ids.$" = "$.stagingFeaturesQuery.execution_ids"
+          "sql_files.$"     = "$.stagingFeaturesQuery.sql_files"  # Checkpointed once they succeed
+        }
+        ResultPath = "$.stagingFeaturesQuery"
+        Next       = "StagingFeaturesComplete"
         Retry = [
           {
             ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException"]
@@ -224,13 +277,63 @@ resource "aws_sfn_state_machine" "pipeline" {
           }
         ]
       }
+      StagingFeaturesComplete = {
+        Type = "Choice"
+        Choices = [
+          {
+            Variable     = "$.stagingFeaturesQuery.query_state"
+            StringEquals = "SUCCEEDED"
+            Next         = "TrainingFeatures"
+          },
+          {
+            Variable     = "$.stagingFeaturesQuery.query_state"
+            StringEquals = "RUNNING"
+            Next         = "WaitForStagingFeatures"
+          }
+        ]
+        Default = "PipelineFailed"
+      }
       TrainingFeatures = {
         Type     = "Task"
         Resource = aws_lambda_function.feature_engineering.arn
         Parameters = {
-          mode = "training"
+          mode   = "training"
+          action = "submit"
+        }
+        ResultPath = "$.trainingFeaturesQuery"
+        Next       = "WaitForTrainingFeatures"
+        Retry = [
+          {
+            ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException"]
+            IntervalSeconds = 2
+            MaxAttempts     = 6
+            BackoffRate     = 2
+          }
+        ]
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"]
+            Next        = "PipelineFailed"
+            ResultPath  = "$.error"
+          }
+        ]
+      }
+      WaitForTrainingFeatures = {
+        Type    = "Wait"
+        Seconds = 30
+        Next    = "CheckTrainingFeatures"
+      }
+      CheckTrainingFeatures = {
+        Type     = "Task"
+        Resource = aws_lambda_function.feature_engineering.arn
+        Comment  = "Poll the Athena query once (no sleeping inside the Lambda)"
+        Parameters = {
+          action            = "check"
+          "execution_ids.$" = "$.trainingFeaturesQuery.execution_ids"
+          "sql_files.$"     = "$.trainingFeaturesQuery.sql_files"  # Checkpointed once they succeed
         }
-        Next     = "Training"
+        ResultPath = "$.trainingFeaturesQuery"
+        Next       = "TrainingFeaturesComplete"
         Retry = [
           {
             ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException"]
@@ -247,9 +350,77 @@ resource "aws_sfn_state_machine" "pipeline" {
           }
         ]
       }
+      TrainingFeaturesComplete = {
+        Type = "Choice"
+        Choices = [
+          {
+            Variable     = "$.trainingFeaturesQuery.query_state"
+            StringEquals = "SUCCEEDED"
+            Next         = "TrainingFeatureSpec"
+          },
+          {
+            Variable     = "$.trainingFeaturesQuery.query_state"
+            StringEquals = "RUNNING"
+            Next         = "WaitForTrainingFeatures"
+          }
+        ]
+        Default = "PipelineFailed"
+      }
+      TrainingFeatureSpec = {
+        Type       = "Task"
+        Resource   = "arn:aws:states:::ecs:runTask.sync"
+        Comment    = "Build predict_age_training_features_parsed_14m (the table training reads) from the feature spec shared with prediction, so training and serving encode features identically"
+        Parameters = {
+          Cluster              = aws_ecs_cluster.main.arn
+          TaskDefinition       = aws_ecs_task_definition.prediction.arn
+          LaunchType           = "FARGATE"
+          NetworkConfiguration = {
+            AwsvpcConfiguration = {
+              Subnets        = data.aws_subnets.default.ids
+              SecurityGroups = [aws_security_group.fargate_tasks.id]
+              AssignPublicIp = "ENABLED"
+            }
+          }
+          Overrides = {
+            ExecutionRoleArn = aws_iam_role.fargate_execution_role.arn
+            TaskRoleArn      = aws_iam_role.fargate_task_role.arn
+            ContainerOverrides = [
+              {
+                Name        = "prediction"
+                Command     = ["feature_spec.py", "ctas"]
+                Environment = [
+                  {
+                    Name  = "RESUME"
+                    Value = tostring(var.resume_reruns)  # Keep the table while its checkpoint has this spec version
+                  }
+                ]
+              }
+            ]
+          }
+        }
+        ResultPath     = null
+        TimeoutSeconds = 3600
+        Next           = "Training"
+        Retry = [
+          {
+            ErrorEquals     = ["States.ALL"]
+            IntervalSeconds = 30
+            MaxAttempts     = 2
+            BackoffRate     = 2
+          }
+        ]
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"]
+            Next        = "PipelineFailed"
+            ResultPath  = "$.error"
+          }
+        ]
+      }
       Training = {
         Type       = "Task"
         Resource   = "arn:aws:states:::ecs:runTask.sync"
+        Comment    = "Train the models (a resumed run reuses them while the training checkpoint matches, keeping batch checkpoints valid)"
         Parameters = {
           Cluster              = aws_ecs_cluster.main.arn
           TaskDefinition       = aws_ecs_task_definition.training.arn
@@ -288,11 +459,12 @@ resource "aws_sfn_state_machine" "pipeline" {
         Type     = "Task"
         Resource = aws_lambda_function.feature_engineering.arn
         Parameters = {
-          mode = "full_evaluation"
+          mode   = "full_evaluation"
+          action = "submit"
         }
         ResultPath = "$.evaluationFeaturesResult"
-        Next       = "GenerateBatchIds"
-        Comment    = "Create evaluation features for all 378M PIDs (12-15 min)"
+        Next       = "WaitForEvaluationFeatures"
+        Comment    = "Submit evaluation features CTAS for all 378M PIDs (12-15 min)"
         Retry = [
           {
             ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException"]
@@ -309,10 +481,124 @@ resource "aws_sfn_state_machine" "pipeline" {
           }
         ]
       }
+      WaitForEvaluationFeatures = {
+        Type    = "Wait"
+        Seconds = 30
+        Next    = "CheckEvaluationFeatures"
+      }
+      CheckEvaluationFeatures = {
+        Type     = "Task"
+        Resource = aws_lambda_function.feature_engineering.arn
+        Comment  = "Poll the Athena query once (no sleeping inside the Lambda)"
+        Parameters = {
+          action            = "check"
+          "execution_ids.$" = "$.evaluationFeaturesResult.execution_ids"
+          "sql_files.$"     = "$.evaluationFeaturesResult.sql_files"  # Checkpointed once they succeed
+        }
+        ResultPath = "$.evaluationFeaturesResult"
+        Next       = "EvaluationFeaturesComplete"
+        Retry = [
+          {
+            ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException"]
+            IntervalSeconds = 2
+            MaxAttempts     = 3
+            BackoffRate     = 2
+          }
+        ]
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"]
+            Next        = "PipelineFailed"
+            ResultPath  = "$.error"
+          }
+        ]
+      }
+      EvaluationFeaturesComplete = {
+        Type = "Choice"
+        Choices = [
+          {
+            Variable     = "$.evaluationFeaturesResult.query_state"
+            StringEquals = "SUCCEEDED"
+            Next         = "BuildNeedsPredictionBitmap"
+          },
+          {
+            Variable     = "$.evaluationFeaturesResult.query_state"
+            StringEquals = "RUNNING"
+            Next         = "WaitForEvaluationFeatures"
+          }
+        ]
+        Default = "PipelineFailed"
+      }
+      BuildNeedsPredictionBitmap = {
+        Type       = "Task"
+        Resource   = "arn:aws:states:::ecs:runTask.sync"
+        Comment    = "Build compressed bitmap of PIDs with no known age ONCE per run (batch sizing, prediction reader, map-side assembly)"
+        Parameters = {
+          Cluster              = aws_ecs_cluster.main.arn
+          TaskDefinition       = aws_ecs_task_definition.prediction.arn
+          LaunchType           = "FARGATE"
+          NetworkConfiguration = {
+            AwsvpcConfiguration = {
+              Subnets        = data.aws_subnets.default.ids
+              SecurityGroups = [aws_security_group.fargate_tasks.id]
+              AssignPublicIp = "ENABLED"
+            }
+          }
+          Overrides = {
+            ExecutionRoleArn = aws_iam_role.fargate_execution_role.arn
+            TaskRoleArn      = aws_iam_role.fargate_task_role.arn
+            ContainerOverrides = [
+              {
+                Name    = "prediction"
+                Command = ["id_bitmap.py"]
+                Environment = [
+                  {
+                    Name  = "RAW_TABLE"
+                    Value = "predict_age_full_evaluation_raw_378m"
+                  },
+                  {
+                    Name  = "TARGET_ROWS_PER_BATCH"
+                    Value = tostring(var.target_rows_per_batch)  # Same sizing rule as GenerateBatchIds
+                  },
+                  {
+                    Name  = "MAX_CONCURRENCY"
+                    Value = tostring(var.prediction_max_concurrency)
+                  },
+                  {
+                    Name  = "RESUME"
+                    Value = tostring(var.resume_reruns)  # Keep the bitmap the current batch plan was built from
+                  }
+                ]
+              }
+            ]
+          }
+        }
+        ResultPath     = null
+        TimeoutSeconds = 1800
+        Next           = "GenerateBatchIds"
+        Retry = [
+          {
+            ErrorEquals     = ["States.ALL"]
+            IntervalSeconds = 30
+            MaxAttempts     = 2
+            BackoffRate     = 2
+          }
+        ]
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"]
+            Next        = "PipelineFailed"
+            ResultPath  = "$.error"
+          }
+        ]
+      }
       GenerateBatchIds = {
         Type     = "Task"
         Resource = aws_lambda_function.batch_generator.arn
-        Comment  = "Generate 898 batch IDs for parallel prediction (~420K records each)"
+        Comment  = "Plan id-range batches from the current work size and write them as a CSV manifest (only its key is passed on)"
+        Parameters = {
+          map_side = var.map_side_final_assembly
+        }
         Next     = "CreatePredictionsTable"
         Retry = [
           {
@@ -335,7 +621,7 @@ resource "aws_sfn_state_machine" "pipeline" {
         Resource = aws_lambda_function.create_predictions_table.arn
         Comment  = "Pre-create predictions table ONCE before parallel tasks (eliminates race condition)"
         ResultPath = "$.tableCreationResult"
-        Next     = "ParallelPrediction"
+        Next     = "SelectDispatch"
         Retry = [
           {
             ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException"]
@@ -352,16 +638,278 @@ resource "aws_sfn_state_machine" "pipeline" {
           }
         ]
       }
-      ParallelPrediction = {
+      SelectDispatch = {
+        Type       = "Pass"
+        Comment    = "Record how prediction batches are launched (Map state, adaptive scheduler or worker-pool queue)"
+        Result = {
+          mode = var.prediction_dispatch
+        }
+        ResultPath = "$.dispatch"
+        Next       = "DispatchMode"
+      }
+      DispatchMode = {
+        Type = "Choice"
+        Choices = [
+          {
+            Variable     = "$.dispatch.mode"
+            StringEquals = "scheduler"
+            Next         = "ScheduleBatches"
+          },
+          {
+            Variable     = "$.dispatch.mode"
+            StringEquals = "queue"
+            Next         = "EnqueueWorkUnits"
+          }
+        ]
+        Default = "ParallelPrediction"
+      }
+      EnqueueWorkUnits = {
+        Type     = "Task"
+        Resource = aws_lambda_function.scheduler.arn
+        Comment  = "Send one SQS work unit per manifest row for the worker pool"
+        Parameters = {
+          action            = "enqueue"
+          "manifest_key.$"  = "$.dispatch_manifest_key"  # Batches without a checkpoint
+          "plan_key.$"      = "$.plan_key"
+          "total_batches.$" = "$.total_batches"
+        }
+        ResultPath = "$.queue"
+        Next       = "SelectWorkers"
+        Retry = [
+          {
+            ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException"]
+            IntervalSeconds = 2
+            MaxAttempts     = 3
+            BackoffRate     = 2
+          },
+          {
+            ErrorEquals     = ["RetryableError"]  # Throttled / transient ECS, SQS, S3 or Athena calls
+            IntervalSeconds = 5
+            MaxAttempts     = 5
+            BackoffRate     = 2
+          }
+        ]
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"]
+            Next        = "PipelineFailed"
+            ResultPath  = "$.error"
+          }
+        ]
+      }
+      SelectWorkers = {
+        Type       = "Pass"
+        Comment    = "Worker ids for the pool (var.worker_pool_size)"
+        Result = {
+          worker_ids = range(var.worker_pool_size)
+        }
+        ResultPath = "$.workers"
+        Next       = "RunWorkerPool"
+      }
+      RunWorkerPool = {
         Type = "Map"
-        Comment = "Run prediction in parallel for all batches (898 batches of ~420K records each)"
-        ItemsPath = "$.batch_ids"
-        MaxConcurrency = 500  # MAXIMUM SPEED: 500 parallel tasks (~10 min for 378M predictions!)
-        ResultPath = null  # Don't collect results - prevents 256KB output limit error
+        Comment = "Fixed pool of Fargate workers; each pulls batches from the work queue until it is empty (a crashed worker's batch is re-leased by another)"
+        ItemsPath = "$.workers.worker_ids"
+        MaxConcurrency = var.worker_pool_size
+        ToleratedFailurePercentage = 0
+        ResultPath = null  # Batch outcomes are in the per-batch manifests
+        ItemSelector = {
+          "worker_id.$" = "$$.Map.Item.Value"
+        }
+        ItemProcessor = {
+          ProcessorConfig = {
+            Mode          = "DISTRIBUTED"
+            ExecutionType = "STANDARD"
+          }
+          StartAt = "RunQueueWorker"
+          States = {
+            RunQueueWorker = {
+              Type = "Task"
+              Resource = "arn:aws:states:::ecs:runTask.sync"
+              Parameters = {
+                Cluster = aws_ecs_cluster.main.arn
+                TaskDefinition = aws_ecs_task_definition.prediction.arn
+                LaunchType = "FARGATE"
+                NetworkConfiguration = {
+                  AwsvpcConfiguration = {
+                    Subnets = data.aws_subnets.default.ids
+                    SecurityGroups = [aws_security_group.fargate_tasks.id]
+                    AssignPublicIp = "ENABLED"
+                  }
+                }
+                Overrides = {
+                  ExecutionRoleArn = aws_iam_role.fargate_execution_role.arn
+                  TaskRoleArn = aws_iam_role.fargate_task_role.arn
+                  ContainerOverrides = [
+                    {
+                      Name = "prediction"
+                      Command = ["work_queue.py", "worker"]
+                      Environment = [
+                        {
+                          Name = "QUEUE_URL"
+                          Value = aws_sqs_queue.work_queue.url
+                        },
+                        {
+                          Name = "WORKER_ID"
+                          "Value.$" = "States.Format('{}', $.worker_id)"
+                        },
+                        {
+                          Name = "RAW_TABLE"
+                          Value = "predict_age_full_evaluation_raw_378m"  # Production: 378M PIDs
+                        },
+                        {
+                          Name = "FINAL_ASSEMBLY"
+                          Value = tostring(var.map_side_final_assembly)  # Write final-schema rows per batch
+                        },
+                        {
+                          Name = "RESUME"
+                          Value = tostring(var.resume_reruns)  # Skip batches whose manifest checkpoint matches
+                        },
+                        {
+                          Name = "INCREMENTAL"
+                          Value = tostring(var.incremental_prediction)  # Carry unchanged profiles forward
+                        }
+                      ]
+                    }
+                  ]
+                }
+              }
+              TimeoutSeconds = 43200  # Workers run until the queue is drained
+              End = true
+              Retry = [
+                {
+                  ErrorEquals = ["States.ALL"]
+                  IntervalSeconds = 10  # A replacement worker resumes pulling
+                  MaxAttempts = 3
+                  BackoffRate = 2
+                }
+              ]
+            }
+          }
+        }
+        Next = "VerifyBatchManifests"
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"]
+            Next        = "PipelineFailed"
+            ResultPath  = "$.error"
+          }
+        ]
+      }
+      ScheduleBatches = {
+        Type     = "Task"
+        Resource = aws_lambda_function.scheduler.arn
+        Comment  = "Measure Athena/Fargate quotas and launch the first batches"
+        Parameters = {
+          action            = "start"
+          "manifest_key.$"  = "$.dispatch_manifest_key"  # Batches without a checkpoint
+          "total_batches.$" = "$.total_batches"
+        }
+        ResultPath = "$.scheduler"
+        Next       = "WaitForScheduler"
+        Retry = [
+          {
+            ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException"]
+            IntervalSeconds = 2
+            MaxAttempts     = 3
+            BackoffRate     = 2
+          },
+          {
+            ErrorEquals     = ["RetryableError"]  # Throttled / transient ECS, SQS, S3 or Athena calls
+            IntervalSeconds = 5
+            MaxAttempts     = 5
+            BackoffRate     = 2
+          }
+        ]
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"]
+            Next        = "PipelineFailed"
+            ResultPath  = "$.error"
+          }
+        ]
+      }
+      WaitForScheduler = {
+        Type    = "Wait"
+        Seconds = 30
+        Next    = "DispatchBatches"
+      }
+      DispatchBatches = {
+        Type     = "Task"
+        Resource = aws_lambda_function.scheduler.arn
+        Comment  = "Reap finished tasks, adapt concurrency to Athena queueing/throttling, launch more (and copies of slow batches)"
         Parameters = {
-          "batch_id.$" = "$$.Map.Item.Value"
+          action = "tick"
         }
-        Iterator = {
+        ResultPath = "$.scheduler"
+        Next       = "SchedulerDone"
+        Retry = [
+          {
+            ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException"]
+            IntervalSeconds = 2
+            MaxAttempts     = 6
+            BackoffRate     = 2
+          },
+          {
+            ErrorEquals     = ["RetryableError"]  # Throttled / transient ECS, SQS, S3 or Athena calls
+            IntervalSeconds = 5
+            MaxAttempts     = 5
+            BackoffRate     = 2
+          }
+        ]
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"]
+            Next        = "PipelineFailed"
+            ResultPath  = "$.error"
+          }
+        ]
+      }
+      SchedulerDone = {
+        Type = "Choice"
+        Choices = [
+          {
+            Variable     = "$.scheduler.scheduler_state"
+            StringEquals = "SUCCEEDED"
+            Next         = "VerifyBatchManifests"
+          },
+          {
+            Variable     = "$.scheduler.scheduler_state"
+            StringEquals = "RUNNING"
+            Next         = "WaitForScheduler"
+          }
+        ]
+        Default = "PipelineFailed"
+      }
+      ParallelPrediction = {
+        Type = "Map"
+        Comment = "Run prediction in parallel for all planned batches (Distributed Map over the id-range manifest from GenerateBatchIds)"
+        ItemReader = {
+          Resource = "arn:aws:states:::s3:getObject"
+          ReaderConfig = {
+            InputType         = "CSV"
+            CSVHeaderLocation = "FIRST_ROW"  # batch_id,id_min,id_max,expected_predictions
+          }
+          Parameters = {
+            Bucket  = data.aws_s3_bucket.data_bucket.bucket
+            "Key.$" = "$.dispatch_manifest_key"  # All batches, or only those without a checkpoint on a resumed run
+          }
+        }
+        MaxConcurrency = var.prediction_max_concurrency  # Batch plan rounds to whole waves of this size
+        ToleratedFailurePercentage = 0
+        ResultPath = null  # Batch outcomes are in the per-batch manifests
+        ItemSelector = {
+          "batch_id.$"             = "$$.Map.Item.Value.batch_id"
+          "id_min.$"               = "$$.Map.Item.Value.id_min"
+          "id_max.$"               = "$$.Map.Item.Value.id_max"
+          "expected_predictions.$" = "$$.Map.Item.Value.expected_predictions"
+          "total_batches.$"        = "$.total_batches"
+        }
+        ItemProcessor = {
+          ProcessorConfig = {
+            Mode          = "DISTRIBUTED"
+            ExecutionType = "STANDARD"
+          }
           StartAt = "RunPredictionBatch"
           States = {
             RunPredictionBatch = {
@@ -387,7 +935,19 @@ resource "aws_sfn_state_machine" "pipeline" {
                       Environment = [
                         {
                           Name = "BATCH_ID"
-                          "Value.$" = "States.Format('{}', $.batch_id)"
+                          "Value.$" = "$.batch_id"  # CSV manifest values are strings
+                        },
+                        {
+                          Name = "ID_MIN"
+                          "Value.$" = "$.id_min"
+                        },
+                        {
+                          Name = "ID_MAX"
+                          "Value.$" = "$.id_max"
+                        },
+                        {
+                          Name = "EXPECTED_PREDICTIONS"
+                          "Value.$" = "$.expected_predictions"  # Empty when not sized by the bitmap
                         },
                         {
                           Name = "RAW_TABLE"
@@ -395,7 +955,19 @@ resource "aws_sfn_state_machine" "pipeline" {
                         },
                         {
                           Name = "TOTAL_BATCHES"
-                          Value = "898"
+                          "Value.$" = "States.Format('{}', $.total_batches)"  # From GenerateBatchIds
+                        },
+                        {
+                          Name = "FINAL_ASSEMBLY"
+                          Value = tostring(var.map_side_final_assembly)  # Write final-schema rows per batch
+                        },
+                        {
+                          Name = "RESUME"
+                          Value = tostring(var.resume_reruns)  # Skip batches whose manifest checkpoint matches
+                        },
+                        {
+                          Name = "INCREMENTAL"
+                          Value = tostring(var.incremental_prediction)  # Carry unchanged profiles forward
                         }
                       ]
                     }
@@ -407,7 +979,7 @@ resource "aws_sfn_state_machine" "pipeline" {
               Retry = [
                 {
                   ErrorEquals = ["States.ALL"]
-                  IntervalSeconds = 30
+                  IntervalSeconds = 10  # Small batches: retry quickly
                   MaxAttempts = 3
                   BackoffRate = 2
                 }
@@ -415,7 +987,7 @@ resource "aws_sfn_state_machine" "pipeline" {
             }
           }
         }
-        Next = "HumanQA"
+        Next = "VerifyBatchManifests"
         Retry = [
           {
             ErrorEquals     = ["States.ALL"]
@@ -432,10 +1004,183 @@ resource "aws_sfn_state_machine" "pipeline" {
           }
         ]
       }
+      VerifyBatchManifests = {
+        Type     = "Task"
+        Resource = aws_lambda_function.verify_batches.arn
+        Comment  = "Check every batch manifest (row count, id range, output file) and remove outputs no manifest references - no table scan"
+        Parameters = {
+          "manifest_key.$"  = "$.manifest_key"
+          "total_batches.$" = "$.total_batches"
+        }
+        ResultPath = "$.batchManifests"
+        Next       = "BatchManifestsComplete"
+        Retry = [
+          {
+            ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException"]
+            IntervalSeconds = 2
+            MaxAttempts     = 3
+            BackoffRate     = 2
+          }
+        ]
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"]
+            Next        = "PipelineFailed"
+            ResultPath  = "$.error"
+          }
+        ]
+      }
+      BatchManifestsComplete = {
+        Type = "Choice"
+        Choices = [
+          {
+            Variable      = "$.batchManifests.complete"
+            BooleanEquals = true
+            Next          = "SelectFinalAssembly"
+          }
+        ]
+        Default = "PipelineFailed"
+      }
+      SelectFinalAssembly = {
+        Type       = "Pass"
+        Comment    = "Record how final results and Human QA are assembled (single pass or map-side)"
+        Result = {
+          single_pass = var.single_pass_final_assembly
+          map_side    = var.map_side_final_assembly
+          compact     = var.compact_predictions
+        }
+        ResultPath = "$.finalAssembly"
+        Next       = "CompactionMode"
+      }
+      CompactionMode = {
+        Type = "Choice"
+        Choices = [
+          {
+            And = [
+              {
+                Variable      = "$.finalAssembly.compact"
+                BooleanEquals = true
+              },
+              {
+                Variable      = "$.finalAssembly.map_side"
+                BooleanEquals = false
+              }
+            ]
+            Next = "CompactPredictions"
+          }
+        ]
+        Default = "FinalAssemblyMode"  # Map-side assembly writes no prediction files
+      }
+      CompactPredictions = {
+        Type       = "Task"
+        Resource   = "arn:aws:states:::ecs:runTask.sync"
+        Comment    = "Rewrite MOD batch prediction files into id-sorted, target-sized files and repoint the predictions table (no-op for disjoint id-range batches)"
+        Parameters = {
+          Cluster              = aws_ecs_cluster.main.arn
+          TaskDefinition       = aws_ecs_task_definition.prediction.arn
+          LaunchType           = "FARGATE"
+          NetworkConfiguration = {
+            AwsvpcConfiguration = {
+              Subnets        = data.aws_subnets.default.ids
+              SecurityGroups = [aws_security_group.fargate_tasks.id]
+              AssignPublicIp = "ENABLED"
+            }
+          }
+          Overrides = {
+            ExecutionRoleArn = aws_iam_role.fargate_execution_role.arn
+            TaskRoleArn      = aws_iam_role.fargate_task_role.arn
+            EphemeralStorage = {
+              SizeInGiB = 100  # Batch inputs + per-range spill files
+            }
+            ContainerOverrides = [
+              {
+                Name    = "prediction"
+                Command = ["compaction.py"]
+              }
+            ]
+          }
+        }
+        ResultPath     = null
+        TimeoutSeconds = 3600
+        Next           = "FinalAssemblyMode"
+        Retry = [
+          {
+            ErrorEquals     = ["States.ALL"]
+            IntervalSeconds = 30
+            MaxAttempts     = 2
+            BackoffRate     = 2
+          }
+        ]
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"]
+            Next        = "PipelineFailed"
+            ResultPath  = "$.error"
+          }
+        ]
+      }
+      FinalAssemblyMode = {
+        Type = "Choice"
+        Choices = [
+          {
+            Or = [
+              {
+                Variable      = "$.finalAssembly.single_pass"
+                BooleanEquals = true
+              },
+              {
+                Variable      = "$.finalAssembly.map_side"
+                BooleanEquals = true
+              }
+            ]
+            Next = "FinalResults"  # No separate Human QA scan/join/write
+          }
+        ]
+        Default = "HumanQA"
+      }
       HumanQA = {
         Type     = "Task"
         Resource = aws_lambda_function.human_qa.arn
-        Next     = "FinalResults"
+        Comment  = "Submit Human QA CTAS (1:1 with source) and return immediately (skipped when resuming with a matching checkpoint)"
+        Parameters = {
+          action                      = "submit"
+          "predictions_fingerprint.$" = "$.batchManifests.predictions_fingerprint"
+        }
+        ResultPath = "$.humanQaQuery"
+        Next       = "WaitForHumanQA"
+        Retry = [
+          {
+            ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException"]
+            IntervalSeconds = 2
+            MaxAttempts     = 6
+            BackoffRate     = 2
+          }
+        ]
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"]
+            Next        = "PipelineFailed"
+            ResultPath  = "$.error"
+          }
+        ]
+      }
+      WaitForHumanQA = {
+        Type    = "Wait"
+        Seconds = 30
+        Next    = "CheckHumanQA"
+      }
+      CheckHumanQA = {
+        Type     = "Task"
+        Resource = aws_lambda_function.human_qa.arn
+        Comment  = "Poll the Athena query once (no sleeping inside the Lambda)"
+        Parameters = {
+          action                      = "check"
+          "execution_ids.$"           = "$.humanQaQuery.execution_ids"
+          "ctas_tables.$"             = "$.humanQaQuery.ctas_tables"  # Checkpointed once they succeed
+          "predictions_fingerprint.$" = "$.batchManifests.predictions_fingerprint"
+        }
+        ResultPath = "$.humanQaQuery"
+        Next       = "HumanQAComplete"
         Retry = [
           {
             ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException"]
@@ -452,11 +1197,34 @@ resource "aws_sfn_state_machine" "pipeline" {
           }
         ]
       }
+      HumanQAComplete = {
+        Type = "Choice"
+        Choices = [
+          {
+            Variable     = "$.humanQaQuery.query_state"
+            StringEquals = "SUCCEEDED"
+            Next         = "FinalResults"
+          },
+          {
+            Variable     = "$.humanQaQuery.query_state"
+            StringEquals = "RUNNING"
+            Next         = "WaitForHumanQA"
+          }
+        ]
+        Default = "PipelineFailed"
+      }
       FinalResults = {
         Type     = "Task"
         Resource = aws_lambda_function.final_results.arn
         Comment  = "Create final results table with 1:1 mapping to source (378M PIDs). Includes default predictions (Age: 35, Confidence: 15.0) for PIDs with missing data."
-        Next     = "WaitForFinalResults"
+        Parameters = {
+          action                      = "submit"
+          "single_pass.$"             = "$.finalAssembly.single_pass"
+          "map_side.$"                = "$.finalAssembly.map_side"
+          "predictions_fingerprint.$" = "$.batchManifests.predictions_fingerprint"
+        }
+        ResultPath = "$.finalResultsQuery"
+        Next       = "WaitForFinalResults"
         Retry = [
           {
             ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException"]
@@ -475,9 +1243,93 @@ resource "aws_sfn_state_machine" "pipeline" {
       }
       WaitForFinalResults = {
         Type    = "Wait"
-        Seconds = 180
-        Comment = "Wait 3 minutes for final results table to complete (378M records)"
-        Next    = "Cleanup"
+        Seconds = 30
+        Next    = "CheckFinalResults"
+      }
+      CheckFinalResults = {
+        Type     = "Task"
+        Resource = aws_lambda_function.final_results.arn
+        Comment  = "Poll the Athena query once (no sleeping inside the Lambda)"
+        Parameters = {
+          action                      = "check"
+          "execution_ids.$"           = "$.finalResultsQuery.execution_ids"
+          "ctas_tables.$"             = "$.finalResultsQuery.ctas_tables"  # Checkpointed once they succeed
+          "single_pass.$"             = "$.finalAssembly.single_pass"
+          "map_side.$"                = "$.finalAssembly.map_side"
+          "predictions_fingerprint.$" = "$.batchManifests.predictions_fingerprint"
+        }
+        ResultPath = "$.finalResultsQuery"
+        Next       = "FinalResultsComplete"
+        Retry = [
+          {
+            ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException"]
+            IntervalSeconds = 2
+            MaxAttempts     = 6
+            BackoffRate     = 2
+          }
+        ]
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"]
+            Next        = "PipelineFailed"
+            ResultPath  = "$.error"
+          }
+        ]
+      }
+      FinalResultsComplete = {
+        Type = "Choice"
+        Choices = [
+          {
+            Variable     = "$.finalResultsQuery.query_state"
+            StringEquals = "SUCCEEDED"
+            Next         = "BuildLookupSnapshot"
+          },
+          {
+            Variable     = "$.finalResultsQuery.query_state"
+            StringEquals = "RUNNING"
+            Next         = "WaitForFinalResults"
+          }
+        ]
+        Default = "PipelineFailed"
+      }
+      BuildLookupSnapshot = {
+        Type       = "Task"
+        Resource   = "arn:aws:states:::ecs:runTask.sync"
+        Comment    = "Rebuild the point lookup snapshot of the new final results (kept under permanent/lookup/)"
+        Parameters = {
+          Cluster              = aws_ecs_cluster.main.arn
+          TaskDefinition       = aws_ecs_task_definition.lookup.arn
+          LaunchType           = "FARGATE"
+          NetworkConfiguration = {
+            AwsvpcConfiguration = {
+              Subnets        = data.aws_subnets.default.ids
+              SecurityGroups = [aws_security_group.fargate_tasks.id]
+              AssignPublicIp = "ENABLED"
+            }
+          }
+          Overrides = {
+            ExecutionRoleArn = aws_iam_role.fargate_execution_role.arn
+            TaskRoleArn      = aws_iam_role.fargate_task_role.arn
+          }
+        }
+        ResultPath     = null
+        TimeoutSeconds = 3600
+        Next           = "Cleanup"
+        Retry = [
+          {
+            ErrorEquals     = ["States.ALL"]
+            IntervalSeconds = 30
+            MaxAttempts     = 2
+            BackoffRate     = 2
+          }
+        ]
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"]
+            Next        = "PipelineFailed"
+            ResultPath  = "$.error"
+          }
+        ]
       }
       Cleanup = {
         Type     = "Task"
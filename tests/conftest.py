@@ -0,0 +1,30 @@
+"""Puts the prediction image, its shared modules and the shared Lambda layer on the import path (as their Dockerfile / layer do)"""
+
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in ['fargate-predict-age/ai-agent-predict-age-prediction',
+             'fargate-predict-age/ai-agent-predict-age-common',
+             'lambda-predict-age/ai-agent-predict-age-common/python']:
+    sys.path.insert(0, os.path.join(ROOT, path))
+
+def load_lambda(name):
+    """
+    lambda-predict-age/ai-agent-predict-age-{name}/lambda_function.py as a fresh module
+    (its boto3 clients are created but never called: tests replace them)
+    """
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('S3_BUCKET', 'bucket')
+    directory = os.path.join(ROOT, 'lambda-predict-age', f'ai-agent-predict-age-{name}')
+    spec = importlib.util.spec_from_file_location(f"lambda_{name.replace('-', '_')}",
+                                                  os.path.join(directory, 'lambda_function.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, directory)  # Modules next to the handler (scheduler.py)
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(directory)
+    return module
@@ -0,0 +1,39 @@
+"""Athena polling for the Step Functions wait loops (athena_query.py, shared Lambda layer)"""
+
+import pytest
+
+from athena_query import check_query_completion
+from conftest import load_lambda
+
+class FakeAthena:
+    def __init__(self, states):
+        self.states = states
+
+    def get_query_execution(self, QueryExecutionId):
+        state = self.states[QueryExecutionId]
+        if isinstance(state, Exception):
+            raise state
+        return {'QueryExecution': {'Status': {'State': state, 'StateChangeReason': f'{QueryExecutionId} reason'}}}
+
+@pytest.mark.parametrize('states,expected', [
+    ({'a': 'SUCCEEDED', 'b': 'SUCCEEDED'}, 'SUCCEEDED'),
+    ({'a': 'SUCCEEDED', 'b': 'RUNNING'}, 'RUNNING'),
+    ({'a': 'QUEUED'}, 'RUNNING'),
+    ({'a': 'RUNNING', 'b': 'FAILED'}, 'FAILED'),
+    ({'a': 'CANCELLED'}, 'CANCELLED'),
+    ({}, 'SUCCEEDED'),
+])
+def test_combined_state(states, expected):
+    result = check_query_completion(FakeAthena(states), list(states))
+    assert result['query_state'] == expected
+    assert result['execution_ids'] == list(states)
+    if expected in ('FAILED', 'CANCELLED'):
+        assert result['statusCode'] == 500 and result['error'].endswith('reason')
+
+@pytest.mark.parametrize('name', ['staging-features', 'feature-engineering', 'human-qa', 'final-results'])
+def test_failed_check_routes_to_pipeline_failed(name):
+    """A handler error still returns the query_state the Choice after each check reads"""
+    module = load_lambda(name)
+    module.athena_client = FakeAthena({'q': RuntimeError('throttled')})
+    result = module.lambda_handler({'action': 'check', 'execution_ids': ['q']}, None)
+    assert result['statusCode'] == 500 and result['query_state'] == 'FAILED'
@@ -0,0 +1,42 @@
+"""batch-generator: a new plan under RESUME clears every output of the previous one; errors are raised"""
+
+import pytest
+
+from conftest import load_lambda
+from test_s3_delete import FakeS3
+
+class PlanS3(FakeS3):
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.keys.add(Key)
+
+@pytest.fixture
+def batch_generator(monkeypatch):
+    monkeypatch.setenv('YYYYQQ', '2025Q3')
+    module = load_lambda('batch-generator')
+    module.RESUME = True
+    return module
+
+PLAN = {'total_batches': 2, 'records_per_batch': 10, 'total_records': 20, 'sized_by': 'raw_table_footers',
+        'created_at': '2025-07-01T00:00:00'}
+
+def test_new_plan_removes_previous_outputs(batch_generator, monkeypatch):
+    previous = ['predict-age/predictions/2025Q3/batch_0000_0123abcd.parquet',
+                'predict-age/manifests/2025Q3/batch_0000.json',
+                'predict-age/prediction-cache/2025Q3/0_9.parquet',
+                'predict-age/final-results/predict_age_final_results_2025Q3/batch_0000_0123abcd.parquet']
+    kept = ['predict-age/predictions/2025Q2/batch_0000_0123abcd.parquet', 'predict-age/checkpoints/2025Q3/training.json']
+    batch_generator.s3_client = s3 = PlanS3(previous + kept)
+    monkeypatch.setattr(batch_generator, 'reusable_plan', lambda map_side: None)
+    monkeypatch.setattr(batch_generator, 'build_plan', lambda map_side: dict(PLAN))
+    monkeypatch.setattr(batch_generator, 'pending_items', lambda plan, map_side: {0: {}, 1: {}})
+
+    result = batch_generator.lambda_handler({'map_side': True}, None)
+    assert result['total_batches'] == 2 and result['dispatch_manifest_key'] == batch_generator.MANIFEST_KEY
+    assert s3.keys == set(kept) | {batch_generator.PLAN_KEY}
+
+def test_errors_are_raised(batch_generator, monkeypatch):
+    def fail(map_side):
+        raise RuntimeError('no bitmap summary and no raw table')
+    monkeypatch.setattr(batch_generator, 'reusable_plan', fail)
+    with pytest.raises(RuntimeError, match='no raw table'):
+        batch_generator.lambda_handler({}, None)
@@ -0,0 +1,47 @@
+"""Batch plan ranges and the CSV manifest (batch_manifest.py, shared Lambda layer)"""
+
+import io
+
+import pytest
+
+from batch_manifest import ranges_from_bounds, read_batch_manifest, write_batch_manifest
+
+@pytest.mark.parametrize('id_min,id_max,bounds,expected', [
+    (0, 99, [], [(0, 99)]),
+    (0, 99, [49], [(0, 49), (50, 99)]),
+    (1, 100, [10, 20, 30], [(1, 10), (11, 20), (21, 30), (31, 100)]),
+    (0, 99, [10, 10, 10, 50], [(0, 10), (11, 50), (51, 99)]),     # Skewed ids: repeated split points
+    (0, 99, [99], [(0, 99)]),                                      # Split point at id_max
+    (5, 99, [0, 5, 40], [(5, 5), (6, 40), (41, 99)]),              # Split points at / below id_min
+    (7, 7, [7], [(7, 7)]),
+])
+def test_ranges_from_bounds(id_min, id_max, bounds, expected):
+    assert ranges_from_bounds(id_min, id_max, bounds) == expected
+
+@pytest.mark.parametrize('bounds', [[3, 3, 8, 8, 8, 9, 20, 21, 21], list(range(0, 1000, 7)), [500] * 20])
+def test_ranges_cover_without_gaps_or_overlaps(bounds):
+    ranges = ranges_from_bounds(0, 999, sorted(bounds))
+    assert ranges[0][0] == 0 and ranges[-1][1] == 999
+    assert all(low <= high for low, high in ranges)
+    assert all(next_low == high + 1 for (_, high), (next_low, _) in zip(ranges, ranges[1:]))
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+def test_manifest_round_trip():
+    s3 = FakeS3()
+    ranges = ranges_from_bounds(0, 999, [249, 499, 749])
+    assert write_batch_manifest(s3, 'bucket', 'plan.csv', ranges, expected_counts=[10, 0, 5, 7]) == 4
+    items = read_batch_manifest(s3, 'bucket', 'plan.csv')
+    assert [(item['id_min'], item['id_max']) for _, item in sorted(items.items())] == ranges
+    assert [items[batch_id]['expected_predictions'] for batch_id in range(4)] == [10, 0, 5, 7]
+
+    write_batch_manifest(s3, 'bucket', 'plan.csv', ranges)
+    assert all(item['expected_predictions'] is None for item in read_batch_manifest(s3, 'bucket', 'plan.csv').values())
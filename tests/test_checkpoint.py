@@ -0,0 +1,88 @@
+"""Run checkpoints (checkpoint.py, shared Lambda layer)"""
+
+import glob
+import io
+import json
+import os
+
+import pytest
+
+from checkpoint import batch_checkpoint, completed_batches, ctas_target, predictions_fingerprint
+from conftest import ROOT
+
+@pytest.mark.parametrize('sql,expected', [
+    ("CREATE TABLE db.t1 WITH (format = 'PARQUET', external_location = 's3://bucket/a/b/') AS SELECT 1",
+     ('t1', 'bucket', 'a/b/')),
+    ("create table t2\nwith (\n  external_location='s3://bucket/no/slash'\n) as select 1",
+     ('t2', 'bucket', 'no/slash/')),
+    ("CREATE TABLE ${DATABASE_NAME}.t3 AS SELECT 1", ('t3', None, None)),
+    ("CREATE TABLE db.predict_age_human_qa_2025Q3\n    WITH (\n"
+     "        external_location = 's3://bucket/predict-age/human-qa/predict_age_human_qa_2025Q3/',\n"
+     "        format = 'PARQUET'\n    ) AS\n    SELECT 1",
+     ('predict_age_human_qa_2025Q3', 'bucket', 'predict-age/human-qa/predict_age_human_qa_2025Q3/')),
+])
+def test_ctas_target(sql, expected):
+    assert ctas_target(sql) == expected
+
+@pytest.mark.parametrize('path', sorted(glob.glob(os.path.join(ROOT, 'lambda-predict-age/*/*.sql'))))
+def test_ctas_target_of_pipeline_sql(path):
+    with open(path) as f:
+        sql = f.read().replace('${DATABASE_NAME}', 'db').replace('${S3_BUCKET}', 'bucket').replace('${YYYYQQ}', '2025Q3')
+    table, bucket, prefix = ctas_target(sql)
+    assert table.startswith('predict_age_') and bucket == 'bucket'
+    assert prefix.startswith('predict-age/') and prefix.endswith('/')
+
+class FakeS3:
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+        class ClientError(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+
+    def put(self, key, body, etag):
+        self.objects[key] = (body, etag)
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        return {'Body': io.BytesIO(self.objects[Key][0]), 'ETag': self.objects[Key][1]}
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.exceptions.ClientError(Key)
+        body, etag = self.objects[Key]
+        return {'ContentLength': len(body), 'ETag': etag}
+
+def test_completed_batches():
+    s3 = FakeS3()
+    checkpoints = {batch_id: batch_checkpoint('2025Q3', batch_id, 8, batch_id * 100, batch_id * 100 + 99, False, 'm1')
+                   for batch_id in range(8)}
+
+    def commit(batch_id, checkpoint, output=b'rows', etag='"e"', file_bytes=None, write_output=True):
+        output_key = f'out/batch_{batch_id:04d}_a.parquet' if output is not None else None
+        if output is not None and write_output:
+            s3.put(output_key, output, etag)
+        manifest = {'batch_id': batch_id, 'output_key': output_key, 'checkpoint': checkpoint,
+                    'file_bytes': len(output or b'') if file_bytes is None else file_bytes, 'etag': '"e"'}
+        s3.put(f'manifests/batch_{batch_id:04d}.json', json.dumps(manifest).encode('utf-8'), '"m"')
+
+    commit(0, checkpoints[0])                                           # Complete
+    commit(1, checkpoints[1], output=None)                              # Nothing to write: complete
+    commit(2, {**checkpoints[2], 'model_hash': 'm0'})                   # Other models
+    commit(3, {**checkpoints[3], 'run_id': '2025Q2'})                   # Other run
+    commit(4, checkpoints[4], write_output=False)                       # Output missing
+    commit(5, checkpoints[5], file_bytes=3)                             # Size differs
+    commit(6, checkpoints[6], etag='"rewritten"')                       # ETag differs
+    # Batch 7: no manifest
+
+    assert completed_batches(s3, 'bucket', 'manifests', checkpoints, max_workers=4) == {0, 1}
+
+def test_predictions_fingerprint():
+    manifests = [{'batch_id': 0, 'output_key': 'a', 'etag': '"1"'}, {'batch_id': 1, 'output_key': None}]
+    fingerprint = predictions_fingerprint(manifests)
+    assert fingerprint == predictions_fingerprint(list(reversed(manifests)))
+    assert fingerprint != predictions_fingerprint([{**manifests[0], 'etag': '"2"'}, manifests[1]])
@@ -0,0 +1,140 @@
+"""
+Training/serving parity: the table training reads is the one feature_spec.py ctas
+builds from the spec that prediction computes with.
+"""
+
+import ast
+import io
+import json
+import os
+import re
+
+import boto3
+import pytest
+
+import feature_spec
+from conftest import ROOT
+
+TRAINING_PY = os.path.join(ROOT, 'fargate-predict-age/ai-agent-predict-age-training/training.py')
+STEP_FUNCTIONS_TF = os.path.join(ROOT, 'terraform/step_functions.tf')
+FARGATE_TF = os.path.join(ROOT, 'terraform/fargate.tf')
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+def training_feature_columns():
+    """feature_columns of training.py prepare_training_data (the model input order)"""
+    tree = ast.parse(read(TRAINING_PY))
+    function = next(node for node in ast.walk(tree)
+                    if isinstance(node, ast.FunctionDef) and node.name == 'prepare_training_data')
+    assign = next(node for node in ast.walk(function) if isinstance(node, ast.Assign)
+                  and getattr(node.targets[0], 'id', None) == 'feature_columns')
+    return ast.literal_eval(assign.value)
+
+class FakeAthena:
+    class exceptions:
+        class MetadataException(Exception):
+            pass
+
+    def __init__(self, tables=()):
+        self.queries, self.tables = [], set(tables)
+
+    def start_query_execution(self, QueryString, **kwargs):
+        self.queries.append(QueryString)
+        return {'QueryExecutionId': f'q{len(self.queries)}'}
+
+    def get_query_execution(self, QueryExecutionId):
+        return {'QueryExecution': {'Status': {'State': 'SUCCEEDED'},
+                                   'Statistics': {'DataScannedInBytes': 0, 'EngineExecutionTimeInMillis': 0}}}
+
+    def get_table_metadata(self, TableName, **kwargs):
+        if TableName not in self.tables:
+            raise self.exceptions.MetadataException(TableName)
+        return {'TableMetadata': {'Name': TableName}}
+
+class FakeS3:
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body.encode('utf-8') if isinstance(Body, str) else Body
+
+    def get_paginator(self, name):
+        objects = self.objects
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                yield {'Contents': [{'Key': key} for key in objects if key.startswith(Prefix)]}
+        return Paginator()
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete['Objects']:
+            self.objects.pop(obj['Key'], None)
+
+@pytest.fixture
+def aws(monkeypatch):
+    s3, athena = FakeS3(), FakeAthena()
+    monkeypatch.setattr(boto3, 'client', lambda name, *args, **kwargs: s3 if name == 's3' else athena)
+    monkeypatch.setattr(feature_spec, 'S3_BUCKET', 'bucket')
+    return s3, athena
+
+def ctas_defaults():
+    parser_defaults = {}
+    for match in re.finditer(r"ctas_parser\.add_argument\('--(\w+)', default='([^']+)'\)", read(feature_spec.__file__)):
+        parser_defaults[match.group(1)] = match.group(2)
+    return parser_defaults
+
+def test_training_model_inputs_are_the_spec_features():
+    assert training_feature_columns() == feature_spec.FEATURE_COLUMNS
+    selected = re.findall(r'\bf\.(\w+),', read(TRAINING_PY))
+    assert selected[1:] == feature_spec.FEATURE_COLUMNS  # After f.id
+
+def test_spec_ctas_builds_the_table_training_reads(aws):
+    s3, athena = aws
+    defaults = ctas_defaults()
+    training_table = re.search(r"FEATURES_TABLE = os.environ.get\('FEATURES_TABLE', '(\w+)'\)", read(TRAINING_PY)).group(1)
+    deployed_table = re.search(r'"predict_age_feature_store" : "(\w+)"', read(FARGATE_TF)).group(1)
+    assert defaults['table'] == training_table == deployed_table
+
+    feature_spec.ctas(defaults['source'], defaults['table'], defaults['location'])
+    ctas_query = athena.queries[-1]
+    assert re.search(rf'CREATE TABLE \S+\.{training_table}\b', ctas_query)
+    aliases = re.findall(r'\bAS (\w+),?\n', ctas_query)
+    assert aliases == ['id'] + feature_spec.FEATURE_COLUMNS + ['feature_creation_date', 'feature_version']
+    for expression in feature_spec.select_expressions():
+        assert expression in ctas_query  # Same compiled expressions as the SQL backend of the spec
+
+    checkpoint = json.loads(s3.objects[feature_spec.ctas_checkpoint_key(training_table)])
+    assert checkpoint['spec_version'] == feature_spec.SPEC_VERSION
+
+def test_spec_ctas_resumes_only_for_the_same_spec_version(aws, monkeypatch):
+    s3, athena = aws
+    defaults = ctas_defaults()
+    monkeypatch.setattr(feature_spec, 'RESUME', True)
+    feature_spec.ctas(defaults['source'], defaults['table'], defaults['location'])
+    athena.tables.add(defaults['table'])
+    submitted = len(athena.queries)
+
+    feature_spec.ctas(defaults['source'], defaults['table'], defaults['location'])
+    assert len(athena.queries) == submitted  # Kept
+
+    monkeypatch.setattr(feature_spec, 'SPEC_VERSION', 'spec_changed')
+    feature_spec.ctas(defaults['source'], defaults['table'], defaults['location'])
+    assert len(athena.queries) > submitted  # Rebuilt
+
+def test_pipeline_builds_the_spec_table_before_training():
+    definition = read(STEP_FUNCTIONS_TF)
+    state = definition[definition.index('TrainingFeatureSpec = {'):definition.index('      Training = {')]
+    assert '"TrainingFeatureSpec"' in definition[:definition.index('TrainingFeatureSpec = {')]
+    assert 'Command     = ["feature_spec.py", "ctas"]' in state
+    assert re.search(r'Next\s+= "Training"', state)
@@ -0,0 +1,63 @@
+"""Feature spec kernel: training encodings, SQL NULL semantics, and precomputed static entries"""
+
+import numpy as np
+import pandas as pd
+
+from feature_spec import (FEATURE_COLUMNS, STATIC_COLUMNS, TIME_FEATURE_COLUMNS, compute_features,
+                          compute_time_features, feature_matrix, select_expressions)
+from raw_frame import bench_raw
+
+TODAY = '2025-01-15'
+
+def profiles():
+    return pd.DataFrame({
+        'id': [1, 2, 3],
+        'compensation_range': ['$200,001+', '$0-25k', None],
+        'employee_range': ['10000+', '11 to 50', None],
+        'job_level': ['C-Team', 'Manager', None],
+        'job_start_date': ['2024-01-15', None, 'not a date'],
+        'ev_last_date': ['2025-01-05', None, None],
+        'work_email': ['a@example.com', '', None],
+        'personal_email': ['b@example.com', None, None],
+        'education': ['[{"degree": "Master of Science", "end_date": "2010"}]', '[]', None],
+        'work_experience': ['[{}, {}, {}]', '[]', None],
+        'skills': ['["python", "sql"]', None, '[]']
+    })
+
+def test_training_encodings_and_null_fallbacks():
+    features = compute_features(profiles(), today=TODAY).set_index('id')
+    expected = {
+        'compensation_encoded': [8, 4, 4],            # Training's '$200,001+' labels; unknown / NULL -> 4
+        'company_size_encoded': [9, 4, 4],
+        'tenure_months': [12, 60, 36],                # No parsable start date -> job level default
+        'days_since_profile_update': [10, 365, 365],
+        'email_engagement_score': [1.0, 0.0, 0.0],    # An empty string is not an email
+        'education_level_encoded': [4, 2, 2],
+        'graduation_year': [2010, 0, 0],
+        'number_of_jobs': [3, 0, 0],
+        'skill_count': [2, 0, 0],
+        'total_career_years': [6.0, 5.0, 3.0],        # 12/12 + 2 * 2.5; else tenure / 12
+        'job_churn_rate': [0.2, 0.2, 0.2],            # Tenure not above 12 months -> default
+        'comp_size_interaction': [72, 16, 16]
+    }
+    for name, values in expected.items():
+        assert np.allclose(features[name].values, values), name
+
+def test_model_matrix_is_the_feature_block():
+    features = compute_features(profiles(), today=TODAY)
+    matrix = feature_matrix(features)
+    assert matrix.dtype == np.float32 and matrix.shape == (3, len(FEATURE_COLUMNS))
+    assert np.shares_memory(matrix, features[FEATURE_COLUMNS[0]].values)
+
+def test_precomputed_static_entries_give_the_same_features():
+    raw = bench_raw(300)
+    direct = compute_features(raw, today=TODAY, with_intermediates=True)
+    static = direct[['id'] + STATIC_COLUMNS]  # What the feature store / the Athena scan hands back
+    assert TIME_FEATURE_COLUMNS and set(TIME_FEATURE_COLUMNS) <= set(FEATURE_COLUMNS)
+    again = compute_time_features(static, today=TODAY)
+    assert np.array_equal(feature_matrix(again), feature_matrix(direct), equal_nan=True)
+
+def test_sql_backend_compiles_every_feature():
+    expressions = select_expressions(prefix='spec_')
+    assert [expression.rsplit(' AS ', 1)[1] for expression in expressions] == ['spec_' + name for name in FEATURE_COLUMNS]
+    assert all(expression.startswith('CAST(') for expression in expressions)
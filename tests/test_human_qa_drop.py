@@ -0,0 +1,70 @@
+"""Human QA and predictions tables: the DROP matches what the catalog holds (athena_query.table_type)"""
+
+import pytest
+
+from conftest import load_lambda
+
+class FakeAthena:
+    """Catalog of name -> TableType; records every statement and applies DROP / CREATE to the catalog"""
+    class exceptions:
+        class MetadataException(Exception):
+            pass
+
+    def __init__(self, catalog):
+        self.catalog = dict(catalog)
+        self.queries = []
+
+    def get_table_metadata(self, CatalogName, DatabaseName, TableName):
+        if TableName not in self.catalog:
+            raise self.exceptions.MetadataException(TableName)
+        return {'TableMetadata': {'Name': TableName, 'TableType': self.catalog[TableName]}}
+
+    def start_query_execution(self, QueryString, **kwargs):
+        query = ' '.join(QueryString.split())
+        self.queries.append(query)
+        table = query.split('.')[1].split()[0] if '.' in query else None
+        if query.startswith('DROP VIEW'):
+            assert self.catalog.pop(table) == 'VIRTUAL_VIEW', 'DROP VIEW on a table'
+        elif query.startswith('DROP TABLE'):
+            assert self.catalog.get(table, 'EXTERNAL_TABLE') != 'VIRTUAL_VIEW', 'DROP TABLE on a view'
+            self.catalog.pop(table, None)
+        elif query.startswith('CREATE TABLE'):
+            self.catalog[table] = 'EXTERNAL_TABLE'
+        return {'QueryExecutionId': f'q{len(self.queries)}'}
+
+    def get_query_execution(self, QueryExecutionId):
+        return {'QueryExecution': {'Status': {'State': 'SUCCEEDED'}}}
+
+class EmptyS3:
+    def get_paginator(self, name):
+        class Paginator:
+            def paginate(self, **kwargs):
+                return iter([{}])
+        return Paginator()
+
+@pytest.fixture
+def human_qa():
+    module = load_lambda('human-qa')
+    module.RESUME = False
+    module.s3_client = EmptyS3()
+    return module
+
+@pytest.mark.parametrize('existing,drop', [('VIRTUAL_VIEW', 'DROP VIEW'), ('EXTERNAL_TABLE', 'DROP TABLE'), (None, None)])
+def test_two_pass_after_single_pass(human_qa, existing, drop):
+    """A single-pass run left Human QA as a view: switching back to two-pass drops the view, then CTAS"""
+    catalog = {human_qa.HUMAN_QA_TABLE: existing} if existing else {}
+    athena = human_qa.athena_client = FakeAthena(catalog)
+    result = human_qa.lambda_handler({'action': 'submit'}, None)
+    assert result['query_state'] == 'RUNNING'
+    drops = [query for query in athena.queries if query.startswith('DROP')]
+    assert [' '.join(query.split()[:2]) for query in drops] == ([drop] if drop else [])
+    assert athena.queries[-1].startswith(f'CREATE TABLE {human_qa.DATABASE_NAME}.{human_qa.HUMAN_QA_TABLE}')
+    assert athena.catalog[human_qa.HUMAN_QA_TABLE] == 'EXTERNAL_TABLE'
+
+def test_predictions_table_or_view():
+    module = load_lambda('create-predictions-table')
+    athena = module.athena_client = FakeAthena({'a_view': 'VIRTUAL_VIEW', 'a_table': 'EXTERNAL_TABLE'})
+    for name in ['a_view', 'a_table', 'missing']:
+        module.drop_table_or_view(name)
+    assert athena.queries == [f'DROP VIEW IF EXISTS {module.DATABASE_NAME}.a_view',
+                              f'DROP TABLE IF EXISTS {module.DATABASE_NAME}.a_table']
@@ -0,0 +1,83 @@
+"""Needs-prediction bitmap: membership across sparse and dense containers, batch sizing and ranges"""
+
+import io
+import json
+
+import numpy as np
+import pytest
+
+import id_bitmap
+from batch_manifest import plan_batch_count
+from id_bitmap import ARRAY_CONTAINER_MAX, IdBitmap, plan_batches, plan_ranges, sorted_unique
+
+@pytest.fixture
+def ids():
+    rng = np.random.default_rng(7)
+    sparse = rng.choice(1 << 16, 300, replace=False) + (5 << 16)          # One sparse container
+    dense = rng.choice(1 << 16, 20000, replace=False) + (9 << 16)         # One dense container
+    edges = np.array([0, 0xFFFF, 1 << 16, (1 << 40) + 3, (1 << 63) - 1])  # Container edges, large ids
+    return np.concatenate([sparse, dense, edges]).astype(np.uint64)
+
+def test_contains_matches_set(ids):
+    bitmap = IdBitmap.from_ids(ids)
+    assert len(bitmap.array_keys) and len(bitmap.bitmap_keys)  # Both container kinds are exercised
+    assert len(bitmap) == len(np.unique(ids))
+
+    probes = np.concatenate([ids, ids + np.uint64(1), ids - np.uint64(1), np.array([7 << 16, 1 << 50], dtype=np.uint64)])
+    expected = np.isin(probes, ids)
+    assert np.array_equal(bitmap.contains(probes), expected)
+
+def test_sorted_build_and_round_trip(ids):
+    unique = sorted_unique(np.concatenate([ids, ids[:100]]))  # Duplicates dropped
+    assert np.array_equal(unique, np.unique(ids))
+
+    bitmap = IdBitmap.from_sorted_ids(unique)
+    restored = IdBitmap.from_bytes(bitmap.to_bytes())
+    assert np.array_equal(restored.contains(ids), np.ones(len(ids), dtype=bool))
+    assert not restored.contains(np.array([8 << 16], dtype=np.uint64)).any()
+
+def test_dense_threshold():
+    lows = np.arange(ARRAY_CONTAINER_MAX, dtype=np.uint64)
+    assert len(IdBitmap.from_ids(lows).bitmap_keys) == 0
+    assert len(IdBitmap.from_ids(np.append(lows, ARRAY_CONTAINER_MAX)).bitmap_keys) == 1
+
+def test_empty_bitmap():
+    bitmap = IdBitmap.from_ids(np.array([], dtype=np.uint64))
+    assert len(bitmap) == 0
+    assert not bitmap.contains(np.array([0, 1], dtype=np.uint64)).any()
+
+def test_plan_batches_and_ranges(ids, monkeypatch):
+    monkeypatch.setattr('id_bitmap.PLAN_CHUNK_IDS', 1000)  # Several bincount passes
+    unique = np.unique(ids)
+    total_batches, batch_counts = plan_batches(unique, target_rows_per_batch=3000, max_concurrency=4)
+    assert total_batches == plan_batch_count(len(unique), 3000, 4) == 8  # 7 batches round up to 2 waves
+    assert np.array_equal(batch_counts, np.bincount((unique % np.uint64(total_batches)).astype(np.int64)))
+
+    id_min, id_max, counts = plan_ranges(unique, total_batches)
+    assert counts.sum() == len(unique) and np.all(id_min[1:] > id_max[:-1])
+    for low, high, count in zip(id_min, id_max, counts):
+        assert ((unique >= low) & (unique <= high)).sum() == count
+
+class PlanS3:
+    """S3 holding a bitmap summary and a batch plan as JSON"""
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        body = json.dumps(self.objects[Key]).encode()
+        return {'Body': io.BytesIO(body)}
+
+@pytest.mark.parametrize('total_records, reused', [(20305, True), (20000, False)])
+def test_resume_keeps_bitmap_the_plan_was_built_from(total_records, reused):
+    summary = {'raw_table': id_bitmap.RAW_TABLE, 'target_rows_per_batch': id_bitmap.TARGET_ROWS_PER_BATCH,
+               'max_concurrency': id_bitmap.MAX_CONCURRENCY, 'needs_prediction_count': 20305}
+    plan = {'sized_by': 'needs_prediction_bitmap', 'total_records': total_records}
+    s3 = PlanS3({id_bitmap.SUMMARY_KEY: summary, id_bitmap.PLAN_KEY: plan})
+    assert id_bitmap.reusable_summary(s3) == (summary if reused else None)
+    assert id_bitmap.reusable_summary(PlanS3({id_bitmap.SUMMARY_KEY: summary})) is None  # Fresh run: no plan
@@ -0,0 +1,85 @@
+"""json_scan.array_lengths must agree with the json.loads reference (decode_length) on every value"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from feature_spec import STRING_DTYPE
+from json_scan import array_lengths, bench_column, decode_length
+
+CASES = [
+    None,
+    '',
+    '   ',
+    '[]',
+    ' [ ] ',
+    '["python", "sql"]',
+    '[1, -2.5e3, true, false, null]',
+    # Escapes
+    r'["say \"hi\"", "back\\slash", "tab\tnewline\n", "é", "\/"]',
+    r'["ends with backslash\\"]',
+    # Commas and braces inside strings
+    '["C, C++", "Go"]',
+    '["{not an object}", "[not, an, array]"]',
+    '[{"title": "Engineer, Data", "company": "A {B}"}, {"title": "[x]"}]',
+    '[{"company": {"name": "Co \\"Inc\\"", "tags": ["b2b", 3]}, "end_date": 2019}]',
+    # NaN / Infinity (accepted by json.loads, not JSON)
+    '[NaN, 1]',
+    '[Infinity, -Infinity]',
+    '[{"score": NaN}]',
+    # Lone surrogates
+    r'["\ud800"]',
+    r'["\udc00", "x"]',
+    r'["😀"]',
+    # Control characters (raw ones are invalid inside strings)
+    '["a\x01b"]',
+    '["line\nbreak", "x"]',
+    '[\t"a",\r\n"b"\n]',
+    '["a"]\x0b',
+    # Nested arrays
+    '[[1, 2], [3]]',
+    '[[], []]',
+    '[{"roles": [{"title": "Intern"}, {"title": "Lead"}]}]',
+    '[{"a": {"b": {"c": {"d": 1}}}}]',
+    '[{"a": [[1]]}]',
+    # Truncated values
+    '["a", "b"',
+    '[{"title": "Engineer"}, {"title": "Lead"',
+    '["unterminated]',
+    '[',
+    # Not arrays
+    '{"a": 1}',
+    '"string"',
+    '42',
+    'null',
+    'not json',
+    '[1, 2] [3]',
+    '[1,]',
+    '[,1]',
+    '[01]',
+]
+
+def scan(values):
+    return array_lengths(pd.Series(values, dtype=STRING_DTYPE))
+
+@pytest.mark.parametrize('value', CASES)
+def test_matches_decoder(value):
+    expected = 0 if value is None else decode_length(value)
+    assert scan([value])[0] == expected
+
+def test_all_cases_in_one_column():
+    expected = [0 if value is None else decode_length(value) for value in CASES]
+    assert scan(CASES).tolist() == expected
+
+def test_chunks_and_counts():
+    values = ['[1, 2, 3]', None, '["a, b"]'] * 10
+    stats = {}
+    lengths = array_lengths(pd.Series(values, dtype=STRING_DTYPE), stats, chunk_rows=7)
+    assert lengths.tolist() == [3.0, 0.0, 1.0] * 10
+    assert stats['decoded'] == 10  # Only the value with a comma inside a string
+
+@pytest.mark.parametrize('kind', ['work_experience', 'skills'])
+def test_benchmark_shaped_columns(kind):
+    values = bench_column(5000, seed=11, kind=kind)
+    expected = np.array([0 if value is None else decode_length(value) for value in values], dtype='float64')
+    np.testing.assert_array_equal(scan(values.tolist()), expected)
@@ -0,0 +1,82 @@
+"""prediction.write_batch_manifest commits a batch with a conditional PUT: the first copy wins, reruns replace it"""
+
+import io
+import json
+import sys
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+
+class CasS3:
+    """Objects with ETags; put_object honours IfMatch / IfNoneMatch like S3 conditional writes"""
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+        ClientError = ClientError
+
+    def __init__(self):
+        self.objects = {}  # key -> (body, ETag)
+        self.deleted = []
+        self.puts = 0
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        current = self.objects.get(Key)
+        if (IfNoneMatch == '*' and current) or (IfMatch and (current is None or current[1] != IfMatch)):
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}, 'ResponseMetadata': {'HTTPStatusCode': 412}},
+                              'PutObject')
+        self.puts += 1
+        self.objects[Key] = (Body, f'"etag-{self.puts}"')
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        body, etag = self.objects[Key]
+        return {'Body': io.BytesIO(body.encode()), 'ETag': etag}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+        self.deleted.append(Key)
+
+@pytest.fixture
+def prediction(monkeypatch):
+    """prediction.py imported against a CasS3 (it reads the batch plan at import)"""
+    s3 = CasS3()
+    monkeypatch.setenv('S3_BUCKET', 'bucket')
+    monkeypatch.setenv('YYYYQQ', '2025Q3')
+    monkeypatch.setenv('TOTAL_BATCHES', '4')
+    monkeypatch.setattr(boto3, 'client', lambda name, *args, **kwargs: s3)
+    sys.modules.pop('prediction', None)
+    import prediction
+    yield prediction
+    sys.modules.pop('prediction', None)
+
+BATCH = {'batch_id': 2, 'id_min': 200, 'id_max': 299, 'expected_predictions': 10}
+OUTPUT = {'row_count': 10, 'id_min': 200, 'id_max': 290, 'checksum': '0' * 16}
+
+def commit(prediction, output_key, committed):
+    return prediction.write_batch_manifest(BATCH, OUTPUT, output_key, 100, 10, 10, {}, {'model_hash': 'm1'},
+                                           etag='"out"', committed=committed)
+
+def test_first_copy_commits_and_the_other_loses(prediction):
+    s3 = prediction.s3_client
+    first, second = prediction.read_batch_manifest(2), prediction.read_batch_manifest(2)
+    assert first == second == (None, None)
+
+    assert commit(prediction, 'predictions/batch_0002_aaaa.parquet', first)['output_key'] == 'predictions/batch_0002_aaaa.parquet'
+    assert commit(prediction, 'predictions/batch_0002_bbbb.parquet', second) is None  # IfNoneMatch refused
+    manifest, _ = prediction.read_batch_manifest(2)
+    assert manifest['output_key'] == 'predictions/batch_0002_aaaa.parquet'
+    assert s3.deleted == []
+
+def test_rerun_replaces_the_manifest_it_read(prediction):
+    s3 = prediction.s3_client
+    commit(prediction, 'predictions/batch_0002_aaaa.parquet', (None, None))
+    rerun, stale = prediction.read_batch_manifest(2), prediction.read_batch_manifest(2)
+
+    assert commit(prediction, 'predictions/batch_0002_cccc.parquet', rerun) is not None
+    assert s3.deleted == ['predictions/batch_0002_aaaa.parquet']  # Output the replaced manifest referenced
+    assert commit(prediction, 'predictions/batch_0002_dddd.parquet', stale) is None  # IfMatch on an old ETag
+    manifest, _ = prediction.read_batch_manifest(2)
+    assert manifest['output_key'] == 'predictions/batch_0002_cccc.parquet'
+    assert json.loads(s3.objects[f'{prediction.MANIFEST_PREFIX}/batch_0002.json'][0])['id_range'] == [200, 299]
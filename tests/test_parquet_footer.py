@@ -0,0 +1,105 @@
+"""Footer-only row counts (parquet_footer) against pyarrow"""
+
+import io
+import struct
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import parquet_footer
+from parquet_footer import (CT_BINARY, CT_BOOLEAN_TRUE, CT_BOOLEAN_FALSE, CT_I32, CT_I64, CT_LIST, CT_MAP,
+                            CT_STRUCT, CompactReader, count_prefix_rows, parse_num_rows)
+
+def varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def zigzag_varint(value):
+    return varint((value << 1) ^ (value >> 63))
+
+def parquet_bytes(table, **kwargs):
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, **kwargs)
+    return buffer.getvalue()
+
+def footer_of(data):
+    length = struct.unpack('<I', data[-8:-4])[0]
+    return data[-8 - length:-8]
+
+def test_varint_and_zigzag():
+    reader = CompactReader(varint(300) + zigzag_varint(-3) + zigzag_varint(2 ** 40))
+    assert reader.read_varint() == 300
+    assert reader.read_zigzag() == -3
+    assert reader.read_zigzag() == 2 ** 40
+    assert reader.pos == len(reader.data)
+
+def test_skips_every_type_before_num_rows():
+    footer = b''.join([
+        bytes([0x10 | CT_BOOLEAN_TRUE]),                        # field 1: bool (value in the header)
+        bytes([0x10 | CT_LIST]), bytes([0x20 | CT_BOOLEAN_FALSE]), b'\x01\x00',  # field 2: list<bool>, 1 byte each
+        bytes([0x00 | CT_BINARY]), zigzag_varint(9), varint(3), b'abc',  # field 9 in the long form
+        bytes([0x10 | CT_MAP]), varint(2), bytes([(CT_BINARY << 4) | CT_I32]),  # field 10: map<binary, i32>
+        varint(1), b'k', zigzag_varint(5), varint(1), b'l', zigzag_varint(-5),
+        bytes([0x10 | CT_LIST]), bytes([0xF0 | CT_I32]), varint(16), b''.join(zigzag_varint(i) for i in range(16)),
+        bytes([0x10 | CT_STRUCT]), bytes([0x10 | CT_I64]), zigzag_varint(7), b'\x00',  # field 12: struct
+        bytes([0x00 | CT_I64]), zigzag_varint(3), zigzag_varint(123456789012),  # field 3 (num_rows), long form
+    ])
+    assert parse_num_rows(footer) == 123456789012
+
+def test_missing_num_rows():
+    with pytest.raises(ValueError):
+        parse_num_rows(bytes([0x10 | CT_I32]) + zigzag_varint(1) + b'\x00')
+
+def test_unknown_type():
+    with pytest.raises(ValueError):
+        CompactReader(b'').skip(13)
+
+@pytest.mark.parametrize('rows,row_group_size', [(0, None), (1, None), (10000, 1000), (250000, 65536)])
+def test_real_footers(rows, row_group_size):
+    table = pa.table({'id': pa.array(range(rows), pa.int64()),
+                      'name': pa.array([f'name {i}' for i in range(rows)]),
+                      'scores': pa.array([[i, i + 1] for i in range(rows)], pa.list_(pa.int32()))})
+    table = table.replace_schema_metadata({'origin': 'test', 'pandas': '{"x": [1, 2]}'})
+    data = parquet_bytes(table, row_group_size=row_group_size)
+    assert parse_num_rows(footer_of(data)) == pq.ParquetFile(io.BytesIO(data)).metadata.num_rows == rows
+
+class FakeS3:
+    def __init__(self, objects):
+        self.objects = objects
+        self.gets = 0
+
+    def get_object(self, Bucket, Key, Range):
+        self.gets += 1
+        return {'Body': io.BytesIO(self.objects[Key][-int(Range.split('-')[-1]):])}
+
+    def get_paginator(self, name):
+        objects = self.objects
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                yield {'Contents': [{'Key': key, 'Size': len(body)} for key, body in objects.items()
+                                    if key.startswith(Prefix)]}
+        return Paginator()
+
+def test_count_prefix_rows(monkeypatch):
+    monkeypatch.setattr(parquet_footer, 'INITIAL_FETCH_BYTES', 256)  # Forces the second, exact footer GET
+    objects = {f'p/part{i}': parquet_bytes(pa.table({'id': list(range(i * 100))})) for i in range(1, 4)}
+    objects['p/'] = b''  # Folder marker
+    objects['other/part0'] = parquet_bytes(pa.table({'id': [1]}))
+    s3 = FakeS3(objects)
+    stats = count_prefix_rows(s3, 'bucket', 'p/', max_workers=2)
+    assert (stats['rows'], stats['files']) == (600, 3)
+    assert s3.gets == 6
+
+def test_not_parquet():
+    s3 = FakeS3({'p/x': b'not a parquet file'})
+    with pytest.raises(ValueError):
+        parquet_footer.read_parquet_row_count(s3, 'bucket', 'p/x', 18)
@@ -0,0 +1,24 @@
+"""precleanup fails the run when a prefix it has to clear was not fully deleted"""
+
+import pytest
+
+from conftest import load_lambda
+from test_s3_delete import FakeS3, FlakyS3
+
+@pytest.fixture
+def precleanup(monkeypatch):
+    monkeypatch.setenv('DATABASE_NAME', 'ml_predict_age')
+    return load_lambda('precleanup')
+
+def test_resumed_run_keeps_resumable_prefixes(precleanup):
+    keys = ['predict-age/scheduler/2025Q3/state.json', 'predict-age/predictions/2025Q3/batch_0000_0123abcd.parquet']
+    precleanup.s3_client = s3 = FakeS3(keys)
+    assert precleanup.clean_final_results_s3(resume=True) == 1
+    assert s3.keys == {keys[1]}
+
+def test_failed_delete_raises(precleanup, monkeypatch):
+    monkeypatch.setattr('s3_delete.backoff_delay', lambda attempt: 0)
+    stuck = 'predict-age/manifests/2025Q3/batch_0000.json'
+    precleanup.s3_client = FlakyS3([stuck, 'predict-age/plans/2025Q3/batch_plan.json'], key_errors={stuck: ['AccessDenied']})
+    with pytest.raises(Exception, match='predict-age/manifests/'):
+        precleanup.clean_final_results_s3(resume=False)
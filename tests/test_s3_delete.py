@@ -0,0 +1,134 @@
+"""S3PrefixDeleter against an in-memory bucket: what it deletes, keeps and reports"""
+
+import pytest
+from botocore.exceptions import ClientError
+
+from conftest import load_lambda
+from s3_delete import S3PrefixDeleter
+
+class FakeS3:
+    """One bucket of keys; list_objects_v2 pages (with '/' delimiter) and delete_objects"""
+
+    def __init__(self, keys):
+        self.keys = set(keys)
+        self.deleted = []
+
+    def get_paginator(self, name):
+        s3 = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix, Delimiter=None, PaginationConfig=None):
+                keys = sorted(key for key in s3.keys if key.startswith(Prefix))
+                if Delimiter is None:
+                    return iter([{'Contents': [{'Key': key} for key in keys]}])
+                direct = [key for key in keys if Delimiter not in key[len(Prefix):]]
+                shards = sorted({Prefix + key[len(Prefix):].split(Delimiter)[0] + Delimiter
+                                 for key in keys if key not in direct})
+                return iter([{'Contents': [{'Key': key} for key in direct],
+                              'CommonPrefixes': [{'Prefix': shard} for shard in shards]}])
+        return Paginator()
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete['Objects']:
+            self.keys.discard(obj['Key'])
+            self.deleted.append(obj['Key'])
+        return {}
+
+    def delete_object(self, Bucket, Key):
+        self.keys.discard(Key)
+
+def test_delete_prefix_removes_only_that_prefix():
+    s3 = FakeS3(['a/1', 'a/x/2', 'a/x/y/3', 'ab/4', 'b/5'])
+    stats = S3PrefixDeleter(s3, 'bucket', max_workers=2).delete_prefix('a/')
+    assert s3.keys == {'ab/4', 'b/5'}
+    assert (stats['deleted'], stats['failed'], stats['kept'], stats['errors']) == (3, 0, 0, [])
+
+def test_keep_spares_matching_keys():
+    s3 = FakeS3(['t/part-0', 't/x/batch_1', 't/x/part-1'])
+    stats = S3PrefixDeleter(s3, 'bucket', max_workers=2).delete_prefix(
+        't/', keep=lambda key: 'batch_' in key)
+    assert s3.keys == {'t/x/batch_1'}
+    assert (stats['deleted'], stats['kept']) == (2, 1)
+
+@pytest.fixture
+def final_results():
+    return load_lambda('final-results')
+
+def test_ctas_leftovers_keep_batch_outputs(final_results):
+    prefix = final_results.FINAL_RESULTS_PREFIX
+    batch_output = f'{prefix}batch_0003_0123abcd.parquet'
+    final_results.s3_client = s3 = FakeS3([batch_output, f'{prefix}20250101_000000_00001_abcde',
+                                           f'{prefix}batch_0003_0123abcd.parquet.tmp', 'other/key'])
+    assert final_results.remove_ctas_leftovers() == 2
+    assert s3.keys == {batch_output, 'other/key'}
+
+class FlakyS3(FakeS3):
+    """FakeS3 whose delete_objects answers from a script: per-key error codes, or a ClientError per call"""
+
+    def __init__(self, keys, key_errors=None, call_errors=None, list_error_prefix=None):
+        super().__init__(keys)
+        self.key_errors = key_errors or {}    # key -> [code per attempt]; exhausted -> deleted
+        self.call_errors = call_errors or []  # codes raised by the next calls
+        self.list_error_prefix = list_error_prefix
+
+    def get_paginator(self, name):
+        paginator = super().get_paginator(name)
+        list_error_prefix = self.list_error_prefix
+
+        class Paginator:
+            def paginate(self, Prefix, **kwargs):
+                if list_error_prefix and Prefix.startswith(list_error_prefix):
+                    raise ClientError({'Error': {'Code': 'AccessDenied'}}, 'ListObjectsV2')
+                return paginator.paginate(Prefix=Prefix, **kwargs)
+        return Paginator()
+
+    def delete_objects(self, Bucket, Delete):
+        if self.call_errors:
+            raise ClientError({'Error': {'Code': self.call_errors.pop(0)}}, 'DeleteObjects')
+        errors, deleted = [], []
+        for obj in Delete['Objects']:
+            codes = self.key_errors.get(obj['Key'])
+            if codes:
+                errors.append({'Key': obj['Key'], 'Code': codes.pop(0)})
+            else:
+                deleted.append(obj)
+        super().delete_objects(Bucket, {'Objects': deleted})
+        return {'Errors': errors} if errors else {}
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr('s3_delete.backoff_delay', lambda attempt: 0)
+
+def test_throttled_keys_are_retried():
+    s3 = FlakyS3(['p/a', 'p/b'], key_errors={'p/a': ['SlowDown', 'InternalError']}, call_errors=['503'])
+    stats = S3PrefixDeleter(s3, 'bucket', max_workers=1).delete_prefix('p/')
+    assert s3.keys == set()
+    assert (stats['deleted'], stats['failed'], stats['errors']) == (2, 0, [])
+    assert stats['retried'] == 2 + 1 + 1  # Whole call, then 'p/a' twice
+
+def test_failed_keys_are_reported():
+    s3 = FlakyS3(['p/a', 'p/b', 'p/c'], key_errors={'p/a': ['AccessDenied'], 'p/b': ['SlowDown'] * 3})
+    stats = S3PrefixDeleter(s3, 'bucket', max_workers=1, max_attempts=3).delete_prefix('p/')
+    assert s3.keys == {'p/a', 'p/b'}
+    assert (stats['deleted'], stats['failed']) == (1, 2)
+    assert stats['errors'] == ['delete of 3 keys failed: gave up on 1 keys after 3 attempts']
+
+def test_refused_keys_are_errors():
+    s3 = FlakyS3(['p/a', 'p/b'], key_errors={'p/a': ['AccessDenied']})
+    stats = S3PrefixDeleter(s3, 'bucket', max_workers=1).delete_prefix('p/')
+    assert (stats['deleted'], stats['failed']) == (1, 1)
+    assert stats['errors'] == ['delete of 2 keys failed: 1 keys refused (last p/a: AccessDenied)']
+
+def test_fatal_call_error_fails_the_batch():
+    s3 = FlakyS3(['p/a', 'p/b'], call_errors=['AccessDenied'])
+    stats = S3PrefixDeleter(s3, 'bucket', max_workers=1).delete_prefix('p/')
+    assert s3.keys == {'p/a', 'p/b'}
+    assert (stats['deleted'], stats['failed'], stats['retried']) == (0, 2, 0)
+    assert len(stats['errors']) == 1 and stats['errors'][0].startswith('delete of 2 keys failed: AccessDenied')
+
+def test_listing_error_stays_with_its_prefix():
+    s3 = FlakyS3(['bad/a', 'good/b'], list_error_prefix='bad/')
+    stats = S3PrefixDeleter(s3, 'bucket', max_workers=2).delete_prefixes(['bad/', 'good/'])
+    assert s3.keys == {'bad/a'}
+    assert stats['good/']['errors'] == [] and stats['good/']['deleted'] == 1
+    assert len(stats['bad/']['errors']) == 1 and stats['bad/']['errors'][0].startswith('list failed')
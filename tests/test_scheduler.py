@@ -0,0 +1,174 @@
+"""Batch scheduler: token bucket pacing, AIMD cap, and the handler's retry / fail paths"""
+
+import io
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+from conftest import load_lambda
+
+handler = load_lambda('scheduler')
+import scheduler  # noqa: E402  (on sys.modules once the handler is loaded)
+
+LIMITS = {'athena_slots': 20, 'max_tasks': 100, 's3_batches_per_sec': 1000.0}
+
+def test_token_bucket_refills_at_rate_up_to_capacity():
+    bucket = scheduler.TokenBucket(rate=2.0, capacity=3, tokens=0, updated_at=100.0)
+    assert not bucket.take(now=100.0)
+    assert bucket.take(now=100.5)            # 1 token after 0.5s at 2/s
+    assert not bucket.take(now=100.5)
+    bucket.refill(now=200.0)
+    assert bucket.tokens == 3                # Capped at capacity, however long it waited
+    assert [bucket.take(now=200.0) for _ in range(4)] == [True, True, True, False]
+
+def test_token_bucket_round_trips_through_state():
+    bucket = scheduler.TokenBucket(rate=0.5, capacity=4, tokens=1.5, updated_at=10.0)
+    restored = scheduler.TokenBucket.from_dict(json.loads(json.dumps(bucket.to_dict())))
+    assert restored.to_dict() == bucket.to_dict()
+
+def test_aimd_limiter_bounds():
+    limiter = scheduler.AimdLimiter(limit=10, minimum=5, maximum=17)
+    limiter.on_clear()
+    assert limiter.limit == 10 + scheduler.ADDITIVE_INCREASE
+    limiter.on_clear()
+    assert limiter.limit == 17               # Never above the Fargate ceiling
+    for _ in range(10):
+        limiter.on_congestion()
+    assert limiter.limit == 5                # Never below the minimum
+    limiter = scheduler.AimdLimiter(limit=40, minimum=5, maximum=100)
+    limiter.on_congestion()
+    assert limiter.limit == pytest.approx(40 * scheduler.MULTIPLICATIVE_DECREASE)
+
+def test_launch_rate_follows_query_time_and_s3_cap():
+    assert scheduler.launch_rate(20, 10.0, 1000.0) == 2.0
+    assert scheduler.launch_rate(20, 0.1, 1000.0) == 20.0  # Query time floored at 1s
+    assert scheduler.launch_rate(20, 10.0, 1.5) == 1.5     # S3 PUT rate caps it
+
+def running_state(running):
+    state = scheduler.new_state(range(200), 200, LIMITS)
+    state['running'] = {str(i): {'task_arn': f'arn:{i}', 'started_at': 0} for i in range(running)}
+    return state
+
+def test_adapt_backs_off_and_drains_bucket_on_queueing():
+    state = running_state(20)
+    limit = state['limiter']['limit']
+    observation = {'queries': 5, 'queue_ms_p50': scheduler.QUEUE_TARGET_MS + 1, 'engine_ms_p50': 20000, 'throttled': 0}
+    assert scheduler.adapt(state, observation)
+    assert state['limiter']['limit'] == pytest.approx(limit * scheduler.MULTIPLICATIVE_DECREASE)
+    assert state['bucket']['tokens'] == 0
+    assert state['query_sec'] == pytest.approx(0.7 * scheduler.EXPECTED_QUERY_SEC + 0.3 * 20)
+    assert state['bucket']['rate'] == pytest.approx(LIMITS['athena_slots'] / state['query_sec'])
+
+def test_adapt_grows_only_when_the_cap_is_used():
+    idle = running_state(3)
+    limit = idle['limiter']['limit']
+    clear = {'queries': 5, 'queue_ms_p50': 100, 'engine_ms_p50': None, 'throttled': 0}
+    assert not scheduler.adapt(idle, clear)
+    assert idle['limiter']['limit'] == limit
+
+    busy = running_state(int(limit))
+    scheduler.adapt(busy, clear)
+    assert busy['limiter']['limit'] == limit + scheduler.ADDITIVE_INCREASE
+
+def test_launch_throttling_counts_as_congestion():
+    state = running_state(0)
+    state['launch_throttled'] = True
+    assert scheduler.adapt(state, None)
+
+class FakeEcs:
+    def __init__(self, error=None):
+        self.error = error
+        self.stopped = []
+
+    def describe_tasks(self, cluster, tasks):
+        if self.error:
+            raise self.error
+        return {'tasks': [], 'failures': []}
+
+    def stop_task(self, cluster, task, reason):
+        self.stopped.append(task)
+
+class FakeS3:
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body.encode()
+
+def client_error(code, status=400):
+    return ClientError({'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, 'DescribeTasks')
+
+@pytest.fixture
+def with_state(monkeypatch):
+    state = running_state(2)
+    state['running']['1']['backup_arn'] = 'arn:1b'
+
+    def install(error):
+        s3 = FakeS3({handler.STATE_KEY: json.dumps(state).encode()})
+        ecs = FakeEcs(error)
+        monkeypatch.setattr(handler, 's3_client', s3)
+        monkeypatch.setattr(handler, 'ecs_client', ecs)
+        return s3, ecs
+    return install
+
+@pytest.mark.parametrize('error', [client_error('ThrottlingException'), client_error('Oops', 503)])
+def test_retryable_error_is_raised_for_the_state_retry(with_state, error):
+    s3, ecs = with_state(error)
+    with pytest.raises(handler.RetryableError):
+        handler.lambda_handler({'action': 'tick'}, None)
+    assert ecs.stopped == []
+    assert len(json.loads(s3.objects[handler.STATE_KEY])['running']) == 2  # Tasks still tracked
+
+def test_failure_stops_the_runs_tasks(with_state):
+    s3, ecs = with_state(client_error('AccessDeniedException'))
+    result = handler.lambda_handler({'action': 'tick'}, None)
+    assert (result['scheduler_state'], result['tasks_stopped']) == ('FAILED', 3)
+    assert sorted(ecs.stopped) == ['arn:0', 'arn:1', 'arn:1b']
+    saved = json.loads(s3.objects[handler.STATE_KEY])
+    assert saved['running'] == {} and sorted(saved['stopping']) == sorted(ecs.stopped)
+
+def test_retried_start_resumes_saved_state(with_state, monkeypatch):
+    s3, ecs = with_state(None)
+    monkeypatch.setattr(handler, 'tick', lambda state, *args, **kwargs: {'scheduler_state': 'RUNNING', 'running': len(state['running'])})
+    result = handler.lambda_handler({'action': 'start', 'total_batches': 200}, None)
+    assert result['running'] == 2  # Not a fresh state with nothing running
+
+class FakeSqs:
+    class exceptions:
+        class PurgeQueueInProgress(Exception):
+            pass
+
+    def __init__(self, purge_in_progress=False):
+        self.purge_in_progress = purge_in_progress
+        self.calls = []
+
+    def purge_queue(self, QueueUrl):
+        self.calls.append('purge')
+        if self.purge_in_progress:
+            raise self.exceptions.PurgeQueueInProgress(QueueUrl)
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.calls.append([json.loads(entry['MessageBody'])['batch_id'] for entry in Entries])
+        return {}
+
+@pytest.mark.parametrize('purge_in_progress', [False, True])
+def test_enqueue_purges_the_queue_first(monkeypatch, purge_in_progress):
+    items = {batch_id: {'id_min': batch_id * 10, 'id_max': batch_id * 10 + 9} for batch_id in range(12)}
+    sqs = FakeSqs(purge_in_progress)
+    monkeypatch.setattr(handler, 'sqs_client', sqs)
+    monkeypatch.setattr(handler, 's3_client', FakeS3({'plan.json': b'{"created_at": "2025-07-01T00:00:00"}'}))
+    monkeypatch.setattr(handler, 'read_batch_manifest', lambda s3, bucket, key: items)
+    monkeypatch.setattr(handler.time, 'sleep', lambda seconds: sqs.calls.append(f'sleep {seconds}'))
+
+    assert handler.enqueue_units('batches.csv', 'plan.json', 12) == 12
+    assert sqs.calls == ['purge', f'sleep {handler.PURGE_SETTLE_SEC}', list(range(10)), [10, 11]]
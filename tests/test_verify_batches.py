@@ -0,0 +1,30 @@
+"""verify-batches removes unreferenced outputs of this run only"""
+
+import pytest
+
+from conftest import load_lambda
+from test_s3_delete import FakeS3
+
+@pytest.fixture
+def verify_batches(monkeypatch):
+    monkeypatch.setenv('YYYYQQ', '2025Q3')
+    return load_lambda('verify-batches')
+
+def test_remove_unreferenced_is_scoped_to_this_run(verify_batches):
+    committed = 'predict-age/predictions/2025Q3/batch_0000_0123abcd.parquet'
+    lost_copy = 'predict-age/predictions/2025Q3/batch_0000_89abcdef.parquet'
+    lost_map_side = 'predict-age/final-results/predict_age_final_results_2025Q3/batch_0001_00000000.parquet'
+    other_quarter = 'predict-age/predictions/2025Q2/batch_0000_0123abcd.parquet'
+    keys = [committed, lost_copy, lost_map_side, other_quarter, 'predict-age/predictions/2025Q3/_SUCCESS']
+    verify_batches.s3_client = s3 = FakeS3(keys)
+    manifests = {0: {'output_key': committed}, 1: {'output_key': None}}
+
+    removed = verify_batches.remove_unreferenced({key: (1, '"etag"') for key in keys}, manifests)
+    assert removed == sorted([lost_copy, lost_map_side])
+    assert s3.keys == {committed, other_quarter, 'predict-age/predictions/2025Q3/_SUCCESS'}
+
+def test_nothing_unreferenced_deletes_nothing(verify_batches):
+    committed = 'predict-age/predictions/2025Q3/batch_0000_0123abcd.parquet'
+    verify_batches.s3_client = s3 = FakeS3([committed])
+    assert verify_batches.remove_unreferenced({committed: (1, '"etag"')}, {0: {'output_key': committed}}) == []
+    assert s3.deleted == []
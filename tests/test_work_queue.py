@@ -0,0 +1,89 @@
+"""Lease semantics of SqliteWorkQueue (the local stand-in for the SQS worker pool queue)"""
+
+import threading
+
+import pytest
+
+from work_queue import SqliteWorkQueue, run_worker, unit_batch
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = SqliteWorkQueue(str(tmp_path / 'queue.db'), max_attempts=2)
+    queue.put([{'batch_id': 0}, {'batch_id': 1}])
+    return queue
+
+def test_lease_hides_unit_until_ack(queue):
+    first = queue.lease(60)
+    second = queue.lease(60)
+    assert (first['unit'], first['attempt']) == ({'batch_id': 0}, 1)
+    assert second['unit'] == {'batch_id': 1}
+    assert queue.lease(60) is None  # Both invisible while leased
+    assert queue.remaining() == 2
+
+    queue.ack(first)
+    queue.ack(second)
+    assert queue.remaining() == 0
+    assert queue.lease(0) is None
+
+def test_expired_lease_comes_back(queue):
+    lease = queue.lease(0)  # Expires at once, as if the worker died
+    again = queue.lease(60)
+    assert again['unit'] == lease['unit'] and again['attempt'] == 2
+
+def test_release_makes_unit_visible(queue):
+    lease = queue.lease(60)
+    queue.release(lease)
+    assert queue.lease(60)['unit'] == lease['unit']
+
+def test_extend_keeps_unit_leased(queue):
+    lease = queue.lease(0)
+    queue.extend(lease, 60)
+    assert queue.lease(60)['unit'] == {'batch_id': 1}
+    assert queue.lease(60) is None
+
+def test_max_attempts_fail_unit(queue):
+    for attempt in (1, 2):
+        lease = queue.lease(60)
+        assert (lease['unit'], lease['attempt']) == ({'batch_id': 0}, attempt)
+        queue.release(lease)
+    assert queue.lease(60)['unit'] == {'batch_id': 1}  # Unit 0 is out of attempts
+    assert queue.failed() == [{'batch_id': 0}]
+    assert queue.remaining() == 1  # Unit 1, still leased
+
+def test_concurrent_leases_are_exclusive(tmp_path):
+    queue = SqliteWorkQueue(str(tmp_path / 'queue.db'))
+    queue.put([{'batch_id': batch_id} for batch_id in range(200)])
+    leased, lock = [], threading.Lock()
+
+    def worker():
+        while True:
+            lease = queue.lease(60)
+            if lease is None:
+                return
+            with lock:
+                leased.append(lease['unit']['batch_id'])
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(leased) == list(range(200))
+
+def test_run_worker_retries_failed_units(queue):
+    calls = []
+
+    def process(unit):
+        calls.append(unit['batch_id'])
+        if unit['batch_id'] == 1 and calls.count(1) == 1:
+            raise RuntimeError('transient')
+
+    stats = run_worker(queue, process, lease_seconds=60, poll_seconds=0)
+    assert (stats['completed'], stats['released']) == (2, 1)
+    assert calls == [0, 1, 1]
+    assert queue.remaining() == 0 and queue.failed() == []
+
+def test_unit_batch_from_manifest_row():
+    row = {'batch_id': '7', 'id_min': '100', 'id_max': '199', 'expected_predictions': '', 'plan_created_at': 'x'}
+    assert unit_batch(row) == {'batch_id': 7, 'id_min': 100, 'id_max': 199, 'expected_predictions': None}
+    assert unit_batch({**row, 'expected_predictions': 42})['expected_predictions'] == 42